@@ -0,0 +1,180 @@
+"""
+Поток событий заказов для админки: GET /admin/events (Server-Sent Events).
+
+update_order_status, update_order_data, add_message_history и уведомления записывают
+событие в order_events той же транзакцией, что и само изменение, — в том числе в процессе
+бота. Один фоновый опрос на процесс админки читает новые события по id (изменения из самой
+админки будят его сразу) и раздает их открытым вкладкам, а вкладки перезапрашивают только
+изменившийся заказ вместо опроса API каждые 5 секунд.
+
+При переподключении браузер присылает Last-Event-ID, и пропущенные события досылаются из таблицы.
+"""
+
+import asyncio
+import json
+import os
+import time
+from typing import AsyncIterator, Dict, Optional, Set
+
+import db
+
+# Как часто проверять события, записанные другим процессом (ботом)
+ORDER_EVENTS_POLL_INTERVAL = float(os.getenv('ORDER_EVENTS_POLL_INTERVAL', '1'))
+
+# Комментарий-пинг держит соединение открытым через прокси
+SSE_HEARTBEAT_SECONDS = 15
+
+# Браузер переподключается через столько миллисекунд после обрыва
+SSE_RETRY_MS = 3000
+
+# Сколько событий может ждать медленная вкладка; при переполнении она получает resync
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+# Сколько событий читается из order_events за один запрос
+ORDER_EVENTS_BATCH_SIZE = 500
+
+ORDER_EVENTS_PRUNE_INTERVAL = 3600
+
+
+class OrderEventSubscriber:
+    """Открытая вкладка: очередь событий заказов, доступных менеджеру"""
+
+    def __init__(self, manager_id: Optional[int]):
+        # None — главный админ, видит события всех заказов
+        self.manager_id = manager_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+
+    def wants(self, event: Dict) -> bool:
+        return self.manager_id is None or event.get('assigned_manager_id') == self.manager_id
+
+    def put(self, event: Dict):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Вкладка не успевает читать: вместо потерянных событий она перезапросит все данные
+            self.overflowed = True
+
+
+class OrderEventBroker:
+    """Опрос order_events и раздача событий подписчикам процесса админки"""
+
+    def __init__(self):
+        self._subscribers: Set[OrderEventSubscriber] = set()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.last_id = 0
+
+    async def start(self):
+        if self._task is not None:
+            return
+        self.last_id = await db.get_last_order_event_id()
+        db.add_order_event_listener(self._wakeup.set)
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        db.remove_order_event_listener(self._wakeup.set)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def subscribe(self, manager_id: Optional[int]) -> OrderEventSubscriber:
+        subscriber = OrderEventSubscriber(manager_id)
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: OrderEventSubscriber):
+        self._subscribers.discard(subscriber)
+
+    async def _run(self):
+        last_prune = 0.0
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=ORDER_EVENTS_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                # Пачка заполнена целиком — за ней могут быть еще события
+                while True:
+                    events = await db.get_order_events_since(self.last_id, ORDER_EVENTS_BATCH_SIZE)
+                    for event in events:
+                        for subscriber in list(self._subscribers):
+                            if subscriber.wants(event):
+                                subscriber.put(event)
+                        self.last_id = event['id']
+                    if len(events) < ORDER_EVENTS_BATCH_SIZE:
+                        break
+
+                if time.monotonic() - last_prune > ORDER_EVENTS_PRUNE_INTERVAL:
+                    last_prune = time.monotonic()
+                    await db.prune_order_events()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Ошибка рассылки событий заказов: {e}")
+
+    def stats(self) -> Dict:
+        return {'subscribers': len(self._subscribers), 'last_id': self.last_id}
+
+
+order_event_broker = OrderEventBroker()
+
+
+def _format_event(event: Dict) -> str:
+    data = {
+        'id': event['id'],
+        'type': event['event_type'],
+        'order_id': event['order_id'],
+        'created_at': event['created_at'],
+    }
+    return f"id: {event['id']}\nevent: {event['event_type']}\ndata: {json.dumps(data)}\n\n"
+
+
+def _resync_event(last_id: int) -> str:
+    return f"id: {last_id}\nevent: resync\ndata: {json.dumps({'type': 'resync'})}\n\n"
+
+
+async def order_event_stream(manager_id: Optional[int], last_event_id: Optional[int] = None) -> AsyncIterator[str]:
+    """Тело ответа text/event-stream для одной вкладки"""
+    subscriber = order_event_broker.subscribe(manager_id)
+    try:
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+
+        # Пропущенные за время обрыва события; дальше из очереди идут только более новые
+        sent_id = last_event_id or 0
+        if last_event_id is not None:
+            missed = await db.get_order_events_since(last_event_id, ORDER_EVENTS_BATCH_SIZE)
+            if len(missed) == ORDER_EVENTS_BATCH_SIZE:
+                # Пропущено слишком много — проще перезапросить все
+                sent_id = order_event_broker.last_id
+                yield _resync_event(sent_id)
+            else:
+                for event in missed:
+                    if subscriber.wants(event):
+                        yield _format_event(event)
+                    sent_id = event['id']
+
+        while True:
+            if subscriber.overflowed:
+                sent_id = order_event_broker.last_id
+                subscriber.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+                subscriber.overflowed = False
+                yield _resync_event(sent_id)
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            if event['id'] <= sent_id:
+                continue
+            sent_id = event['id']
+            yield _format_event(event)
+    finally:
+        order_event_broker.unsubscribe(subscriber)
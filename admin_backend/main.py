@@ -1,8 +1,15 @@
 from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form, Query, Request, Header
 import time
 import json
+import re
+import hashlib
+import io
+import csv
+import tempfile
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from fastapi import FastAPI
@@ -14,6 +21,7 @@ except NameError:
     app = FastAPI()
 from admin_backend.auth import authenticate_manager, create_access_token, ACCESS_TOKEN_EXPIRE_MINUTES, SECRET_KEY, ALGORITHM
 from admin_backend.users import init_managers_db
+from admin_backend.media import MEDIA_ROOTS, media_response, resolve_media_path, serve_media
 from datetime import timedelta, datetime, timezone
 import pytz
 from jose import JWTError, jwt
@@ -188,9 +196,7 @@ def get_order_progress_status(order_status: str, product_type: str) -> str:
 async def get_order_product_type(order_id: int) -> str:
     """Получает тип продукта из order_data конкретного заказа"""
     try:
-        import aiosqlite
-        DB_PATH = 'bookai.db'
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_connection(readonly=True) as db:
             async with db.execute('''
                 SELECT order_data FROM orders WHERE id = ?
             ''', (order_id,)) as cursor:
@@ -204,12 +210,9 @@ async def get_order_product_type(order_id: int) -> str:
                     except json.JSONDecodeError:
                         pass
                 
-                # Если не найден в order_data, ищем в event_metrics для этого заказа
+                # Если не найден в order_data, берем первый product_type из событий заказа (order_attribution)
                 async with db.execute('''
-                    SELECT product_type FROM event_metrics 
-                    WHERE order_id = ? AND product_type IS NOT NULL AND product_type != ''
-                    ORDER BY timestamp ASC
-                    LIMIT 1
+                    SELECT event_product_type FROM order_attribution WHERE order_id = ?
                 ''', (order_id,)) as cursor:
                     row = await cursor.fetchone()
                     if row and row[0]:
@@ -224,9 +227,7 @@ async def get_order_product_type(order_id: int) -> str:
 async def get_product_format(order_id: int) -> str:
     """Получает формат продукта из order_data конкретного заказа"""
     try:
-        import aiosqlite
-        DB_PATH = 'bookai.db'
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_connection(readonly=True) as db:
             async with db.execute('''
                 SELECT order_data FROM orders WHERE id = ?
             ''', (order_id,)) as cursor:
@@ -271,9 +272,7 @@ async def get_product_format(order_id: int) -> str:
 async def get_detailed_order_product_type(order_id: int) -> str:
     """Получает детализированный тип продукта из order_data конкретного заказа с учетом формата книги"""
     try:
-        import aiosqlite
-        DB_PATH = 'bookai.db'
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_connection(readonly=True) as db:
             async with db.execute('''
                 SELECT order_data FROM orders WHERE id = ?
             ''', (order_id,)) as cursor:
@@ -302,12 +301,9 @@ async def get_detailed_order_product_type(order_id: int) -> str:
                     except json.JSONDecodeError:
                         pass
                 
-                # Если не найден в order_data, ищем в event_metrics для этого заказа
+                # Если не найден в order_data, берем первый product_type из событий заказа (order_attribution)
                 async with db.execute('''
-                    SELECT product_type FROM event_metrics 
-                    WHERE order_id = ? AND product_type IS NOT NULL AND product_type != ''
-                    ORDER BY timestamp ASC
-                    LIMIT 1
+                    SELECT event_product_type FROM order_attribution WHERE order_id = ?
                 ''', (order_id,)) as cursor:
                     row = await cursor.fetchone()
                     if row and row[0]:
@@ -352,15 +348,13 @@ def format_msk_time(dt_str, format_str="%Y-%m-%d %H:%M:%S"):
 async def check_order_has_upsell(order_id: int) -> bool:
     """Проверяет, есть ли у заказа допродажа (событие upsell_purchased)"""
     try:
-        async with db.aiosqlite.connect(db.DB_PATH) as conn:
+        async with db_connection(readonly=True) as conn:
             conn.row_factory = db.aiosqlite.Row
             async with conn.execute('''
-                SELECT COUNT(*) as count 
-                FROM event_metrics 
-                WHERE order_id = ? AND event_type = 'upsell_purchased'
+                SELECT has_upsell FROM order_attribution WHERE order_id = ?
             ''', (order_id,)) as cursor:
                 row = await cursor.fetchone()
-                return row['count'] > 0 if row else False
+                return bool(row['has_upsell']) if row else False
     except Exception as e:
         print(f"❌ Ошибка проверки допродажи для заказа {order_id}: {e}")
         return False
@@ -370,11 +364,16 @@ import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import db
 from aiogram.types import FSInputFile, InputMediaPhoto, InlineKeyboardMarkup, InlineKeyboardButton
-from db import get_orders_filtered, log_order_status_change, get_order_status_history, add_message_history, get_message_history, get_order_timeline, get_managers, add_manager, delete_manager, is_super_admin, get_orders_with_permissions, get_orders_filtered_with_permissions, can_access_order, get_all_photos, get_selected_photos, get_complete_photos, get_cover_templates, get_cover_template_by_id, add_cover_template, delete_cover_template, get_book_styles, add_book_style, delete_book_style, update_book_style, get_voice_styles, add_voice_style, delete_voice_style, update_voice_style, get_all_delayed_messages, get_manager_delayed_messages, can_manager_access_delayed_message, delete_delayed_message, add_delayed_message, add_delayed_message_file, get_delayed_message_files, get_pricing_items, create_pricing_item, update_pricing_item, toggle_pricing_item, delete_pricing_item, get_content_steps, create_content_step, update_content_step, toggle_content_step, delete_content_step, get_manager_by_id, get_detailed_revenue_metrics, get_manager_by_email, create_or_update_order_notification, mark_notification_as_read, get_order_notifications, get_notification_by_order_id, update_manager_super_admin_status, get_orders_count_with_permissions, assign_manager_to_order, assign_managers_to_all_orders, check_pages_sent_before, get_funnel_metrics, get_abandonment_metrics, get_revenue_metrics, get_event_metrics, get_order_pages, create_notifications_for_all_orders, get_song_quiz_list, get_song_quiz_item, get_song_quiz_by_id, create_song_quiz_item, update_song_quiz_item, delete_song_quiz_item
+from db import db_connection, get_analytics_orders, iter_analytics_orders, AWAITING_PAYMENT_STATUSES, get_orders_filtered, log_order_status_change, get_order_status_history, add_message_history, get_message_history, get_order_timeline, get_managers, add_manager, delete_manager, is_super_admin, get_orders_with_permissions, get_orders_filtered_with_permissions, can_access_order, get_selected_photos, get_cover_templates, get_cover_template_by_id, add_cover_template, delete_cover_template, get_book_styles, add_book_style, delete_book_style, update_book_style, get_voice_styles, add_voice_style, delete_voice_style, update_voice_style, get_all_delayed_messages, get_manager_delayed_messages, can_manager_access_delayed_message, delete_delayed_message, add_delayed_message, add_delayed_message_file, get_delayed_message_files, get_pricing_items, create_pricing_item, update_pricing_item, toggle_pricing_item, delete_pricing_item, get_content_steps, create_content_step, update_content_step, toggle_content_step, delete_content_step, get_manager_by_id, get_detailed_revenue_metrics, get_manager_by_email, create_or_update_order_notification, mark_notification_as_read, get_order_notifications, get_notification_by_order_id, update_manager_super_admin_status, get_orders_count_with_permissions, assign_manager_to_order, assign_managers_to_all_orders, check_pages_sent_before, get_funnel_metrics, get_abandonment_metrics, get_revenue_metrics, get_event_metrics, get_order_status_totals, msk_period_bounds, get_order_pages, create_notifications_for_all_orders, get_song_quiz_list, get_song_quiz_item, get_song_quiz_by_id, create_song_quiz_item, update_song_quiz_item, delete_song_quiz_item
 import asyncio
 import os
 import pandas as pd
-from yookassa_integration import process_payment_webhook
+from yookassa_integration import process_payment_webhook, reload_pricing_catalog
+from image_pipeline import process_image, existing_thumbnail, is_image_file, shutdown_image_pipeline, THUMBNAIL_SIZES
+from zip_stream import get_cached_archive, stream_zip_cached
+from telegram_media_fetcher import telegram_media_fetcher
+from telegram_client import get_bot, close_bot
+from admin_backend.events import order_event_broker, order_event_stream
 from pydantic import BaseModel
 import shutil
 import uuid
@@ -384,6 +383,26 @@ from pathlib import Path
 UPLOAD_DIR = Path("manager_files")
 UPLOAD_DIR.mkdir(exist_ok=True)
 
+# Файлы, которые менеджер отправляет пользователю: проверяется content-type, расширение — запасной вариант
+ALLOWED_UPLOAD_CONTENT_TYPES = {
+    'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp', 'image/tiff', 'image/svg+xml',
+    'video/mp4', 'video/mov', 'video/avi', 'video/mkv', 'video/flv', 'video/wmv', 
+    'video/m4v', 'video/3gp', 'video/ogv', 'video/webm', 'video/quicktime',
+    'audio/mpeg', 'audio/wav', 'audio/ogg', 'audio/mp4', 'audio/m4a', 'audio/wma', 
+    'audio/aac', 'audio/flac', 'audio/opus', 'audio/amr', 'audio/midi', 'audio/mid',
+    'audio/xmf', 'audio/rtttl', 'audio/smf', 'audio/imy', 'audio/rtx', 'audio/ota',
+    'audio/jad', 'audio/jar',
+    'application/pdf', 'application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'text/plain', 'text/html', 'text/css', 'text/javascript', 'application/json',
+    'application/xml', 'text/xml'
+}
+ALLOWED_UPLOAD_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tiff', '.svg',
+    '.mp4', '.mov', '.avi', '.mkv', '.flv', '.wmv', '.m4v', '.3gp', '.ogv', '.webm',
+    '.mp3', '.wav', '.ogg', '.m4a', '.wma', '.aac', '.flac', '.opus', '.amr', '.midi', '.mid',
+    '.pdf', '.doc', '.docx', '.txt', '.html', '.css', '.js', '.json', '.xml'
+}
+
 async def save_uploaded_file(file: UploadFile, order_id: int) -> str:
     """Сохраняет загруженный файл и возвращает путь к нему"""
     # Создаем уникальное имя файла
@@ -403,63 +422,21 @@ async def save_uploaded_file(file: UploadFile, order_id: int) -> str:
     
     return str(file_path)
 
+async def save_upload_to(file: UploadFile, save_path: str) -> int:
+    """Копирует загруженный файл в save_path блоками в пуле потоков (без чтения в память), возвращает размер"""
+    def _copy() -> int:
+        with open(save_path, "wb") as buffer:
+            shutil.copyfileobj(file.file, buffer, 1024 * 1024)
+        return os.path.getsize(save_path)
+    
+    return await run_in_threadpool(_copy)
+
 async def compress_image_admin(image_path: str, max_size_mb: float = 5.0, quality: int = 85):
     """
-    Сжимает изображение до указанного размера (для админки)
+    Сжимает изображение до указанного размера и строит миниатюры (для админки).
+    PIL работает в пуле процессов (image_pipeline)
     """
-    try:
-        from PIL import Image
-        import io
-        
-        # Открываем изображение
-        with Image.open(image_path) as img:
-            # Конвертируем в RGB если нужно
-            if img.mode in ('RGBA', 'LA', 'P'):
-                img = img.convert('RGB')
-            
-            # Проверяем размер файла
-            file_size = os.path.getsize(image_path) / (1024 * 1024)  # в МБ
-            
-            if file_size <= max_size_mb:
-                print(f"📸 Файл {image_path} уже подходящего размера ({file_size:.2f} МБ)")
-                return
-            
-            # Сжимаем изображение
-            output = io.BytesIO()
-            
-            # Определяем формат
-            if image_path.lower().endswith('.png'):
-                img.save(output, format='PNG', optimize=True)
-            else:
-                img.save(output, format='JPEG', quality=quality, optimize=True)
-            
-            # Проверяем размер после сжатия
-            compressed_size = len(output.getvalue()) / (1024 * 1024)  # в МБ
-            
-            if compressed_size <= max_size_mb:
-                # Сохраняем сжатое изображение
-                with open(image_path, 'wb') as f:
-                    f.write(output.getvalue())
-                print(f"📸 Изображение сжато: {file_size:.2f} МБ → {compressed_size:.2f} МБ")
-            else:
-                # Если все еще слишком большое, уменьшаем качество
-                while compressed_size > max_size_mb and quality > 30:
-                    quality -= 10
-                    output = io.BytesIO()
-                    img.save(output, format='JPEG', quality=quality, optimize=True)
-                    compressed_size = len(output.getvalue()) / (1024 * 1024)
-                
-                if compressed_size <= max_size_mb:
-                    with open(image_path, 'wb') as f:
-                        f.write(output.getvalue())
-                    print(f"📸 Изображение сжато с качеством {quality}: {file_size:.2f} МБ → {compressed_size:.2f} МБ")
-                else:
-                    print(f"⚠️ Не удалось сжать изображение {image_path} до {max_size_mb} МБ")
-                    
-    except ImportError:
-        print("⚠️ PIL не установлен, сжатие изображений недоступно")
-    except Exception as e:
-        print(f"❌ Ошибка сжатия изображения {image_path}: {e}")
+    await process_image(image_path, max_size_mb, quality)
 
 class Token(BaseModel):
     access_token: str
@@ -484,6 +461,7 @@ class OrderOut(BaseModel):
 class UploadResponse(BaseModel):
     success: bool
     detail: str
+    job_id: Optional[int] = None  # задание доставки, прогресс: GET /admin/delivery-jobs/{job_id}
 
 class MessageRequest(BaseModel):
     text: str
@@ -622,6 +600,20 @@ async def get_content_editor(current_manager: str = Depends(get_current_manager)
 async def startup_event():
     await db.init_db()
     await init_managers_db()
+    await order_event_broker.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    shutdown_image_pipeline()
+    await telegram_media_fetcher.close()
+    await close_bot()
+    await order_event_broker.close()
+    await db.close_db_pool()
+
+@app.get("/admin/db-pool", response_model=dict)
+async def get_db_pool_stats(current_manager: str = Depends(get_super_admin)):
+    """Размер пула соединений SQLite и счетчики ожидания (для диагностики конкуренции)"""
+    return db.get_db_pool_stats()
 
 @app.post("/auth/login", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
@@ -774,17 +766,15 @@ async def send_all_covers_to_user(
         if not cover_templates:
             raise HTTPException(status_code=404, detail="Нет доступных обложек")
         
-        # Добавляем задание в outbox для отправки всех обложек
-        await db.add_outbox_task(
-            order_id=order_id,
-            user_id=user_id,
-            type_="covers_selection",
-            content="",  # Пустой контент, так как обложки будут загружены в боте
-            file_type="covers",
-            comment="Выберите обложку для вашей книги"
-        )
+        # Ставим задание на отправку всех обложек (обложки загружает бот)
+        job_id = await db.create_delivery_job(order_id, user_id, "covers", [{
+            "type": "covers_selection",
+            "content": "",
+            "file_type": "covers",
+            "comment": "Выберите обложку для вашей книги",
+        }], created_by=current_manager)
         
-        return {"success": True, "detail": f"Отправлено {len(cover_templates)} обложек для выбора"}
+        return {"success": True, "detail": f"{len(cover_templates)} обложек поставлены в очередь на отправку", "job_id": job_id}
     finally:
         # Освобождаем блокировку
         release_request_lock(request_key)
@@ -917,21 +907,83 @@ async def send_file_to_user(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка при сохранении файла: {str(e)}")
 
+SYNC_CURSOR_RE = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$')
+
+def _orders_list_etag(current_manager: str, state: dict, page: int, limit: int, after: Optional[str] = None,
+                      since: Optional[str] = None) -> str:
+    """
+    Слабый ETag списка заказов по снимку get_orders_sync_state (без самого списка).
+    since входит в ключ: дельта и полный список одного снимка — разные ответы.
+    """
+    key = json.dumps([
+        current_manager, page, limit, after, since, state["total"], state["max_updated_at"],
+        state["max_notification_at"], state["last_event_id"],
+    ])
+    return f'W/"{hashlib.sha1(key.encode()).hexdigest()[:20]}"'
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag.removeprefix("W/") for tag in tags)
+
 @app.get("/admin/orders", response_model=List[OrderOut])
 async def get_admin_orders(
+    request: Request,
     current_manager: str = Depends(get_current_manager),
     page: int = Query(1, ge=1),
-    limit: int = Query(50, ge=1, le=100)
+    limit: int = Query(50, ge=1, le=100),
+    since: Optional[str] = Query(None, description="Курсор X-Sync-Cursor прошлого ответа: только изменившиеся заказы"),
+    after: Optional[str] = Query(None, description="Курсор X-Next-Cursor прошлой страницы: следующая страница без OFFSET")
 ):
-    from fastapi.responses import JSONResponse
+    """
+    Список заказов. Если с прошлого ответа ничего не менялось (If-None-Match), отдается 304
+    без запроса самого списка. С since возвращаются только заказы, изменившиеся после курсора,
+    а id заказов, которые менеджер больше не видит, — в заголовке X-Removed-Ids; новый курсор —
+    в заголовке X-Sync-Cursor. Если изменений больше ORDERS_DELTA_MAX_ROWS или курсор старше
+    журнала событий, отдается 410: список нужно загрузить заново без since. Для следующей
+    страницы вместо page лучше передавать after из X-Next-Cursor: она читается по индексу
+    за то же время, что и первая.
+    """
+    from fastapi.responses import JSONResponse, Response
+    
+    if since is not None and not SYNC_CURSOR_RE.match(since):
+        raise HTTPException(status_code=400, detail="Некорректный курсор since")
+    
+    state = await db.get_orders_sync_state(current_manager)
+    if state is None:
+        state = {"total": 0, "max_updated_at": None, "max_notification_at": None, "last_event_id": 0, "cursor": None}
+    etag = _orders_list_etag(current_manager, state, page, limit, after, since)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, no-cache",
+        "X-Total-Count": str(state["total"]),
+    }
+    if state["cursor"]:
+        headers["X-Sync-Cursor"] = state["cursor"]
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    
+    removed_ids = []
+    if since:
+        removed_ids = await db.get_removed_order_ids(current_manager, since)
+    
+    try:
+        orders = await get_orders_with_permissions(current_manager, page=page, limit=limit, since=since, after=after)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    # Получаем заказы и общее количество
-    orders = await get_orders_with_permissions(current_manager, page=page, limit=limit)
-    total_count = await get_orders_count_with_permissions(current_manager)
+    if since and (removed_ids is None or len(orders) > db.ORDERS_DELTA_MAX_ROWS):
+        raise HTTPException(status_code=410, detail="Курсор since устарел, загрузите список заново")
     
-    # Возвращаем ответ с заголовком
-    response = JSONResponse(content=orders)
-    response.headers["X-Total-Count"] = str(total_count)
+    # Возвращаем ответ с заголовками
+    response = JSONResponse(content=orders, headers=headers)
+    if since:
+        response.headers["X-Removed-Ids"] = ",".join(str(order_id) for order_id in removed_ids)
+    if not since and len(orders) == limit:
+        last = orders[-1]
+        response.headers["X-Next-Cursor"] = db.encode_page_cursor(last['created_at'], last['id'])
     return response
 
 @app.get("/admin/orders/{order_id}", response_model=OrderOut)
@@ -980,9 +1032,15 @@ async def edit_order(order_id: int, req: OrderEditRequest, current_manager: str
     if update_fields:
         set_clause = ', '.join([f"{k} = ?" for k in update_fields.keys()])
         values = list(update_fields.values()) + [order_id]
-        async with db.aiosqlite.connect(db.DB_PATH) as dbconn:
-            await dbconn.execute(f"UPDATE orders SET {set_clause}, updated_at = ? WHERE id = ?", values + [get_msk_now().strftime('%Y-%m-%d %H:%M:%S')])
+        async with db_connection() as dbconn:
+            # updated_at в UTC, как во всех остальных записях заказа: по нему работает since-курсор списка
+            # order_data может сменить продукт — строка заказа в сводке metrics_daily переносится
+            await db.shift_order_metrics(dbconn, order_id, -1)
+            await dbconn.execute(f"UPDATE orders SET {set_clause}, updated_at = datetime('now') WHERE id = ?", values)
+            await db.shift_order_metrics(dbconn, order_id, 1)
+            await db.record_order_event(dbconn, order_id, 'order_changed')
             await dbconn.commit()
+        db.notify_order_events()
     return await db.get_order(order_id)
 
 @app.post("/admin/orders/{order_id}/status", response_model=dict)
@@ -1038,76 +1096,43 @@ async def get_order_timeline_api(order_id: int, current_manager: str = Depends(g
     return await get_order_timeline(order_id)
 
 @app.get("/photo/{filename:path}")
-async def get_photo(filename: str):
-    # Используем абсолютный путь к папке uploads
-    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    uploads_dir = os.path.join(project_root, "uploads")
-    file_path = os.path.join(uploads_dir, filename)
-    print(f"Запрос файла: {filename}")
-    print(f"Полный путь: {file_path}")
-    print(f"Файл существует: {os.path.exists(file_path)}")
-    
-    if os.path.exists(file_path):
-        return FileResponse(file_path)
-    
-    # Если файл не найден, возможно это Telegram file_id
-    # Попробуем скачать его из Telegram
-    try:
-        # Импортируем бота для скачивания файлов
-        import sys
-        sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-        from bot import bot
-        
-        # Скачиваем файл из Telegram
-        file_info = await bot.get_file(filename)
-        downloaded_file = await bot.download_file(file_info.file_path)
-        
-        # Сохраняем файл в папку uploads
-        os.makedirs(uploads_dir, exist_ok=True)
-        save_path = os.path.join(uploads_dir, filename)
-        
-        with open(save_path, 'wb') as f:
-            f.write(downloaded_file)
-        
-        print(f"Файл скачан из Telegram и сохранен: {save_path}")
-        return FileResponse(save_path)
-        
-    except Exception as e:
-        print(f"Ошибка скачивания файла из Telegram: {e}")
-        return {"detail": "Not Found"}
-
-@app.get("/covers/{filename}")
-async def get_cover(filename: str):
-    # Используем абсолютный путь к папке covers
-    covers_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "covers")
-    file_path = os.path.join(covers_dir, filename)
+async def get_photo(filename: str, request: Request):
+    file_path = resolve_media_path("uploads", filename)
+    if file_path is None:
+        raise HTTPException(status_code=404, detail="Файл не найден")
     
-    if os.path.exists(file_path):
-        return FileResponse(file_path)
+    response = media_response(request, file_path)
+    if response is not None:
+        return response
     
-    raise HTTPException(status_code=404, detail="Обложка не найдена")
+    # Если файл не найден, возможно это Telegram file_id — скачиваем его в фоне
+    # (одновременные запросы одного файла ждут одну загрузку, неудачи запоминаются)
+    if await telegram_media_fetcher.fetch(filename, file_path):
+        response = media_response(request, file_path)
+        if response is not None:
+            return response
+    raise HTTPException(status_code=404, detail="Файл не найден")
 
-@app.get("/styles/{filename}")
-async def get_style(filename: str):
-    # Используем абсолютный путь к папке styles
-    styles_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "styles")
-    file_path = os.path.join(styles_dir, filename)
-    
-    if os.path.exists(file_path):
-        return FileResponse(file_path)
-    
-    raise HTTPException(status_code=404, detail="Стиль не найден")
+@app.get("/covers/{filename:path}")
+async def get_cover(filename: str, request: Request):
+    response = serve_media(request, "covers", filename)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Обложка не найдена")
+    return response
 
-@app.get("/voices/{filename}")
-async def get_voice(filename: str):
-    # Используем абсолютный путь к папке voices
-    voices_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "voices")
-    file_path = os.path.join(voices_dir, filename)
-    
-    if os.path.exists(file_path):
-        return FileResponse(file_path)
-    
-    raise HTTPException(status_code=404, detail="Голос не найден")
+@app.get("/styles/{filename:path}")
+async def get_style(filename: str, request: Request):
+    response = serve_media(request, "styles", filename)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Стиль не найден")
+    return response
+
+@app.get("/voices/{filename:path}")
+async def get_voice(filename: str, request: Request):
+    response = serve_media(request, "voices", filename)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Голос не найден")
+    return response
 
 @app.post("/admin/orders/{order_id}/upload_file", response_model=UploadResponse)
 async def upload_file_to_order(
@@ -1262,49 +1287,28 @@ async def send_multiple_files_with_text_and_button(
         uploads_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "uploads")
         os.makedirs(uploads_dir, exist_ok=True)
         
-        # Сохраняем все файлы
-        saved_files = []
+        # Сначала проверяем все файлы, чтобы не сохранять часть набора
+        max_size = 100 * 1024 * 1024  # 100MB
         for file in files:
-            # Проверка размера файла (100MB лимит)
-            file_content = await file.read()
-            file_size = len(file_content)
-            max_size = 100 * 1024 * 1024  # 100MB
-            
-            if file_size > max_size:
+            if file.size is not None and file.size > max_size:
                 raise HTTPException(
                     status_code=400,
-                    detail=f"Файл {file.filename} слишком большой: {file_size / (1024*1024):.1f}MB. Максимальный размер: 100MB"
+                    detail=f"Файл {file.filename} слишком большой: {file.size / (1024*1024):.1f}MB. Максимальный размер: 100MB"
                 )
             
-            # Валидация типа файла
-            allowed_types = [
-                'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp', 'image/tiff', 'image/svg+xml',
-                'video/mp4', 'video/mov', 'video/avi', 'video/mkv', 'video/flv', 'video/wmv', 
-                'video/m4v', 'video/3gp', 'video/ogv', 'video/webm', 'video/quicktime',
-                'audio/mpeg', 'audio/wav', 'audio/ogg', 'audio/mp4', 'audio/m4a', 'audio/wma', 
-                'audio/aac', 'audio/flac', 'audio/opus', 'audio/amr', 'audio/midi', 'audio/mid',
-                'audio/xmf', 'audio/rtttl', 'audio/smf', 'audio/imy', 'audio/rtx', 'audio/ota',
-                'audio/jad', 'audio/jar',
-                'application/pdf', 'application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-                'text/plain', 'text/html', 'text/css', 'text/javascript', 'application/json',
-                'application/xml', 'text/xml'
-            ]
-            
             file_ext = os.path.splitext(file.filename)[1].lower()
-            allowed_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tiff', '.svg',
-                                 '.mp4', '.mov', '.avi', '.mkv', '.flv', '.wmv', '.m4v', '.3gp', '.ogv', '.webm',
-                                 '.mp3', '.wav', '.ogg', '.m4a', '.wma', '.aac', '.flac', '.opus', '.amr', '.midi', '.mid',
-                                 '.pdf', '.doc', '.docx', '.txt', '.html', '.css', '.js', '.json', '.xml']
-            
-            if file.content_type not in allowed_types and file_ext not in allowed_extensions:
+            if file.content_type not in ALLOWED_UPLOAD_CONTENT_TYPES and file_ext not in ALLOWED_UPLOAD_EXTENSIONS:
                 raise HTTPException(
                     status_code=400, 
                     detail=f"Неподдерживаемый тип файла {file.filename}: {file.content_type}"
                 )
-            
+        
+        # Сохраняем все файлы (потоково, без чтения в память)
+        saved_files = []
+        uploads = []
+        for file in files:
             save_path = os.path.join(uploads_dir, f"order_{order_id}_{file.filename}")
-            with open(save_path, "wb") as f:
-                f.write(file_content)
+            await save_upload_to(file, save_path)
             
             # Определяем тип файла для демо-контента
             file_type = "demo_photo"
@@ -1315,30 +1319,27 @@ async def send_multiple_files_with_text_and_button(
             elif file.content_type == "application/pdf":
                 file_type = "demo_pdf"
             
-            # Сохраняем информацию о файле в базу данных
-            await db.add_upload(order_id, file.filename, file_type)
-            
             saved_files.append(save_path)
+            uploads.append((file.filename, file_type, save_path))
     
         print(f"🔍 ОТЛАДКА: Сохранено файлов: {len(saved_files)}")
-        print(f"🔍 ОТЛАДКА: Пути файлов: {saved_files}")
         
-        # Добавляем задание в outbox для отправки всех файлов одним сообщением
-        await db.add_outbox_task(
-            order_id=order_id,
-            user_id=user_id,
-            type_="multiple_images_with_text_and_button",
-            content=json.dumps(saved_files),  # Сохраняем список файлов как JSON
-            file_type="multiple",
-            comment=text,
-            button_text=button_text,
-            button_callback=button_callback
-        )
+        # Файлы в uploads и задача отправки всех файлов одним сообщением записываются одним заданием
+        job_id = await db.create_delivery_job(order_id, user_id, "demo_content", [{
+            "type": "multiple_images_with_text_and_button",
+            "content": json.dumps(saved_files),  # Сохраняем список файлов как JSON
+            "file_type": "multiple",
+            "comment": text,
+            "button_text": button_text,
+            "button_callback": button_callback,
+        }], created_by=current_manager, uploads=uploads)
         
-        print(f"✅ ОТЛАДКА: Задание добавлено в outbox для пользователя {user_id}")
+        print(f"✅ ОТЛАДКА: Задание доставки {job_id} поставлено в очередь для пользователя {user_id}")
         
-        return {"success": True, "detail": f"Демо-контент отправлен ({len(saved_files)} файлов)"}
+        return {"success": True, "detail": f"Демо-контент поставлен в очередь на отправку ({len(saved_files)} файлов)", "job_id": job_id}
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ ОТЛАДКА: Ошибка в send_multiple_files_with_text_and_button: {e}")
         import traceback
@@ -1369,68 +1370,40 @@ async def send_pages_for_selection(
     uploads_dir = "uploads"
     os.makedirs(uploads_dir, exist_ok=True)
     
-    saved_files = []
     for file in files:
-        file_content = await file.read()
-        
-        # Проверка типов файлов (копируем из оригинальной функции)
-        allowed_types = [
-            'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp', 'image/tiff', 'image/svg+xml',
-            'video/mp4', 'video/mov', 'video/avi', 'video/mkv', 'video/flv', 'video/wmv', 
-            'video/m4v', 'video/3gp', 'video/ogv', 'video/webm', 'video/quicktime',
-            'audio/mpeg', 'audio/wav', 'audio/ogg', 'audio/mp4', 'audio/m4a', 'audio/wma', 
-            'audio/aac', 'audio/flac', 'audio/opus', 'audio/amr', 'audio/midi', 'audio/mid',
-            'audio/xmf', 'audio/rtttl', 'audio/smf', 'audio/imy', 'audio/rtx', 'audio/ota',
-            'audio/jad', 'audio/jar',
-            'application/pdf', 'application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            'text/plain', 'text/html', 'text/css', 'text/javascript', 'application/json',
-            'application/xml', 'text/xml'
-        ]
-        
         file_ext = os.path.splitext(file.filename)[1].lower()
-        allowed_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tiff', '.svg',
-                             '.mp4', '.mov', '.avi', '.mkv', '.flv', '.wmv', '.m4v', '.3gp', '.ogv', '.webm',
-                             '.mp3', '.wav', '.ogg', '.m4a', '.wma', '.aac', '.flac', '.opus', '.amr', '.midi', '.mid',
-                             '.pdf', '.doc', '.docx', '.txt', '.html', '.css', '.js', '.json', '.xml']
-        
-        if file.content_type not in allowed_types and file_ext not in allowed_extensions:
+        if file.content_type not in ALLOWED_UPLOAD_CONTENT_TYPES and file_ext not in ALLOWED_UPLOAD_EXTENSIONS:
             raise HTTPException(
                 status_code=400, 
                 detail=f"Неподдерживаемый тип файла {file.filename}: {file.content_type}"
             )
-        
-        save_path = os.path.join(uploads_dir, f"order_{order_id}_{file.filename}")
-        with open(save_path, "wb") as f:
-            f.write(file_content)
-        
-        saved_files.append(save_path)
     
-    # Убираем лишнюю инструкцию - она не нужна
+    # Номера страниц продолжают уже сохраненные в базе данных
+    next_page_num = await db.get_next_page_number(order_id)
     
-    # Добавляем задания для отправки каждого файла отдельно с кнопкой выбора
-    # Используем правильную нумерацию страниц из базы данных
-    from db import get_next_page_number, save_page_number
+    pages = []
+    tasks = []
+    for file in files:
+        save_path = os.path.join(uploads_dir, f"order_{order_id}_{file.filename}")
+        await save_upload_to(file, save_path)
+        
+        page_number = next_page_num
+        next_page_num += 1
+        pages.append((page_number, os.path.basename(save_path), f"Страница {page_number}", save_path))
+        # Каждая страница отправляется отдельно с кнопкой выбора
+        tasks.append({
+            "type": "page_selection",
+            "content": save_path,
+            "file_type": "image",
+            "comment": f"Страница {page_number}",
+            "button_text": "✅ Выбрать",
+            "button_callback": f"choose_page_{page_number}",
+        })
     
-    for i, file_path in enumerate(saved_files):
-        # Получаем следующий номер страницы из базы данных
-        page_number = await get_next_page_number(order_id)
-        
-        # Сохраняем информацию о странице в базу данных
-        filename = os.path.basename(file_path)
-        await save_page_number(order_id, page_number, filename, f"Страница {page_number}")
-        
-        await db.add_outbox_task(
-            order_id=order_id,
-            user_id=user_id,
-            type_="page_selection",
-            content=file_path,
-            file_type="image",
-            comment=f"Страница {page_number}",
-            button_text="✅ Выбрать",
-            button_callback=f"choose_page_{page_number}"
-        )
+    job_id = await db.create_delivery_job(order_id, user_id, "pages_selection", tasks,
+                                          created_by=current_manager, pages=pages)
     
-    return {"success": True, "detail": f"Загружено {len(files)} страниц для выбора"}
+    return {"success": True, "detail": f"Загружено {len(files)} страниц для выбора, отправка поставлена в очередь", "job_id": job_id}
 
 @app.post("/admin/orders/{order_id}/send_image_with_button", response_model=UploadResponse)
 async def send_file_with_text_and_button(
@@ -1850,28 +1823,70 @@ class PhotoOut(BaseModel):
     type: str
     created_at: str
     path: str
+    thumbnail_path: Optional[str] = None  # миниатюра 256px для сетки галереи
+    preview_path: Optional[str] = None  # миниатюра 1024px для просмотра
+
+# Фоновая генерация миниатюр для фотографий, загруженных до появления image_pipeline
+_thumbnail_backfill_task = None
+
+async def _backfill_thumbnails(file_paths: List[str]):
+    for file_path in file_paths:
+        await process_image(file_path, max_size_mb=None)
+    print(f"✅ Миниатюры построены для {len(file_paths)} фотографий")
+
+def attach_photo_thumbnails(photos: List[Dict]) -> List[Dict]:
+    """Добавляет к фотографиям пути миниатюр; недостающие миниатюры строятся в фоне"""
+    global _thumbnail_backfill_task
+    from urllib.parse import quote, unquote
+    
+    small_size, preview_size = THUMBNAIL_SIZES
+    missing = []
+    for photo in photos:
+        file_path = unquote(photo["path"])
+        if not is_image_file(file_path):
+            continue
+        thumbnail = existing_thumbnail(file_path, small_size)
+        preview = existing_thumbnail(file_path, preview_size)
+        if thumbnail and preview:
+            photo["thumbnail_path"] = quote(thumbnail.replace(os.sep, "/"))
+            photo["preview_path"] = quote(preview.replace(os.sep, "/"))
+        elif os.path.exists(file_path):
+            missing.append(file_path)
+    
+    if missing and (_thumbnail_backfill_task is None or _thumbnail_backfill_task.done()):
+        _thumbnail_backfill_task = asyncio.create_task(_backfill_thumbnails(missing))
+    return photos
 @app.get("/admin/photos", response_model=List[PhotoOut])
-async def get_photos(current_manager: str = Depends(get_current_manager)):
-    """Получает фотографии заказов"""
+async def get_photos(
+    current_manager: str = Depends(get_current_manager),
+    order_id: Optional[int] = Query(None),
+    photo_type: Optional[str] = Query(None, alias="type"),
+    source: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(db.PHOTO_CATALOG_PAGE_SIZE, ge=1, le=db.PHOTO_CATALOG_MAX_PAGE_SIZE)
+):
+    """
+    Страница фотографий заказов из photo_catalog, новые сначала.
+    Следующая страница запрашивается с cursor из заголовка X-Next-Cursor (его нет на последней странице).
+    """
+    from fastapi.responses import JSONResponse
+    from urllib.parse import unquote
+    
     try:
-        print("🔍 Загружаем фотографии...")
-        # Сначала попробуем простую загрузку из таблицы order_photos
-        photos = await db.get_all_photos()
-        print(f"✅ Успешно загружено {len(photos)} фотографий из таблицы order_photos")
-        
-        # Если таблица пуста, попробуем комплексную загрузку
-        if len(photos) == 0:
-            print("🔍 Таблица order_photos пуста, пробуем комплексную загрузку...")
-            photos = await db.get_complete_photos()
-            print(f"✅ Загружено {len(photos)} фотографий через комплексную загрузку")
-        
-        return photos
-    except Exception as e:
-        print(f"❌ Ошибка получения фотографий: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        # Возвращаем пустой список вместо ошибки, чтобы интерфейс не ломался
-        return []
+        photos, next_cursor = await db.get_photo_catalog(
+            order_id=order_id, photo_type=photo_type, source=source, cursor=cursor, limit=limit
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Файлы, удаленные с диска мимо каталога, не показываем (проверяется только текущая страница)
+    photos = [photo for photo in photos if os.path.exists(unquote(photo["path"]))]
+    content = [PhotoOut(**photo).dict() for photo in attach_photo_thumbnails(photos)]
+    
+    response = JSONResponse(content=content)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
 
 @app.get("/admin/orders/{order_id}/other-heroes", response_model=List[dict])
 async def get_order_other_heroes(
@@ -3044,6 +3059,7 @@ async def create_pricing_item(
             item.upgrade_price_difference,
             item.is_active
         )
+        await reload_pricing_catalog()
         
         # Получаем созданную цену
         items = await db.get_pricing_items()
@@ -3078,6 +3094,7 @@ async def update_pricing_item(
         
         if not success:
             raise HTTPException(status_code=404, detail="Цена не найдена")
+        await reload_pricing_catalog()
         
         # Получаем обновленную цену
         items = await db.get_pricing_items()
@@ -3103,6 +3120,7 @@ async def toggle_pricing_item(
         success = await db.toggle_pricing_item(item_id, toggle_data["is_active"])
         if not success:
             raise HTTPException(status_code=404, detail="Цена не найдена")
+        await reload_pricing_catalog()
         
         return {"success": True, "message": "Статус цены изменен"}
     except HTTPException:
@@ -3120,6 +3138,7 @@ async def delete_pricing_item(
         success = await db.delete_pricing_item(item_id)
         if not success:
             raise HTTPException(status_code=404, detail="Цена не найдена")
+        await reload_pricing_catalog()
         
         return {"success": True, "message": "Цена удалена"}
     except HTTPException:
@@ -3131,6 +3150,7 @@ async def populate_pricing_items(current_manager: str = Depends(get_super_admin)
     """Заполняет таблицу цен начальными данными (только для суперадмина)"""
     try:
         await db.populate_pricing_items()
+        await reload_pricing_catalog()
         return {"success": True, "message": "Цены заполнены начальными данными"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка заполнения цен: {str(e)}")
@@ -3524,253 +3544,107 @@ async def upload_individual_pages(
     request: Request,
     current_manager: str = Depends(get_current_manager)
 ):
-    """Загружает индивидуальные страницы для заказа и отправляет их пользователю"""
+    """
+    Загружает индивидуальные страницы для заказа и ставит их отправку пользователю в очередь.
+    Отправку с повторами выполняет диспетчер outbox бота, прогресс — GET /admin/delivery-jobs/{job_id}
+    """
     print(f"🔍 ОТЛАДКА: Начинаем загрузку страниц для заказа {order_id}")
     
     # Проверяем права доступа к заказу
     if not await can_access_order(current_manager, order_id):
         raise HTTPException(status_code=403, detail="Доступ к заказу запрещен")
     
-    # Проверяем состояние бота
-    try:
-        from bot import bot
-        if bot:
-            bot_info = await bot.get_me()
-            print(f"🔍 ОТЛАДКА: Бот {bot_info.username} активен")
-        else:
-            print(f"❌ Бот не инициализирован")
-    except Exception as e:
-        print(f"❌ Ошибка проверки состояния бота: {e}")
-    
     try:
         # Получаем данные формы
         form_data = await request.form()
-        
-        print(f"🔍 ОТЛАДКА: Получены данные формы:")
         print(f"🔍 ОТЛАДКА: Всего ключей в форме: {len(form_data)}")
-        for key, value in form_data.items():
-            print(f"  - {key}: {type(value).__name__} = {value}")
-            if isinstance(value, UploadFile):
-                print(f"    Файл: {value.filename}, размер: {value.size if hasattr(value, 'size') else 'неизвестно'}")
-        
-        # Функция для получения следующего номера страницы
-        # Используем функцию из базы данных для получения следующего номера страницы
-        from db import get_next_page_number as db_get_next_page_number
-        next_page_num = await db_get_next_page_number(order_id)
-        print(f"🔍 ОТЛАДКА: Следующий номер страницы из БД: {next_page_num}")
         
-        # Проверяем существующие страницы в базе данных
-        from db import get_order_pages
-        existing_pages = await get_order_pages(order_id)
-        print(f"🔍 ОТЛАДКА: Существующие страницы в БД: {existing_pages}")
-        
-        # Извлекаем файлы и описания
-        pages = []
-        file_count = 0
+        # Номера страниц продолжают уже сохраненные в базе данных
+        next_page_num = await db.get_next_page_number(order_id)
+        print(f"🔍 ОТЛАДКА: Следующий номер страницы из БД: {next_page_num}")
         
         # Собираем все файлы страниц из формы
         page_files = []
         for key, value in form_data.items():
-            if key.startswith("page_") and not key.startswith("description_"):
+            if key.startswith("page_") and not isinstance(value, str):
                 # Извлекаем номер из ключа (например, "page_1" -> 1)
                 try:
                     form_page_num = int(key.split("_")[1])
-                    page_files.append((form_page_num, key, value))
+                    page_files.append((form_page_num, value))
                 except (ValueError, IndexError):
                     continue
         
-        # Сортируем по номеру в форме для правильного порядка
-        page_files.sort(key=lambda x: x[0])
-        
-        # Обрабатываем файлы в порядке их появления в форме
-        for form_page_num, page_key, file_value in page_files:
-            description_key = f"description_{form_page_num}"
-            # Всегда используем правильный номер страницы из базы данных
-            description = f"Страница {next_page_num}"
-            
-            print(f"🔍 ОТЛАДКА: Обрабатываем файл {page_key} (form_page_num={form_page_num}) -> page_num={next_page_num}")
-            
-            pages.append({
-                "file": file_value,
-                "description": description,
-                "page_num": next_page_num
-            })
-            next_page_num += 1
-            file_count += 1
-        
-        if not pages:
+        if not page_files:
             raise HTTPException(status_code=400, detail="Не найдено файлов для загрузки")
         
-        # Сортируем по номеру страницы
-        pages.sort(key=lambda x: x["page_num"])
+        # Сортируем по номеру в форме для правильного порядка
+        page_files.sort(key=lambda x: x[0])
         
-        # Сохраняем файлы и отправляем пользователю
-        import os
-        from datetime import datetime
+        order = await db.get_order(order_id)
+        if not order:
+            raise HTTPException(status_code=404, detail="Заказ не найден")
+        user_id = order["user_id"]
         
         # Создаем папку для страниц заказа
         pages_dir = f"uploads/order_{order_id}_pages"
         os.makedirs(pages_dir, exist_ok=True)
         
-        # Получаем информацию о заказе
-        order = await db.get_order(order_id)
-        if not order:
-            raise HTTPException(status_code=404, detail="Заказ не найден")
+        # Проверяем до создания задания: оно само добавит задачи page_upload
+        pages_sent_before = await db.check_pages_sent_before(order_id)
         
-        user_id = order["user_id"]
+        pages = []
+        tasks = []
+        # Основное сообщение отправляем только при первой отправке страниц
+        if not pages_sent_before:
+            tasks.append({
+                "type": "text",
+                "content": "📖 <b>Выберите страницы для вашей книги</b>\n\n"
+                           "Здесь представлены сгенерированные страницы и готовые вкладыши.\n"
+                           "Выберите минимум <b>24 страницы</b> из предложенных.\n"
+                           "После выбора напишите 'Далее' для продолжения.",
+            })
         
-                            # Сначала сохраняем все файлы
-        saved_pages = []
-        for page in pages:
-            # Сохраняем файл
-            timestamp = get_msk_now().strftime("%Y%m%d_%H%M%S")
+        skipped_pages = 0
+        timestamp = get_msk_now().strftime("%Y%m%d_%H%M%S")
+        for _, upload in page_files:
+            page_num = next_page_num
+            next_page_num += 1
+            description = f"Страница {page_num}"
+            
             # Очищаем имя файла от проблемных символов
-            safe_filename = page['file'].filename.replace('\\', '_').replace('/', '_').replace(':', '_')
-            filename = f"page_{page['page_num']}_{timestamp}_{safe_filename}"
+            safe_filename = upload.filename.replace('\\', '_').replace('/', '_').replace(':', '_')
+            filename = f"page_{page_num}_{timestamp}_{safe_filename}"
             file_path = os.path.join(pages_dir, filename)
             
-            print(f"🔍 ОТЛАДКА: Сохраняем файл {page['file'].filename} как {filename}")
-            print(f"🔍 ОТЛАДКА: Полный путь: {file_path}")
-            
-            with open(file_path, "wb") as f:
-                content = await page["file"].read()
-                f.write(content)
+            # Файл копируется на диск блоками в пуле потоков, не занимая цикл событий
+            file_size = await save_upload_to(upload, file_path)
+            print(f"✅ Файл сохранен: {file_path} (размер: {file_size / (1024 * 1024):.2f} МБ)")
+            pages.append((page_num, filename, description, file_path))
             
-            # Проверяем, что файл сохранился
-            if os.path.exists(file_path):
-                file_size = os.path.getsize(file_path) / (1024 * 1024)  # в МБ
-                print(f"✅ Файл сохранен: {file_path} (размер: {file_size:.2f} МБ)")
-            else:
-                print(f"❌ Файл не сохранен: {file_path}")
+            # Telegram не принимает фото больше 10 МБ: страница сохраняется, но не отправляется
+            if file_size > 10 * 1024 * 1024:
+                print(f"⚠️ Файл {file_path} слишком большой ({file_size / (1024 * 1024):.2f} МБ), не отправляем")
+                skipped_pages += 1
                 continue
             
-            # Сохраняем информацию о странице в базу данных
-            from db import save_page_number
-            print(f"🔍 ОТЛАДКА: Сохраняем страницу {page['page_num']} в БД: {filename}")
-            try:
-                await save_page_number(order_id, page['page_num'], filename, page['description'])
-                print(f"✅ Страница {page['page_num']} сохранена в БД")
-            except Exception as db_error:
-                print(f"❌ Ошибка сохранения страницы {page['page_num']} в БД: {db_error}")
-                continue
-            
-            saved_pages.append({
-                'file_path': file_path,
-                'page_num': page['page_num'],
-                'description': page['description']
+            tasks.append({
+                "type": "page_upload",
+                "content": file_path,
+                "file_type": "image",
+                "comment": description,
+                "button_text": "✅ Выбрать",
+                "button_callback": f"choose_page_{page_num}",
             })
         
-        # Теперь отправляем все страницы одним блоком
-        try:
-            from bot import bot
-            from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-            
-            # Проверяем, что бот работает
-            if not bot:
-                print(f"❌ Бот не инициализирован")
-                return {"success": False, "detail": "Бот не инициализирован"}
-            
-            # Проверяем, что пользователь не заблокировал бота
-            try:
-                chat_member = await bot.get_chat_member(user_id, bot.id)
-                if chat_member.status == "kicked":
-                    print(f"❌ Пользователь {user_id} заблокировал бота")
-                    return {"success": False, "detail": "Пользователь заблокировал бота"}
-            except Exception as e:
-                print(f"❌ Не удалось проверить статус пользователя {user_id}: {e}")
-            
-            # Проверяем, отправлялись ли уже страницы для этого заказа
-            pages_sent_before = await db.check_pages_sent_before(order_id)
-            
-            # Отправляем основное сообщение только при первой отправке страниц
-            if not pages_sent_before:
-                try:
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text="📖 <b>Выберите страницы для вашей книги</b>\n\n"
-                         "Здесь представлены сгенерированные страницы и готовые вкладыши.\n"
-                         "Выберите минимум <b>24 страницы</b> из предложенных.\n"
-                         "После выбора напишите 'Далее' для продолжения.",
-                        parse_mode="HTML"
-                    )
-                    print(f"✅ Основное сообщение отправлено пользователю {user_id}")
-                except Exception as instructions_error:
-                    print(f"❌ Ошибка отправки основного сообщения: {instructions_error}")
-            else:
-                print(f"ℹ️ Страницы уже отправлялись для заказа {order_id}, пропускаем основное сообщение")
-            
-            # Отправляем каждую страницу по отдельности с кнопкой выбора
-            print(f"📤 Отправляем {len(saved_pages)} страниц по отдельности с кнопками")
-            successful_pages = 0
-            
-            for page in saved_pages:
-                # Проверяем существование файла
-                if not os.path.exists(page['file_path']):
-                    print(f"❌ Файл {page['file_path']} не существует!")
-                    continue
-                
-                # Проверяем размер файла
-                file_size = os.path.getsize(page['file_path']) / (1024 * 1024)  # в МБ
-                print(f"🔍 ОТЛАДКА: Размер файла {page['file_path']}: {file_size:.2f} МБ")
-                
-                if file_size > 10:  # Если файл больше 10 МБ
-                    print(f"⚠️ Файл {page['file_path']} слишком большой ({file_size:.2f} МБ), пропускаем...")
-                    continue
-                
-                # Отправляем страницу с кнопкой выбора
-                try:
-                    await bot.send_photo(
-                        chat_id=user_id,
-                        photo=FSInputFile(page['file_path']),
-                        caption=f"📖 {page['description']}\n\nВыберите эту страницу для вашей книги:",
-                        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                            [InlineKeyboardButton(text="✅ Выбрать", callback_data=f"choose_page_{page['page_num']}")]
-                        ])
-                    )
-                    successful_pages += 1
-                    print(f"✅ Страница {page['page_num']} отправлена с кнопкой выбора")
-                except Exception as single_error:
-                    print(f"❌ Ошибка отправки страницы {page['page_num']}: {single_error}")
-                    # Добавляем в outbox для отправки позже
-                    try:
-                        await db.add_outbox_task(
-                            order_id=order_id,
-                            user_id=user_id,
-                            type_="page_selection",
-                            content=page['file_path'],
-                            file_type="image",
-                            comment=f"Страница {page['page_num']}",
-                            button_text="✅ Выбрать",
-                            button_callback=f"choose_page_{page['page_num']}"
-                        )
-                        print(f"📝 Страница {page['page_num']} добавлена в outbox для отправки позже")
-                    except Exception as outbox_error:
-                        print(f"❌ Ошибка добавления в outbox: {outbox_error}")
-            
-            print(f"✅ Отправлено {successful_pages} из {len(saved_pages)} страниц пользователю {user_id} с кнопками выбора")
+        # Страницы и задачи их отправки записываются одной транзакцией
+        job_id = await db.create_delivery_job(order_id, user_id, "pages_upload", tasks,
+                                              created_by=current_manager, pages=pages)
+        print(f"✅ Задание доставки {job_id}: {len(pages)} страниц заказа {order_id} поставлены в очередь")
         
-        except Exception as send_error:
-            print(f"❌ Ошибка отправки страниц: {send_error}")
-            # Добавляем все оставшиеся страницы в outbox
-            for page in saved_pages:
-                try:
-                    await db.add_outbox_task(
-                        order_id=order_id,
-                        user_id=user_id,
-                        type_="page_selection",
-                        content=page['file_path'],
-                        file_type="image",
-                        comment=f"Страница {page['page_num']}",
-                        button_text="✅ Выбрать",
-                        button_callback=f"choose_page_{page['page_num']}"
-                    )
-                except Exception as outbox_error:
-                    print(f"❌ Ошибка добавления страницы {page['page_num']} в outbox: {outbox_error}")
-        
-        print(f"✅ Все файлы обработаны успешно")
-        print(f"🔍 ОТЛАДКА: Всего обработано файлов: {len(pages)}")
-        print(f"🔍 ОТЛАДКА: Успешно сохранено файлов: {len(saved_pages)}")
-        return {"success": True, "detail": f"Загружено и отправлено {len(saved_pages)} страниц"}
+        detail = f"Загружено {len(pages)} страниц, отправка поставлена в очередь"
+        if skipped_pages:
+            detail += f" (не отправлено {skipped_pages} файлов больше 10 МБ)"
+        return {"success": True, "detail": detail, "job_id": job_id}
         
     except HTTPException:
         raise
@@ -3780,6 +3654,16 @@ async def upload_individual_pages(
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Ошибка загрузки страниц: {str(e)}")
 
+@app.get("/admin/delivery-jobs/{job_id}", response_model=dict)
+async def get_delivery_job_progress(job_id: int, current_manager: str = Depends(get_current_manager)):
+    """Прогресс задания доставки: сколько сообщений отправлено, не отправлено и еще в очереди"""
+    job = await db.get_delivery_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Задание не найдено")
+    if not await can_access_order(current_manager, job["order_id"]):
+        raise HTTPException(status_code=403, detail="Доступ к заказу запрещен")
+    return job
+
 # --- Webhook для ЮKassa ---
 
 @app.post("/webhook/yookassa")
@@ -3823,15 +3707,8 @@ async def get_order_photos(
     try:
         print(f"🔍 ОТЛАДКА: Запрос фотографий для заказа {order_id}")
         
-        # Получаем все полные фотографии
-        all_photos = await db.get_complete_photos()
-        print(f"🔍 ОТЛАДКА: Получено {len(all_photos)} полных фотографий")
-        
-        # Фильтруем фотографии для конкретного заказа
-        order_photos = [photo for photo in all_photos if photo.get('order_id') == order_id]
-        
+        order_photos = await db.get_order_catalog_photos(order_id)
         print(f"✅ Найдено {len(order_photos)} фотографий для заказа {order_id}")
-        print(f"🔍 ОТЛАДКА: Фотографии заказа {order_id}: {order_photos}")
         return order_photos
     except Exception as e:
         print(f"❌ Ошибка получения фотографий для заказа {order_id}: {e}")
@@ -4073,6 +3950,7 @@ async def get_demo_content_files(
 @app.get("/admin/files/{file_path:path}")
 async def get_protected_file(
     file_path: str,
+    request: Request,
     token: str = Query(None)
 ):
     """Защищенный endpoint для получения файлов"""
@@ -4089,41 +3967,15 @@ async def get_protected_file(
     except JWTError:
         raise HTTPException(status_code=401, detail="Недействительный токен")
     
-    try:
-        # Проверяем, что файл находится в разрешенных папках
-        allowed_paths = ['uploads', 'covers', 'styles', 'voices']
-        if not any(file_path.startswith(allowed_path) for allowed_path in allowed_paths):
-            raise HTTPException(status_code=403, detail="Доступ к файлу запрещен")
-        
-        # Проверяем существование файла
-        full_path = file_path
-        if not os.path.exists(full_path):
-            raise HTTPException(status_code=404, detail="Файл не найден")
-        
-        # Определяем MIME тип
-        mime_type = "application/octet-stream"
-        if file_path.lower().endswith(('.jpg', '.jpeg')):
-            mime_type = "image/jpeg"
-        elif file_path.lower().endswith('.png'):
-            mime_type = "image/png"
-        elif file_path.lower().endswith('.gif'):
-            mime_type = "image/gif"
-        elif file_path.lower().endswith('.webp'):
-            mime_type = "image/webp"
-        elif file_path.lower().endswith('.mp3'):
-            mime_type = "audio/mpeg"
-        elif file_path.lower().endswith('.mp4'):
-            mime_type = "video/mp4"
-        elif file_path.lower().endswith('.pdf'):
-            mime_type = "application/pdf"
-        
-        # Возвращаем файл
-        from fastapi.responses import FileResponse
-        return FileResponse(full_path, media_type=mime_type)
-        
-    except Exception as e:
-        print(f"❌ Ошибка получения файла {file_path}: {e}")
-        raise HTTPException(status_code=500, detail=f"Ошибка получения файла: {str(e)}")
+    # Проверяем, что файл находится в разрешенных папках
+    root, _, relative_path = file_path.replace("\\", "/").partition("/")
+    if root not in MEDIA_ROOTS:
+        raise HTTPException(status_code=403, detail="Доступ к файлу запрещен")
+    
+    response = serve_media(request, root, relative_path)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    return response
 
 @app.get("/admin/orders/{order_id}/download-selected-pages")
 async def download_selected_pages_archive(
@@ -4139,11 +3991,6 @@ async def download_selected_pages_archive(
     try:
         print(f"🔍 ОТЛАДКА: Создание архива выбранных страниц для заказа {order_id}")
         
-        # Импортируем необходимые модули
-        import zipfile
-        import io
-        import os
-        
         # Получаем файлы выбранных страниц напрямую из базы
         order = await db.get_order(order_id)
         if not order:
@@ -4155,48 +4002,36 @@ async def download_selected_pages_archive(
         # Получаем страницы из базы данных
         order_pages = await get_order_pages(order_id)
         
-        selected_pages_files = []
+        entries = []
         for page_info in order_pages:
             page_num = page_info['page_number']
             if page_num in selected_pages:
                 pages_dir = f"uploads/order_{order_id}_pages"
                 file_path = os.path.join(pages_dir, page_info['filename'])
                 if os.path.exists(file_path):
-                    selected_pages_files.append({
-                        'page_num': page_num,
-                        'filename': page_info['filename'],
-                        'description': page_info['description'],
-                        'file_path': file_path
-                    })
+                    # Добавляем файл в архив с понятным именем
+                    entries.append((file_path, f"Страница_{page_num}_{page_info['filename']}"))
         
-        files_response = selected_pages_files
-        if not files_response:
+        if not entries:
             raise HTTPException(status_code=404, detail="Файлы выбранных страниц не найдены")
         
-        # Создаем архив в памяти
-        zip_buffer = io.BytesIO()
-        
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for page_file in files_response:
-                file_path = page_file['file_path']
-                if os.path.exists(file_path):
-                    # Добавляем файл в архив с понятным именем
-                    archive_name = f"Страница_{page_file['page_num']}_{page_file['filename']}"
-                    zip_file.write(file_path, archive_name)
-                    print(f"✅ Добавлен в архив: {archive_name}")
-                else:
-                    print(f"⚠️ Файл не найден: {file_path}")
+        headers = {
+            "Content-Disposition": f"attachment; filename=selected_pages_order_{order_id}.zip"
+        }
         
-        # Подготавливаем ответ
-        zip_buffer.seek(0)
+        # Готовый архив для этого набора страниц (ключ меняется вместе с order_pages и файлами)
+        archive_prefix = f"selected_pages_order_{order_id}"
+        cached_path = await run_in_threadpool(get_cached_archive, archive_prefix, entries)
+        if cached_path:
+            print(f"✅ Архив заказа {order_id} отдается из кэша: {cached_path}")
+            return FileResponse(cached_path, media_type="application/zip", headers=headers)
         
-        from fastapi.responses import StreamingResponse
+        # Архив собирается по ходу отдачи и одновременно сохраняется в кэш
+        print(f"✅ Потоковая сборка архива заказа {order_id}: {len(entries)} файлов")
         return StreamingResponse(
-            io.BytesIO(zip_buffer.getvalue()),
+            stream_zip_cached(archive_prefix, entries),
             media_type="application/zip",
-            headers={
-                "Content-Disposition": f"attachment; filename=selected_pages_order_{order_id}.zip"
-            }
+            headers=headers
         )
         
     except Exception as e:
@@ -4208,30 +4043,12 @@ async def download_selected_pages_archive(
 # --- Обработчик статических файлов ---
 
 @app.get("/uploads/{filename:path}")
-async def serve_upload_file(filename: str):
+async def serve_upload_file(filename: str, request: Request):
     """Обрабатывает запросы к статическим файлам в папке uploads"""
-    try:
-        file_path = os.path.join("uploads", filename)
-        if os.path.exists(file_path) and os.path.isfile(file_path):
-            return FileResponse(file_path)
-        else:
-            raise HTTPException(status_code=404, detail="Файл не найден")
-    except Exception as e:
-        print(f"❌ Ошибка при обработке файла {filename}: {e}")
-        raise HTTPException(status_code=404, detail="Файл не найден")
-
-@app.get("/covers/{filename:path}")
-async def serve_cover_file(filename: str):
-    """Обрабатывает запросы к статическим файлам в папке covers"""
-    try:
-        file_path = os.path.join("covers", filename)
-        if os.path.exists(file_path) and os.path.isfile(file_path):
-            return FileResponse(file_path)
-        else:
-            raise HTTPException(status_code=404, detail="Файл не найден")
-    except Exception as e:
-        print(f"❌ Ошибка при обработке файла {filename}: {e}")
+    response = serve_media(request, "uploads", filename)
+    if response is None:
         raise HTTPException(status_code=404, detail="Файл не найден")
+    return response
 
 # --- API для работы с шаблоном сводки заказа ---
 
@@ -4285,37 +4102,13 @@ async def get_metrics(
 ):
     """Получает метрики за указанный период"""
     try:
-        import aiosqlite
-        DB_PATH = 'bookai.db'
-        # Получаем основные метрики заказов
-        orders = await get_orders_filtered_with_permissions(current_manager)
+        # Границы периода (дни по Москве) в UTC: фильтр по created_at идет по индексу в SQL
+        period_from, period_to = msk_period_bounds(start_date, end_date)
         
-        # Фильтруем заказы по дате (в московском времени)
-        start_dt = datetime.strptime(start_date, "%Y-%m-%d")
-        end_dt = datetime.strptime(end_date, "%Y-%m-%d")
-        # Конвертируем в московское время
-        start_dt = MSK_TZ.localize(start_dt)
-        end_dt = MSK_TZ.localize(end_dt).replace(hour=23, minute=59, second=59)
-        
-        filtered_orders = []
-        for order in orders:
-            # Парсим дату создания заказа и конвертируем в московское время
-            order_created_str = order['created_at']
-            if 'T' in order_created_str:
-                order_date = datetime.fromisoformat(order_created_str.replace('Z', '+00:00'))
-            else:
-                order_date = datetime.strptime(order_created_str, "%Y-%m-%d %H:%M:%S")
-                if order_date.tzinfo is None:
-                    order_date = pytz.UTC.localize(order_date)
-            
-            # Конвертируем в московское время
-            order_date_msk = order_date.astimezone(MSK_TZ)
-            
-            if start_dt <= order_date_msk <= end_dt:
-                filtered_orders.append(order)
-        
-        # Подсчитываем основные метрики - используем данные из базы
-        total_orders = len(filtered_orders)  # Пока используем отфильтрованные заказы
+        # Получаем основные метрики заказов
+        filtered_orders = await get_orders_filtered_with_permissions(
+            current_manager, created_from=period_from, created_to=period_to
+        )
         
         # ОТЛАДКА: Проверяем статусы в отфильтрованных заказах
         status_counts = {}
@@ -4323,118 +4116,21 @@ async def get_metrics(
             status = order.get('status', 'unknown')
             status_counts[status] = status_counts.get(status, 0) + 1
         
-        print(f"🔍 ОТЛАДКА метрик: всего заказов {total_orders}")
+        print(f"🔍 ОТЛАДКА метрик: заказов менеджера {len(filtered_orders)}")
         print(f"🔍 ОТЛАДКА метрик: статусы в отфильтрованных заказах: {status_counts}")
         
-        # Считаем оплаченные заказы и общее количество напрямую из базы (без фильтрации по правам доступа)
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Сначала считаем все заказы за период
-            async with db.execute('''
-                SELECT COUNT(*) as total_count, GROUP_CONCAT(status) as all_statuses
-                FROM orders 
-                WHERE DATE(created_at) BETWEEN ? AND ?
-            ''', (start_date, end_date)) as cursor:
-                result = await cursor.fetchone()
-                total_orders = result[0] if result else 0
-                all_statuses = result[1] if result else ""
-            
-            print(f"🔍 ОТЛАДКА: Все заказы из базы: {total_orders}, статусы: {all_statuses}")
-            
-            # Считаем оплаченные заказы ПО СТАТУСАМ (как в аналитике)
-            status_placeholders = ','.join(['?' for _ in PAID_ORDER_STATUSES])
-            async with db.execute(f'''
-                SELECT COUNT(*) as paid_count
-                FROM orders o
-                WHERE o.status IN ({status_placeholders})
-                AND DATE(o.created_at) BETWEEN ? AND ?
-            ''', (*PAID_ORDER_STATUSES, start_date, end_date)) as cursor:
-                result = await cursor.fetchone()
-                paid_orders = result[0] if result else 0
-            
-            print(f"🔍 ОТЛАДКА: Оплаченные заказы (по статусам): {paid_orders}")
-            
-            # Дополнительная проверка: посмотрим на все заказы с их статусами
-            async with db.execute('''
-                SELECT id, status, created_at, order_data
-                FROM orders 
-                WHERE DATE(created_at) BETWEEN ? AND ?
-                ORDER BY created_at DESC
-            ''', (start_date, end_date)) as cursor:
-                all_orders = await cursor.fetchall()
-                print(f"🔍 ОТЛАДКА: Детали всех заказов за период:")
-                for order in all_orders:
-                    order_data_preview = order[3][:50] + "..." if order[3] and len(order[3]) > 50 else (order[3] or "нет данных")
-                    print(f"  Заказ {order[0]}: статус={order[1]}, дата={order[2]}, order_data={order_data_preview}")
-            
-            # Специально ищем заказ #10
-            async with db.execute('''
-                SELECT id, status, created_at, order_data
-                FROM orders 
-                WHERE id = 10
-            ''') as cursor:
-                order_10 = await cursor.fetchone()
-                if order_10:
-                    print(f"🔍 ОТЛАДКА: Заказ #10 найден: статус={order_10[1]}, дата={order_10[2]}, order_data={order_10[3][:100] if order_10[3] else 'нет данных'}...")
-                    
-                    # Проверяем, попадает ли заказ #10 в период дат
-                    order_date = order_10[2]
-                    print(f"🔍 ОТЛАДКА: Заказ #10 дата: {order_date}")
-                    print(f"🔍 ОТЛАДКА: Период запроса: {start_date} - {end_date}")
-                    
-                    # Проверяем, есть ли заказ #10 в списке всех заказов за период
-                    order_10_in_period = any(order[0] == 10 for order in all_orders)
-                    print(f"🔍 ОТЛАДКА: Заказ #10 в периоде: {order_10_in_period}")
-                    
-                    # Проверяем статус заказа #10
-                    if order_10[1] in ['paid', 'upsell_paid', 'waiting_draft', 'draft_sent', 'editing', 'ready', 'delivered', 'completed', 'waiting_plot_options', 'plot_selected', 'waiting_final_version', 'waiting_story_options']:
-                        print(f"🔍 ОТЛАДКА: Заказ #10 имеет статус 'оплачен': {order_10[1]}")
-                    else:
-                        print(f"🔍 ОТЛАДКА: Заказ #10 НЕ имеет статус 'оплачен': {order_10[1]}")
-                        
-                    # Проверяем тип продукта в заказе #10
-                    if order_10[3]:
-                        order_data = order_10[3]
-                        if '"product": "Книга"' in order_data or '"product": "\\u041a\\u043d\\u0438\\u0433\\u0430"' in order_data:
-                            print(f"🔍 ОТЛАДКА: Заказ #10 содержит 'Книга' в order_data")
-                        else:
-                            print(f"🔍 ОТЛАДКА: Заказ #10 НЕ содержит 'Книга' в order_data")
-                else:
-                    print(f"🔍 ОТЛАДКА: Заказ #10 не найден в базе данных")
-            
-            # Ищем все заказы с книгами в базе данных
-            async with db.execute('''
-                SELECT id, status, created_at, order_data
-                FROM orders 
-                WHERE order_data LIKE '%"product": "Книга"%' 
-                   OR order_data LIKE '%"product": "\\u041a\\u043d\\u0438\\u0433\\u0430"%'
-                ORDER BY id
-            ''') as cursor:
-                book_orders = await cursor.fetchall()
-                print(f"🔍 ОТЛАДКА: Все заказы с книгами в базе данных:")
-                for order in book_orders:
-                    order_data_preview = order[3][:50] + "..." if order[3] and len(order[3]) > 50 else (order[3] or "нет данных")
-                    print(f"  Заказ {order[0]}: статус={order[1]}, дата={order[2]}, order_data={order_data_preview}")
-            
-            # Ищем все заказы с книгами в выбранном периоде
-            async with db.execute('''
-                SELECT id, status, created_at, order_data
-                FROM orders 
-                WHERE (order_data LIKE '%"product": "Книга"%' 
-                   OR order_data LIKE '%"product": "\\u041a\\u043d\\u0438\\u0433\\u0430"%')
-                AND DATE(created_at) BETWEEN ? AND ?
-                ORDER BY id
-            ''', (start_date, end_date)) as cursor:
-                book_orders_in_period = await cursor.fetchall()
-                print(f"🔍 ОТЛАДКА: Заказы с книгами в периоде {start_date} - {end_date}:")
-                for order in book_orders_in_period:
-                    order_data_preview = order[3][:50] + "..." if order[3] and len(order[3]) > 50 else (order[3] or "нет данных")
-                    print(f"  Заказ {order[0]}: статус={order[1]}, дата={order[2]}, order_data={order_data_preview}")
+        # Оплаченные заказы и общее количество — по всем заказам (без фильтрации по правам доступа)
+        # из дневных сводок metrics_daily (за сегодня — из orders)
+        status_totals = await get_order_status_totals(start_date, end_date)
+        total_orders = sum(row['count'] for row in status_totals)
+        
+        # Считаем оплаченные заказы ПО СТАТУСАМ (как в аналитике)
+        paid_orders = sum(row['count'] for row in status_totals if row['status'] in PAID_ORDER_STATUSES)
+        
+        print(f"🔍 ОТЛАДКА: Все заказы за период: {total_orders}, оплаченные (по статусам): {paid_orders}")
         
         # Доплаты (заказы с событием upsell_purchased)
-        upsell_orders = 0
-        for order in filtered_orders:
-            if await check_order_has_upsell(order['id']):
-                upsell_orders += 1
+        upsell_orders = len([o for o in filtered_orders if o.get('has_upsell')])
         
         # Завершенные заказы (готовые, доставленные, завершенные)
         # Включаем 'ready' как завершенные, так как это финальная версия
@@ -4504,10 +4200,9 @@ async def get_metrics(
             manager_upsell_revenue = 0
             
             if order_ids:
-                import aiosqlite
                 placeholders = ','.join(['?'] * len(order_ids))
                 
-                async with aiosqlite.connect(DB_PATH) as db:
+                async with db_connection(readonly=True) as db:
                     # Получаем начальные суммы покупок из event_metrics (для заказов с допродажами)
                     initial_amounts_query = f'''
                         SELECT 
@@ -4576,11 +4271,11 @@ async def get_metrics(
                         FROM event_metrics
                         WHERE event_type = 'upsell_purchased'
                         AND order_id IN ({placeholders})
-                        AND DATE(timestamp) BETWEEN ? AND ?
+                        AND timestamp >= ? AND timestamp < ?
                         AND amount IS NOT NULL
                         AND amount > 0
                     '''
-                    args = (*order_ids, start_date, end_date)
+                    args = (*order_ids, period_from, period_to)
                     async with db.execute(query, args) as cursor:
                         row = await cursor.fetchone()
                         if row and row[0] is not None:
@@ -4607,57 +4302,23 @@ async def get_metrics(
         
         # Детальные метрики по продуктам
         # Получаем реальные данные о выборах книги и песни
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_connection(readonly=True) as db:
             # Общее количество уникальных пользователей, выбравших любой продукт
             async with db.execute('''
                 SELECT COUNT(DISTINCT user_id) as total_unique_users
                 FROM event_metrics 
                 WHERE event_type = 'product_selected' 
-                AND timestamp BETWEEN ? AND ?
-            ''', (start_date, end_date)) as cursor:
+                AND timestamp >= ? AND timestamp < ?
+            ''', (period_from, period_to)) as cursor:
                 total_result = await cursor.fetchone()
                 total_unique_users = total_result[0] if total_result and total_result[0] is not None else 0
             
-            # Выборы книги (общее количество заказов с книгами)
-            async with db.execute('''
-                SELECT COUNT(*) as total_orders
-                FROM orders 
-                WHERE (order_data LIKE '%"product": "Книга"%' 
-                   OR order_data LIKE '%"product": "\\u041a\\u043d\\u0438\\u0433\\u0430"%')
-                AND DATE(created_at) BETWEEN ? AND ?
-            ''', (start_date, end_date)) as cursor:
-                book_result = await cursor.fetchone()
-                book_selections = book_result[0] if book_result and book_result[0] is not None else 0
+            # Выборы книги и песни (общее количество заказов с книгами / песнями)
+            book_selections = sum(row['count'] for row in status_totals if row['product_type'] == 'Книга')
+            song_selections = sum(row['count'] for row in status_totals if row['product_type'] == 'Песня')
             
-            print(f"🔍 ОТЛАДКА: Выборы книги: {book_selections}")
-            
-            # Выборы песни (общее количество заказов с песнями)
-            async with db.execute('''
-                SELECT COUNT(*) as total_orders
-                FROM orders 
-                WHERE (order_data LIKE '%"product": "Песня"%' 
-                   OR order_data LIKE '%"product": "\\u041f\\u0435\\u0441\\u043d\\u044f"%')
-                AND DATE(created_at) BETWEEN ? AND ?
-            ''', (start_date, end_date)) as cursor:
-                song_result = await cursor.fetchone()
-                song_selections = song_result[0] if song_result and song_result[0] is not None else 0
-            
-            print(f"🔍 ОТЛАДКА: Выборы песни: {song_selections}")
-            # Сначала посмотрим на все оплаченные заказы и их order_data (включаем все статусы после оплаты)
+            print(f"🔍 ОТЛАДКА: Выборы книги: {book_selections}, выборы песни: {song_selections}")
             status_placeholders = ','.join(['?' for _ in PAID_ORDER_STATUSES])
-            async with db.execute(f'''
-                SELECT id, status, order_data, total_amount,
-                       (SELECT COUNT(*) FROM payments p WHERE p.order_id = o.id AND p.status = 'succeeded') as payment_count,
-                       (SELECT COUNT(*) FROM event_metrics em WHERE em.order_id = o.id AND em.event_type = 'upsell_purchased') as is_upsell
-                FROM orders o
-                WHERE status IN ({status_placeholders})
-                AND DATE(created_at) BETWEEN ? AND ?
-                AND order_data IS NOT NULL AND order_data != ""
-            ''', (*PAID_ORDER_STATUSES, start_date, end_date)) as cursor:
-                all_paid_orders = await cursor.fetchall()
-                print(f"🔍 ОТЛАДКА: Всего оплаченных заказов с order_data: {len(all_paid_orders)}")
-                for order in all_paid_orders:
-                    print(f"  Заказ {order[0]}: статус={order[1]}, order_data={order[2][:100]}...")
             
             # Покупки книги - используем детализированные метрики
             # Они уже правильно учитывают заказы с доплатами (берут начальную сумму)
@@ -4674,56 +4335,17 @@ async def get_metrics(
             
             print(f"🔍 ОТЛАДКА: Печатных книг: {print_book_purchases}, Электронных книг: {electronic_book_purchases}")
             
-            # ОТЛАДКА: Показываем ВСЕ заказы книг (включая те, что не попали в подсчёт)
-            async with db.execute('''
-                SELECT o.id, o.status, o.order_data, o.total_amount,
-                       (SELECT COUNT(*) FROM payments p WHERE p.order_id = o.id AND p.status = 'succeeded') as payment_count,
-                       (SELECT COUNT(*) FROM event_metrics em WHERE em.order_id = o.id AND em.event_type = 'upsell_purchased') as is_upsell
-                FROM orders o
-                WHERE DATE(o.created_at) BETWEEN ? AND ?
-                AND (
-                    o.order_data LIKE '%"product": "Книга"%' 
-                    OR o.order_data LIKE '%"product":"Книга"%'
-                    OR o.order_data LIKE '%"product": "\\u041a\\u043d\\u0438\\u0433\\u0430"%'
-                    OR o.order_data LIKE '%"product":"\\u041a\\u043d\\u0438\\u0433\\u0430"%'
-                    OR o.order_data LIKE '%Книга%'
-                )
-                ORDER BY o.id
-            ''', (start_date, end_date)) as cursor:
-                all_book_orders = await cursor.fetchall()
-                print(f"🔍 ОТЛАДКА: ВСЕ заказы книг за период ({len(all_book_orders)} шт.):")
-                for order in all_book_orders:
-                    order_id, status, order_data_str, total_amount, payment_count, is_upsell = order
-                    # Проверяем, учитывается ли заказ (оплачен И НЕ является допродажей)
-                    is_paid = status in PAID_ORDER_STATUSES
-                    is_counted = is_paid and is_upsell == 0
-                    counted_mark = "✅ УЧТЁН" if is_counted else "❌ НЕ УЧТЁН"
-                    upsell_mark = " [ДОПРОДАЖА]" if is_upsell > 0 else ""
-                    payment_info = f", платежей: {payment_count}, сумма: {total_amount}₽" if payment_count > 0 or total_amount else ""
-                    print(f"  Заказ #{order_id}: статус='{status}' {counted_mark}{upsell_mark}{payment_info}")
-            
             # Покупки песни - используем детализированные метрики
             song_purchases = detailed_revenue_metrics.get('Песня', {}).get('count', 0)
             
             print(f"🔍 ОТЛАДКА: Покупки песни (из детализированных метрик): {song_purchases}")
             
-            # Также проверим все заказы с order_data для отладки
-            async with db.execute('''
-                SELECT id, status, order_data
-                FROM orders 
-                WHERE DATE(created_at) BETWEEN ? AND ?
-                AND order_data IS NOT NULL AND order_data != ""
-                LIMIT 5
-            ''', (start_date, end_date)) as cursor:
-                sample_orders = await cursor.fetchall()
-                print(f"🔍 ОТЛАДКА: Примеры заказов с order_data: {sample_orders}")
-            
             # Подсчет уникальных пользователей для книг и песен отдельно
             async with db.execute(f'''
                 SELECT COUNT(DISTINCT user_id) as unique_book_users
                 FROM orders
                 WHERE status IN ({status_placeholders})
-                AND DATE(created_at) BETWEEN ? AND ?
+                AND created_at >= ? AND created_at < ?
                 AND (
                     order_data LIKE '%"product": "Книга"%' 
                     OR order_data LIKE '%"product":"Книга"%'
@@ -4734,7 +4356,7 @@ async def get_metrics(
                     SELECT order_id FROM event_metrics 
                     WHERE event_type = 'upsell_purchased'
                 )
-            ''', (*PAID_ORDER_STATUSES, start_date, end_date)) as cursor:
+            ''', (*PAID_ORDER_STATUSES, period_from, period_to)) as cursor:
                 row = await cursor.fetchone()
                 unique_book_purchasers = row[0] if row else 0
             
@@ -4742,7 +4364,7 @@ async def get_metrics(
                 SELECT COUNT(DISTINCT user_id) as unique_song_users
                 FROM orders
                 WHERE status IN ({status_placeholders})
-                AND DATE(created_at) BETWEEN ? AND ?
+                AND created_at >= ? AND created_at < ?
                 AND (
                     order_data LIKE '%"product": "Песня"%' 
                     OR order_data LIKE '%"product":"Песня"%'
@@ -4753,7 +4375,7 @@ async def get_metrics(
                     SELECT order_id FROM event_metrics 
                     WHERE event_type = 'upsell_purchased'
                 )
-            ''', (*PAID_ORDER_STATUSES, start_date, end_date)) as cursor:
+            ''', (*PAID_ORDER_STATUSES, period_from, period_to)) as cursor:
                 row = await cursor.fetchone()
                 unique_song_purchasers = row[0] if row else 0
             
@@ -4762,9 +4384,9 @@ async def get_metrics(
                 SELECT COUNT(DISTINCT user_id) as unique_upsell_users
                 FROM event_metrics
                 WHERE event_type = 'upsell_purchased'
-                AND DATE(timestamp) BETWEEN ? AND ?
+                AND timestamp >= ? AND timestamp < ?
                 AND order_id IS NOT NULL
-            ''', (start_date, end_date)) as cursor:
+            ''', (period_from, period_to)) as cursor:
                 row = await cursor.fetchone()
                 unique_upsell_purchasers = row[0] if row else 0
         
@@ -4818,6 +4440,29 @@ async def get_metrics(
         print(f"❌ Ошибка получения метрик: {e}")
         print(f"❌ Полный traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Ошибка получения метрик: {str(e)}")
+def get_purchase_status(order_status: str) -> str:
+    """Статус покупки для аналитики и выгрузки по статусу заказа"""
+    if order_status in PAID_ORDER_STATUSES:
+        return 'Оплачен'
+    if order_status in AWAITING_PAYMENT_STATUSES:
+        return 'Ждет оплаты'
+    return 'Не оплачен'
+
+def filter_analytics_by_progress(orders: List[dict], progress: Optional[str]) -> List[dict]:
+    """Фильтр по прогрессу (карта прогресса живет в бэкенде, поэтому не в SQL)"""
+    if not progress or not progress.strip():
+        return orders
+    filtered = []
+    for order in orders:
+        order_status = order.get('status', '')
+        # Специальная обработка для "Завершено" - включаем все завершенные статусы
+        if progress == 'Завершено':
+            if order_status in ['ready', 'delivered', 'completed', 'upsell_paid']:
+                filtered.append(order)
+        elif progress in get_order_progress_status(order_status, order.get('product') or ''):
+            filtered.append(order)
+    return filtered
+
 @app.get("/admin/analytics")
 async def get_analytics(
     start_date: str = Query(..., description="Дата начала в формате YYYY-MM-DD"),
@@ -4835,241 +4480,41 @@ async def get_analytics(
 ):
     """Получает аналитические данные с фильтрацией"""
     try:
-        # Получаем все заказы без фильтрации по правам доступа
-        orders = await get_orders_filtered()
-        
-        # Фильтруем по дате (в московском времени)
-        start_dt = datetime.strptime(start_date, "%Y-%m-%d")
-        end_dt = datetime.strptime(end_date, "%Y-%m-%d")
-        # Конвертируем в московское время
-        start_dt = MSK_TZ.localize(start_dt)
-        end_dt = MSK_TZ.localize(end_dt).replace(hour=23, minute=59, second=59)
-        
-        filtered_orders = []
-        upsell_orders_before_date_filter = 0
-        for order in orders:
-            if order.get('status') == 'upsell_paid':
-                upsell_orders_before_date_filter += 1
-            
-            # Парсим дату создания заказа и конвертируем в московское время
-            order_created_str = order['created_at']
-            if 'T' in order_created_str:
-                order_date = datetime.fromisoformat(order_created_str.replace('Z', '+00:00'))
-            else:
-                order_date = datetime.strptime(order_created_str, "%Y-%m-%d %H:%M:%S")
-                if order_date.tzinfo is None:
-                    order_date = pytz.UTC.localize(order_date)
-            
-            # Конвертируем в московское время
-            order_date_msk = order_date.astimezone(MSK_TZ)
-            
-            if start_dt <= order_date_msk <= end_dt:
-                filtered_orders.append(order)
-        
-        print(f"🔍 ОТЛАДКА: Заказов upsell_paid до фильтрации по дате: {upsell_orders_before_date_filter}")
-        print(f"🔍 ОТЛАДКА: Диапазон дат: {start_date} - {end_date}")
-        
-        # Применяем дополнительные фильтры
-        if source and source.strip():
-            source_lower = source.lower()
-            # Фильтруем по источнику, получая его из event_metrics
-            from db import get_order_source
-            temp_orders = []
-            for order in filtered_orders:
-                order_source = await get_order_source(order.get('id'))
-                if order_source.lower() == source_lower:
-                    temp_orders.append(order)
-            filtered_orders = temp_orders
-        
-        if product_type and product_type.strip():
-            product_type_lower = product_type.lower()
-            temp_orders = []
-            for order in filtered_orders:
-                order_product_type = await get_order_product_type(order.get('id'))
-                # Проверяем совпадение: для "Книга" ищем "Книга"
-                if product_type_lower == 'книга':
-                    # Если выбрана общая "Книга", включаем все заказы с типом "Книга"
-                    if order_product_type.lower() == 'книга':
-                        temp_orders.append(order)
-                elif order_product_type.lower() == product_type_lower:
-                    # Для остальных фильтров - точное совпадение
-                    temp_orders.append(order)
-            filtered_orders = temp_orders
-        
-        if purchase_status and purchase_status.strip():
-            # Фильтруем по статусу покупки на основе поля status
-            temp_orders = []
-            for order in filtered_orders:
-                order_status = order.get('status', '')
-                if order_status in PAID_ORDER_STATUSES:
-                    order_purchase_status = 'Оплачен'
-                elif order_status in ['waiting_payment', 'payment_pending', 'payment_created', 'upsell_payment_created', 'upsell_payment_pending']:
-                    order_purchase_status = 'Ждет оплаты'
-                else:
-                    order_purchase_status = 'Не оплачен'
-                
-                if order_purchase_status == purchase_status:
-                    temp_orders.append(order)
-            filtered_orders = temp_orders
-        
-        if upsell_status and upsell_status.strip():
-            # Фильтруем по статусу допродажи на основе события upsell_purchased
-            temp_orders = []
-            for order in filtered_orders:
-                has_upsell = await check_order_has_upsell(order['id'])
-                order_upsell_status = 'Оплачен' if has_upsell else 'Не оплачен'
-                
-                if order_upsell_status == upsell_status:
-                    temp_orders.append(order)
-            filtered_orders = temp_orders
-        
-        if progress and progress.strip():
-            # Фильтруем по прогрессу, определяя его на основе статуса и типа продукта
-            temp_orders = []
-            for order in filtered_orders:
-                order_status = order.get('status', '')
-                product_type = order.get('product_type', order.get('product', ''))
-                
-                # Определяем прогресс на основе статуса и типа продукта
-                order_progress = get_order_progress_status(order_status, product_type)
-                
-                # Специальная обработка для "Завершено" - включаем все завершенные статусы
-                if progress == 'Завершено':
-                    if order_status in ['ready', 'delivered', 'completed', 'upsell_paid']:
-                        temp_orders.append(order)
-                elif progress in order_progress:
-                    temp_orders.append(order)
-            filtered_orders = temp_orders
-        
-        # Фильтрация по UTM-параметрам
-        if utm_source and utm_source.strip():
-            from db import get_order_utm_data
-            temp_orders = []
-            for order in filtered_orders:
-                utm_data = await get_order_utm_data(order.get('id'))
-                if utm_data['utm_source'].lower() == utm_source.lower():
-                    temp_orders.append(order)
-            filtered_orders = temp_orders
-        
-        if utm_medium and utm_medium.strip():
-            from db import get_order_utm_data
-            temp_orders = []
-            for order in filtered_orders:
-                utm_data = await get_order_utm_data(order.get('id'))
-                if utm_data['utm_medium'].lower() == utm_medium.lower():
-                    temp_orders.append(order)
-            filtered_orders = temp_orders
-        
-        if utm_campaign and utm_campaign.strip():
-            from db import get_order_utm_data
-            temp_orders = []
-            for order in filtered_orders:
-                utm_data = await get_order_utm_data(order.get('id'))
-                if utm_data['utm_campaign'].lower() == utm_campaign.lower():
-                    temp_orders.append(order)
-            filtered_orders = temp_orders
-        
-        if search and search.strip():
-            search_lower = search.lower()
-            filtered_orders = [o for o in filtered_orders if 
-                             search_lower in (o.get('username') or '').lower() or
-                             search_lower in str(o.get('id') or '').lower() or
-                             search_lower in (o.get('created_at') or '').lower()]
-        
-        # ОТЛАДКА: Проверяем статусы в аналитике
-        analytics_status_counts = {}
-        upsell_orders_found = 0
-        for order in filtered_orders:
-            status = order.get('status', 'unknown')
-            analytics_status_counts[status] = analytics_status_counts.get(status, 0) + 1
-            if status == 'upsell_paid':
-                upsell_orders_found += 1
+        # Все заказы за период вместе с источником, UTM, типом продукта и допродажей —
+        # одним запросом (фильтры, кроме прогресса, применяются в SQL)
+        filtered_orders = await get_analytics_orders(
+            start_date, end_date,
+            source=source,
+            product_type=product_type,
+            purchase_status=purchase_status,
+            upsell_status=upsell_status,
+            utm_source=utm_source,
+            utm_medium=utm_medium,
+            utm_campaign=utm_campaign,
+            search=search,
+        )
+        filtered_orders = filter_analytics_by_progress(filtered_orders, progress)
         
-        print(f"🔍 ОТЛАДКА аналитики: всего заказов {len(filtered_orders)}")
-        print(f"🔍 ОТЛАДКА аналитики: статусы в отфильтрованных заказах: {analytics_status_counts}")
-        print(f"🔍 ОТЛАДКА аналитики: найдено заказов upsell_paid: {upsell_orders_found}")
+        print(f"🔍 ОТЛАДКА аналитики: {start_date} - {end_date}, всего заказов {len(filtered_orders)}")
         
         # Формируем ответ
         analytics_data = []
         for order in filtered_orders:
-            # Определяем статусы на основе поля status
-            order_status = order.get('status', '')
-            
-            # ОТЛАДКА: Проверяем заказ #10
-            if order.get('id') == 10:
-                print(f"🔍 ОТЛАДКА АНАЛИТИКИ: Заказ #10 - статус={order_status}")
-            
-            # Определяем статус покупки
-            if order_status in PAID_ORDER_STATUSES:
-                purchase_status = 'Оплачен'
-                # ОТЛАДКА: Проверяем заказ #10
-                if order.get('id') == 10:
-                    print(f"🔍 ОТЛАДКА АНАЛИТИКИ: Заказ #10 -> purchase_status = 'Оплачен'")
-            elif order_status in ['waiting_payment', 'payment_pending', 'payment_created', 'upsell_payment_created', 'upsell_payment_pending']:
-                purchase_status = 'Ждет оплаты'
-                # ОТЛАДКА: Проверяем заказ #10
-                if order.get('id') == 10:
-                    print(f"🔍 ОТЛАДКА АНАЛИТИКИ: Заказ #10 -> purchase_status = 'Ждет оплаты'")
-            else:
-                purchase_status = 'Не оплачен'
-                # ОТЛАДКА: Проверяем заказ #10
-                if order.get('id') == 10:
-                    print(f"🔍 ОТЛАДКА АНАЛИТИКИ: Заказ #10 -> purchase_status = 'Не оплачен'")
-            
-            # Определяем статус допродажи - проверяем наличие события upsell_purchased
-            order_id = order.get('id')
-            has_upsell = await check_order_has_upsell(order_id)
-            if has_upsell:
-                upsell_status = 'Оплачен'
-                print(f"🔍 ОТЛАДКА: Заказ #{order_id} имеет допродажу -> upsell_status = 'Оплачен'")
-            else:
-                upsell_status = 'Не оплачен'
-            
-            # Тип продукта без разделения форматов (для экспорта)
-            product_type = await get_order_product_type(order.get('id'))
-            
-            # Получаем формат продукта
-            product_format = await get_product_format(order.get('id'))
-            
-            # Прогресс для аналитики должен совпадать с тем, что видит пользователь во вкладке Orders.
-            # Для этого используем карту прогресса/статусов, где значения уже на русском и совпадают
-            # с переводами фронтенда. Логика совместима с текущими фильтрами.
-            progress = get_order_progress_status(order.get('status', ''), product_type)
-            
-            # Получаем источник заказа и UTM-данные из event_metrics
-            from db import get_order_source, get_order_utm_data
-            order_source = await get_order_source(order.get('id'))
-            utm_data = await get_order_utm_data(order.get('id'))
-            
-            # Конвертируем дату создания в московское время для отображения
-            order_created_str = order.get('created_at', '')
-            if order_created_str:
-                if 'T' in order_created_str:
-                    order_date = datetime.fromisoformat(order_created_str.replace('Z', '+00:00'))
-                else:
-                    order_date = datetime.strptime(order_created_str, "%Y-%m-%d %H:%M:%S")
-                    if order_date.tzinfo is None:
-                        order_date = pytz.UTC.localize(order_date)
-                
-                # Конвертируем в московское время
-                order_date_msk = order_date.astimezone(MSK_TZ)
-                created_at_msk = order_date_msk.strftime("%Y-%m-%d %H:%M:%S")
-            else:
-                created_at_msk = order_created_str
-
+            product_type = order['product_type']
             analytics_data.append({
                 'order_id': str(order.get('id', '')),
-                'source': order_source,
-                'utm_source': utm_data['utm_source'],
-                'utm_medium': utm_data['utm_medium'],
-                'utm_campaign': utm_data['utm_campaign'],
+                'source': order['source'],
+                'utm_source': order['utm_source'],
+                'utm_medium': order['utm_medium'],
+                'utm_campaign': order['utm_campaign'],
                 'username': order.get('username', ''),
                 'product_type': product_type,
-                'product_format': product_format,
-                'created_at': created_at_msk,
-                'purchase_status': purchase_status,
-                'upsell_status': upsell_status,
-                'progress': progress,
+                'product_format': order['product_format'],
+                'created_at': order['created_at_msk'] or order['created_at'],
+                'purchase_status': get_purchase_status(order.get('status', '')),
+                'upsell_status': 'Оплачен' if order['has_upsell'] else 'Не оплачен',
+                # Прогресс для аналитики должен совпадать с тем, что видит пользователь во вкладке Orders
+                'progress': get_order_progress_status(order.get('status', ''), product_type),
                 'manager': order.get('manager_email', ''),
                 'phone': order.get('phone', ''),
                 'email': order.get('email', '')
@@ -5096,29 +4541,21 @@ async def get_utm_filters(
         # Получаем заказы с правами доступа (те же, что в аналитике)
         orders = await get_orders_filtered_with_permissions(current_manager)
         
-        # Получаем UTM данные для всех заказов
-        from db import get_order_utm_data
+        # UTM данные приходят вместе с заказами (JOIN к order_attribution)
         utm_sources = set()
         utm_mediums = set()
         utm_campaigns = set()
-        
+
         for order in orders:
-            try:
-                utm_data = await get_order_utm_data(order.get('id'))
-                
-                # Добавляем значения, если они не пустые и не "Неизвестно"
-                if utm_data['utm_source'] and utm_data['utm_source'] not in ['', 'Неизвестно']:
-                    utm_sources.add(utm_data['utm_source'])
-                
-                if utm_data['utm_medium'] and utm_data['utm_medium'] not in ['', 'Неизвестно']:
-                    utm_mediums.add(utm_data['utm_medium'])
-                
-                if utm_data['utm_campaign'] and utm_data['utm_campaign'] not in ['', 'Неизвестно']:
-                    utm_campaigns.add(utm_data['utm_campaign'])
-                    
-            except Exception as e:
-                print(f"❌ Ошибка получения UTM данных для заказа {order.get('id')}: {e}")
-                continue
+            # Добавляем значения, если они не пустые и не "Неизвестно"
+            if order.get('attribution_utm_source') and order['attribution_utm_source'] != 'Неизвестно':
+                utm_sources.add(order['attribution_utm_source'])
+
+            if order.get('attribution_utm_medium') and order['attribution_utm_medium'] != 'Неизвестно':
+                utm_mediums.add(order['attribution_utm_medium'])
+
+            if order.get('attribution_utm_campaign') and order['attribution_utm_campaign'] != 'Неизвестно':
+                utm_campaigns.add(order['attribution_utm_campaign'])
         
         return {
             'status': 'success',
@@ -5133,6 +4570,102 @@ async def get_utm_filters(
         print(f"❌ Ошибка получения UTM-фильтров: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка получения UTM-фильтров: {str(e)}")
 
+# Колонки выгрузки аналитики и их ширина в Excel (write-only режим не позволяет подбирать ширину после записи)
+ANALYTICS_EXPORT_COLUMNS = {
+    'order_id': 10,
+    'utm_source': 18,
+    'utm_medium': 18,
+    'utm_campaign': 22,
+    'username': 20,
+    'telegram_id': 14,
+    'product_type': 20,
+    'product_format': 16,
+    'created_at': 21,
+    'purchase_status': 16,
+    'upsell_status': 16,
+    'progress': 30,
+    'manager': 26,
+    'phone': 18,
+    'email': 28,
+}
+
+def build_analytics_export_row(order: dict) -> dict:
+    """Формирует строку выгрузки аналитики из заказа get_analytics_orders/iter_analytics_orders"""
+    product_type = order['product_type']
+    return {
+        'order_id': str(order.get('id', '')),
+        'utm_source': order['utm_source'],
+        'utm_medium': order['utm_medium'],
+        'utm_campaign': order['utm_campaign'],
+        'username': order.get('username', ''),
+        'telegram_id': str(order.get('telegram_id', order.get('user_id', ''))),
+        'product_type': product_type,
+        'product_format': order['product_format'],
+        'created_at': order['created_at_msk'] or order['created_at'],
+        'purchase_status': get_purchase_status(order.get('status', '')),
+        'upsell_status': 'Оплачен' if order['has_upsell'] else 'Не оплачен',
+        'progress': get_order_progress_status(order.get('status', ''), product_type),
+        'manager': order.get('manager_email', ''),
+        'phone': order.get('phone', ''),
+        'email': order.get('email', '')
+    }
+
+async def iter_analytics_export_rows(start_date: str, end_date: str, progress: Optional[str], **filters):
+    """Отдает строки выгрузки пачками, читая заказы с курсора постепенно"""
+    total = 0
+    async for orders in iter_analytics_orders(start_date, end_date, detailed_product_type=True, **filters):
+        orders = filter_analytics_by_progress(orders, progress)
+        if orders:
+            total += len(orders)
+            yield [build_analytics_export_row(order) for order in orders]
+    print(f"🔍 ЭКСПОРТ: Выгружено заказов: {total}")
+
+async def stream_analytics_csv(rows):
+    """Пишет CSV по мере поступления пачек строк"""
+    output = io.StringIO()
+    # Используем точку с запятой как разделитель для лучшей совместимости с Excel
+    writer = csv.DictWriter(output, fieldnames=list(ANALYTICS_EXPORT_COLUMNS), delimiter=';', quoting=csv.QUOTE_ALL)
+    writer.writeheader()
+    # BOM для корректного отображения в Excel
+    yield output.getvalue().encode('utf-8-sig')
+    try:
+        async for chunk in rows:
+            output.seek(0)
+            output.truncate(0)
+            writer.writerows(chunk)
+            yield output.getvalue().encode('utf-8')
+    except Exception as e:
+        # Заголовки ответа уже отправлены — остается только оборвать поток
+        print(f"❌ Ошибка потоковой выгрузки CSV: {e}")
+        raise
+
+def _append_xlsx_rows(worksheet, chunk: List[dict]):
+    for row in chunk:
+        worksheet.append([row[column] for column in ANALYTICS_EXPORT_COLUMNS])
+
+async def build_analytics_xlsx(rows) -> str:
+    """Пишет XLSX в write-only режиме openpyxl во временный файл и возвращает путь к нему"""
+    from openpyxl import Workbook
+    from openpyxl.utils import get_column_letter
+
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet('Analytics')
+    for index, width in enumerate(ANALYTICS_EXPORT_COLUMNS.values(), start=1):
+        worksheet.column_dimensions[get_column_letter(index)].width = width
+    worksheet.append(list(ANALYTICS_EXPORT_COLUMNS))
+
+    async for chunk in rows:
+        await run_in_threadpool(_append_xlsx_rows, worksheet, chunk)
+
+    fd, path = tempfile.mkstemp(prefix='analytics_', suffix='.xlsx')
+    os.close(fd)
+    try:
+        await run_in_threadpool(workbook.save, path)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
 @app.get("/admin/analytics/export")
 async def export_analytics(
     start_date: str = Query(..., description="Дата начала в формате YYYY-MM-DD"),
@@ -5149,311 +4682,91 @@ async def export_analytics(
     search: str = Query(None, description="Поиск по тексту"),
     current_manager: str = Depends(get_current_manager)
 ):
-    """Экспортирует аналитические данные в CSV или Excel"""
+    """Экспортирует аналитические данные в CSV или Excel потоково, не собирая всю выборку в памяти"""
     try:
-        # Получаем данные аналитики напрямую, а не через вызов функции
-        # Получаем все заказы без фильтрации по правам доступа
-        orders = await get_orders_filtered()
-        
-        # ОТЛАДКА: Выводим информацию о полученных заказах
-        print(f"🔍 ЭКСПОРТ: Получено заказов из БД: {len(orders)}")
         print(f"🔍 ЭКСПОРТ: Параметры фильтрации - start_date={start_date}, end_date={end_date}")
         print(f"🔍 ЭКСПОРТ: Фильтры - product_type={product_type}, purchase_status={purchase_status}, upsell_status={upsell_status}")
         print(f"🔍 ЭКСПОРТ: UTM фильтры - utm_source={utm_source}, utm_medium={utm_medium}, utm_campaign={utm_campaign}")
         print(f"🔍 ЭКСПОРТ: Поиск - search={search}")
         
-        # Фильтруем по дате (в московском времени)
-        start_dt = datetime.strptime(start_date, "%Y-%m-%d")
-        end_dt = datetime.strptime(end_date, "%Y-%m-%d")
-        # Конвертируем в московское время
-        start_dt = MSK_TZ.localize(start_dt)
-        end_dt = MSK_TZ.localize(end_dt).replace(hour=23, minute=59, second=59)
-        
-        filtered_orders = []
-        for order in orders:
-            # Парсим дату создания заказа и конвертируем в московское время
-            order_created_str = order['created_at']
-            if 'T' in order_created_str:
-                order_date = datetime.fromisoformat(order_created_str.replace('Z', '+00:00'))
-            else:
-                order_date = datetime.strptime(order_created_str, "%Y-%m-%d %H:%M:%S")
-                if order_date.tzinfo is None:
-                    order_date = pytz.UTC.localize(order_date)
-            
-            # Конвертируем в московское время
-            order_date_msk = order_date.astimezone(MSK_TZ)
-            
-            if start_dt <= order_date_msk <= end_dt:
-                filtered_orders.append(order)
-        
-        # ОТЛАДКА: Проверяем сколько заказов осталось после фильтрации по дате
-        print(f"🔍 ЭКСПОРТ: После фильтрации по дате осталось заказов: {len(filtered_orders)}")
-        
-        # Применяем дополнительные фильтры (копируем логику из get_analytics)
-        if source and source.strip():
-            source_lower = source.lower()
-            from db import get_order_source
-            temp_orders = []
-            for order in filtered_orders:
-                order_source = await get_order_source(order.get('id'))
-                if order_source.lower() == source_lower:
-                    temp_orders.append(order)
-            filtered_orders = temp_orders
-        
-        if product_type and product_type.strip():
-            product_type_lower = product_type.lower()
-            temp_orders = []
-            for order in filtered_orders:
-                order_product_type = await get_detailed_order_product_type(order.get('id'))
-                # Проверяем совпадение: для "Книга" ищем "Книга печатная" или "Книга электронная"
-                if product_type_lower == 'книга':
-                    # Если выбрана общая "Книга", включаем все типы книг
-                    if 'книга' in order_product_type.lower():
-                        temp_orders.append(order)
-                elif order_product_type.lower() == product_type_lower:
-                    # Для остальных фильтров - точное совпадение
-                    temp_orders.append(order)
-            filtered_orders = temp_orders
-            print(f"🔍 ЭКСПОРТ: После фильтрации по типу продукта '{product_type}' осталось: {len(filtered_orders)}")
-        
-        if purchase_status and purchase_status.strip():
-            temp_orders = []
-            for order in filtered_orders:
-                order_status = order.get('status', '')
-                if order_status in PAID_ORDER_STATUSES:
-                    order_purchase_status = 'Оплачен'
-                elif order_status in ['waiting_payment', 'payment_pending', 'payment_created', 'upsell_payment_created', 'upsell_payment_pending']:
-                    order_purchase_status = 'Ждет оплаты'
-                else:
-                    order_purchase_status = 'Не оплачен'
-                
-                if order_purchase_status == purchase_status:
-                    temp_orders.append(order)
-            filtered_orders = temp_orders
-            print(f"🔍 ЭКСПОРТ: После фильтрации по статусу покупки '{purchase_status}' осталось: {len(filtered_orders)}")
-        
-        if upsell_status and upsell_status.strip():
-            temp_orders = []
-            for order in filtered_orders:
-                has_upsell = await check_order_has_upsell(order['id'])
-                order_upsell_status = 'Оплачен' if has_upsell else 'Не оплачен'
-                
-                if order_upsell_status == upsell_status:
-                    temp_orders.append(order)
-            filtered_orders = temp_orders
-            print(f"🔍 ЭКСПОРТ: После фильтрации по upsell статусу '{upsell_status}' осталось: {len(filtered_orders)}")
-        
-        if progress and progress.strip():
-            temp_orders = []
-            for order in filtered_orders:
-                order_status = order.get('status', '')
-                product_type = order.get('product_type', order.get('product', ''))
-                
-                order_progress = get_order_progress_status(order_status, product_type)
-                
-                if progress == 'Завершено':
-                    if order_status in ['ready', 'delivered', 'completed', 'upsell_paid']:
-                        temp_orders.append(order)
-                elif progress in order_progress:
-                    temp_orders.append(order)
-            filtered_orders = temp_orders
-            print(f"🔍 ЭКСПОРТ: После фильтрации по прогрессу '{progress}' осталось: {len(filtered_orders)}")
-        
-        # Фильтрация по UTM-параметрам
-        if utm_source and utm_source.strip():
-            from db import get_order_utm_data
-            temp_orders = []
-            for order in filtered_orders:
-                utm_data = await get_order_utm_data(order.get('id'))
-                if utm_data['utm_source'].lower() == utm_source.lower():
-                    temp_orders.append(order)
-            filtered_orders = temp_orders
-            print(f"🔍 ЭКСПОРТ: После фильтрации по UTM source '{utm_source}' осталось: {len(filtered_orders)}")
-        
-        if utm_medium and utm_medium.strip():
-            from db import get_order_utm_data
-            temp_orders = []
-            for order in filtered_orders:
-                utm_data = await get_order_utm_data(order.get('id'))
-                if utm_data['utm_medium'].lower() == utm_medium.lower():
-                    temp_orders.append(order)
-            filtered_orders = temp_orders
-            print(f"🔍 ЭКСПОРТ: После фильтрации по UTM medium '{utm_medium}' осталось: {len(filtered_orders)}")
-        
-        if utm_campaign and utm_campaign.strip():
-            from db import get_order_utm_data
-            temp_orders = []
-            for order in filtered_orders:
-                utm_data = await get_order_utm_data(order.get('id'))
-                if utm_data['utm_campaign'].lower() == utm_campaign.lower():
-                    temp_orders.append(order)
-            filtered_orders = temp_orders
-            print(f"🔍 ЭКСПОРТ: После фильтрации по UTM campaign '{utm_campaign}' осталось: {len(filtered_orders)}")
-        
-        if search and search.strip():
-            search_lower = search.lower()
-            filtered_orders = [o for o in filtered_orders if 
-                             search_lower in (o.get('username') or '').lower() or
-                             search_lower in str(o.get('id') or '').lower() or
-                             search_lower in (o.get('created_at') or '').lower()]
-            print(f"🔍 ЭКСПОРТ: После фильтрации по поиску '{search}' осталось: {len(filtered_orders)}")
-        
-        # ОТЛАДКА: Финальное количество заказов перед формированием данных для экспорта
-        print(f"🔍 ЭКСПОРТ: Финальное количество заказов для экспорта: {len(filtered_orders)}")
-        
-        # Формируем данные для экспорта
-        analytics_data = []
-        for order in filtered_orders:
-            order_status = order.get('status', '')
-            
-            if order_status in PAID_ORDER_STATUSES:
-                purchase_status = 'Оплачен'
-            elif order_status in ['waiting_payment', 'payment_pending', 'payment_created', 'upsell_payment_created', 'upsell_payment_pending']:
-                purchase_status = 'Ждет оплаты'
-            else:
-                purchase_status = 'Не оплачен'
-            
-            has_upsell = await check_order_has_upsell(order['id'])
-            if has_upsell:
-                upsell_status = 'Оплачен'
-            else:
-                upsell_status = 'Не оплачен'
-            
-            # Тип продукта без разделения форматов (для экспорта)
-            product_type = await get_order_product_type(order.get('id'))
-            
-            # Получаем формат продукта
-            product_format = await get_product_format(order.get('id'))
-            
-            progress = get_order_progress_status(order_status, product_type)
-            
-            # Получаем UTM-данные из event_metrics
-            from db import get_order_utm_data
-            utm_data = await get_order_utm_data(order.get('id'))
-            
-            # Конвертируем дату создания в московское время для отображения
-            order_created_str = order.get('created_at', '')
-            if order_created_str:
-                if 'T' in order_created_str:
-                    order_date = datetime.fromisoformat(order_created_str.replace('Z', '+00:00'))
-                else:
-                    order_date = datetime.strptime(order_created_str, "%Y-%m-%d %H:%M:%S")
-                    if order_date.tzinfo is None:
-                        order_date = pytz.UTC.localize(order_date)
-                
-                # Конвертируем в московское время
-                order_date_msk = order_date.astimezone(MSK_TZ)
-                created_at_msk = order_date_msk.strftime("%Y-%m-%d %H:%M:%S")
-            else:
-                created_at_msk = order_created_str
-            
-            analytics_data.append({
-                'order_id': str(order.get('id', '')),
-                'utm_source': utm_data['utm_source'],
-                'utm_medium': utm_data['utm_medium'],
-                'utm_campaign': utm_data['utm_campaign'],
-                'username': order.get('username', ''),
-                'telegram_id': str(order.get('telegram_id', order.get('user_id', ''))),
-                'product_type': product_type,
-                'product_format': product_format,
-                'created_at': created_at_msk,
-                'purchase_status': purchase_status,
-                'upsell_status': upsell_status,
-                'progress': progress,
-                'manager': order.get('manager_email', ''),
-                'phone': order.get('phone', ''),
-                'email': order.get('email', '')
-            })
-        
-        data = analytics_data
+        export_format = format.lower()
+        if export_format not in ('csv', 'excel'):
+            raise HTTPException(status_code=400, detail="Неподдерживаемый формат экспорта")
         
-        # ОТЛАДКА: Проверяем сформированные данные
-        print(f"🔍 ЭКСПОРТ: Сформировано записей для экспорта: {len(data)}")
-        if data:
-            print(f"🔍 ЭКСПОРТ: Пример первой записи: {data[0]}")
+        # Те же данные, что и в аналитике, но фильтр по типу продукта учитывает формат книги
+        rows = iter_analytics_export_rows(
+            start_date, end_date, progress,
+            source=source,
+            product_type=product_type,
+            purchase_status=purchase_status,
+            upsell_status=upsell_status,
+            utm_source=utm_source,
+            utm_medium=utm_medium,
+            utm_campaign=utm_campaign,
+            search=search,
+        )
         
-        if format.lower() == 'csv':
-            # Создаем CSV с правильным разделителем
-            import io
-            import csv
-            
-            output = io.StringIO()
-            if data:
-                # Определяем заголовки
-                fieldnames = ['order_id', 'utm_source', 'utm_medium', 'utm_campaign', 'username', 'telegram_id', 'product_type', 'product_format', 'created_at', 
-                            'purchase_status', 'upsell_status', 'progress', 'manager', 'phone', 'email']
-                # Используем точку с запятой как разделитель для лучшей совместимости с Excel
-                writer = csv.DictWriter(output, fieldnames=fieldnames, delimiter=';', quoting=csv.QUOTE_ALL)
-                writer.writeheader()
-                writer.writerows(data)
-            else:
-                # Если нет данных, создаем пустой CSV с заголовками
-                fieldnames = ['order_id', 'utm_source', 'utm_medium', 'utm_campaign', 'username', 'telegram_id', 'product_type', 'product_format', 'created_at', 
-                            'purchase_status', 'upsell_status', 'progress', 'manager', 'phone', 'email']
-                writer = csv.DictWriter(output, fieldnames=fieldnames, delimiter=';', quoting=csv.QUOTE_ALL)
-                writer.writeheader()
-            
-            csv_content = output.getvalue()
-            output.close()
-            
+        if export_format == 'csv':
             return StreamingResponse(
-                io.BytesIO(csv_content.encode('utf-8-sig')),  # BOM для корректного отображения в Excel
+                stream_analytics_csv(rows),
                 media_type='text/csv; charset=utf-8',
                 headers={"Content-Disposition": f"attachment; filename=analytics_{start_date}_to_{end_date}.csv"}
             )
-            
-        elif format.lower() == 'excel':
-            # Создаем Excel с правильным форматированием
-            import io
-            
-            output = io.BytesIO()
-            if data:
-                df = pd.DataFrame(data)
-                # Устанавливаем правильный порядок колонок
-                column_order = ['order_id', 'utm_source', 'utm_medium', 'utm_campaign', 'username', 'telegram_id', 'product_type', 'product_format', 'created_at', 
-                              'purchase_status', 'upsell_status', 'progress', 'manager', 'phone', 'email']
-                df = df.reindex(columns=column_order)
-            else:
-                # Если нет данных, создаем пустой DataFrame с заголовками
-                df = pd.DataFrame(columns=['order_id', 'utm_source', 'utm_medium', 'utm_campaign', 'username', 'telegram_id', 'product_type', 'product_format', 'created_at', 
-                                         'purchase_status', 'upsell_status', 'progress', 'manager', 'phone', 'email'])
-            
-            # Создаем Excel файл с форматированием
-            with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                df.to_excel(writer, index=False, sheet_name='Analytics')
-                
-                # Получаем рабочую книгу для форматирования
-                workbook = writer.book
-                worksheet = writer.sheets['Analytics']
-                
-                # Автоподбор ширины колонок
-                for column in worksheet.columns:
-                    max_length = 0
-                    column_letter = column[0].column_letter
-                    for cell in column:
-                        try:
-                            if len(str(cell.value)) > max_length:
-                                max_length = len(str(cell.value))
-                        except:
-                            pass
-                    adjusted_width = min(max_length + 2, 50)  # Максимум 50 символов
-                    worksheet.column_dimensions[column_letter].width = adjusted_width
-            
-            output.seek(0)
-            
-            return StreamingResponse(
-                output,
-                media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                headers={"Content-Disposition": f"attachment; filename=analytics_{start_date}_to_{end_date}.xlsx"}
-            )
         
-        else:
-            raise HTTPException(status_code=400, detail="Неподдерживаемый формат экспорта")
+        # XLSX нельзя отдавать до записи последней строки, поэтому строки идут во временный файл
+        path = await build_analytics_xlsx(rows)
+        return FileResponse(
+            path,
+            media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            headers={"Content-Disposition": f"attachment; filename=analytics_{start_date}_to_{end_date}.xlsx"},
+            background=BackgroundTask(os.remove, path)
+        )
             
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ Ошибка экспорта аналитики: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка экспорта: {str(e)}")
 
+# --- Поток событий заказов (SSE) ---
+
+@app.get("/admin/events")
+async def stream_order_events(
+    request: Request,
+    token: Optional[str] = Query(None),
+    last_event_id: Optional[str] = Header(None),
+):
+    """
+    Поток событий заказов (text/event-stream): order_changed, message, notification и resync.
+    EventSource не передает заголовок Authorization, поэтому токен принимается и в ?token=
+    """
+    authorization = request.headers.get("authorization", "")
+    if not token and authorization.lower().startswith("bearer "):
+        token = authorization[len("bearer "):]
+    if not token:
+        raise HTTPException(status_code=401, detail="Could not validate credentials")
+    current_manager = await get_current_manager(token)
+    
+    # Главный админ получает события всех заказов, менеджер — только своих
+    if await is_super_admin(current_manager):
+        manager_id = None
+    else:
+        manager = await get_manager_by_email(current_manager)
+        if not manager:
+            raise HTTPException(status_code=403, detail="Менеджер не найден")
+        manager_id = manager["id"]
+    
+    try:
+        last_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_id = None
+    
+    return StreamingResponse(
+        order_event_stream(manager_id, last_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # --- API для работы с уведомлениями ---
 
 @app.get("/admin/notifications", response_model=List[dict])
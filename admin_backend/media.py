@@ -0,0 +1,189 @@
+"""
+Отдача медиафайлов админки: /photo, /uploads, /covers, /styles, /voices и /admin/files.
+
+Все эндпоинты отвечают через media_response:
+- ETag и Last-Modified по размеру и mtime файла, ответ 304 на If-None-Match / If-Modified-Since;
+- Range-запросы (206) — браузер перематывает примеры голосов и аудио без скачивания целиком;
+- Cache-Control по типу папки: библиотека обложек, стилей и голосов хранится под уникальными
+  именами и кэшируется как неизменяемая, файлы заказов (могут перезаписываться) — с ревалидацией;
+- stat неизменяемых файлов библиотеки кэшируется в памяти на MEDIA_STAT_CACHE_TTL секунд,
+  поэтому повторные просмотры из SPA почти ничего не стоят. Файлы заказов stat'ятся
+  при каждом запросе: закэшированный размер перезаписанного файла дал бы неверный
+  Content-Length и ETag.
+"""
+
+import mimetypes
+import os
+import stat
+import time
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Сколько секунд доверять закэшированному stat файла
+MEDIA_STAT_CACHE_TTL = float(os.getenv('MEDIA_STAT_CACHE_TTL', '2'))
+MEDIA_STAT_CACHE_SIZE = 10000
+
+# Библиотека (covers, styles, voices): файлы не перезаписываются — новое содержимое получает новое имя
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Файлы заказов: личные данные и могут перезаписываться под тем же именем, поэтому всегда ревалидация по ETag
+PRIVATE_CACHE_CONTROL = "private, no-cache"
+
+MEDIA_CHUNK_SIZE = 256 * 1024
+
+# Папки, из которых отдаются файлы, и их политика кэширования
+MEDIA_ROOTS = {
+    'uploads': PRIVATE_CACHE_CONTROL,
+    'covers': IMMUTABLE_CACHE_CONTROL,
+    'styles': IMMUTABLE_CACHE_CONTROL,
+    'voices': IMMUTABLE_CACHE_CONTROL,
+}
+
+_stat_cache: 'OrderedDict[str, Tuple[float, os.stat_result]]' = OrderedDict()
+
+
+def _stat(path: str, cache: bool = False) -> Optional[os.stat_result]:
+    """
+    stat обычного файла (None, если его нет). С cache найденные файлы кэшируются
+    на MEDIA_STAT_CACHE_TTL — только для файлов, которые не перезаписываются.
+    """
+    now = time.monotonic()
+    cached = _stat_cache.get(path) if cache else None
+    if cached and cached[0] > now:
+        return cached[1]
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
+        # Отсутствие файла не кэшируем: его могут скачать или загрузить в следующую же секунду
+        _stat_cache.pop(path, None)
+        return None
+    if not cache:
+        return st
+    _stat_cache[path] = (now + MEDIA_STAT_CACHE_TTL, st)
+    _stat_cache.move_to_end(path)
+    while len(_stat_cache) > MEDIA_STAT_CACHE_SIZE:
+        _stat_cache.popitem(last=False)
+    return st
+
+
+def resolve_media_path(root: str, relative_path: str) -> Optional[str]:
+    """Абсолютный путь файла внутри папки root проекта или None, если путь выходит за ее пределы"""
+    base = os.path.join(PROJECT_ROOT, root)
+    path = os.path.normpath(os.path.join(base, relative_path))
+    if os.path.commonpath([base, path]) != base:
+        return None
+    return path
+
+
+def _etag(st: os.stat_result) -> str:
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def _not_modified(request: Request, etag: str, st: os.stat_result) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(st.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _parse_range(request: Request, etag: str, st: os.stat_result) -> Optional[Tuple[int, int]]:
+    """
+    Диапазон (start, end) включительно из заголовка Range; None — отдать файл целиком.
+    ValueError — диапазон за пределами файла (416).
+    """
+    range_header = request.headers.get("range")
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        # Несколько диапазонов не поддерживаем — допустимо ответить всем файлом
+        return None
+    if_range = request.headers.get("if-range")
+    if if_range and if_range != etag and if_range != formatdate(st.st_mtime, usegmt=True):
+        return None
+
+    start_str, _, end_str = range_header[len("bytes="):].strip().partition("-")
+    size = st.st_size
+    try:
+        if start_str:
+            start = int(start_str)
+            end = int(end_str) if end_str else size - 1
+        else:
+            # bytes=-500 — последние 500 байт
+            start = max(size - int(end_str), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    end = min(end, size - 1)
+    if start > end or start >= size:
+        raise ValueError("Range Not Satisfiable")
+    return start, end
+
+
+def _read_range(path: str, start: int, end: int):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(MEDIA_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def media_response(request: Request, path: str, cache_control: str = PRIVATE_CACHE_CONTROL,
+                   media_type: str = None) -> Optional[Response]:
+    """
+    Ответ с файлом path с учетом условных и Range-запросов.
+    Возвращает None, если файла нет (эндпоинт сам решает, что отвечать).
+    """
+    st = _stat(path, cache=cache_control == IMMUTABLE_CACHE_CONTROL)
+    if st is None:
+        return None
+
+    etag = _etag(st)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+    if _not_modified(request, etag, st):
+        return Response(status_code=304, headers=headers)
+
+    media_type = media_type or mimetypes.guess_type(path)[0] or "application/octet-stream"
+    try:
+        byte_range = _parse_range(request, etag, st)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{st.st_size}"})
+
+    if byte_range is None:
+        return FileResponse(path, media_type=media_type, headers=headers, stat_result=st)
+
+    start, end = byte_range
+    headers.update({
+        "Content-Range": f"bytes {start}-{end}/{st.st_size}",
+        "Content-Length": str(end - start + 1),
+    })
+    # Синхронный генератор StreamingResponse читает файл в пуле потоков
+    return StreamingResponse(_read_range(path, start, end), status_code=206, media_type=media_type, headers=headers)
+
+
+def serve_media(request: Request, root: str, relative_path: str, media_type: str = None) -> Optional[Response]:
+    """media_response для файла relative_path в одной из папок MEDIA_ROOTS"""
+    path = resolve_media_path(root, relative_path)
+    if path is None:
+        return None
+    return media_response(request, path, MEDIA_ROOTS[root], media_type)
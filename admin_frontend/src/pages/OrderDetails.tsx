@@ -3,6 +3,7 @@ import { useParams, useNavigate } from "react-router-dom";
 import { Button } from "../components/ui/button";
 import { Card } from "../components/ui/card";
 import { translateStatus } from "../utils/statusTranslations";
+import { subscribeOrderEvents, debounce } from "../utils/orderEvents";
 
 // CSS-классы для плавных переходов
 const smoothTransitionClasses = {
@@ -1059,8 +1060,7 @@ export const OrderDetailsPage: React.FC = () => {
   useEffect(() => {
     fetchOrder(true); // загружаем только один раз при монтировании компонента
     
-    // Автообновление каждые 5 секунд
-    const interval = setInterval(async () => {
+    const refreshOrder = async () => {
       console.log("🔄 Автообновление данных заказа...");
       try {
         await fetchOrder(false); // обновляем без изменения состояния загрузки
@@ -1104,9 +1104,24 @@ export const OrderDetailsPage: React.FC = () => {
       } catch (error) {
         console.error("❌ Ошибка обновления прогревочных сообщений:", error);
       }
-    }, 5000);
+    };
+    
+    // Обновляем заказ, когда сервер сообщает о его изменении
+    const refreshOnEvent = debounce(refreshOrder, 500);
+    const unsubscribe = subscribeOrderEvents((event) => {
+      if (event.type === "resync" || (event.type === "order_changed" && event.order_id === Number(id))) {
+        refreshOnEvent();
+      }
+    });
+    
+    // Редкий опрос на случай, если поток событий недоступен
+    const interval = setInterval(refreshOrder, 60000);
 
-    return () => clearInterval(interval);
+    return () => {
+      clearInterval(interval);
+      unsubscribe();
+      refreshOnEvent.cancel();
+    };
   }, [id]); // Убираем fetchOrder из зависимостей
 
   // Загрузка истории сообщений
@@ -1130,9 +1145,19 @@ export const OrderDetailsPage: React.FC = () => {
     };
     fetchMessages();
     
-    // Автообновление истории сообщений каждые 5 секунд
-    const messagesInterval = setInterval(fetchMessages, 5000);
-    return () => clearInterval(messagesInterval);
+    // История сообщений перезапрашивается по событиям сервера о новых сообщениях заказа
+    const fetchMessagesOnEvent = debounce(fetchMessages, 300);
+    const unsubscribe = subscribeOrderEvents((event) => {
+      if (event.type === "resync" || (event.type === "message" && event.order_id === Number(id))) {
+        fetchMessagesOnEvent();
+      }
+    });
+    const messagesInterval = setInterval(fetchMessages, 60000);
+    return () => {
+      clearInterval(messagesInterval);
+      unsubscribe();
+      fetchMessagesOnEvent.cancel();
+    };
   }, [id, sendSuccess]);
 
   // Загрузка истории статусов
@@ -1643,6 +1668,28 @@ export const OrderDetailsPage: React.FC = () => {
     setPageFilePreviews(newPreviews);
   };
 
+  // Страницы отправляет очередь бота: опрашиваем задание доставки и показываем прогресс
+  const trackDeliveryJob = async (jobId: number, setMessage: (message: string) => void) => {
+    const token = localStorage.getItem("token");
+    for (let attempt = 0; attempt < 300; attempt++) {
+      const response = await fetch(`/admin/delivery-jobs/${jobId}`, {
+        headers: { Authorization: `Bearer ${token}` },
+      });
+      if (!response.ok) return;
+      const job = await response.json();
+      if (job.status === "completed") {
+        setMessage(`✅ Отправлено пользователю: ${job.sent} из ${job.total}`);
+        return;
+      }
+      if (job.status === "completed_with_errors") {
+        setMessage(`⚠️ Отправлено ${job.sent} из ${job.total}, не доставлено: ${job.failed}`);
+        return;
+      }
+      setMessage(`⏳ Отправляем пользователю: ${job.sent} из ${job.total}...`);
+      await new Promise((resolve) => setTimeout(resolve, 2000));
+    }
+  };
+
   const handleUploadPages = async (e: React.FormEvent) => {
     e.preventDefault();
     setUploadingPages(true);
@@ -1676,7 +1723,11 @@ export const OrderDetailsPage: React.FC = () => {
         throw new Error("Ошибка загрузки страниц");
       }
 
-      setPagesSuccess("✅ Страницы загружены и отправлены пользователю!");
+      const result = await response.json();
+      setPagesSuccess("✅ Страницы загружены, отправка поставлена в очередь");
+      if (result.job_id) {
+        trackDeliveryJob(result.job_id, setPagesSuccess);
+      }
       setPageFiles([]);
       setPageDescriptions([]);
       setPageFilePreviews([]);
@@ -1749,7 +1800,11 @@ export const OrderDetailsPage: React.FC = () => {
         throw new Error(`Ошибка быстрой загрузки страниц: ${response.status} - ${errorText}`);
       }
 
-      setBulkSuccess(`✅ Быстро загружено и отправлено ${bulkFiles.length} страниц!`);
+      const result = await response.json();
+      setBulkSuccess(`✅ Быстро загружено ${bulkFiles.length} страниц, отправка поставлена в очередь`);
+      if (result.job_id) {
+        trackDeliveryJob(result.job_id, setBulkSuccess);
+      }
       setBulkFiles([]);
       setBulkFilePreviews([]);
       
@@ -1,6 +1,7 @@
-import React, { useEffect, useState, useMemo } from "react";
+import React, { useEffect, useState, useMemo, useRef } from "react";
 import { useNavigate } from "react-router-dom";
 import { translateStatus, ALL_STATUS_OPTIONS } from "../utils/statusTranslations";
+import { subscribeOrderEvents, debounce } from "../utils/orderEvents";
 
 // Компонент для отображения прогресса в таблице
 const OrderProgressBadge: React.FC<{ status: string; product: string }> = ({ status, product }) => {
@@ -245,6 +246,69 @@ export const OrdersPage: React.FC = () => {
   // Состояние для отслеживания активного поиска
   const [isSearchActive, setIsSearchActive] = useState(false);
   const navigate = useNavigate();
+  
+  // ETag последнего ответа списка: фоновые перезапросы без изменений получают 304 без тела
+  const ordersEtagRef = useRef<string | null>(null);
+  
+  // Курсоры страниц из X-Next-Cursor ("размер:страница" -> курсор): соседние страницы
+  // запрашиваются по курсору и стоят столько же, сколько первая; без курсора — по номеру
+  const pageCursorsRef = useRef<Record<string, string>>({});
+  
+  const ordersPageParams = () => {
+    const params = new URLSearchParams({
+      page: currentPage.toString(),
+      limit: pageSize.toString()
+    });
+    const after = pageCursorsRef.current[`${pageSize}:${currentPage}`];
+    if (currentPage > 1 && after) {
+      params.append("after", after);
+    }
+    return params;
+  };
+  
+  const rememberNextCursor = (response: Response) => {
+    const nextCursor = response.headers.get("X-Next-Cursor");
+    if (nextCursor) {
+      pageCursorsRef.current[`${pageSize}:${currentPage + 1}`] = nextCursor;
+    }
+  };
+  
+  // Курсор X-Sync-Cursor и X-Total-Count последней полной загрузки: фоновые обновления
+  // запрашивают только изменившиеся заказы (since) и подменяют их строки на текущей странице
+  const syncCursorRef = useRef<string | null>(null);
+  const syncTotalRef = useRef<string | null>(null);
+  
+  const rememberSyncState = (response: Response) => {
+    syncCursorRef.current = response.headers.get("X-Sync-Cursor");
+    syncTotalRef.current = response.headers.get("X-Total-Count");
+  };
+  
+  // Применяет дельту к текущей странице. false — нужна полная загрузка: курсор устарел (410),
+  // заказы пропали из видимых или их стало больше/меньше (тогда сдвигаются страницы)
+  const applyOrdersDelta = async (): Promise<boolean> => {
+    if (!syncCursorRef.current) {
+      return false;
+    }
+    const params = new URLSearchParams({ since: syncCursorRef.current });
+    const response = await fetch(`/admin/orders?${params}`, {
+      headers: { Authorization: `Bearer ${localStorage.getItem("token")}` },
+      cache: "no-store",
+    });
+    if (!response.ok) {
+      return false;
+    }
+    const removedIds = response.headers.get("X-Removed-Ids");
+    if (removedIds || response.headers.get("X-Total-Count") !== syncTotalRef.current) {
+      return false;
+    }
+    const changed: Order[] = await response.json();
+    if (changed.length > 0) {
+      const changedById = new Map(changed.map((order) => [order.id, order]));
+      setOrders((prev) => prev.map((order) => changedById.get(order.id) ?? order));
+    }
+    syncCursorRef.current = response.headers.get("X-Sync-Cursor") ?? syncCursorRef.current;
+    return true;
+  };
 
   // Функция для загрузки заказов
   const fetchOrder = async (isInitial = false) => {
@@ -260,15 +324,22 @@ export const OrdersPage: React.FC = () => {
     console.log(`🔍 ОТЛАДКА пагинации: загружаем страницу ${currentPage}, размер страницы ${pageSize}`);
     
     try {
-      const params = new URLSearchParams({
-        page: currentPage.toString(),
-        limit: pageSize.toString()
-      });
+      if (!isInitial && (await applyOrdersDelta())) {
+        return;
+      }
+      
+      const params = ordersPageParams();
+      
+      const headers: Record<string, string> = {
+        Authorization: `Bearer ${localStorage.getItem("token")}`,
+      };
+      if (!isInitial && ordersEtagRef.current) {
+        headers["If-None-Match"] = ordersEtagRef.current;
+      }
       
       const response = await fetch(`/admin/orders?${params}`, {
-        headers: {
-          Authorization: `Bearer ${localStorage.getItem("token")}`,
-        },
+        headers,
+        cache: "no-store",
       });
       
       if (response.status === 401) {
@@ -277,11 +348,20 @@ export const OrdersPage: React.FC = () => {
         return;
       }
       
+      // Список не изменился с прошлого запроса
+      if (response.status === 304) {
+        rememberSyncState(response);
+        return;
+      }
+      
       if (!response.ok) {
         throw new Error("Ошибка загрузки заказов");
       }
       const data = await response.json();
       setOrders(data);
+      ordersEtagRef.current = response.headers.get("ETag");
+      rememberNextCursor(response);
+      rememberSyncState(response);
       
       // ОТЛАДКА: Выводим информацию о полученных данных
       console.log(`🔍 ОТЛАДКА пагинации: получено ${data.length} заказов`);
@@ -399,10 +479,16 @@ export const OrdersPage: React.FC = () => {
     
     fetchUserPermissions();
     fetchOrder(true); // первый раз с лоадером
+    
+    // Далее список перезапрашивается по событиям сервера (пачка событий — один запрос, без лоадера)
+    const refetchOnEvent = debounce(() => fetchOrder(false), 500);
+    const unsubscribe = subscribeOrderEvents(refetchOnEvent);
+    
+    // Редкий опрос на случай, если поток событий недоступен
     interval = setInterval(() => {
       console.log("🔄 Автообновление списка заказов...");
       fetchOrder(false);
-    }, 5000); // далее без лоадера
+    }, 60000);
     
     // Обновляем данные при фокусе на странице (например, при возврате с другой страницы)
     const handleFocus = () => {
@@ -427,6 +513,8 @@ export const OrdersPage: React.FC = () => {
     
     return () => {
       clearInterval(interval);
+      unsubscribe();
+      refetchOnEvent.cancel();
       window.removeEventListener('focus', handleFocus);
       document.removeEventListener('visibilitychange', handleVisibilityChange);
       window.removeEventListener('popstate', handlePopState);
@@ -443,10 +531,7 @@ export const OrdersPage: React.FC = () => {
     setLoading(true);
     setError("");
     try {
-      const params = new URLSearchParams({
-        page: currentPage.toString(),
-        limit: pageSize.toString()
-      });
+      const params = ordersPageParams();
       
       const response = await fetch(`/admin/orders?${params}`, {
         headers: {
@@ -465,6 +550,8 @@ export const OrdersPage: React.FC = () => {
       }
       const data = await response.json();
       setOrders(data);
+      rememberNextCursor(response);
+      rememberSyncState(response);
       
       // Обновляем информацию о пагинации
       const totalCount = response.headers.get('X-Total-Count');
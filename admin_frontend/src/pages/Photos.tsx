@@ -11,6 +11,8 @@ interface Photo {
   type: string;
   created_at: string;
   path: string;  // Добавляем поле path
+  thumbnail_path?: string;  // Миниатюра 256px для сетки
+  preview_path?: string;  // Миниатюра 1024px для просмотра
   order_data?: string;
   user_id?: number;
 }
@@ -54,6 +56,8 @@ interface VoiceStyle {
 const PhotosPage: React.FC = () => {
   const [activeTab, setActiveTab] = useState<'orders' | 'covers' | 'styles' | 'voices'>('orders');
   const [photos, setPhotos] = useState<Photo[]>([]);
+  const [photosCursor, setPhotosCursor] = useState<string | null>(null);
+  const [loadingMorePhotos, setLoadingMorePhotos] = useState(false);
   const [coverTemplates, setCoverTemplates] = useState<CoverTemplate[]>([]);
   const [bookStyles, setBookStyles] = useState<BookStyle[]>([]);
   const [voiceStyles, setVoiceStyles] = useState<VoiceStyle[]>([]);
@@ -125,13 +129,17 @@ const PhotosPage: React.FC = () => {
 
   useEffect(() => {
     fetchUserPermissions();
-    fetchPhotos();
     fetchOrders();
     fetchCoverTemplates();
     fetchBookStyles();
     fetchVoiceStyles();
   }, []);
 
+  // Фотографии загружаются страницами; при смене заказа — заново с фильтром по заказу
+  useEffect(() => {
+    fetchPhotos();
+  }, [selectedOrder]);
+
   const fetchUserPermissions = async () => {
     try {
       const token = localStorage.getItem("token");
@@ -154,7 +162,7 @@ const PhotosPage: React.FC = () => {
     }
   };
 
-  const fetchPhotos = async () => {
+  const fetchPhotos = async (cursor?: string) => {
     try {
       const token = localStorage.getItem("token");
       if (!token) {
@@ -163,7 +171,11 @@ const PhotosPage: React.FC = () => {
       }
       
       console.log("🔍 Загружаем фотографии...");
-      const response = await fetch("/admin/photos", {
+      const params = new URLSearchParams();
+      if (selectedOrder) params.set("order_id", String(selectedOrder));
+      if (cursor) params.set("cursor", cursor);
+      const query = params.toString();
+      const response = await fetch(`/admin/photos${query ? `?${query}` : ""}`, {
         headers: {
           Authorization: `Bearer ${token}`,
         },
@@ -181,7 +193,8 @@ const PhotosPage: React.FC = () => {
       if (response.ok) {
         const data = await response.json();
         console.log("📸 Полученные фотографии:", data);
-        setPhotos(data);
+        setPhotos(prev => cursor ? [...prev, ...data] : data);
+        setPhotosCursor(response.headers.get("X-Next-Cursor"));
         setError(""); // Очищаем ошибки при успешной загрузке
       } else {
         const errorText = await response.text();
@@ -193,9 +206,16 @@ const PhotosPage: React.FC = () => {
       setError("Ошибка загрузки фотографий");
     } finally {
       setLoading(false);
+      setLoadingMorePhotos(false);
     }
   };
 
+  const loadMorePhotos = () => {
+    if (!photosCursor || loadingMorePhotos) return;
+    setLoadingMorePhotos(true);
+    fetchPhotos(photosCursor);
+  };
+
   const fetchOrders = async () => {
     try {
       const token = localStorage.getItem("token");
@@ -822,7 +842,7 @@ const PhotosPage: React.FC = () => {
                 : 'bg-gray-600 text-gray-200 hover:bg-gray-500'
             }`}
           >
-            📸 Фотографии по заказам ({photos.length})
+            📸 Фотографии по заказам ({photos.length}{photosCursor ? '+' : ''})
           </button>
           <button
             onClick={() => setActiveTab('covers')}
@@ -918,8 +938,9 @@ const PhotosPage: React.FC = () => {
                   <Card key={photo.id} className="p-4">
                     <div className="mb-3">
                       <img
-                        src={`/${photo.path}`}
+                        src={`/${photo.thumbnail_path || photo.path}`}
                         alt={`Фото заказа ${photo.order_id}`}
+                        loading="lazy"
                         className="w-full h-48 object-cover rounded"
                         onError={(e) => {
                           e.currentTarget.src = "data:image/svg+xml,%3Csvg xmlns='http://www.w3.org/2000/svg' width='200' height='200' viewBox='0 0 200 200'%3E%3Crect width='200' height='200' fill='%23f3f4f6'/%3E%3Ctext x='50%25' y='50%25' text-anchor='middle' dy='.3em' fill='%236b7280'%3EФото не найдено%3C/text%3E%3C/svg%3E";
@@ -1016,8 +1037,9 @@ const PhotosPage: React.FC = () => {
                       {orderPhotos.map((photo) => (
                         <div key={photo.id} className="relative group">
                           <img
-                            src={`/${photo.path}`}
+                            src={`/${photo.thumbnail_path || photo.path}`}
                             alt={`Фото заказа ${photo.order_id}`}
+                            loading="lazy"
                             className="w-full h-24 object-cover rounded cursor-pointer hover:opacity-80 transition-opacity"
                             onClick={() => window.open(`/${photo.path}`, '_blank')}
                             onError={(e) => {
@@ -1040,6 +1062,14 @@ const PhotosPage: React.FC = () => {
             </div>
           )}
 
+          {!loading && !error && photosCursor && (
+            <div className="text-center mt-6">
+              <Button onClick={loadMorePhotos} disabled={loadingMorePhotos}>
+                {loadingMorePhotos ? 'Загрузка...' : 'Показать ещё'}
+              </Button>
+            </div>
+          )}
+
           {filteredPhotos.length === 0 && selectedOrder && (
             <div className="text-center text-gray-500 mt-8">
               Нет фотографий для выбранного заказа
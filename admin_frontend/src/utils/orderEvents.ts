@@ -0,0 +1,64 @@
+// Поток изменений заказов с сервера (/admin/events, Server-Sent Events).
+// Страницы перезапрашивают данные только когда заказ изменился, а не каждые 5 секунд.
+
+export type OrderEventType = "order_changed" | "message" | "notification" | "resync";
+
+export interface OrderEvent {
+  id?: number;
+  type: OrderEventType;
+  order_id?: number | null;
+  created_at?: string;
+}
+
+const EVENT_TYPES: OrderEventType[] = ["order_changed", "message", "notification", "resync"];
+
+// Одно соединение на вкладку, общее для всех подписчиков страницы
+let source: EventSource | null = null;
+const listeners = new Set<(event: OrderEvent) => void>();
+
+const handleEvent = (e: Event) => {
+  let event: OrderEvent;
+  try {
+    event = JSON.parse((e as MessageEvent).data);
+  } catch (error) {
+    console.error("Ошибка разбора события заказа:", error);
+    return;
+  }
+  listeners.forEach((listener) => listener(event));
+};
+
+// Подписывается на события заказов; возвращает функцию отписки.
+// EventSource сам переподключается и досылает пропущенное по Last-Event-ID.
+export const subscribeOrderEvents = (onEvent: (event: OrderEvent) => void): (() => void) => {
+  const token = localStorage.getItem("token");
+  if (!token || typeof EventSource === "undefined") {
+    return () => {};
+  }
+
+  listeners.add(onEvent);
+  if (!source) {
+    source = new EventSource(`/admin/events?token=${encodeURIComponent(token)}`);
+    EVENT_TYPES.forEach((type) => source!.addEventListener(type, handleEvent));
+  }
+
+  return () => {
+    listeners.delete(onEvent);
+    if (listeners.size === 0 && source) {
+      source.close();
+      source = null;
+    }
+  };
+};
+
+// Вызывает callback не чаще одного раза за delay мс (пачка событий — один перезапрос)
+export const debounce = (callback: () => void, delay: number) => {
+  let timer: ReturnType<typeof setTimeout> | undefined;
+  const debounced = () => {
+    if (timer) clearTimeout(timer);
+    timer = setTimeout(callback, delay);
+  };
+  debounced.cancel = () => {
+    if (timer) clearTimeout(timer);
+  };
+  return debounced;
+};
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Скрипт для пересчета таблицы order_attribution по event_metrics.
+Запускается один раз после обновления или после ручной чистки event_metrics.
+"""
+
+import asyncio
+import sys
+import os
+
+# Добавляем путь к модулям
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from db import init_db, backfill_order_attribution, close_db_pool
+
+async def main():
+    """Основная функция"""
+    print("🚀 Пересчитываем атрибуцию заказов...")
+
+    try:
+        # Создаем таблицу, если ее еще нет
+        await init_db()
+
+        rows = await backfill_order_attribution()
+        print(f"✅ Атрибуция пересчитана для {rows} заказов")
+    except Exception as e:
+        print(f"❌ Ошибка пересчета атрибуции: {e}")
+        return 1
+    finally:
+        await close_db_pool()
+
+    return 0
+
+if __name__ == "__main__":
+    exit_code = asyncio.run(main())
+    sys.exit(exit_code)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Скрипт для заполнения каталога фотографий photo_catalog по существующим заказам.
+Дополняет каталог файлами, которых в нем нет (например, после переноса файлов или ручной чистки таблиц).
+"""
+
+import asyncio
+import sys
+import os
+
+# Добавляем путь к модулям
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from db import init_db, backfill_photo_catalog, close_db_pool
+
+async def main():
+    """Основная функция"""
+    print("🚀 Заполняем каталог фотографий...")
+
+    try:
+        # Создаем таблицу, если ее еще нет
+        await init_db()
+
+        rows = await backfill_photo_catalog()
+        print(f"✅ В каталог добавлено {rows} фотографий")
+    except Exception as e:
+        print(f"❌ Ошибка заполнения каталога фотографий: {e}")
+        return 1
+    finally:
+        await close_db_pool()
+
+    return 0
+
+if __name__ == "__main__":
+    exit_code = asyncio.run(main())
+    sys.exit(exit_code)
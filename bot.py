@@ -1,5 +1,7 @@
 import asyncio
 
+import functools
+
 import json
 
 import logging
@@ -8,6 +10,8 @@ import os
 
 import re
 
+import time
+
 from datetime import datetime, timedelta
 
 from aiogram import Bot, Dispatcher, types, F
@@ -22,9 +26,9 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 from aiogram.types import InputMediaPhoto, InputMediaAudio, InputMediaVideo, InputMediaDocument, FSInputFile
 
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter
 
-from db import init_db, save_user_profile, get_user_book, create_order, get_pending_outbox_tasks, update_outbox_task_status, increment_outbox_retry_count, update_order_status, add_outbox_task, get_order, get_user_active_order, update_order_data, save_selected_pages, save_main_hero_photo, save_hero_photo, save_joint_photo, save_uploaded_file, update_order_email, get_voice_styles, add_upload, update_order_field, track_event
+from db import init_db, save_user_profile, get_user_book, create_order, claim_outbox_tasks, release_outbox_tasks, add_outbox_listener, get_orders_by_ids, update_outbox_task_status, increment_outbox_retry_count, update_order_status, add_outbox_task, get_order, get_user_active_order, update_order_data, save_selected_pages, save_main_hero_photo, save_hero_photo, save_joint_photo, save_uploaded_file, update_order_email, get_voice_styles, add_upload, update_order_field, track_event
 
 
 
@@ -134,7 +138,7 @@ async def send_file_by_type(bot: Bot, user_id: int, file_path: str, file_type: s
             await bot.send_message(user_id, error_message)
             return False
 
-        input_file = FSInputFile(file_path)
+        input_file = CachedInputFile(file_path)
         
         logging.info(f"📤 Отправляю {file_type} файл {file_path} ({file_size_mb:.1f} МБ) пользователю {user_id}")
 
@@ -249,7 +253,7 @@ async def create_mixed_media_group(files: list, content: str = None):
             logging.error(f"❌ Ошибка проверки размера файла {file_path}: {size_error}")
             continue
 
-        input_file = FSInputFile(file_path)
+        input_file = CachedInputFile(file_path)
 
         caption = content if i == 0 else None  # Подпись только к первому файлу
 
@@ -289,21 +293,26 @@ from yookassa_integration import (
 
     get_product_price, get_product_price_async, format_payment_description, process_payment_webhook,
 
-    update_payment_status, get_payment_by_payment_id, get_upgrade_price_difference
+    update_payment_status, get_payment_by_payment_id, get_upgrade_price_difference, settled_payment_ids
 
 )
 
-from db import aiosqlite, DB_PATH
+from db import db_connection, reschedule_outbox_task
+from delivery_scheduler import delivery_scheduler, setup_delivery
 
+from telegram_file_cache import CachedInputFile, setup_file_cache
 
+from fsm_storage import create_fsm_storage
 
-dotenv.load_dotenv()
+from image_pipeline import process_image
+
+from telegram_client import API_TOKEN, get_bot
 
 
 
-# Замените на ваш токен, полученный у BotFather
-# Сначала пробуем BOT_TOKEN (как в .env/docker-compose), затем TELEGRAM_BOT_TOKEN
-API_TOKEN = os.getenv('BOT_TOKEN') or os.getenv('TELEGRAM_BOT_TOKEN', 'ВАШ_ТОКЕН_БОТА')
+dotenv.load_dotenv()
+
+
 
 # ID администраторов (через запятую)
 ADMIN_IDS = [int(x.strip()) for x in os.getenv('ADMIN_IDS', '').split(',') if x.strip()]
@@ -336,9 +345,15 @@ WELCOME_TEXT = (
 
 # Инициализация бота и диспетчера
 
-bot = Bot(token=API_TOKEN)
+# Общий Bot процесса (см. telegram_client.py)
+bot = get_bot()
+# Лимиты Telegram и RetryAfter для рассылок планировщика доставки
+setup_delivery(bot)
+
+setup_file_cache(bot)
 
-storage = MemoryStorage()
+# Состояния FSM хранятся в SQLite (или Redis), чтобы диалоги переживали перезапуск
+storage = create_fsm_storage()
 
 dp = Dispatcher(storage=storage)
 
@@ -4018,7 +4033,7 @@ async def skip_add_hero(callback: types.CallbackQuery, state: FSMContext):
 
                     await callback.message.answer_photo(
 
-                        types.FSInputFile(photo_path),
+                        CachedInputFile(photo_path),
 
                         caption=caption,
 
@@ -5183,7 +5198,7 @@ async def finish_photos(message_or_callback, state: FSMContext):
 
                     await message_or_callback.message.answer_photo(
 
-                        types.FSInputFile(photo_path),
+                        CachedInputFile(photo_path),
 
                         caption=caption,
 
@@ -5195,7 +5210,7 @@ async def finish_photos(message_or_callback, state: FSMContext):
 
                     await message_or_callback.answer_photo(
 
-                        types.FSInputFile(photo_path),
+                        CachedInputFile(photo_path),
 
                         caption=caption,
 
@@ -8422,120 +8437,229 @@ async def format_chosen(callback: types.CallbackQuery, state: FSMContext):
 
 # --- Автоматическая проверка платежей ---
 
+# Сверка ожидающих платежей с ЮKassa: сколько проверок идет одновременно
+PAYMENT_CHECK_CONCURRENCY = int(os.getenv('PAYMENT_CHECK_CONCURRENCY', '10'))
+
+# Как часто проверять платеж в зависимости от его возраста (секунды): свежие — часто, старые — редко
+PAYMENT_CHECK_BACKOFF = (
+    (120, 2),      # первые 2 минуты — каждые 2 секунды
+    (600, 10),     # до 10 минут — каждые 10 секунд
+    (1800, 30),    # до 30 минут — каждые 30 секунд
+    (None, 120),   # до 2 часов — раз в 2 минуты
+)
+
+# Как часто помечать старые недействительные платежи истекшими
+PAYMENT_CLEANUP_INTERVAL = 600
+
+
+def payment_check_interval(age_seconds: float) -> float:
+
+    """Интервал между проверками платежа с учетом его возраста"""
+
+    for max_age, interval in PAYMENT_CHECK_BACKOFF:
+
+        if max_age is None or age_seconds < max_age:
+
+            return interval
+
+    return PAYMENT_CHECK_BACKOFF[-1][1]
+
+
+async def reconcile_payment(payment: dict):
+
+    """Сверяет один ожидающий платеж с ЮKassa и доводит его до конечного статуса"""
+
+    payment_id = payment['payment_id']
+
+    order_id = payment['order_id']
+
+    logging.info(f"🔍 AUTO-CHECK: Проверяем платеж {payment_id} для заказа {order_id}, пользователь {payment['user_id']}")
+
+    try:
+
+        payment_status = await get_payment_status(payment_id)
+
+        # Пока ждали ЮKassa, платеж мог быть обработан в этом процессе. Вебхук приходит в процесс
+        # админки: от повторной обработки после него защищает claim_payment_status в process_payment_webhook,
+        # который занимает платеж статусом processing до конца обработки заказа
+        if payment_id in settled_payment_ids:
+
+            return
+
+        if payment_status and payment_status.get('status') == 'succeeded':
+
+            logging.info(f"🔄 AUTO-CHECK: Найден успешный платеж {payment_id} для заказа {order_id}")
+
+            logging.info(f"🚀 АВТОМАТИЧЕСКАЯ ОБРАБОТКА: Платеж {payment_id} будет обработан автоматически!")
+
+            # Описание платежа (для определения доплаты) уже получено при выборке ожидающих платежей
+            webhook_data = {
+
+                'event': 'payment.succeeded',
+
+                'object': {
+
+                    'id': payment_id,
+
+                    'status': 'succeeded',
+
+                    'amount': {'value': payment_status.get('amount', 0)},
+
+                    'description': payment.get('description') or ''
+
+                }
+
+            }
+
+            # Статус succeeded записывает process_payment_webhook после обработки заказа;
+            # если обработка не удалась, платеж остается ожидающим и сверится снова
+            if not await process_payment_webhook(webhook_data):
+
+                logging.warning(f"⚠️ AUTO-CHECK: Платеж {payment_id} не обработан, повторим при следующей сверке")
+
+                return
+
+            # Задачи outbox, созданные обработчиком платежа, сразу будят диспетчер (add_outbox_task)
+            logging.info(f"✅ AUTO-CHECK: Платеж {payment_id} обработан, сообщения отправятся через outbox")
+
+        elif payment_status and payment_status.get('status') == 'canceled':
+
+            # Платеж отменен - обновляем статус
+            logging.info(f"🔄 AUTO-CHECK: Платеж {payment_id} отменен")
+
+            await update_payment_status(payment_id, 'canceled')
+
+    except Exception as payment_error:
+
+        # Если платеж не найден или есть ошибка доступа - помечаем как недействительный
+        if 'not_found' in str(payment_error) or 'access denied' in str(payment_error) or 'Incorrect payment_id' in str(payment_error):
+
+            logging.warning(f"🔄 AUTO-CHECK: Платеж {payment_id} не найден или недоступен, помечаем как недействительный")
+
+            await update_payment_status(payment_id, 'invalid')
+
+            # Также помечаем заказ как имеющий проблему с платежом
+            try:
+
+                from db import update_order_status
+
+                await update_order_status(order_id, "payment_error")
+
+            except:
+
+                pass
+
+        else:
+
+            logging.error(f"🔄 AUTO-CHECK: Ошибка проверки платежа {payment_id}: {payment_error}")
+
+
 async def auto_check_payments():
+
     """
-    Автоматически проверяет статус платежей каждые 10 секунд
+    Сверяет ожидающие платежи с ЮKassa.
+
+    Каждые 2 секунды выбираются платежи в статусе pending за последние 2 часа, но проверяются
+    только те, у которых подошло время по PAYMENT_CHECK_BACKOFF. Проверки идут параллельно
+    (не больше PAYMENT_CHECK_CONCURRENCY), уже проведенные вебхуком платежи пропускаются.
     """
+
+    semaphore = asyncio.Semaphore(PAYMENT_CHECK_CONCURRENCY)
+
+    # payment_id -> время (monotonic) следующей проверки
+    next_check_at = {}
+
+    last_cleanup = 0.0
+
+    async def _check(payment: dict):
+
+        async with semaphore:
+
+            await reconcile_payment(payment)
+
     while True:
+
         try:
-            # Получаем все платежи со статусом 'pending' старше 30 секунд
-            # Исключаем тестовые платежи и платежи с ошибками
-            async with aiosqlite.connect(DB_PATH) as db:
+
+            # Получаем все платежи со статусом 'pending' старше 2 секунд, а также занятые обработкой
+            # (processing): если обработка оборвалась, process_payment_webhook займет платеж заново
+            # Исключаем тестовые платежи
+            async with db_connection(readonly=True) as db:
+
                 async with db.execute('''
-                    SELECT p.*, o.user_id, o.order_data 
+                    SELECT p.payment_id, p.order_id, p.description, o.user_id,
+                           (julianday('now') - julianday(p.created_at)) * 86400 AS age_seconds
                     FROM payments p
                     JOIN orders o ON p.order_id = o.id
-                    WHERE p.status = 'pending' 
+                    WHERE p.status IN ('pending', 'processing')
                     AND p.payment_id NOT LIKE 'test_payment_%'
-                    AND p.status NOT IN ('invalid', 'expired', 'error')
-                    AND datetime(p.created_at) < datetime('now', '-2 seconds')
-                    AND datetime(p.created_at) > datetime('now', '-2 hours')
+                    AND p.created_at < datetime('now', '-2 seconds')
+                    AND p.created_at > datetime('now', '-2 hours')
                 ''') as cursor:
+
                     rows = await cursor.fetchall()
-                    
-                    for row in rows:
-                        payment_id = row[2]  # payment_id
-                        order_id = row[1]    # order_id
-                        user_id = row[8]     # user_id
-                        
-                        logging.info(f"🔍 AUTO-CHECK: Проверяем платеж {payment_id} для заказа {order_id}, пользователь {user_id}")
-                        
-                        # Проверяем статус платежа в ЮKassa
-                        try:
-                            payment_status = await get_payment_status(payment_id)
-                            
-                            if payment_status and payment_status.get('status') == 'succeeded':
-                                logging.info(f"🔄 AUTO-CHECK: Найден успешный платеж {payment_id} для заказа {order_id}")
-                                logging.info(f"🚀 АВТОМАТИЧЕСКАЯ ОБРАБОТКА: Платеж {payment_id} будет обработан автоматически!")
-                                
-                                # Получаем описание платежа для определения типа
-                                payment_data = await get_payment_by_payment_id(payment_id)
-                                description = payment_data.get('description', '') if payment_data else ''
-                                
-                                # logging.info(f"🔄 AUTO-CHECK: Описание платежа: '{description}'")
-                                
-                                # Обрабатываем успешный платеж
-                                webhook_data = {
-                                    'event': 'payment.succeeded',
-                                    'object': {
-                                        'id': payment_id,
-                                        'status': 'succeeded',
-                                        'amount': {'value': payment_status.get('amount', 0)},
-                                        'description': description
-                                    }
-                                }
-                                
-                                await process_payment_webhook(webhook_data)
-                                
-                                # Обновляем статус платежа в БД
-                                await update_payment_status(payment_id, 'succeeded')
-                                
-                                # Принудительно обрабатываем outbox задачи для этого пользователя
-                                try:
-                                    from db import get_pending_outbox_tasks, update_outbox_task_status
-                                    user_tasks = await get_pending_outbox_tasks()
-                                    if user_tasks:
-                                        for task in user_tasks:
-                                            if task.get('user_id') == user_id and task.get('order_id') == order_id:
-                                                logging.info(f"🔄 AUTO-CHECK: Принудительно обрабатываем задачу {task.get('id')} для заказа {order_id}")
-                                                # Здесь можно добавить принудительную обработку задачи
-                                except Exception as force_error:
-                                    logging.error(f"❌ AUTO-CHECK: Ошибка принудительной обработки outbox: {force_error}")
-                                
-                                # Удален код прямой отправки сообщений - используется система outbox
-                                logging.info(f"✅ AUTO-CHECK: Платеж {payment_id} обработан, сообщения отправятся через outbox")
-                            elif payment_status and payment_status.get('status') == 'canceled':
-                                # Платеж отменен - обновляем статус
-                                logging.info(f"🔄 AUTO-CHECK: Платеж {payment_id} отменен")
-                                await update_payment_status(payment_id, 'canceled')
-                        except Exception as payment_error:
-                            # Если платеж не найден или есть ошибка доступа - помечаем как недействительный
-                            if 'not_found' in str(payment_error) or 'access denied' in str(payment_error) or 'Incorrect payment_id' in str(payment_error):
-                                logging.warning(f"🔄 AUTO-CHECK: Платеж {payment_id} не найден или недоступен, помечаем как недействительный")
-                                await update_payment_status(payment_id, 'invalid')
-                                
-                                # Также помечаем заказ как имеющий проблему с платежом
-                                try:
-                                    from db import update_order_status
-                                    await update_order_status(order_id, "payment_error")
-                                except:
-                                    pass
-                            else:
-                                logging.error(f"🔄 AUTO-CHECK: Ошибка проверки платежа {payment_id}: {payment_error}")
-                            
+
+            pending = {
+                row[0]: {'payment_id': row[0], 'order_id': row[1], 'description': row[2], 'user_id': row[3], 'age_seconds': row[4] or 0}
+                for row in rows
+            }
+
+            # Забываем платежи, которые больше не ожидают оплаты
+            settled_payment_ids.intersection_update(pending)
+
+            for payment_id in list(next_check_at):
+
+                if payment_id not in pending:
+
+                    del next_check_at[payment_id]
+
+            now = time.monotonic()
+
+            due = [
+                payment for payment_id, payment in pending.items()
+                if payment_id not in settled_payment_ids and next_check_at.get(payment_id, 0) <= now
+            ]
+
+            for payment in due:
+
+                next_check_at[payment['payment_id']] = now + payment_check_interval(payment['age_seconds'])
+
+            if due:
+
+                await asyncio.gather(*(_check(payment) for payment in due))
+
         except Exception as e:
+
             logging.error(f"❌ Ошибка автоматической проверки платежей: {e}")
-        
+
         # Очищаем старые недействительные платежи (старше 24 часов)
-        try:
-            async with aiosqlite.connect(DB_PATH) as db:
-                # Помечаем старые недействительные платежи как истекшие
-                await db.execute('''
-                    UPDATE payments 
-                    SET status = 'expired' 
-                    WHERE status = 'invalid' 
-                    AND datetime(created_at) < datetime('now', '-24 hours')
-                ''')
-                
-                # Удален код помечания платежей 3069* как недействительные - теперь они обрабатываются автоматически
-                
-                await db.commit()
-        except Exception as cleanup_error:
-            logging.error(f"❌ Ошибка очистки недействительных платежей: {cleanup_error}")
-        
-        # Ждем 2 секунды перед следующей проверкой для максимально быстрой обработки
+        if time.monotonic() - last_cleanup >= PAYMENT_CLEANUP_INTERVAL:
+
+            last_cleanup = time.monotonic()
+
+            try:
+
+                async with db_connection() as db:
+
+                    # Помечаем старые недействительные платежи как истекшие
+                    await db.execute('''
+                        UPDATE payments 
+                        SET status = 'expired' 
+                        WHERE status = 'invalid' 
+                        AND created_at < datetime('now', '-24 hours')
+                    ''')
+
+                    await db.commit()
+
+            except Exception as cleanup_error:
+
+                logging.error(f"❌ Ошибка очистки недействительных платежей: {cleanup_error}")
+
+        # Ждем 2 секунды перед следующей выборкой; частоту запросов к ЮKassa задает PAYMENT_CHECK_BACKOFF
         await asyncio.sleep(2)
 
+
+
 # --- Напоминания об оплате (эмуляция через команду /remind) ---
 
 @dp.message(StateFilter(lambda c: c.text == "/remind"))
@@ -10066,7 +10190,7 @@ async def show_cover_library(message, state):
 
                 sent_message = await message.answer_photo(
 
-                    photo=types.FSInputFile(photo_path),
+                    photo=CachedInputFile(photo_path),
 
                     caption=caption,
 
@@ -13104,7 +13228,7 @@ async def send_voice_examples(message: types.Message, user_gender: str):
 
                 await message.answer_audio(
 
-                    types.FSInputFile(audio_path),
+                    CachedInputFile(audio_path),
 
                     caption=f"Пример {style_name.lower()}",
 
@@ -18275,2429 +18399,2463 @@ async def handle_product_choice_text(message: types.Message, state: FSMContext):
 
 
 
+# Сколько задач outbox диспетчер забирает за раз
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '20'))
+# Интервал опроса outbox на случай задач, добавленных другим процессом (админкой)
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '2'))
+# Сколько задач может одновременно находиться в планировщике доставки
+OUTBOX_MAX_IN_FLIGHT = int(os.getenv('OUTBOX_MAX_IN_FLIGHT', '200'))
+
 async def process_outbox_tasks(bot: Bot):
     logging.info("🚀 ПРОЦЕСС OUTBOX ЗАПУЩЕН - начинаем обработку задач")
 
+    # add_outbox_task в этом процессе будит диспетчер сразу;
+    # задачи из других процессов подхватываются опросом раз в OUTBOX_POLL_INTERVAL
+    wakeup = asyncio.Event()
+    add_outbox_listener(wakeup.set)
+    claim_now = True
+    # Задачи, которые уже стоят в очередях планировщика доставки
+    in_flight = set()
+
+    def _task_done(task_id):
+        in_flight.discard(task_id)
+        wakeup.set()
+
     while True:
+        if not claim_now or len(in_flight) >= OUTBOX_MAX_IN_FLIGHT:
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        wakeup.clear()
+        claim_now = False
+        tasks = []
 
         try:
-            from db import get_order
-            logging.info("🔄 ПРОВЕРЯЕМ OUTBOX ЗАДАЧИ...")
-            tasks = await get_pending_outbox_tasks()
-            logging.info(f"🔍 РЕЗУЛЬТАТ ЗАПРОСА: найдено {len(tasks) if tasks else 0} pending задач в outbox")
-
-            if tasks:
+            if len(in_flight) >= OUTBOX_MAX_IN_FLIGHT:
+                continue
 
-                logging.info(f"🔍 Найдено {len(tasks)} pending задач в outbox")
+            # Повторная выдача задачи, которая еще в очереди планировщика, только продлевает ее аренду
+            claimed = await claim_outbox_tasks(OUTBOX_BATCH_SIZE)
+            tasks = [task for task in claimed if task['id'] not in in_flight]
+            # Пачка заполнена целиком — в очереди могут остаться задачи, следующую забираем без ожидания
+            claim_now = len(claimed) == OUTBOX_BATCH_SIZE
+            if not tasks:
+                continue
 
-            
+            logging.info(f"🔍 Взято в работу {len(tasks)} задач из outbox")
+            # Заказы всех задач пачки — одним запросом
+            orders_by_id = await get_orders_by_ids([task.get('order_id') for task in tasks])
 
+            # Разные пользователи обслуживаются параллельно, задачи одного пользователя — по порядку
             for task in tasks:
-                # Проверяем, что task не является None
-                if not task or not isinstance(task, dict):
-                    logging.error(f"❌ Некорректная задача: {task}")
-                    continue
-                
-                try:
-                    logging.info(f"🔧 НАЧИНАЕМ ОБРАБОТКУ ЗАДАЧИ: {task}")
-                    logging.info(f"🔧 ПРОВЕРЯЕМ TASK: type={type(task)}, is_dict={isinstance(task, dict)}")
-                    
-                    if not task or not isinstance(task, dict):
-                        logging.error(f"❌ TASK НЕ СЛОВАРЬ: {task}")
-                        continue
-                        
-                    user_id = task.get('user_id')
-                    type_ = task.get('type')
-                    content = task.get('content')
-                    task_id = task.get('id')
-                    
-                    if not all([user_id, type_, task_id]):
-                        logging.error(f"❌ Неполные данные в задаче: user_id={user_id}, type={type_}, task_id={task_id}")
-                        continue
-                    order_id = task.get('order_id')
-                    logging.info(f"🔧 ИЗВЛЕЧЕНЫ ДАННЫЕ ЗАДАЧИ {task_id}: user_id={user_id}, type={type_}, order_id={order_id}")
-                except KeyError as e:
-                    logging.error(f"❌ Отсутствует обязательное поле в задаче {task}: {e}")
-                    continue
-                except Exception as e:
-                    logging.error(f"❌ КРИТИЧЕСКАЯ ОШИБКА при извлечении данных задачи {task}: {e}")
-                    import traceback
-                    logging.error(f"❌ TRACEBACK: {traceback.format_exc()}")
-                    continue
+                in_flight.add(task['id'])
+                future = delivery_scheduler.submit(
+                    task.get('user_id') or 0,
+                    functools.partial(deliver_outbox_task, bot, task, orders_by_id)
+                )
+                future.add_done_callback(lambda _future, task_id=task['id']: _task_done(task_id))
+            tasks = []
 
-                
+        except Exception as e:
+            logging.error(f"❌ КРИТИЧЕСКАЯ ОШИБКА В PROCESS_OUTBOX_TASKS: {e}")
+            import traceback
+            logging.error(f"❌ ПОЛНЫЙ TRACEBACK: {traceback.format_exc()}")
+            # Не переданные планировщику задачи возвращаем в очередь, не дожидаясь окончания аренды
+            pending_ids = [task['id'] for task in tasks if task['id'] not in in_flight]
+            if pending_ids:
+                await release_outbox_tasks(pending_ids)
+                claim_now = True
+
+async def deliver_outbox_task(bot: Bot, task: dict, orders_by_id: dict):
+    """Выполняет задачу outbox в очереди ее пользователя и разбирает ошибки отправки"""
+    try:
+        await _deliver_outbox_task(bot, task, orders_by_id)
+    except TelegramRetryAfter as e:
+        # Flood control Telegram: переносим задачу на указанное время, не расходуя retry_count
+        logging.warning(f"⏳ Flood control для задачи {task.get('id')}: повтор через {e.retry_after} с")
+        await reschedule_outbox_task(task['id'], e.retry_after)
+    except Exception as e:
 
-                # Безопасное логирование с проверкой на None
-                safe_content = str(content)[:100] if content else 'None'
-                safe_comment = (task.get('comment') or '')[:50]
-                logging.info(f"📤 Обрабатываем задачу {task_id}: type={type_}, user_id={user_id}, content={safe_content}..., file_type={task.get('file_type')}, comment={safe_comment}...")
+        error_msg = str(e)
+        
+        # Безопасное получение task_id и user_id
+        safe_task_id = task.get('id') or 'неизвестно'
+        safe_user_id = task.get('user_id') or 'неизвестно'
 
-                
+        logging.error(f"Ошибка отправки задания {safe_task_id}: {error_msg}")
+        
+        # Добавляем полный traceback для диагностики
+        import traceback
+        logging.error(f"🔍 ПОЛНЫЙ TRACEBACK ОШИБКИ: {traceback.format_exc()}")
 
-                # Проверяем валидность user_id
+        
 
-                if not user_id or user_id <= 0 or user_id in [12345, 0, -1]:
+        # Определяем тип ошибки для лучшей диагностики
 
-                    logging.error(f"❌ Некорректный user_id {user_id} в задаче {task_id}. Пропускаем задачу.")
+        if "Forbidden" in error_msg or "bot was blocked" in error_msg.lower():
 
-                    await update_outbox_task_status(task_id, 'failed')
+            logging.error(f"Пользователь {safe_user_id} заблокировал бота")
 
-                    continue
+            # Для заблокированных пользователей помечаем задачу как failed и не повторяем
+            if safe_task_id != 'неизвестно':
+                await update_outbox_task_status(safe_task_id, 'failed')
 
-                
+            # Добавляем комментарий о том, что пользователь заблокировал бота
 
-                # Проверяем статус заказа для предотвращения дублирования финальных версий
+            # Добавляем уведомление менеджеру только если есть данные задачи
+            if task:
+                await add_outbox_task(
+                    order_id=task.get('order_id'),
+                    user_id=0,  # Системное сообщение
+                    type_="manager_notification",
+                    content=f"⚠️ ВНИМАНИЕ: Пользователь {safe_user_id} заблокировал бота. Демо-контент не доставлен. Необходимо связаться с пользователем другим способом."
+                )
 
-                if order_id:
+        elif "chat not found" in error_msg.lower():
 
-                    try:
+            logging.error(f"Чат с пользователем {safe_user_id} не найден (возможно, пользователь не взаимодействовал с ботом)")
 
-                        order_data = await get_order(order_id)
+            if safe_task_id != 'неизвестно':
+                await update_outbox_task_status(safe_task_id, 'failed')
 
-                        if order_data:
+        elif "user not found" in error_msg.lower():
 
-                            order_status = order_data.get('status')
+            logging.error(f"Пользователь {safe_user_id} не найден в Telegram")
 
-                            if order_status == 'ready':
+            if safe_task_id != 'неизвестно':
+                await update_outbox_task_status(safe_task_id, 'failed')
 
-                                logging.info(f"📚 Заказ {order_id} имеет статус 'ready' - пропускаем задачу {task_id} для предотвращения дублирования")
+        else:
 
-                                await update_outbox_task_status(task_id, 'sent')
+            # Для других ошибок оставляем задачу в pending для повторной попытки
 
-                                continue
+            logging.error(f"Неизвестная ошибка для пользователя {safe_user_id}: {error_msg}")
 
-                            elif order_status == 'completed':
+            if safe_task_id != 'неизвестно':
+                # Повторяем не больше max_retries раз, после этого задача считается неотправленной
+                if task.get('retry_count', 0) + 1 >= task.get('max_retries', 3):
+                    await update_outbox_task_status(safe_task_id, 'failed')
+                else:
+                    await increment_outbox_retry_count(safe_task_id)
+                    await update_outbox_task_status(safe_task_id, 'pending')
 
-                                logging.info(f"✅ Заказ {order_id} завершен - пропускаем задачу {task_id}")
+async def _deliver_outbox_task(bot: Bot, task: dict, orders_by_id: dict):
+    """
+    Отправляет пользователю одну задачу outbox в зависимости от ее типа.
 
-                                await update_outbox_task_status(task_id, 'sent')
+    Flood control и сетевые сбои (TelegramRetryAfter, TelegramNetworkError) обработчики типов
+    не помечают как failed, а пробрасывают: задачу переносит или повторяет deliver_outbox_task.
+    """
+    # Проверяем, что task не является None
+    if not task or not isinstance(task, dict):
+        logging.error(f"❌ Некорректная задача: {task}")
+        return
+    
+    try:
+        logging.info(f"🔧 НАЧИНАЕМ ОБРАБОТКУ ЗАДАЧИ: {task}")
+        logging.info(f"🔧 ПРОВЕРЯЕМ TASK: type={type(task)}, is_dict={isinstance(task, dict)}")
+        
+        if not task or not isinstance(task, dict):
+            logging.error(f"❌ TASK НЕ СЛОВАРЬ: {task}")
+            return
+            
+        user_id = task.get('user_id')
+        type_ = task.get('type')
+        content = task.get('content')
+        task_id = task.get('id')
+        
+        if not all([user_id, type_, task_id]):
+            logging.error(f"❌ Неполные данные в задаче: user_id={user_id}, type={type_}, task_id={task_id}")
+            return
+        order_id = task.get('order_id')
+        logging.info(f"🔧 ИЗВЛЕЧЕНЫ ДАННЫЕ ЗАДАЧИ {task_id}: user_id={user_id}, type={type_}, order_id={order_id}")
+    except KeyError as e:
+        logging.error(f"❌ Отсутствует обязательное поле в задаче {task}: {e}")
+        return
+    except Exception as e:
+        logging.error(f"❌ КРИТИЧЕСКАЯ ОШИБКА при извлечении данных задачи {task}: {e}")
+        import traceback
+        logging.error(f"❌ TRACEBACK: {traceback.format_exc()}")
+        return
 
-                                continue
+    
 
-                    except Exception as e:
+    # Безопасное логирование с проверкой на None
+    safe_content = str(content)[:100] if content else 'None'
+    safe_comment = (task.get('comment') or '')[:50]
+    logging.info(f"📤 Обрабатываем задачу {task_id}: type={type_}, user_id={user_id}, content={safe_content}..., file_type={task.get('file_type')}, comment={safe_comment}...")
 
-                        logging.error(f"❌ Ошибка проверки статуса заказа {order_id}: {e}")
+    
 
-                
+    # Проверяем валидность user_id
 
-                if type_ == 'text' or type_ == 'text_message':
+    if not user_id or user_id <= 0 or user_id in [12345, 0, -1]:
 
-                    try:
+        logging.error(f"❌ Некорректный user_id {user_id} в задаче {task_id}. Пропускаем задачу.")
 
-                        logging.info(f"📝 Отправляем текстовое сообщение пользователю {user_id}: {content[:50]}...")
+        await update_outbox_task_status(task_id, 'failed')
 
-                        
+        return
 
-                        # Обычное текстовое сообщение
+    
 
-                        await bot.send_message(user_id, content, parse_mode="HTML")
+    # Проверяем статус заказа для предотвращения дублирования финальных версий
 
-                        await update_outbox_task_status(task_id, 'sent')
+    if order_id:
 
-                        logging.info(f"✅ Сообщение отправлено успешно")
+        try:
 
-                    except Exception as e:
+            order_data = orders_by_id.get(order_id)
 
-                        logging.error(f"Ошибка отправки текстового сообщения {task_id}: {e}")
+            if order_data:
 
-                        await update_outbox_task_status(task_id, 'failed')
+                order_status = order_data.get('status')
 
-                elif type_ == 'stories':
+                if order_status == 'ready':
 
-                    try:
+                    logging.info(f"📚 Заказ {order_id} имеет статус 'ready' - пропускаем задачу {task_id} для предотвращения дублирования")
 
-                        logging.info(f"📖 Отправляем сюжеты пользователю {user_id}: {content[:50]}...")
+                    await update_outbox_task_status(task_id, 'sent')
 
-                        
+                    return
 
-                        # Создаем виртуальное сообщение для обработки сюжетов
+                elif order_status == 'completed':
 
-                        from aiogram.types import Message
+                    logging.info(f"✅ Заказ {order_id} завершен - пропускаем задачу {task_id}")
 
-                        from aiogram.fsm.context import FSMContext
+                    await update_outbox_task_status(task_id, 'sent')
 
-                        
+                    return
 
-                        # Создаем виртуальное сообщение от менеджера
+        except Exception as e:
 
-                        virtual_message = Message(
+            logging.error(f"❌ Ошибка проверки статуса заказа {order_id}: {e}")
 
-                            message_id=0,
+    
 
-                            date=datetime.now(),
+    if type_ == 'text' or type_ == 'text_message':
 
-                            chat=types.Chat(id=user_id, type="private"),
+        try:
 
-                            from_user=types.User(id=0, is_bot=False, first_name="Manager"),
+            logging.info(f"📝 Отправляем текстовое сообщение пользователю {user_id}: {content[:50]}...")
 
-                            text=content
+            
 
-                        )
+            # Обычное текстовое сообщение
 
-                        
+            await bot.send_message(user_id, content, parse_mode="HTML")
 
-                        # Получаем состояние пользователя
+            await update_outbox_task_status(task_id, 'sent')
 
-                        from aiogram.fsm.storage.base import StorageKey
+            logging.info(f"✅ Сообщение отправлено успешно")
 
-                        storage_key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
+        except (TelegramRetryAfter, TelegramNetworkError):
+            raise
 
-                        
+        except Exception as e:
 
-                        # Создаем контекст состояния
+            logging.error(f"Ошибка отправки текстового сообщения {task_id}: {e}")
 
-                        from aiogram.fsm.context import FSMContext
+            await update_outbox_task_status(task_id, 'failed')
 
-                        state = FSMContext(storage=storage, key=storage_key)
+    elif type_ == 'stories':
 
-                        
+        try:
 
-                        # Проверяем текущее состояние пользователя
+            logging.info(f"📖 Отправляем сюжеты пользователю {user_id}: {content[:50]}...")
 
-                        current_state = await state.get_state()
+            
 
-                        
+            # Создаем виртуальное сообщение для обработки сюжетов
 
-                        if current_state == "ManagerContentStates:waiting_story_options":
+            from aiogram.types import Message
 
-                            # Пользователь ожидает страницы для выбора - переводим в состояние выбора страниц
+            from aiogram.fsm.context import FSMContext
 
-                            await state.set_state(BookFinalStates.choosing_pages)
+            
 
-                            
+            # Создаем виртуальное сообщение от менеджера
 
-                            # Инициализируем данные заказа
+            virtual_message = Message(
 
-                            order_id = task.get('order_id')
+                message_id=0,
 
-                            if order_id:
+                date=datetime.now(),
 
-                                await state.update_data(order_id=order_id)
+                chat=types.Chat(id=user_id, type="private"),
 
-                            
+                from_user=types.User(id=0, is_bot=False, first_name="Manager"),
 
-                            # Отправляем как обычное сообщение, так как страницы будут отправлены через page_selection
+                text=content
 
-                            await bot.send_message(user_id, content)
+            )
 
-                            logging.info(f"✅ Переведен в состояние выбора страниц и отправлено сообщение пользователю {user_id}")
+            
 
-                        elif current_state == "StoryCustomizationStates:waiting_for_stories":
+            # Получаем состояние пользователя
 
-                            # Пользователь ожидает сюжеты - обрабатываем их (старый код)
+            from aiogram.fsm.storage.base import StorageKey
 
-                            await receive_stories_from_manager(virtual_message, state)
+            storage_key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
 
-                            logging.info(f"✅ Сюжеты обработаны и отправлены пользователю {user_id}")
+            
 
-                        else:
+            # Создаем контекст состояния
 
-                            # Пользователь не в состоянии ожидания сюжетов - отправляем как обычное сообщение
+            from aiogram.fsm.context import FSMContext
 
-                            await bot.send_message(user_id, content)
+            state = FSMContext(storage=storage, key=storage_key)
 
-                            logging.info(f"✅ Сюжеты отправлены как обычное сообщение пользователю {user_id}")
+            
 
-                            logging.info(f"🔍 Текущее состояние пользователя: {current_state}")
+            # Проверяем текущее состояние пользователя
 
-                        
+            current_state = await state.get_state()
 
-                        await update_outbox_task_status(task_id, 'sent')
+            
 
-                        logging.info(f"✅ Сюжеты отправлены успешно")
+            if current_state == "ManagerContentStates:waiting_story_options":
 
-                    except Exception as e:
+                # Пользователь ожидает страницы для выбора - переводим в состояние выбора страниц
 
-                        logging.error(f"Ошибка отправки сюжетов {task_id}: {e}")
+                await state.set_state(BookFinalStates.choosing_pages)
 
-                        await update_outbox_task_status(task_id, 'failed')
+                
 
-                elif type_ == 'file':
+                # Инициализируем данные заказа
 
-                    try:
+                order_id = task.get('order_id')
 
-                        file_type = (task.get('file_type') or '').lower()
+                if order_id:
 
-                        comment = task.get('comment') or ''
-                        
-                        # Проверяем, является ли это общим сообщением
-                        is_general_message = task.get('is_general_message', 0) == 1
+                    await state.update_data(order_id=order_id)
 
-                        logging.info(f"📤 Полученный тип файла в file: '{file_type}'")
-                        logging.info(f"📤 Общее сообщение: {is_general_message}")
+                
 
-                        # Если это общее сообщение, отправляем файл без кнопок
-                        if is_general_message:
-                            logging.info(f"📤 ОБЩЕЕ СООБЩЕНИЕ: Отправляем файл для задачи {task_id}")
-                            logging.info(f"📤 Файл: {content}, Тип: {file_type}, Комментарий: {comment}")
-                            
-                            # Проверяем существование файла
-                            if not os.path.exists(content):
-                                logging.error(f"❌ Файл не существует: {content}")
-                                await update_outbox_task_status(task_id, 'failed')
-                                continue
-                            
-                            try:
-                                # Логируем размер файла перед отправкой
-                                file_size_mb = os.path.getsize(content) / (1024 * 1024)
-                                logging.info(f"📤 Размер файла перед отправкой: {file_size_mb:.2f} МБ")
-                                
-                                # Для общих сообщений отправляем файлы как нативные типы, но без кнопок
-                                input_file = FSInputFile(content)
-                                
-                                if file_type in ['image', 'jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp']:
-                                    # Изображение - отправляем как фото
-                                    logging.info(f"📤 Отправляем как ФОТО: {file_type}")
-                                    await bot.send_photo(
-                                        user_id, 
-                                        input_file, 
-                                        caption=comment if comment else None
-                                    )
-                                elif file_type in ['video', 'mp4', 'avi', 'mov', 'mkv', 'webm']:
-                                    # Видео - отправляем как видео
-                                    logging.info(f"📤 Отправляем как ВИДЕО: {file_type}")
-                                    await bot.send_video(
-                                        user_id, 
-                                        input_file, 
-                                        caption=comment if comment else None
-                                    )
-                                elif file_type in ['audio', 'mp3', 'wav', 'ogg', 'm4a', 'aac']:
-                                    # Аудио - отправляем как аудио
-                                    logging.info(f"📤 Отправляем как АУДИО: {file_type}")
-                                    await bot.send_audio(
-                                        user_id, 
-                                        input_file, 
-                                        caption=comment if comment else None
-                                    )
-                                else:
-                                    # Остальные файлы (PDF, документы) - как документы
-                                    logging.info(f"📤 Отправляем как ДОКУМЕНТ: {file_type}")
-                                    await bot.send_document(
-                                        user_id, 
-                                        input_file, 
-                                        caption=comment if comment else None
-                                    )
-                                
-                                # Помечаем задачу как отправленную
-                                await update_outbox_task_status(task_id, 'sent')
-                                logging.info(f"✅ Общее сообщение с файлом отправлено успешно")
-                                continue
-                                
-                            except Exception as send_error:
-                                error_msg = str(send_error)
-                                logging.error(f"❌ Ошибка отправки общего сообщения {task_id}: {error_msg}")
-                                await update_outbox_task_status(task_id, 'failed')
-                                continue
-
-                        # Проверяем, является ли это черновиком или финальной версией песни
-
-                        order_id = task.get('order_id')
-                        logging.info(f"📋 Получен order_id: {order_id} для задачи {task_id}")
-                        
-                        if not order_id:
-                            logging.error(f"❌ Отсутствует order_id в задаче {task_id}")
-                            await update_outbox_task_status(task_id, 'failed')
-                            continue
-                        
-                        # НЕ отправляем файл сразу! Сначала определим тип и добавим кнопки
-
-                        is_song_draft = False
-
-                        is_song_final = False
-
-                        is_book_draft = False
+                # Отправляем как обычное сообщение, так как страницы будут отправлены через page_selection
 
-                        is_book_demo = False
+                await bot.send_message(user_id, content)
 
-                        is_song_demo = False
+                logging.info(f"✅ Переведен в состояние выбора страниц и отправлено сообщение пользователю {user_id}")
 
-                        
-
-                        logging.info(f"🔍 ОТЛАДКА: Обрабатываем файл для заказа {order_id or 'неизвестно'}")
-
-                        logging.info(f"📄 Тип файла: {file_type}, Комментарий: {comment}")
-
-                        # Получаем данные заказа
-                        from db import get_order
-                        order = await get_order(order_id)
-
-                        if order and order.get('order_data'):
-
-                            import json
-
-                            try:
+            elif current_state == "StoryCustomizationStates:waiting_for_stories":
 
-                                order_data = json.loads(order.get('order_data', '{}')) if order and order.get('order_data') else {}
+                # Пользователь ожидает сюжеты - обрабатываем их (старый код)
 
-                                product = order_data.get('product', '')
-
-                                order_status = order.get('status', '')
-
-                                
-
-                                logging.info(f"📊 Продукт: {product}, Статус заказа: {order_status}")
-                                
-                                logging.info(f"📋 ДЕТАЛЬНАЯ ОТЛАДКА для задачи {task_id}:")
-                                logging.info(f"📋 - Задача ID: {task_id}")
-                                logging.info(f"📋 - Заказ ID: {order_id}")
-                                logging.info(f"📋 - Продукт: '{product}'")
-                                logging.info(f"📋 - Статус заказа: '{order_status}'")
-                                logging.info(f"📋 - Тип файла: '{file_type}'")
-                                logging.info(f"📋 - Комментарий: '{comment}'")
+                await receive_stories_from_manager(virtual_message, state)
 
-                                
+                logging.info(f"✅ Сюжеты обработаны и отправлены пользователю {user_id}")
 
-                                if product == 'Песня':
+            else:
 
-                                    logging.info(f"🎵 Проверяем статус для песни: {order_status}, file_type: {file_type}")
+                # Пользователь не в состоянии ожидания сюжетов - отправляем как обычное сообщение
 
-                                    # Если это демо-контент для песни (аудио или видео)
-                                    if file_type in ['demo_audio', 'demo_video'] or order_status in ['waiting_manager', 'demo_content', 'questions_completed']:
-                                        
-                                        is_song_demo = True
-                                        
-                                        logging.info(f"🎵 Обнаружен демо-контент песни для заказа {order_id}")
-                                        
-                                        # Обновляем статус заказа
-                                        await update_order_status(order_id, "demo_sent")
+                await bot.send_message(user_id, content)
 
-                                    # Если это черновик/предфинальная версия песни
+                logging.info(f"✅ Сюжеты отправлены как обычное сообщение пользователю {user_id}")
 
-                                    elif file_type == 'mp3' and order_status in ['paid', 'waiting_draft', 'editing', 'draft_sent', 'prefinal_sent']:
+                logging.info(f"🔍 Текущее состояние пользователя: {current_state}")
 
-                                        is_song_draft = True
+            
 
-                                        logging.info(f"🎵 Обнаружен черновик/предфинальная версия песни для заказа {order_id}")
+            await update_outbox_task_status(task_id, 'sent')
 
-                                    # Если это финальная версия песни
+            logging.info(f"✅ Сюжеты отправлены успешно")
 
-                                    elif file_type == 'mp3' and order_status in ['waiting_final', 'ready']:
+        except (TelegramRetryAfter, TelegramNetworkError):
+            raise
 
-                                        is_song_final = True
+        except Exception as e:
 
-                                        logging.info(f"🎼 Обнаружена финальная версия песни для заказа {order_id}")
+            logging.error(f"Ошибка отправки сюжетов {task_id}: {e}")
 
-                                    else:
+            await update_outbox_task_status(task_id, 'failed')
 
-                                        logging.info(f"❌ НЕ черновик/финал песни: product={product}, file_type={file_type}, status={order_status}")
+    elif type_ == 'file':
 
-                                        logging.info(f"🔍 Доступные статусы для песни: paid, waiting_draft, editing, draft_sent, prefinal_sent, waiting_final")
+        try:
 
-                                elif product == 'Книга':
+            file_type = (task.get('file_type') or '').lower()
 
-                                    # Определяем тип контента для книги
+            comment = task.get('comment') or ''
+            
+            # Проверяем, является ли это общим сообщением
+            is_general_message = task.get('is_general_message', 0) == 1
 
-                                    logging.info(f"📖 Обработка файла для книги: file_type={file_type}, status={order_status}")
+            logging.info(f"📤 Полученный тип файла в file: '{file_type}'")
+            logging.info(f"📤 Общее сообщение: {is_general_message}")
 
-                                    
+            # Если это общее сообщение, отправляем файл без кнопок
+            if is_general_message:
+                logging.info(f"📤 ОБЩЕЕ СООБЩЕНИЕ: Отправляем файл для задачи {task_id}")
+                logging.info(f"📤 Файл: {content}, Тип: {file_type}, Комментарий: {comment}")
+                
+                # Проверяем существование файла
+                if not os.path.exists(content):
+                    logging.error(f"❌ Файл не существует: {content}")
+                    await update_outbox_task_status(task_id, 'failed')
+                    return
+                
+                try:
+                    # Логируем размер файла перед отправкой
+                    file_size_mb = os.path.getsize(content) / (1024 * 1024)
+                    logging.info(f"📤 Размер файла перед отправкой: {file_size_mb:.2f} МБ")
+                    
+                    # Для общих сообщений отправляем файлы как нативные типы, но без кнопок
+                    input_file = FSInputFile(content)
+                    
+                    if file_type in ['image', 'jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp']:
+                        # Изображение - отправляем как фото
+                        logging.info(f"📤 Отправляем как ФОТО: {file_type}")
+                        await bot.send_photo(
+                            user_id, 
+                            input_file, 
+                            caption=comment if comment else None
+                        )
+                    elif file_type in ['video', 'mp4', 'avi', 'mov', 'mkv', 'webm']:
+                        # Видео - отправляем как видео
+                        logging.info(f"📤 Отправляем как ВИДЕО: {file_type}")
+                        await bot.send_video(
+                            user_id, 
+                            input_file, 
+                            caption=comment if comment else None
+                        )
+                    elif file_type in ['audio', 'mp3', 'wav', 'ogg', 'm4a', 'aac']:
+                        # Аудио - отправляем как аудио
+                        logging.info(f"📤 Отправляем как АУДИО: {file_type}")
+                        await bot.send_audio(
+                            user_id, 
+                            input_file, 
+                            caption=comment if comment else None
+                        )
+                    else:
+                        # Остальные файлы (PDF, документы) - как документы
+                        logging.info(f"📤 Отправляем как ДОКУМЕНТ: {file_type}")
+                        await bot.send_document(
+                            user_id, 
+                            input_file, 
+                            caption=comment if comment else None
+                        )
+                    
+                    # Помечаем задачу как отправленную
+                    await update_outbox_task_status(task_id, 'sent')
+                    logging.info(f"✅ Общее сообщение с файлом отправлено успешно")
+                    return
+                    
+                except (TelegramRetryAfter, TelegramNetworkError):
+                    raise
 
-                                    # Проверяем по статусу заказа
+                except Exception as send_error:
+                    error_msg = str(send_error)
+                    logging.error(f"❌ Ошибка отправки общего сообщения {task_id}: {error_msg}")
+                    await update_outbox_task_status(task_id, 'failed')
+                    return
 
-                                    if order_status in ['questions_completed', 'waiting_manager', 'demo_sent', 'demo_content']:
+            # Проверяем, является ли это черновиком или финальной версией песни
 
-                                        is_book_demo = True
+            order_id = task.get('order_id')
+            logging.info(f"📋 Получен order_id: {order_id} для задачи {task_id}")
+            
+            if not order_id:
+                logging.error(f"❌ Отсутствует order_id в задаче {task_id}")
+                await update_outbox_task_status(task_id, 'failed')
+                return
+            
+            # НЕ отправляем файл сразу! Сначала определим тип и добавим кнопки
 
-                                        logging.info(f"📖 Обнаружен демо-контент книги по статусу для заказа {order_id}")
+            is_song_draft = False
 
-                                        logging.info(f"📖 Статус заказа: {order_status}")
+            is_song_final = False
 
-                                        # Обновляем статус заказа
+            is_book_draft = False
 
-                                        await update_order_status(order_id, "demo_sent")
+            is_book_demo = False
 
-                                    elif order_status in ['waiting_draft', 'draft_sent', 'editing']:
+            is_song_demo = False
 
-                                        is_book_draft = True
+            
 
-                                        logging.info(f"📖 Обнаружен черновик книги по статусу для заказа {order_id}")
+            logging.info(f"🔍 ОТЛАДКА: Обрабатываем файл для заказа {order_id or 'неизвестно'}")
 
-                                        logging.info(f"📖 Продукт: {product}, Статус: {order_status}")
+            logging.info(f"📄 Тип файла: {file_type}, Комментарий: {comment}")
 
-                                    elif order_status == 'ready':
+            # Получаем данные заказа
+            from db import get_order
+            order = await get_order(order_id)
 
-                                        is_book_final = True
+            if order and order.get('order_data'):
 
-                                        logging.info(f"📚 Обнаружена финальная версия книги по статусу для заказа {order_id}")
+                import json
 
-                                        logging.info(f"📚 Продукт: {product}, Статус: {order_status}")
+                try:
 
-                                        logging.info(f"📚 Финальная версия книги - пропускаем повторную отправку")
+                    order_data = json.loads(order.get('order_data', '{}')) if order and order.get('order_data') else {}
 
-                                    # Проверяем по тексту комментария
+                    product = order_data.get('product', '')
 
-                                    elif 'демо-контент' in comment.lower() or 'примеры оформления' in comment.lower():
+                    order_status = order.get('status', '')
 
-                                        is_book_demo = True
+                    
 
-                                        logging.info(f"📖 Обнаружен демо-контент книги по комментарию для заказа {order_id}")
+                    logging.info(f"📊 Продукт: {product}, Статус заказа: {order_status}")
+                    
+                    logging.info(f"📋 ДЕТАЛЬНАЯ ОТЛАДКА для задачи {task_id}:")
+                    logging.info(f"📋 - Задача ID: {task_id}")
+                    logging.info(f"📋 - Заказ ID: {order_id}")
+                    logging.info(f"📋 - Продукт: '{product}'")
+                    logging.info(f"📋 - Статус заказа: '{order_status}'")
+                    logging.info(f"📋 - Тип файла: '{file_type}'")
+                    logging.info(f"📋 - Комментарий: '{comment}'")
 
-                                        # Обновляем статус заказа
+                    
 
-                                        await update_order_status(order_id, "demo_sent")
+                    if product == 'Песня':
 
-                                    elif 'черновик' in comment.lower() or 'внимательно просмотрите' in comment.lower():
+                        logging.info(f"🎵 Проверяем статус для песни: {order_status}, file_type: {file_type}")
 
-                                        is_book_draft = True
+                        # Если это демо-контент для песни (аудио или видео)
+                        if file_type in ['demo_audio', 'demo_video'] or order_status in ['waiting_manager', 'demo_content', 'questions_completed']:
+                            
+                            is_song_demo = True
+                            
+                            logging.info(f"🎵 Обнаружен демо-контент песни для заказа {order_id}")
+                            
+                            # Обновляем статус заказа
+                            await update_order_status(order_id, "demo_sent")
 
-                                        logging.info(f"📖 Обнаружен черновик книги по комментарию для заказа {order_id}")
+                        # Если это черновик/предфинальная версия песни
 
-                                    else:
+                        elif file_type == 'mp3' and order_status in ['paid', 'waiting_draft', 'editing', 'draft_sent', 'prefinal_sent']:
 
-                                        logging.info(f"📖 Обычная отправка файла для книги: file_type={file_type}, status={order_status}")
+                            is_song_draft = True
 
-                                else:
+                            logging.info(f"🎵 Обнаружен черновик/предфинальная версия песни для заказа {order_id}")
 
-                                    # Для других продуктов - обычная отправка файлов
+                        # Если это финальная версия песни
 
-                                    logging.info(f"📖 Обычная отправка файла для {product}: file_type={file_type}, status={order_status}")
+                        elif file_type == 'mp3' and order_status in ['waiting_final', 'ready']:
 
-                            except Exception as e:
+                            is_song_final = True
 
-                                logging.error(f"Ошибка проверки типа заказа: {e}")
+                            logging.info(f"🎼 Обнаружена финальная версия песни для заказа {order_id}")
 
                         else:
 
-                            logging.warning(f"⚠️ Заказ {order_id} не найден или нет данных")
-
-                        
-                        # ПРИНУДИТЕЛЬНАЯ ЛОГИКА ОПРЕДЕЛЕНИЯ ДЕМО-КОНТЕНТА
-                        # Проверяем по статусу заказа (ПРИОРИТЕТ #1)
-                        if order:
-                            try:
-                                order_data = json.loads(order.get('order_data', '{}')) if order.get('order_data') else {}
-                                product = order_data.get('product', '')
-                                order_status = order.get('status', '')
-                                
-                                # Если статус указывает на демо - это ТОЧНО демо
-                                if order_status in ['waiting_manager', 'demo_content', 'questions_completed']:
-                                    if product == 'Книга':
-                                        is_book_demo = True
-                                        logging.info(f"🔧 ПРИНУДИТЕЛЬНО: статус {order_status} -> is_book_demo=True")
-                                    elif product == 'Песня':
-                                        is_song_demo = True
-                                        logging.info(f"🔧 ПРИНУДИТЕЛЬНО: статус {order_status} -> is_song_demo=True")
-                                        
-                            except Exception as e:
-                                logging.error(f"❌ Ошибка определения демо по статусу: {e}")
-                        
-                        # Если в комментарии есть ключевые слова демо - это демо (ПРИОРИТЕТ #2)
-                        demo_keywords = ['демо', 'demo', 'пробные страницы', 'примеры оформления', 'образцы']
-                        if any(keyword in comment.lower() for keyword in demo_keywords):
-                            if order:
-                                try:
-                                    order_data = json.loads(order.get('order_data', '{}')) if order.get('order_data') else {}
-                                    product = order_data.get('product', '')
-                                    if product == 'Книга':
-                                        is_book_demo = True
-                                        logging.info(f"🔧 ПРИНУДИТЕЛЬНО: ключевые слова -> is_book_demo=True")
-                                    elif product == 'Песня':
-                                        is_song_demo = True
-                                        logging.info(f"🔧 ПРИНУДИТЕЛЬНО: ключевые слова -> is_song_demo=True")
-                                except Exception as e:
-                                    logging.error(f"❌ Ошибка определения демо по ключевым словам: {e}")
-                        
-                        # ПОСЛЕДНЯЯ ПОПЫТКА: если ничего не определилось, но есть файл - делаем демо
-                        if not any([is_song_draft, is_song_final, is_book_draft, is_book_demo, is_song_demo]):
-                            if order:
-                                try:
-                                    order_data = json.loads(order.get('order_data', '{}')) if order.get('order_data') else {}
-                                    product = order_data.get('product', '')
-                                    # Если есть файл и продукт, но тип не определился - делаем демо
-                                    if product == 'Книга' and file_type in ['jpg', 'jpeg', 'png', 'pdf']:
-                                        is_book_demo = True
-                                        logging.info(f"🔧 РЕЗЕРВНАЯ ЛОГИКА: файл {file_type} для книги -> is_book_demo=True")
-                                    elif product == 'Песня' and file_type in ['mp3', 'wav', 'demo_audio', 'demo_video']:
-                                        is_song_demo = True
-                                        logging.info(f"🔧 РЕЗЕРВНАЯ ЛОГИКА: файл {file_type} для песни -> is_song_demo=True")
-                                except Exception as e:
-                                    logging.error(f"❌ Ошибка резервной логики: {e}")
-                        
-                        # Логируем финальные результаты определения типов
-                        logging.info(f"📋 РЕЗУЛЬТАТЫ ОПРЕДЕЛЕНИЯ ТИПОВ для задачи {task_id}:")
-                        logging.info(f"📋 - is_song_draft: {is_song_draft}")
-                        logging.info(f"📋 - is_song_final: {is_song_final}")
-                        logging.info(f"📋 - is_book_draft: {is_book_draft}")
-                        logging.info(f"📋 - is_book_demo: {is_book_demo}")
-                        logging.info(f"📋 - is_song_demo: {is_song_demo}")
-
-                        # Проверяем существование и размер файла перед отправкой
-                        if not os.path.exists(content):
-                            logging.error(f"❌ Файл не существует: {content}")
-                            if safe_task_id != 'неизвестно':
-                                await update_outbox_task_status(safe_task_id, 'failed')
-                            continue
-                        
-                        # Логируем размер файла, но не блокируем отправку
-                        try:
-                            file_size_mb = os.path.getsize(content) / (1024 * 1024)
-                            logging.info(f"📄 Отправляем файл {content} размером {file_size_mb:.1f}MB")
-                        except Exception as e:
-                            logging.error(f"❌ Ошибка получения размера файла {content}: {e}")
-
-                        # Обычная обработка файлов
+                            logging.info(f"❌ НЕ черновик/финал песни: product={product}, file_type={file_type}, status={order_status}")
 
-                        if file_type == 'pdf':
+                            logging.info(f"🔍 Доступные статусы для песни: paid, waiting_draft, editing, draft_sent, prefinal_sent, waiting_final")
 
-                            input_file = FSInputFile(content)
-                            
-                            logging.info(f"🔍 ОТЛАДКА PDF: is_book_draft={is_book_draft}, comment='{comment}', order_id={order_id}")
-
-                            
+                    elif product == 'Книга':
 
-                            # Проверяем, является ли это черновиком книги
+                        # Определяем тип контента для книги
 
-                            if is_book_draft:
+                        logging.info(f"📖 Обработка файла для книги: file_type={file_type}, status={order_status}")
 
-                                # Для черновика книги добавляем кнопки
+                        
 
-                                keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                        # Проверяем по статусу заказа
 
-                                    [InlineKeyboardButton(text="Все супер", callback_data="book_draft_ok")],
+                        if order_status in ['questions_completed', 'waiting_manager', 'demo_sent', 'demo_content']:
 
-                                    [InlineKeyboardButton(text="Внести правки", callback_data="book_draft_edit")]
+                            is_book_demo = True
 
-                                ])
+                            logging.info(f"📖 Обнаружен демо-контент книги по статусу для заказа {order_id}")
 
-                                
+                            logging.info(f"📖 Статус заказа: {order_status}")
 
-                                # Добавляем дополнительный текст для черновика книги
+                            # Обновляем статус заказа
 
-                                # Получаем сообщение из базы данных
-                                from bot_messages_cache import get_book_final_version
-                                additional_text = "\n\n" + await get_book_final_version()
+                            await update_order_status(order_id, "demo_sent")
 
-                                full_caption = comment + additional_text
+                        elif order_status in ['waiting_draft', 'draft_sent', 'editing']:
 
-                                
+                            is_book_draft = True
 
-                                try:
-                                    await bot.send_document(user_id, input_file, caption=full_caption, reply_markup=keyboard)
-
-                                    # Обновляем статус заказа ТОЛЬКО если это действительно черновик
-                                    if any(keyword in comment.lower() for keyword in ['черновик', 'внимательно просмотрите', 'готов', 'готово']):
-                                        await update_order_status(order_id, "draft_sent")
-                                        logging.info(f"📋 Статус заказа {order_id} изменен на draft_sent")
-                                    else:
-                                        logging.info(f"📋 Файл отправлен без изменения статуса (не черновик)")
-                                    
-                                    # Помечаем задачу как отправленную
-                                    await update_outbox_task_status(task_id, 'sent')
-                                    logging.info(f"✅ Черновик книги отправлен с кнопками успешно")
-                                    
-                                except Exception as send_error:
-                                    error_msg = str(send_error)
-                                    logging.error(f"❌ Ошибка отправки черновика {task_id}: {error_msg}")
-                                    
-                                    # Увеличиваем счетчик попыток
-                                    await increment_outbox_retry_count(task_id)
-                                    current_retry_count = task.get('retry_count', 0) + 1
-                                    max_retries = task.get('max_retries', 5)
-                                    
-                                    # Проверяем тип ошибки для принятия решения о повторе
-                                    if any(err in error_msg.lower() for err in ['timeout', 'too many requests', 'network', 'connection', 'read timeout']):
-                                        # Временные ошибки - проверяем лимит попыток
-                                        if current_retry_count >= max_retries:
-                                            logging.error(f"❌ Превышен лимит попыток ({max_retries}) для задачи {task_id}")
-                                            await update_outbox_task_status(task_id, 'failed')
-                                        else:
-                                            logging.info(f"🔄 Временная ошибка для задачи {task_id}, попытка {current_retry_count}/{max_retries}")
-                                            await update_outbox_task_status(task_id, 'pending')
-                                    elif "file size" in error_msg.lower() or "too large" in error_msg.lower():
-                                        # Ошибки размера файла - логируем но не блокируем
-                                        logging.warning(f"⚠️ Возможна проблема с размером файла для задачи {task_id}")
-                                        await update_outbox_task_status(task_id, 'failed')
-                                    elif "forbidden" in error_msg.lower() or "blocked" in error_msg.lower():
-                                        # Пользователь заблокировал бота
-                                        logging.error(f"❌ Пользователь {user_id} заблокировал бота")
-                                        await update_outbox_task_status(task_id, 'failed')
-                                    else:
-                                        # Неизвестные ошибки - проверяем лимит попыток
-                                        if current_retry_count >= max_retries:
-                                            logging.error(f"❌ Превышен лимит попыток ({max_retries}) для неизвестной ошибки задачи {task_id}")
-                                            await update_outbox_task_status(task_id, 'failed')
-                                        else:
-                                            logging.info(f"🔄 Неизвестная ошибка для задачи {task_id}, попытка {current_retry_count}/{max_retries}")
-                                            await update_outbox_task_status(task_id, 'pending')
-                                    
-                                    continue
+                            logging.info(f"📖 Обнаружен черновик книги по статусу для заказа {order_id}")
 
-                            else:
+                            logging.info(f"📖 Продукт: {product}, Статус: {order_status}")
 
-                                # Обычная отправка PDF без кнопок
-                                logging.info(f"📄 Отправляем обычный PDF (не черновик) пользователю {user_id}")
+                        elif order_status == 'ready':
 
-                                try:
-                                    await bot.send_document(user_id, input_file, caption=comment)
-                                    logging.info(f"✅ PDF отправлен успешно пользователю {user_id}")
-                                    
-                                    # Помечаем задачу как отправленную
-                                    await update_outbox_task_status(task_id, 'sent')
-                                    
-                                except Exception as pdf_error:
-                                    logging.error(f"❌ Ошибка отправки обычного PDF {task_id}: {pdf_error}")
-                                    await update_outbox_task_status(task_id, 'failed')
+                            is_book_final = True
 
-                        elif file_type == 'mp3':
+                            logging.info(f"📚 Обнаружена финальная версия книги по статусу для заказа {order_id}")
 
-                            input_file = FSInputFile(content)
+                            logging.info(f"📚 Продукт: {product}, Статус: {order_status}")
 
-                            
+                            logging.info(f"📚 Финальная версия книги - пропускаем повторную отправку")
 
-                            # Если это финальная версия песни (Глава 2.12)
+                        # Проверяем по тексту комментария
 
-                            if is_song_final:
+                        elif 'демо-контент' in comment.lower() or 'примеры оформления' in comment.lower():
 
-                                # Глава 2.12. Доставка финальной песни
+                            is_book_demo = True
 
-                                # НЕ отправляем аудиофайл повторно - он уже был отправлен менеджером
+                            logging.info(f"📖 Обнаружен демо-контент книги по комментарию для заказа {order_id}")
 
-                                logging.info(f"🎼 Финальная версия песни уже отправлена менеджером, пропускаем повторную отправку")
+                            # Обновляем статус заказа
 
-                            
+                            await update_order_status(order_id, "demo_sent")
 
-                                await bot.send_message(user_id, "🎵 Ваша песня готова! Как вам? Надеемся, она вызовет сильные эмоции 💖")
+                        elif 'черновик' in comment.lower() or 'внимательно просмотрите' in comment.lower():
 
-                                
+                            is_book_draft = True
 
-                                # Отправляем прогревочные сообщения для книги сразу
+                            logging.info(f"📖 Обнаружен черновик книги по комментарию для заказа {order_id}")
 
-                                from bot_messages_cache import get_song_thank_you
-                                song_thank_you_text = await get_song_thank_you()
-                                await bot.send_message(user_id, song_thank_you_text)
+                        else:
 
-                                
+                            logging.info(f"📖 Обычная отправка файла для книги: file_type={file_type}, status={order_status}")
 
-                                # Отправляем предложение с кнопками
+                    else:
 
-                                keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                        # Для других продуктов - обычная отправка файлов
 
-                                    [InlineKeyboardButton(text="Создать пробную книгу", callback_data="create_book_after_song")],
+                        logging.info(f"📖 Обычная отправка файла для {product}: file_type={file_type}, status={order_status}")
 
-                                    [InlineKeyboardButton(text="Вернусь к вам чуть позже ❤️", callback_data="finish_song_order")]
+                except Exception as e:
 
-                                ])
+                    logging.error(f"Ошибка проверки типа заказа: {e}")
 
-                                
+            else:
 
-                                from bot_messages_cache import get_song_book_upsell
-                                song_book_upsell_text = await get_song_book_upsell()
-                                
-                                await bot.send_message(
-                                    user_id,
-                                    song_book_upsell_text,
-                                    reply_markup=keyboard
-                                )
+                logging.warning(f"⚠️ Заказ {order_id} не найден или нет данных")
 
+            
+            # ПРИНУДИТЕЛЬНАЯ ЛОГИКА ОПРЕДЕЛЕНИЯ ДЕМО-КОНТЕНТА
+            # Проверяем по статусу заказа (ПРИОРИТЕТ #1)
+            if order:
+                try:
+                    order_data = json.loads(order.get('order_data', '{}')) if order.get('order_data') else {}
+                    product = order_data.get('product', '')
+                    order_status = order.get('status', '')
+                    
+                    # Если статус указывает на демо - это ТОЧНО демо
+                    if order_status in ['waiting_manager', 'demo_content', 'questions_completed']:
+                        if product == 'Книга':
+                            is_book_demo = True
+                            logging.info(f"🔧 ПРИНУДИТЕЛЬНО: статус {order_status} -> is_book_demo=True")
+                        elif product == 'Песня':
+                            is_song_demo = True
+                            logging.info(f"🔧 ПРИНУДИТЕЛЬНО: статус {order_status} -> is_song_demo=True")
                             
+                except Exception as e:
+                    logging.error(f"❌ Ошибка определения демо по статусу: {e}")
+            
+            # Если в комментарии есть ключевые слова демо - это демо (ПРИОРИТЕТ #2)
+            demo_keywords = ['демо', 'demo', 'пробные страницы', 'примеры оформления', 'образцы']
+            if any(keyword in comment.lower() for keyword in demo_keywords):
+                if order:
+                    try:
+                        order_data = json.loads(order.get('order_data', '{}')) if order.get('order_data') else {}
+                        product = order_data.get('product', '')
+                        if product == 'Книга':
+                            is_book_demo = True
+                            logging.info(f"🔧 ПРИНУДИТЕЛЬНО: ключевые слова -> is_book_demo=True")
+                        elif product == 'Песня':
+                            is_song_demo = True
+                            logging.info(f"🔧 ПРИНУДИТЕЛЬНО: ключевые слова -> is_song_demo=True")
+                    except Exception as e:
+                        logging.error(f"❌ Ошибка определения демо по ключевым словам: {e}")
+            
+            # ПОСЛЕДНЯЯ ПОПЫТКА: если ничего не определилось, но есть файл - делаем демо
+            if not any([is_song_draft, is_song_final, is_book_draft, is_book_demo, is_song_demo]):
+                if order:
+                    try:
+                        order_data = json.loads(order.get('order_data', '{}')) if order.get('order_data') else {}
+                        product = order_data.get('product', '')
+                        # Если есть файл и продукт, но тип не определился - делаем демо
+                        if product == 'Книга' and file_type in ['jpg', 'jpeg', 'png', 'pdf']:
+                            is_book_demo = True
+                            logging.info(f"🔧 РЕЗЕРВНАЯ ЛОГИКА: файл {file_type} для книги -> is_book_demo=True")
+                        elif product == 'Песня' and file_type in ['mp3', 'wav', 'demo_audio', 'demo_video']:
+                            is_song_demo = True
+                            logging.info(f"🔧 РЕЗЕРВНАЯ ЛОГИКА: файл {file_type} для песни -> is_song_demo=True")
+                    except Exception as e:
+                        logging.error(f"❌ Ошибка резервной логики: {e}")
+            
+            # Логируем финальные результаты определения типов
+            logging.info(f"📋 РЕЗУЛЬТАТЫ ОПРЕДЕЛЕНИЯ ТИПОВ для задачи {task_id}:")
+            logging.info(f"📋 - is_song_draft: {is_song_draft}")
+            logging.info(f"📋 - is_song_final: {is_song_final}")
+            logging.info(f"📋 - is_book_draft: {is_book_draft}")
+            logging.info(f"📋 - is_book_demo: {is_book_demo}")
+            logging.info(f"📋 - is_song_demo: {is_song_demo}")
+
+            # Проверяем существование и размер файла перед отправкой
+            if not os.path.exists(content):
+                logging.error(f"❌ Файл не существует: {content}")
+                await update_outbox_task_status(task_id, 'failed')
+                return
+            
+            # Логируем размер файла, но не блокируем отправку
+            try:
+                file_size_mb = os.path.getsize(content) / (1024 * 1024)
+                logging.info(f"📄 Отправляем файл {content} размером {file_size_mb:.1f}MB")
+            except Exception as e:
+                logging.error(f"❌ Ошибка получения размера файла {content}: {e}")
 
-                                # Обновляем состояние пользователя в хранилище
-
-                                try:
-
-                                    from aiogram.fsm.storage.base import StorageKey
-
-                                    storage_key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
-
-                                    await storage.set_state(key=storage_key, state=SongFinalStates.final_received)
-
-                                    
-
-                                    # Также сохраняем order_id в данных состояния
-
-                                    await storage.set_data(key=storage_key, data={"order_id": order_id})
-
-                                    
-
-                                    logging.info(f"🔄 Состояние пользователя {user_id} изменено на SongFinalStates.final_received")
+            # Обычная обработка файлов
 
-                                except Exception as e:
+            if file_type == 'pdf':
 
-                                    logging.error(f"Ошибка обновления состояния: {e}")
+                input_file = FSInputFile(content)
+                
+                logging.info(f"🔍 ОТЛАДКА PDF: is_book_draft={is_book_draft}, comment='{comment}', order_id={order_id}")
 
-                                
+                
 
-                                # Обновляем статус заказа
+                # Проверяем, является ли это черновиком книги
 
-                                await update_order_status(order_id, "ready")
+                if is_book_draft:
 
-                                logging.info(f"📋 Статус заказа {order_id} изменен на ready")
+                    # Для черновика книги добавляем кнопки
 
-                                
+                    keyboard = InlineKeyboardMarkup(inline_keyboard=[
 
-                                # Удаляем задачу из outbox после успешной отправки
+                        [InlineKeyboardButton(text="Все супер", callback_data="book_draft_ok")],
 
-                                await update_outbox_task_status(task_id, 'sent')
+                        [InlineKeyboardButton(text="Внести правки", callback_data="book_draft_edit")]
 
-                                logging.info(f"✅ Финальная версия песни отправлена успешно, задача {task_id} удалена из outbox")
+                    ])
 
-                                logging.info(f"🔍 Задача {task_id} помечена как 'sent' в базе данных")
+                    
 
-                            
+                    # Добавляем дополнительный текст для черновика книги
 
-                            # Если это черновик/предфинальная версия песни, добавляем кнопки
+                    # Получаем сообщение из базы данных
+                    from bot_messages_cache import get_book_final_version
+                    additional_text = "\n\n" + await get_book_final_version()
 
-                            elif is_song_draft:
+                    full_caption = comment + additional_text
 
-                                logging.info(f"🔘 Статус заказа: {order_status}")
+                    
 
-                                
+                    try:
+                        await bot.send_document(user_id, input_file, caption=full_caption, reply_markup=keyboard)
 
-                                from bot_messages_cache import get_song_final_version
-                                message_text = await get_song_final_version()
+                        # Обновляем статус заказа ТОЛЬКО если это действительно черновик
+                        if any(keyword in comment.lower() for keyword in ['черновик', 'внимательно просмотрите', 'готов', 'готово']):
+                            await update_order_status(order_id, "draft_sent")
+                            logging.info(f"📋 Статус заказа {order_id} изменен на draft_sent")
+                        else:
+                            logging.info(f"📋 Файл отправлен без изменения статуса (не черновик)")
+                        
+                        # Помечаем задачу как отправленную
+                        await update_outbox_task_status(task_id, 'sent')
+                        logging.info(f"✅ Черновик книги отправлен с кнопками успешно")
+                        
+                    except (TelegramRetryAfter, TelegramNetworkError):
+                        raise
 
-                                button_text = "Все нравится, отличная песня"
+                    except Exception as send_error:
+                        error_msg = str(send_error)
+                        logging.error(f"❌ Ошибка отправки черновика {task_id}: {error_msg}")
+                        
+                        # Увеличиваем счетчик попыток
+                        await increment_outbox_retry_count(task_id)
+                        current_retry_count = task.get('retry_count', 0) + 1
+                        max_retries = task.get('max_retries', 5)
+                        
+                        # Проверяем тип ошибки для принятия решения о повторе
+                        if any(err in error_msg.lower() for err in ['timeout', 'too many requests', 'network', 'connection', 'read timeout']):
+                            # Временные ошибки - проверяем лимит попыток
+                            if current_retry_count >= max_retries:
+                                logging.error(f"❌ Превышен лимит попыток ({max_retries}) для задачи {task_id}")
+                                await update_outbox_task_status(task_id, 'failed')
+                            else:
+                                logging.info(f"🔄 Временная ошибка для задачи {task_id}, попытка {current_retry_count}/{max_retries}")
+                                await update_outbox_task_status(task_id, 'pending')
+                        elif "file size" in error_msg.lower() or "too large" in error_msg.lower():
+                            # Ошибки размера файла - логируем но не блокируем
+                            logging.warning(f"⚠️ Возможна проблема с размером файла для задачи {task_id}")
+                            await update_outbox_task_status(task_id, 'failed')
+                        elif "forbidden" in error_msg.lower() or "blocked" in error_msg.lower():
+                            # Пользователь заблокировал бота
+                            logging.error(f"❌ Пользователь {user_id} заблокировал бота")
+                            await update_outbox_task_status(task_id, 'failed')
+                        else:
+                            # Неизвестные ошибки - проверяем лимит попыток
+                            if current_retry_count >= max_retries:
+                                logging.error(f"❌ Превышен лимит попыток ({max_retries}) для неизвестной ошибки задачи {task_id}")
+                                await update_outbox_task_status(task_id, 'failed')
+                            else:
+                                logging.info(f"🔄 Неизвестная ошибка для задачи {task_id}, попытка {current_retry_count}/{max_retries}")
+                                await update_outbox_task_status(task_id, 'pending')
+                        
+                        return
 
-                                logging.info(f"🔘 Создаю кнопки для черновика/предфинальной версии: {button_text}")
+                else:
 
-                                
+                    # Обычная отправка PDF без кнопок
+                    logging.info(f"📄 Отправляем обычный PDF (не черновик) пользователю {user_id}")
 
-                                keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                    try:
+                        await bot.send_document(user_id, input_file, caption=comment)
+                        logging.info(f"✅ PDF отправлен успешно пользователю {user_id}")
+                        
+                        # Помечаем задачу как отправленную
+                        await update_outbox_task_status(task_id, 'sent')
+                        
+                    except (TelegramRetryAfter, TelegramNetworkError):
+                        raise
 
-                                    [InlineKeyboardButton(text=button_text, callback_data="song_draft_ok")],
+                    except Exception as pdf_error:
+                        logging.error(f"❌ Ошибка отправки обычного PDF {task_id}: {pdf_error}")
+                        await update_outbox_task_status(task_id, 'failed')
 
-                                    [InlineKeyboardButton(text="Обратная связь", callback_data="song_draft_edit")]
+            elif file_type == 'mp3':
 
-                                ])
+                input_file = FSInputFile(content)
 
-                                await bot.send_audio(user_id, input_file, caption=message_text, reply_markup=keyboard)
+                
 
-                                
+                # Если это финальная версия песни (Глава 2.12)
 
-                                # Обновляем состояние пользователя в хранилище
+                if is_song_final:
 
-                                try:
+                    # Глава 2.12. Доставка финальной песни
 
-                                    from aiogram.fsm.storage.base import StorageKey
+                    # НЕ отправляем аудиофайл повторно - он уже был отправлен менеджером
 
-                                    storage_key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
+                    logging.info(f"🎼 Финальная версия песни уже отправлена менеджером, пропускаем повторную отправку")
 
-                                    await storage.set_state(key=storage_key, state=SongDraftStates.draft_received)
+                
 
-                                    
+                    await bot.send_message(user_id, "🎵 Ваша песня готова! Как вам? Надеемся, она вызовет сильные эмоции 💖")
 
-                                    # Также сохраняем order_id в данных состояния
+                    
 
-                                    await storage.set_data(key=storage_key, data={"order_id": order_id})
+                    # Отправляем прогревочные сообщения для книги сразу
 
-                                    
+                    from bot_messages_cache import get_song_thank_you
+                    song_thank_you_text = await get_song_thank_you()
+                    await bot.send_message(user_id, song_thank_you_text)
 
-                                    logging.info(f"🔄 Состояние пользователя {user_id} изменено на SongDraftStates.draft_received")
+                    
 
-                                except Exception as e:
+                    # Отправляем предложение с кнопками
 
-                                    logging.error(f"Ошибка обновления состояния: {e}")
+                    keyboard = InlineKeyboardMarkup(inline_keyboard=[
 
-                                
+                        [InlineKeyboardButton(text="Создать пробную книгу", callback_data="create_book_after_song")],
 
-                                logging.info(f"✅ Черновик песни отправлен с кнопками успешно")
+                        [InlineKeyboardButton(text="Вернусь к вам чуть позже ❤️", callback_data="finish_song_order")]
 
-                                
+                    ])
 
-                                # Удаляем задачу из outbox после отправки аудиофайла
+                    
 
-                                await update_outbox_task_status(task_id, 'sent')
+                    from bot_messages_cache import get_song_book_upsell
+                    song_book_upsell_text = await get_song_book_upsell()
+                    
+                    await bot.send_message(
+                        user_id,
+                        song_book_upsell_text,
+                        reply_markup=keyboard
+                    )
 
-                                logging.info(f"✅ Черновик песни отправлен, задача {task_id} удалена из outbox")
+                
 
-                            else:
+                    # Обновляем состояние пользователя в хранилище
 
-                                await bot.send_audio(user_id, input_file)
+                    try:
 
-                                
+                        from aiogram.fsm.storage.base import StorageKey
 
-                                # Обновляем статус заказа ТОЛЬКО если это действительно черновик
+                        storage_key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
 
-                                # Проверяем, что комментарий содержит ключевые слова черновика
+                        await storage.set_state(key=storage_key, state=SongFinalStates.final_received)
 
-                                if any(keyword in comment.lower() for keyword in ['черновик', 'пробная версия', 'предфинальная', 'готов', 'готово']):
+                        
 
-                                    await update_order_status(order_id, "draft_sent")
+                        # Также сохраняем order_id в данных состояния
 
-                                    logging.info(f"📋 Статус заказа {order_id} изменен на draft_sent")
+                        await storage.set_data(key=storage_key, data={"order_id": order_id})
 
-                                else:
+                        
 
-                                    logging.info(f"📋 MP3 файл отправлен без изменения статуса (не черновик)")
+                        logging.info(f"🔄 Состояние пользователя {user_id} изменено на SongFinalStates.final_received")
 
-                                
+                    except Exception as e:
 
-                                # Удаляем задачу из outbox после отправки аудиофайла
+                        logging.error(f"Ошибка обновления состояния: {e}")
 
-                                await update_outbox_task_status(task_id, 'sent')
+                    
 
-                                logging.info(f"✅ MP3 файл отправлен, задача {task_id} удалена из outbox")
+                    # Обновляем статус заказа
 
-                        elif file_type in ['jpg', 'jpeg', 'png', 'image']:
+                    await update_order_status(order_id, "ready")
 
-                            try:
+                    logging.info(f"📋 Статус заказа {order_id} изменен на ready")
 
-                                input_file = FSInputFile(content)
+                    
 
-                                
+                    # Удаляем задачу из outbox после успешной отправки
 
-                                # Проверяем, является ли это черновиком книги
+                    await update_outbox_task_status(task_id, 'sent')
 
-                                if is_book_draft:
+                    logging.info(f"✅ Финальная версия песни отправлена успешно, задача {task_id} удалена из outbox")
 
-                                    # Для черновика книги добавляем кнопки
+                    logging.info(f"🔍 Задача {task_id} помечена как 'sent' в базе данных")
 
-                                    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                
 
-                                        [InlineKeyboardButton(text="Все супер", callback_data="book_draft_ok")],
+                # Если это черновик/предфинальная версия песни, добавляем кнопки
 
-                                        [InlineKeyboardButton(text="Внести правки", callback_data="book_draft_edit")]
+                elif is_song_draft:
 
-                                    ])
+                    logging.info(f"🔘 Статус заказа: {order_status}")
 
-                                    
+                    
 
-                                    # Добавляем дополнительный текст для черновика книги
+                    from bot_messages_cache import get_song_final_version
+                    message_text = await get_song_final_version()
 
-                                    # Получаем сообщение из базы данных
-                                    from bot_messages_cache import get_book_final_version
-                                    additional_text = "\n\n" + await get_book_final_version()
+                    button_text = "Все нравится, отличная песня"
 
-                                    full_caption = comment + additional_text
+                    logging.info(f"🔘 Создаю кнопки для черновика/предфинальной версии: {button_text}")
 
-                                    
+                    
 
-                                    await bot.send_photo(user_id, input_file, caption=full_caption, reply_markup=keyboard)
+                    keyboard = InlineKeyboardMarkup(inline_keyboard=[
 
-                                    
+                        [InlineKeyboardButton(text=button_text, callback_data="song_draft_ok")],
 
-                                    # Обновляем статус заказа ТОЛЬКО если это действительно черновик
+                        [InlineKeyboardButton(text="Обратная связь", callback_data="song_draft_edit")]
 
-                                    # Проверяем, что комментарий содержит ключевые слова черновика
+                    ])
 
-                                    if any(keyword in comment.lower() for keyword in ['черновик', 'внимательно просмотрите', 'готов', 'готово']):
+                    await bot.send_audio(user_id, input_file, caption=message_text, reply_markup=keyboard)
 
-                                        await update_order_status(order_id, "draft_sent")
+                    
 
-                                        logging.info(f"📋 Статус заказа {order_id} изменен на draft_sent")
+                    # Обновляем состояние пользователя в хранилище
 
-                                    else:
+                    try:
 
-                                        logging.info(f"📋 Изображение отправлено без изменения статуса (не черновик)")
+                        from aiogram.fsm.storage.base import StorageKey
 
-                                    
+                        storage_key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
 
-                                    # Помечаем задачу как отправленную
+                        await storage.set_state(key=storage_key, state=SongDraftStates.draft_received)
 
-                                    await update_outbox_task_status(task_id, 'sent')
+                        
 
-                                    logging.info(f"✅ Черновик книги отправлен с кнопками успешно")
+                        # Также сохраняем order_id в данных состояния
 
-                                else:
+                        await storage.set_data(key=storage_key, data={"order_id": order_id})
 
-                                    # Обычная отправка фото без кнопок
+                        
 
-                                    await bot.send_photo(user_id, input_file, caption=comment)
+                        logging.info(f"🔄 Состояние пользователя {user_id} изменено на SongDraftStates.draft_received")
 
-                                    # Помечаем задачу как отправленную
+                    except Exception as e:
 
-                                    await update_outbox_task_status(task_id, 'sent')
+                        logging.error(f"Ошибка обновления состояния: {e}")
 
-                            except Exception as e:
+                    
 
-                                logging.error(f"Ошибка отправки изображения {task_id}: {e}")
+                    logging.info(f"✅ Черновик песни отправлен с кнопками успешно")
 
-                                await update_outbox_task_status(task_id, 'failed')
+                    
 
-                        elif file_type in ['gif', 'mov', 'mp4', 'avi', 'mkv', 'webm'] or file_type == 'video':
+                    # Удаляем задачу из outbox после отправки аудиофайла
 
-                            try:
+                    await update_outbox_task_status(task_id, 'sent')
 
-                                input_file = FSInputFile(content)
+                    logging.info(f"✅ Черновик песни отправлен, задача {task_id} удалена из outbox")
 
-                                logging.info(f"🎬 Отправляю видео файл: file_type='{file_type}', user_id={user_id}")
+                else:
 
-                                
+                    await bot.send_audio(user_id, input_file)
 
-                                # Отправляем анимацию/видео
+                    
 
-                                if file_type == 'gif':
+                    # Обновляем статус заказа ТОЛЬКО если это действительно черновик
 
-                                    # GIF отправляем как анимацию
+                    # Проверяем, что комментарий содержит ключевые слова черновика
 
-                                    await bot.send_animation(user_id, input_file, caption=comment)
+                    if any(keyword in comment.lower() for keyword in ['черновик', 'пробная версия', 'предфинальная', 'готов', 'готово']):
 
-                                    logging.info(f"🎬 GIF анимация отправлена пользователю {user_id}")
+                        await update_order_status(order_id, "draft_sent")
 
-                                else:
+                        logging.info(f"📋 Статус заказа {order_id} изменен на draft_sent")
 
-                                    # Видео файлы отправляем как видео
-
-                                    # Проверяем, является ли это черновиком книги
-                                    if is_book_draft:
-                                        # Для черновика книги добавляем кнопки
-                                        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                                            [InlineKeyboardButton(text="Все супер", callback_data="book_draft_ok")],
-                                            [InlineKeyboardButton(text="Внести правки", callback_data="book_draft_edit")]
-                                        ])
-                                        
-                                        # Добавляем дополнительный текст для черновика книги
-                                        # Получаем сообщение из базы данных
-                                        from bot_messages_cache import get_book_final_version
-                                        additional_text = "\n\n" + await get_book_final_version()
-                                        
-                                        full_caption = comment + additional_text
-                                        
-                                        await bot.send_video(user_id, input_file, caption=full_caption, reply_markup=keyboard)
-                                        
-                                        # Обновляем статус заказа ТОЛЬКО если это действительно черновик
-                                        if any(keyword in comment.lower() for keyword in ['черновик', 'внимательно просмотрите', 'готов', 'готово']):
-                                            await update_order_status(order_id, "draft_sent")
-                                            logging.info(f"📋 Статус заказа {order_id} изменен на draft_sent")
-                                        
-                                        logging.info(f"✅ Черновик книги (видео) отправлен с кнопками успешно")
-                                    else:
-                                        # Обычная отправка видео
-                                        await bot.send_video(user_id, input_file, caption=comment)
-                                    logging.info(f"🎬 Видео файл ({file_type}) отправлен пользователю {user_id}")
-
-                                await update_outbox_task_status(task_id, 'sent')
+                    else:
 
-                            except Exception as e:
+                        logging.info(f"📋 MP3 файл отправлен без изменения статуса (не черновик)")
 
-                                logging.error(f"Ошибка отправки видео {task_id}: {e}")
+                    
 
-                                await update_outbox_task_status(task_id, 'failed')
+                    # Удаляем задачу из outbox после отправки аудиофайла
 
-                        else:
+                    await update_outbox_task_status(task_id, 'sent')
 
-                            try:
+                    logging.info(f"✅ MP3 файл отправлен, задача {task_id} удалена из outbox")
 
-                                input_file = FSInputFile(content)
+            elif file_type in ['jpg', 'jpeg', 'png', 'image']:
 
-                                logging.info(f"📄 Отправляю как документ: file_type='{file_type}', user_id={user_id}")
+                try:
 
-                                await bot.send_document(user_id, input_file, caption=comment)
+                    input_file = FSInputFile(content)
 
-                                await update_outbox_task_status(task_id, 'sent')
+                    
 
-                            except Exception as e:
+                    # Проверяем, является ли это черновиком книги
 
-                                logging.error(f"Ошибка отправки документа {task_id}: {e}")
+                    if is_book_draft:
 
-                        await update_outbox_task_status(task_id, 'failed')
+                        # Для черновика книги добавляем кнопки
 
-                    except Exception as e:
-                        logging.error(f"Ошибка отправки файла {task_id}: {e}")
-                        await update_outbox_task_status(task_id, 'failed')
+                        keyboard = InlineKeyboardMarkup(inline_keyboard=[
 
-                elif type_ == 'multiple_images_with_text_and_button':
+                            [InlineKeyboardButton(text="Все супер", callback_data="book_draft_ok")],
 
-                    try:
+                            [InlineKeyboardButton(text="Внести правки", callback_data="book_draft_edit")]
 
-                        # Отправляем несколько файлов с текстом и кнопкой одним сообщением
+                        ])
 
-                        file_type = (task.get('file_type') or '').lower()
+                        
 
-                        text = task.get('comment') or ''
+                        # Добавляем дополнительный текст для черновика книги
 
-                        button_text = task.get('button_text') or 'Продолжить'
+                        # Получаем сообщение из базы данных
+                        from bot_messages_cache import get_book_final_version
+                        additional_text = "\n\n" + await get_book_final_version()
 
-                        button_callback = task.get('button_callback') or 'continue_creation'
+                        full_caption = comment + additional_text
 
-                        # Получаем order_id из задачи
-                        order_id = task.get('order_id')
                         
-                        if not order_id:
-                            logging.error(f"❌ Отсутствует order_id в задаче multiple_images_with_text_and_button {task_id}")
-                            await update_outbox_task_status(task_id, 'failed')
-                            continue
 
-                        logging.info(f"🔘 Обрабатываю outbox задание типа 'multiple_images_with_text_and_button'")
-
-                        logging.info(f"🔘 Task data: {task}")
+                        await bot.send_photo(user_id, input_file, caption=full_caption, reply_markup=keyboard)
 
                         
 
-                        # Парсим список файлов из JSON
-
-                        import json
+                        # Обновляем статус заказа ТОЛЬКО если это действительно черновик
 
-                        try:
-
-                            file_paths = json.loads(content)
-
-                            if not isinstance(file_paths, list):
+                        # Проверяем, что комментарий содержит ключевые слова черновика
 
-                                file_paths = [content]  # Fallback для одного файла
+                        if any(keyword in comment.lower() for keyword in ['черновик', 'внимательно просмотрите', 'готов', 'готово']):
 
-                        except (json.JSONDecodeError, TypeError):
+                            await update_order_status(order_id, "draft_sent")
 
-                            file_paths = [content]  # Fallback для одного файла
+                            logging.info(f"📋 Статус заказа {order_id} изменен на draft_sent")
 
-                        
+                        else:
 
-                        logging.info(f"🔘 Отправляю {len(file_paths)} файлов одним сообщением")
+                            logging.info(f"📋 Изображение отправлено без изменения статуса (не черновик)")
 
                         
 
-                        # Создаем медиагруппу
-
-                        media_group = []
-
-                        for i, file_path in enumerate(file_paths):
-
-                            if os.path.exists(file_path):
-
-                                input_file = FSInputFile(file_path)
-
-                                # Добавляем текст только к первому файлу
+                        # Помечаем задачу как отправленную
 
-                                caption = text if i == 0 else None
-
-                                
-
-                                # Определяем тип файла по расширению
+                        await update_outbox_task_status(task_id, 'sent')
 
-                                file_extension = os.path.splitext(file_path)[1].lower()
+                        logging.info(f"✅ Черновик книги отправлен с кнопками успешно")
 
-                                if file_extension in ['.mp3', '.wav', '.ogg', '.m4a', '.aac']:
+                    else:
 
-                                    # Аудиофайл
+                        # Обычная отправка фото без кнопок
 
-                                    media_group.append(InputMediaAudio(media=input_file, caption=caption))
+                        await bot.send_photo(user_id, input_file, caption=comment)
 
-                                    logging.info(f"🔘 Добавляю аудиофайл: {file_path}")
+                        # Помечаем задачу как отправленную
 
-                                elif file_extension in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']:
+                        await update_outbox_task_status(task_id, 'sent')
 
-                                    # Изображение
+                except (TelegramRetryAfter, TelegramNetworkError):
+                    raise
 
-                                    media_group.append(InputMediaPhoto(media=input_file, caption=caption))
+                except Exception as e:
 
-                                    logging.info(f"🔘 Добавляю изображение: {file_path}")
+                    logging.error(f"Ошибка отправки изображения {task_id}: {e}")
 
-                                elif file_extension in ['.mp4', '.avi', '.mov', '.mkv']:
+                    await update_outbox_task_status(task_id, 'failed')
 
-                                    # Видеофайл
+            elif file_type in ['gif', 'mov', 'mp4', 'avi', 'mkv', 'webm'] or file_type == 'video':
 
-                                    media_group.append(InputMediaVideo(media=input_file, caption=caption))
+                try:
 
-                                    logging.info(f"🔘 Добавляю видеофайл: {file_path}")
+                    input_file = FSInputFile(content)
 
-                                else:
+                    logging.info(f"🎬 Отправляю видео файл: file_type='{file_type}', user_id={user_id}")
 
-                                    # Документ
+                    
 
-                                    media_group.append(InputMediaDocument(media=input_file, caption=caption))
+                    # Отправляем анимацию/видео
 
-                                    logging.info(f"🔘 Добавляю документ: {file_path}")
+                    if file_type == 'gif':
 
-                            else:
+                        # GIF отправляем как анимацию
 
-                                logging.error(f"❌ Файл не найден: {file_path}")
+                        await bot.send_animation(user_id, input_file, caption=comment)
 
-                        
+                        logging.info(f"🎬 GIF анимация отправлена пользователю {user_id}")
 
-                        if media_group:
+                    else:
 
-                            # Создаем клавиатуру с кнопкой
+                        # Видео файлы отправляем как видео
 
+                        # Проверяем, является ли это черновиком книги
+                        if is_book_draft:
+                            # Для черновика книги добавляем кнопки
                             keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                                [InlineKeyboardButton(text="Все супер", callback_data="book_draft_ok")],
+                                [InlineKeyboardButton(text="Внести правки", callback_data="book_draft_edit")]
+                            ])
+                            
+                            # Добавляем дополнительный текст для черновика книги
+                            # Получаем сообщение из базы данных
+                            from bot_messages_cache import get_book_final_version
+                            additional_text = "\n\n" + await get_book_final_version()
+                            
+                            full_caption = comment + additional_text
+                            
+                            await bot.send_video(user_id, input_file, caption=full_caption, reply_markup=keyboard)
+                            
+                            # Обновляем статус заказа ТОЛЬКО если это действительно черновик
+                            if any(keyword in comment.lower() for keyword in ['черновик', 'внимательно просмотрите', 'готов', 'готово']):
+                                await update_order_status(order_id, "draft_sent")
+                                logging.info(f"📋 Статус заказа {order_id} изменен на draft_sent")
+                            
+                            logging.info(f"✅ Черновик книги (видео) отправлен с кнопками успешно")
+                        else:
+                            # Обычная отправка видео
+                            await bot.send_video(user_id, input_file, caption=comment)
+                        logging.info(f"🎬 Видео файл ({file_type}) отправлен пользователю {user_id}")
 
-                                [InlineKeyboardButton(text=button_text, callback_data=button_callback)]
+                    await update_outbox_task_status(task_id, 'sent')
 
-                            ])
+                except (TelegramRetryAfter, TelegramNetworkError):
+                    raise
 
-                            
+                except Exception as e:
 
-                            # Отправляем медиагруппу
+                    logging.error(f"Ошибка отправки видео {task_id}: {e}")
 
-                            await bot.send_media_group(user_id, media_group)
+                    await update_outbox_task_status(task_id, 'failed')
 
-                            
+            else:
 
-                            # Отправляем кнопку отдельным сообщением
+                try:
 
-                            # Проверяем тип продукта для правильного текста
+                    input_file = FSInputFile(content)
 
-                            from db import get_order
+                    logging.info(f"📄 Отправляю как документ: file_type='{file_type}', user_id={user_id}")
 
-                            order_data = await get_order(order_id)
+                    await bot.send_document(user_id, input_file, caption=comment)
 
-                            product_type = ''
+                    await update_outbox_task_status(task_id, 'sent')
 
-                            if order_data and order_data.get('order_data'):
+                except (TelegramRetryAfter, TelegramNetworkError):
+                    raise
 
-                                import json
+                except Exception as e:
 
-                                parsed_order_data = json.loads(order_data.get('order_data', '{}'))
+                    logging.error(f"Ошибка отправки документа {task_id}: {e}")
 
-                                product_type = parsed_order_data.get('product', '')
+            await update_outbox_task_status(task_id, 'failed')
 
-                            
+        except (TelegramRetryAfter, TelegramNetworkError):
+            raise
 
-                            logging.info(f"🔍 Отложенное сообщение: order_id={order_id}, product_type='{product_type}', order_data={order_data}")
+        except Exception as e:
+            logging.error(f"Ошибка отправки файла {task_id}: {e}")
+            await update_outbox_task_status(task_id, 'failed')
 
-                            
+    elif type_ == 'multiple_images_with_text_and_button':
 
-                            if product_type == 'Песня':
+        try:
 
-                                from bot_messages_cache import get_song_price_request
-                                message_text = await get_song_price_request()
+            # Отправляем несколько файлов с текстом и кнопкой одним сообщением
 
-                                logging.info(f"🎵 Используем текст для песни")
+            file_type = (task.get('file_type') or '').lower()
 
-                            elif product_type == 'Книга':
+            text = task.get('comment') or ''
 
-                                # Получаем сообщение из базы данных
-                                from bot_messages_cache import get_book_price_request
-                                message_text = await get_book_price_request()
+            button_text = task.get('button_text') or 'Продолжить'
 
-                                logging.info(f"📖 Используем текст для книги")
+            button_callback = task.get('button_callback') or 'continue_creation'
 
-                            else:
+            # Получаем order_id из задачи
+            order_id = task.get('order_id')
+            
+            if not order_id:
+                logging.error(f"❌ Отсутствует order_id в задаче multiple_images_with_text_and_button {task_id}")
+                await update_outbox_task_status(task_id, 'failed')
+                return
 
-                                # Если тип продукта не определен, используем текст для книги по умолчанию
+            logging.info(f"🔘 Обрабатываю outbox задание типа 'multiple_images_with_text_and_button'")
 
-                                # Получаем сообщение из базы данных
-                                from bot_messages_cache import get_book_price_request
-                                message_text = await get_book_price_request()
+            logging.info(f"🔘 Task data: {task}")
 
-                                logging.info(f"📖 Используем текст для книги по умолчанию, product_type='{product_type}'")
+            
 
-                            
+            # Парсим список файлов из JSON
 
-                            await bot.send_message(user_id, message_text, reply_markup=keyboard)
+            import json
 
-                            await update_outbox_task_status(task_id, 'sent')
-                            
-                            # Создаем таймер для этапа demo_received_book (Глава 3: Получение демо-контента книги)
-                            if product_type == 'Книга':
-                                try:
-                                    from db import create_or_update_user_timer
-                                    await create_or_update_user_timer(user_id, order_id, "demo_received_book", "Книга")
-                                    logging.info(f"✅ Создан таймер для этапа demo_received_book (Глава 3), пользователь {user_id}, заказ {order_id}")
-                                except Exception as timer_error:
-                                    logging.error(f"❌ Ошибка создания таймера для demo_received_book: {timer_error}")
-                            
-                            # Создаем таймер для этапа demo_received_song (Глава 3: Получение демо-контента песни)
-                            elif product_type == 'Песня':
-                                try:
-                                    from db import create_or_update_user_timer
-                                    await create_or_update_user_timer(user_id, order_id, "demo_received_song", "Песня")
-                                    logging.info(f"✅ Создан таймер для этапа demo_received_song (Глава 3), пользователь {user_id}, заказ {order_id}")
-                                except Exception as timer_error:
-                                    logging.error(f"❌ Ошибка создания таймера для demo_received_song: {timer_error}")
+            try:
 
-                        else:
+                file_paths = json.loads(content)
 
-                            await update_outbox_task_status(task_id, 'failed')
+                if not isinstance(file_paths, list):
 
-                    except Exception as e:
+                    file_paths = [content]  # Fallback для одного файла
 
-                        logging.error(f"Ошибка отправки multiple_images_with_text_and_button {task_id}: {e}")
+            except (json.JSONDecodeError, TypeError):
 
-                        await update_outbox_task_status(task_id, 'failed')
+                file_paths = [content]  # Fallback для одного файла
 
-                elif type_ == 'image_with_text_and_button':
+            
 
-                    try:
+            logging.info(f"🔘 Отправляю {len(file_paths)} файлов одним сообщением")
 
-                        # Отправляем файл с текстом и кнопкой
+            
 
-                        file_type = (task.get('file_type') or '').lower()
+            # Создаем медиагруппу
 
-                        text = task.get('comment') or ''
+            media_group = []
 
-                        button_text = task.get('button_text') or 'Продолжить'
+            for i, file_path in enumerate(file_paths):
 
-                        button_callback = task.get('button_callback') or 'continue_creation'
+                if os.path.exists(file_path):
 
-                        # Получаем order_id из задачи
-                        order_id = task.get('order_id')
-                        
-                        if not order_id:
-                            logging.error(f"❌ Отсутствует order_id в задаче image_with_text_and_button {task_id}")
-                            await update_outbox_task_status(task_id, 'failed')
-                            continue
+                    input_file = FSInputFile(file_path)
 
-                        logging.info(f"🔘 Обрабатываю outbox задание типа 'image_with_text_and_button'")
+                    # Добавляем текст только к первому файлу
 
-                        logging.info(f"🔘 Task data: {task}")
+                    caption = text if i == 0 else None
 
-                        logging.info(f"🔘 Создаю кнопку: text='{button_text}', callback='{button_callback}'")
+                    
 
-                        logging.info(f"🔘 Полученный текст: '{text}'")
+                    # Определяем тип файла по расширению
 
-                        
+                    file_extension = os.path.splitext(file_path)[1].lower()
 
-                        # Проверяем тип заказа и статус
+                    if file_extension in ['.mp3', '.wav', '.ogg', '.m4a', '.aac']:
 
-                        order = await get_order(order_id)
+                        # Аудиофайл
 
-                        is_song_demo = False
+                        media_group.append(InputMediaAudio(media=input_file, caption=caption))
 
-                        is_book_demo = False
+                        logging.info(f"🔘 Добавляю аудиофайл: {file_path}")
 
-                        is_book_draft = False
+                    elif file_extension in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']:
 
-                        is_song_draft = False
+                        # Изображение
 
-                        is_book_final = False
+                        media_group.append(InputMediaPhoto(media=input_file, caption=caption))
 
-                        
+                        logging.info(f"🔘 Добавляю изображение: {file_path}")
 
-                        if order and order.get('order_data'):
+                    elif file_extension in ['.mp4', '.avi', '.mov', '.mkv']:
 
-                            import json
+                        # Видеофайл
 
-                            try:
+                        media_group.append(InputMediaVideo(media=input_file, caption=caption))
 
-                                order_data = json.loads(order.get('order_data', '{}')) if order and order.get('order_data') else {}
+                        logging.info(f"🔘 Добавляю видеофайл: {file_path}")
 
-                                product = order_data.get('product', '')
+                    else:
 
-                                order_status = order.get('status', '')
+                        # Документ
 
-                                
+                        media_group.append(InputMediaDocument(media=input_file, caption=caption))
 
-                                # Проверяем, является ли это демо-файлом для песни
-                                logging.info(f"🔍 ПРОВЕРКА ПЕСНИ: product='{product}', order_status='{order_status}'")
+                        logging.info(f"🔘 Добавляю документ: {file_path}")
 
-                                if product == 'Песня' and order_status in ['waiting_manager', 'demo_content']:
-                                    logging.info(f"✅ НАЙДЕНА ПЕСНЯ! Создаем is_song_demo=True для заказа {order_id}")
-                                    is_song_demo = True
+                else:
 
-                                    # Обновляем статус заказа
-                                    logging.info(f"🔄 Обновляем статус заказа {order_id} с '{order_status}' на 'demo_sent'")
-                                    await update_order_status(order_id, "demo_sent")
-                                    logging.info(f"✅ Статус заказа {order_id} обновлен на 'demo_sent'")
+                    logging.error(f"❌ Файл не найден: {file_path}")
 
-                                
+            
 
-                                # Проверяем тип контента по тексту сообщения (приоритет)
+            if media_group:
 
-                                logging.info(f"🔍 Проверяем тип контента: product={product}, order_status={order_status}")
+                # Создаем клавиатуру с кнопкой
 
-                                if product == 'Книга':
+                keyboard = InlineKeyboardMarkup(inline_keyboard=[
 
-                                    if 'демо-контент' in text.lower() or 'примеры оформления' in text.lower() or any(keyword in text.lower() for keyword in ['демо', 'demo', 'пробные страницы', 'образцы']):
+                    [InlineKeyboardButton(text=button_text, callback_data=button_callback)]
 
-                                        is_book_demo = True
+                ])
 
-                                        logging.info(f"📖 Обнаружен демо-контент книги по тексту для заказа {order_id}")
+                
 
-                                        # Обновляем статус заказа
+                # Отправляем медиагруппу
 
-                                        await update_order_status(order_id, "demo_sent")
+                await bot.send_media_group(user_id, media_group)
 
-                                    elif 'черновик' in text.lower() or 'внимательно просмотрите' in text.lower():
+                
 
-                                        is_book_draft = True
+                # Отправляем кнопку отдельным сообщением
 
-                                        logging.info(f"📖 Обнаружен черновик книги по тексту для заказа {order_id}")
+                # Проверяем тип продукта для правильного текста
 
-                                        logging.info(f"📖 Продукт: {product}, Статус: {order_status}")
+                order_data = orders_by_id.get(order_id)
 
-                                    # Если по тексту не определили, проверяем по callback_data (ПРИОРИТЕТ)
+                product_type = ''
 
-                                    elif button_callback == "continue_after_demo":
+                if order_data and order_data.get('order_data'):
 
-                                        is_book_demo = True
+                    import json
 
-                                        logging.info(f"📖 Обнаружен демо-контент книги по callback_data для заказа {order_id}")
+                    parsed_order_data = json.loads(order_data.get('order_data', '{}'))
 
-                                        # Обновляем статус заказа
+                    product_type = parsed_order_data.get('product', '')
 
-                                        await update_order_status(order_id, "demo_sent")
+                
 
-                                    elif button_callback in ["book_draft_ok", "book_draft_edit"]:
+                logging.info(f"🔍 Отложенное сообщение: order_id={order_id}, product_type='{product_type}', order_data={order_data}")
 
-                                        is_book_draft = True
+                
 
-                                        logging.info(f"📖 Обнаружен черновик книги по callback_data для заказа {order_id}")
+                if product_type == 'Песня':
 
-                                        logging.info(f"📖 Продукт: {product}, Статус: {order_status}")
+                    from bot_messages_cache import get_song_price_request
+                    message_text = await get_song_price_request()
 
-                                    # Если по callback_data не определили, проверяем по статусу
+                    logging.info(f"🎵 Используем текст для песни")
 
-                                    elif order_status in ['questions_completed', 'waiting_manager', 'demo_sent', 'demo_content']:
+                elif product_type == 'Книга':
 
-                                        is_book_demo = True
+                    # Получаем сообщение из базы данных
+                    from bot_messages_cache import get_book_price_request
+                    message_text = await get_book_price_request()
 
-                                        logging.info(f"📖 Обнаружен демо-контент книги по статусу для заказа {order_id}")
+                    logging.info(f"📖 Используем текст для книги")
 
-                                        logging.info(f"📖 Статус заказа: {order_status}")
+                else:
 
-                                        # Обновляем статус заказа
+                    # Если тип продукта не определен, используем текст для книги по умолчанию
 
-                                        await update_order_status(order_id, "demo_sent")
+                    # Получаем сообщение из базы данных
+                    from bot_messages_cache import get_book_price_request
+                    message_text = await get_book_price_request()
 
-                                    elif order_status in ['waiting_draft', 'draft_sent', 'editing']:
+                    logging.info(f"📖 Используем текст для книги по умолчанию, product_type='{product_type}'")
 
-                                        is_book_draft = True
+                
 
-                                        logging.info(f"📖 Обнаружен черновик книги по статусу для заказа {order_id}")
+                await bot.send_message(user_id, message_text, reply_markup=keyboard)
 
-                                        logging.info(f"📖 Продукт: {product}, Статус: {order_status}")
+                await update_outbox_task_status(task_id, 'sent')
+                
+                # Создаем таймер для этапа demo_received_book (Глава 3: Получение демо-контента книги)
+                if product_type == 'Книга':
+                    try:
+                        from db import create_or_update_user_timer
+                        await create_or_update_user_timer(user_id, order_id, "demo_received_book", "Книга")
+                        logging.info(f"✅ Создан таймер для этапа demo_received_book (Глава 3), пользователь {user_id}, заказ {order_id}")
+                    except Exception as timer_error:
+                        logging.error(f"❌ Ошибка создания таймера для demo_received_book: {timer_error}")
+                
+                # Создаем таймер для этапа demo_received_song (Глава 3: Получение демо-контента песни)
+                elif product_type == 'Песня':
+                    try:
+                        from db import create_or_update_user_timer
+                        await create_or_update_user_timer(user_id, order_id, "demo_received_song", "Песня")
+                        logging.info(f"✅ Создан таймер для этапа demo_received_song (Глава 3), пользователь {user_id}, заказ {order_id}")
+                    except Exception as timer_error:
+                        logging.error(f"❌ Ошибка создания таймера для demo_received_song: {timer_error}")
 
-                                    elif order_status == 'ready':
+            else:
 
-                                        is_book_final = True
+                await update_outbox_task_status(task_id, 'failed')
 
-                                        logging.info(f"📚 Обнаружена финальная версия книги по статусу для заказа {order_id}")
+        except (TelegramRetryAfter, TelegramNetworkError):
+            raise
 
-                                        logging.info(f"📚 Продукт: {product}, Статус: {order_status}")
+        except Exception as e:
 
-                                        logging.info(f"📚 Финальная версия книги - пропускаем повторную отправку")
+            logging.error(f"Ошибка отправки multiple_images_with_text_and_button {task_id}: {e}")
 
-                                    else:
+            await update_outbox_task_status(task_id, 'failed')
 
-                                        logging.info(f"🔍 Проверка типа контента: продукт={product}, статус={order_status}, callback={button_callback}, текст={text[:50]}...")
+    elif type_ == 'image_with_text_and_button':
 
-                                elif product == 'Песня':
+        try:
 
-                                    # Проверяем демо песни по callback_data
+            # Отправляем файл с текстом и кнопкой
 
-                                    if button_callback == "continue_after_demo":
+            file_type = (task.get('file_type') or '').lower()
 
-                                        is_song_demo = True
+            text = task.get('comment') or ''
 
-                                        logging.info(f"🎵 Обнаружено демо песни по callback_data для заказа {order_id}")
+            button_text = task.get('button_text') or 'Продолжить'
 
-                                        # Обновляем статус заказа
+            button_callback = task.get('button_callback') or 'continue_creation'
 
-                                        await update_order_status(order_id, "demo_sent")
+            # Получаем order_id из задачи
+            order_id = task.get('order_id')
+            
+            if not order_id:
+                logging.error(f"❌ Отсутствует order_id в задаче image_with_text_and_button {task_id}")
+                await update_outbox_task_status(task_id, 'failed')
+                return
 
-                                    # Проверяем черновик песни по callback_data
+            logging.info(f"🔘 Обрабатываю outbox задание типа 'image_with_text_and_button'")
 
-                                    elif button_callback == "song_draft_ok":
+            logging.info(f"🔘 Task data: {task}")
 
-                                        is_song_draft = True
+            logging.info(f"🔘 Создаю кнопку: text='{button_text}', callback='{button_callback}'")
 
-                                        logging.info(f"🎵 Обнаружен черновик песни по callback_data для заказа {order_id}")
+            logging.info(f"🔘 Полученный текст: '{text}'")
 
-                                    # Проверяем по статусу
+            
 
-                                    elif order_status in ['waiting_draft', 'editing', 'draft_sent', 'prefinal_sent']:
+            # Проверяем тип заказа и статус
 
-                                        is_song_draft = True
+            order = await get_order(order_id)
 
-                                        logging.info(f"🎵 Обнаружен черновик песни по статусу для заказа {order_id}")
+            is_song_demo = False
 
-                                    # Проверяем демо по статусу
+            is_book_demo = False
 
-                                    elif order_status in ['paid', 'demo_sent']:
+            is_book_draft = False
 
-                                        is_song_demo = True
+            is_song_draft = False
 
-                                        logging.info(f"🎵 Обнаружено демо песни по статусу для заказа {order_id}")
+            is_book_final = False
 
-                                    else:
+            
 
-                                        logging.info(f"🔍 Проверка типа контента для песни: статус={order_status}, callback={button_callback}")
+            if order and order.get('order_data'):
 
-                            except (json.JSONDecodeError, KeyError):
-                                logging.error(f"❌ Ошибка парсинга JSON в image_with_text_and_button")
-                        
-                        # ПРИНУДИТЕЛЬНАЯ ЛОГИКА: если ничего не определилось - делаем демо
-                        if not any([is_song_demo, is_book_demo, is_book_draft, is_song_draft, is_book_final]):
-                            if order:
-                                try:
-                                    order_data = json.loads(order.get('order_data', '{}')) if order.get('order_data') else {}
-                                    product = order_data.get('product', '')
-                                    logging.info(f"🔧 ПРИНУДИТЕЛЬНАЯ ЛОГИКА: продукт={product}, ничего не определилось")
-                                    if product == 'Книга':
-                                        is_book_demo = True
-                                        logging.info(f"🔧 ПРИНУДИТЕЛЬНО: is_book_demo=True (резерв)")
-                                    elif product == 'Песня':
-                                        is_song_demo = True
-                                        logging.info(f"🔧 ПРИНУДИТЕЛЬНО: is_song_demo=True (резерв)")
-                                except Exception as e:
-                                    logging.error(f"❌ Ошибка принудительной логики: {e}")
-                            else:
-                                # Если заказ не найден, но есть файл - делаем книга демо по умолчанию
-                                logging.info(f"🔧 ЗАКАЗ НЕ НАЙДЕН - делаем book_demo по умолчанию для task_id {task_id}")
-                                is_book_demo = True
-                        
-                        
+                import json
 
-                        # ЛОГИРУЕМ ОКОНЧАТЕЛЬНЫЙ ВЫБОР ТИПА
-                        logging.info(f"📋 ФИНАЛЬНЫЙ ТИП для task_id {task_id}:")
-                        logging.info(f"📋 - is_song_demo: {is_song_demo}")
-                        logging.info(f"📋 - is_book_demo: {is_book_demo}")
-                        logging.info(f"📋 - is_book_draft: {is_book_draft}")
-                        logging.info(f"📋 - is_song_draft: {is_song_draft}")
-                        logging.info(f"📋 - is_book_final: {is_book_final}")
-                        
-                        # Отправляем файл в зависимости от типа
-                        input_file = FSInputFile(content)
+                try:
 
-                        
+                    order_data = json.loads(order.get('order_data', '{}')) if order and order.get('order_data') else {}
 
-                        # Логируем тип файла для диагностики
+                    product = order_data.get('product', '')
 
-                        logging.info(f"📤 ДЕМО-КОНТЕНТ: file_type='{file_type}', is_book_demo={is_book_demo}")
+                    order_status = order.get('status', '')
 
-                        
+                    
 
-                        # Создаем клавиатуру в зависимости от типа заказа
+                    # Проверяем, является ли это демо-файлом для песни
+                    logging.info(f"🔍 ПРОВЕРКА ПЕСНИ: product='{product}', order_status='{order_status}'")
 
-                        logging.info(f"🔍 ФИНАЛЬНАЯ ПРОВЕРКА: is_book_demo={is_book_demo}, is_book_draft={is_book_draft}, is_song_draft={is_song_draft}, is_book_final={is_book_final}")
+                    if product == 'Песня' and order_status in ['waiting_manager', 'demo_content']:
+                        logging.info(f"✅ НАЙДЕНА ПЕСНЯ! Создаем is_song_demo=True для заказа {order_id}")
+                        is_song_demo = True
 
-                        if is_book_final:
+                        # Обновляем статус заказа
+                        logging.info(f"🔄 Обновляем статус заказа {order_id} с '{order_status}' на 'demo_sent'")
+                        await update_order_status(order_id, "demo_sent")
+                        logging.info(f"✅ Статус заказа {order_id} обновлен на 'demo_sent'")
 
-                            # Для финальной версии книги - НЕ отправляем файл повторно, удаляем задачу из outbox
+                    
 
-                            logging.info(f"📚 Финальная версия книги уже отправлена менеджером, пропускаем повторную отправку")
+                    # Проверяем тип контента по тексту сообщения (приоритет)
 
-                            logging.info(f"📚 Задача {task_id} удалена из outbox без отправки файла")
+                    logging.info(f"🔍 Проверяем тип контента: product={product}, order_status={order_status}")
 
-                            await update_outbox_task_status(task_id, 'sent')
+                    if product == 'Книга':
 
-                            continue
+                        if 'демо-контент' in text.lower() or 'примеры оформления' in text.lower() or any(keyword in text.lower() for keyword in ['демо', 'demo', 'пробные страницы', 'образцы']):
 
-                        elif is_book_demo:
+                            is_book_demo = True
 
-                            # Для демо-контента книги - кнопка перехода к оплате
+                            logging.info(f"📖 Обнаружен демо-контент книги по тексту для заказа {order_id}")
 
-                            keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                            # Обновляем статус заказа
 
-                                [InlineKeyboardButton(text="Узнать цену", callback_data="continue_after_demo")]
+                            await update_order_status(order_id, "demo_sent")
 
-                            ])
+                        elif 'черновик' in text.lower() or 'внимательно просмотрите' in text.lower():
 
-                            # ПРИНУДИТЕЛЬНО заменяем текст на правильный для демо-контента
+                            is_book_draft = True
 
-                            # Получаем сообщение из базы данных
-                            from bot_messages_cache import get_book_demo_ready
-                            full_text = await get_book_demo_ready()
+                            logging.info(f"📖 Обнаружен черновик книги по тексту для заказа {order_id}")
 
-                            logging.info(f"🔧 ПРИНУДИТЕЛЬНО заменен текст на демо-контент для заказа {task.get('order_id', 'неизвестно')}")
+                            logging.info(f"📖 Продукт: {product}, Статус: {order_status}")
 
-                            logging.info(f"🔧 Исходный текст был: {comment}")
+                        # Если по тексту не определили, проверяем по callback_data (ПРИОРИТЕТ)
 
-                        elif is_song_demo:
+                        elif button_callback == "continue_after_demo":
 
-                            # Для демо-аудио песни - кнопка перехода к оплате
+                            is_book_demo = True
 
-                            keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                            logging.info(f"📖 Обнаружен демо-контент книги по callback_data для заказа {order_id}")
 
-                                [InlineKeyboardButton(text="Узнать цену", callback_data="continue_after_demo")]
+                            # Обновляем статус заказа
 
-                            ])
+                            await update_order_status(order_id, "demo_sent")
 
-                            # ПРИНУДИТЕЛЬНО заменяем текст на правильный для демо-аудио песни
+                        elif button_callback in ["book_draft_ok", "book_draft_edit"]:
 
-                            from bot_messages_cache import get_song_demo_ready
-                            full_text = await get_song_demo_ready()
+                            is_book_draft = True
 
-                            logging.info(f"🔧 ПРИНУДИТЕЛЬНО заменен текст на демо-аудио песни для заказа {order_id or 'неизвестно'}")
+                            logging.info(f"📖 Обнаружен черновик книги по callback_data для заказа {order_id}")
 
-                            logging.info(f"🔧 Исходный текст был: {comment}")
+                            logging.info(f"📖 Продукт: {product}, Статус: {order_status}")
 
-                        elif is_book_draft:
+                        # Если по callback_data не определили, проверяем по статусу
 
-                            # Для черновика книги - две кнопки (как в правильных путях)
+                        elif order_status in ['questions_completed', 'waiting_manager', 'demo_sent', 'demo_content']:
 
-                            logging.info(f"🔘 Создаю кнопки для черновика книги: 'book_draft_edit' и 'book_draft_ok'")
+                            is_book_demo = True
 
-                            keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                            logging.info(f"📖 Обнаружен демо-контент книги по статусу для заказа {order_id}")
 
-                            [InlineKeyboardButton(text="Все супер", callback_data="book_draft_ok")],
+                            logging.info(f"📖 Статус заказа: {order_status}")
 
-                            [InlineKeyboardButton(text="Внести правки", callback_data="book_draft_edit")]
+                            # Обновляем статус заказа
 
-                            ])
+                            await update_order_status(order_id, "demo_sent")
 
-                            
+                        elif order_status in ['waiting_draft', 'draft_sent', 'editing']:
 
-                            # Добавляем дополнительный текст для черновика книги (как в правильных путях)
+                            is_book_draft = True
 
-                            # Получаем сообщение из базы данных
-                            from bot_messages_cache import get_book_final_version
-                            additional_text = "\n\n" + await get_book_final_version()
+                            logging.info(f"📖 Обнаружен черновик книги по статусу для заказа {order_id}")
 
-                            additional_text += "Если хочешь внести правки — нажми \"Внести правки\"."
+                            logging.info(f"📖 Продукт: {product}, Статус: {order_status}")
 
-                            full_text = text + additional_text
+                        elif order_status == 'ready':
 
-                            logging.info(f"📝 Текст для черновика книги: {full_text[:100]}...")
+                            is_book_final = True
 
-                            
+                            logging.info(f"📚 Обнаружена финальная версия книги по статусу для заказа {order_id}")
 
-                            # Обновляем статус заказа ТОЛЬКО если это действительно черновик
+                            logging.info(f"📚 Продукт: {product}, Статус: {order_status}")
 
-                            # Проверяем, что текст содержит ключевые слова черновика
+                            logging.info(f"📚 Финальная версия книги - пропускаем повторную отправку")
 
-                            if any(keyword in text.lower() for keyword in ['черновик', 'внимательно просмотрите', 'готов', 'готово']):
+                        else:
 
-                                await update_order_status(order_id, "draft_sent")
+                            logging.info(f"🔍 Проверка типа контента: продукт={product}, статус={order_status}, callback={button_callback}, текст={text[:50]}...")
 
-                                logging.info(f"📋 Статус заказа {order_id} изменен на draft_sent")
+                    elif product == 'Песня':
 
-                            else:
+                        # Проверяем демо песни по callback_data
 
-                                logging.info(f"📋 Текстовое сообщение отправлено без изменения статуса (не черновик)")
+                        if button_callback == "continue_after_demo":
 
-                            logging.info(f"✅ Черновик книги отправлен с кнопками успешно")
+                            is_song_demo = True
 
-                        elif is_song_draft:
+                            logging.info(f"🎵 Обнаружено демо песни по callback_data для заказа {order_id}")
 
-                            # Для черновика песни - две кнопки
+                            # Обновляем статус заказа
 
-                            logging.info(f"🔘 Создаю кнопки для черновика песни: 'song_draft_edit' и 'song_draft_ok'")
+                            await update_order_status(order_id, "demo_sent")
 
-                            keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                        # Проверяем черновик песни по callback_data
 
-                            [InlineKeyboardButton(text="Все нравится, отличная песня", callback_data="song_draft_ok")],
+                        elif button_callback == "song_draft_ok":
 
-                            [InlineKeyboardButton(text="Обратная связь", callback_data="song_draft_edit")]
+                            is_song_draft = True
 
-                            ])
+                            logging.info(f"🎵 Обнаружен черновик песни по callback_data для заказа {order_id}")
 
-                            
+                        # Проверяем по статусу
 
-                            # Добавляем дополнительный текст для черновика песни
+                        elif order_status in ['waiting_draft', 'editing', 'draft_sent', 'prefinal_sent']:
 
-                            from bot_messages_cache import get_song_final_version
-                            additional_text = "\n\n" + await get_song_final_version()
+                            is_song_draft = True
 
-                            full_text = text + additional_text
+                            logging.info(f"🎵 Обнаружен черновик песни по статусу для заказа {order_id}")
 
-                            logging.info(f"📝 Текст для черновика песни: {full_text[:100]}...")
+                        # Проверяем демо по статусу
 
-                        else:
+                        elif order_status in ['paid', 'demo_sent']:
 
-                            # Для остальных случаев - одна кнопка
+                            is_song_demo = True
 
-                            logging.info(f"🔘 Создаю обычную кнопку: text='{button_text}', callback='{button_callback}'")
+                            logging.info(f"🎵 Обнаружено демо песни по статусу для заказа {order_id}")
 
-                            
+                        else:
 
-                            # ПРОСТАЯ ПРОВЕРКА: если callback = "continue_after_demo", то это демо-контент
+                            logging.info(f"🔍 Проверка типа контента для песни: статус={order_status}, callback={button_callback}")
 
-                            if button_callback == "continue_after_demo":
+                except (json.JSONDecodeError, KeyError):
+                    logging.error(f"❌ Ошибка парсинга JSON в image_with_text_and_button")
+            
+            # ПРИНУДИТЕЛЬНАЯ ЛОГИКА: если ничего не определилось - делаем демо
+            if not any([is_song_demo, is_book_demo, is_book_draft, is_song_draft, is_book_final]):
+                if order:
+                    try:
+                        order_data = json.loads(order.get('order_data', '{}')) if order.get('order_data') else {}
+                        product = order_data.get('product', '')
+                        logging.info(f"🔧 ПРИНУДИТЕЛЬНАЯ ЛОГИКА: продукт={product}, ничего не определилось")
+                        if product == 'Книга':
+                            is_book_demo = True
+                            logging.info(f"🔧 ПРИНУДИТЕЛЬНО: is_book_demo=True (резерв)")
+                        elif product == 'Песня':
+                            is_song_demo = True
+                            logging.info(f"🔧 ПРИНУДИТЕЛЬНО: is_song_demo=True (резерв)")
+                    except Exception as e:
+                        logging.error(f"❌ Ошибка принудительной логики: {e}")
+                else:
+                    # Если заказ не найден, но есть файл - делаем книга демо по умолчанию
+                    logging.info(f"🔧 ЗАКАЗ НЕ НАЙДЕН - делаем book_demo по умолчанию для task_id {task_id}")
+                    is_book_demo = True
+            
+            
 
-                                # Проверяем тип продукта для правильного текста
+            # ЛОГИРУЕМ ОКОНЧАТЕЛЬНЫЙ ВЫБОР ТИПА
+            logging.info(f"📋 ФИНАЛЬНЫЙ ТИП для task_id {task_id}:")
+            logging.info(f"📋 - is_song_demo: {is_song_demo}")
+            logging.info(f"📋 - is_book_demo: {is_book_demo}")
+            logging.info(f"📋 - is_book_draft: {is_book_draft}")
+            logging.info(f"📋 - is_song_draft: {is_song_draft}")
+            logging.info(f"📋 - is_book_final: {is_book_final}")
+            
+            # Отправляем файл в зависимости от типа
+            input_file = FSInputFile(content)
 
-                                try:
+            
 
-                                    order = await get_order(order_id)
+            # Логируем тип файла для диагностики
 
-                                    if order and order.get('order_data'):
+            logging.info(f"📤 ДЕМО-КОНТЕНТ: file_type='{file_type}', is_book_demo={is_book_demo}")
 
-                                        order_data = json.loads(order.get('order_data', '{}')) if order and order.get('order_data') else {}
+            
 
-                                        product = order_data.get('product', '')
+            # Создаем клавиатуру в зависимости от типа заказа
 
-                                        if product == 'Песня':
+            logging.info(f"🔍 ФИНАЛЬНАЯ ПРОВЕРКА: is_book_demo={is_book_demo}, is_book_draft={is_book_draft}, is_song_draft={is_song_draft}, is_book_final={is_book_final}")
 
-                                            from bot_messages_cache import get_song_demo_ready
-                                            full_text = await get_song_demo_ready()
+            if is_book_final:
 
-                                            logging.info(f"🔧 Исправлен текст для демо-аудио песни")
+                # Для финальной версии книги - НЕ отправляем файл повторно, удаляем задачу из outbox
 
-                                        else:
+                logging.info(f"📚 Финальная версия книги уже отправлена менеджером, пропускаем повторную отправку")
 
-                                            # Получаем сообщение из базы данных
-                                            from bot_messages_cache import get_book_demo_ready
-                                            full_text = await get_book_demo_ready()
+                logging.info(f"📚 Задача {task_id} удалена из outbox без отправки файла")
 
-                                            logging.info(f"🔧 Исправлен текст для демо-контента книги")
+                await update_outbox_task_status(task_id, 'sent')
 
-                                    else:
+                return
 
-                                        # Получаем сообщение из базы данных
-                                        from bot_messages_cache import get_book_demo_ready
-                                        full_text = await get_book_demo_ready()
+            elif is_book_demo:
 
-                                        logging.info(f"🔧 Исправлен текст для демо-контента (по умолчанию)")
+                # Для демо-контента книги - кнопка перехода к оплате
 
-                                except Exception as e:
+                keyboard = InlineKeyboardMarkup(inline_keyboard=[
 
-                                    logging.error(f"❌ Ошибка при определении типа продукта: {e}")
+                    [InlineKeyboardButton(text="Узнать цену", callback_data="continue_after_demo")]
 
-                                    # Получаем сообщение из базы данных
-                                    from bot_messages_cache import get_book_demo_ready
-                                    full_text = await get_book_demo_ready()
+                ])
 
-                                    logging.info(f"🔧 Исправлен текст для демо-контента (по умолчанию)")
+                # ПРИНУДИТЕЛЬНО заменяем текст на правильный для демо-контента
 
-                            else:
+                # Получаем сообщение из базы данных
+                from bot_messages_cache import get_book_demo_ready
+                full_text = await get_book_demo_ready()
 
-                                full_text = text
+                logging.info(f"🔧 ПРИНУДИТЕЛЬНО заменен текст на демо-контент для заказа {task.get('order_id', 'неизвестно')}")
 
-                            
+                logging.info(f"🔧 Исходный текст был: {comment}")
 
-                            # Проверяем тип продукта для правильного текста кнопки
+            elif is_song_demo:
 
-                            try:
+                # Для демо-аудио песни - кнопка перехода к оплате
 
-                                order = await get_order(order_id)
+                keyboard = InlineKeyboardMarkup(inline_keyboard=[
 
-                                if order and order.get('order_data'):
+                    [InlineKeyboardButton(text="Узнать цену", callback_data="continue_after_demo")]
 
-                                    order_data = json.loads(order.get('order_data', '{}')) if order and order.get('order_data') else {}
+                ])
 
-                                    product = order_data.get('product', '')
+                # ПРИНУДИТЕЛЬНО заменяем текст на правильный для демо-аудио песни
 
-                                    if product == 'Песня' and button_callback == "continue_after_demo":
+                from bot_messages_cache import get_song_demo_ready
+                full_text = await get_song_demo_ready()
 
-                                        button_text = "Узнать цену"
+                logging.info(f"🔧 ПРИНУДИТЕЛЬНО заменен текст на демо-аудио песни для заказа {order_id or 'неизвестно'}")
 
-                                        logging.info(f"🔧 Исправлен текст кнопки для песни")
+                logging.info(f"🔧 Исходный текст был: {comment}")
 
-                                    elif product == 'Книга' and button_callback == "continue_after_demo":
+            elif is_book_draft:
 
-                                        button_text = "Узнать цену"
+                # Для черновика книги - две кнопки (как в правильных путях)
 
-                                        logging.info(f"🔧 Исправлен текст кнопки для книги")
+                logging.info(f"🔘 Создаю кнопки для черновика книги: 'book_draft_edit' и 'book_draft_ok'")
 
-                            except Exception as e:
+                keyboard = InlineKeyboardMarkup(inline_keyboard=[
 
-                                logging.error(f"❌ Ошибка при определении типа продукта для кнопки: {e}")
+                [InlineKeyboardButton(text="Все супер", callback_data="book_draft_ok")],
 
-                            
+                [InlineKeyboardButton(text="Внести правки", callback_data="book_draft_edit")]
 
-                            keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                ])
 
-                                [InlineKeyboardButton(text=button_text, callback_data=button_callback)]
+                
 
-                            ])
+                # Добавляем дополнительный текст для черновика книги (как в правильных путях)
 
-                        
+                # Получаем сообщение из базы данных
+                from bot_messages_cache import get_book_final_version
+                additional_text = "\n\n" + await get_book_final_version()
 
-                        if file_type in ['jpg', 'jpeg', 'png', 'image']:
+                additional_text += "Если хочешь внести правки — нажми \"Внести правки\"."
 
-                            # Проверяем существование файла
+                full_text = text + additional_text
 
-                            if not os.path.exists(content):
+                logging.info(f"📝 Текст для черновика книги: {full_text[:100]}...")
 
-                                logging.error(f"❌ Файл не существует: {content}")
+                
 
-                                await update_outbox_task_status(task_id, 'failed')
+                # Обновляем статус заказа ТОЛЬКО если это действительно черновик
 
-                                continue
+                # Проверяем, что текст содержит ключевые слова черновика
 
-                            
+                if any(keyword in text.lower() for keyword in ['черновик', 'внимательно просмотрите', 'готов', 'готово']):
 
-                            # Размер файла логируем, но не блокируем отправку
+                    await update_order_status(order_id, "draft_sent")
 
-                            try:
+                    logging.info(f"📋 Статус заказа {order_id} изменен на draft_sent")
 
-                                file_size = os.path.getsize(content) / (1024 * 1024)  # в МБ
+                else:
 
-                                logging.info(f"🔍 Размер файла {content}: {file_size:.2f} МБ")
+                    logging.info(f"📋 Текстовое сообщение отправлено без изменения статуса (не черновик)")
 
-                            except Exception as size_error:
+                logging.info(f"✅ Черновик книги отправлен с кнопками успешно")
 
-                                logging.error(f"❌ Ошибка проверки размера файла {content}: {size_error}")
+            elif is_song_draft:
 
-                            
+                # Для черновика песни - две кнопки
 
-                            await bot.send_photo(user_id, input_file, caption=full_text, reply_markup=keyboard)
+                logging.info(f"🔘 Создаю кнопки для черновика песни: 'song_draft_edit' и 'song_draft_ok'")
 
-                        elif file_type == 'mp3':
+                keyboard = InlineKeyboardMarkup(inline_keyboard=[
 
-                            await bot.send_audio(user_id, input_file, caption=full_text, reply_markup=keyboard)
+                [InlineKeyboardButton(text="Все нравится, отличная песня", callback_data="song_draft_ok")],
 
-                        elif file_type == 'pdf':
+                [InlineKeyboardButton(text="Обратная связь", callback_data="song_draft_edit")]
 
-                            # Проверяем существование файла
+                ])
 
-                            if not os.path.exists(content):
+                
 
-                                logging.error(f"❌ Файл не существует: {content}")
+                # Добавляем дополнительный текст для черновика песни
 
-                                await update_outbox_task_status(task_id, 'failed')
+                from bot_messages_cache import get_song_final_version
+                additional_text = "\n\n" + await get_song_final_version()
 
-                                continue
+                full_text = text + additional_text
 
-                            
+                logging.info(f"📝 Текст для черновика песни: {full_text[:100]}...")
 
-                            # Логируем размер PDF файла, но не блокируем отправку
-                            try:
-                                file_size = os.path.getsize(content) / (1024 * 1024)  # в МБ
-                                logging.info(f"🔍 Размер PDF файла {content}: {file_size:.2f} МБ")
-                            except Exception as size_error:
-                                logging.error(f"❌ Ошибка проверки размера PDF файла {content}: {size_error}")
+            else:
 
-                            # Отправляем PDF документ с обработкой ошибок
-                            try:
-                                await bot.send_document(user_id, input_file, caption=full_text, reply_markup=keyboard)
-                                logging.info(f"✅ PDF документ отправлен успешно пользователю {user_id}")
-                            except Exception as pdf_error:
-                                error_msg = str(pdf_error)
-                                logging.error(f"❌ Ошибка отправки PDF документа: {pdf_error}")
-                                await update_outbox_task_status(task_id, 'failed')
-                                continue
+                # Для остальных случаев - одна кнопка
 
-                        elif file_type == 'gif':
+                logging.info(f"🔘 Создаю обычную кнопку: text='{button_text}', callback='{button_callback}'")
 
-                            # GIF отправляем как анимацию
+                
 
-                            await bot.send_animation(user_id, input_file, caption=full_text, reply_markup=keyboard)
+                # ПРОСТАЯ ПРОВЕРКА: если callback = "continue_after_demo", то это демо-контент
 
-                            logging.info(f"🎬 GIF анимация с кнопкой отправлена пользователю {user_id}")
+                if button_callback == "continue_after_demo":
 
-                        elif file_type in ['mov', 'mp4', 'avi', 'mkv', 'webm'] or file_type == 'video':
+                    # Проверяем тип продукта для правильного текста
 
-                            # Видео файлы отправляем как видео
+                    try:
 
-                            logging.info(f"🎬 Отправляю видео файл: file_type='{file_type}', user_id={user_id}")
+                        order = orders_by_id.get(order_id)
 
-                            await bot.send_video(user_id, input_file, caption=full_text, reply_markup=keyboard)
+                        if order and order.get('order_data'):
 
-                            logging.info(f"🎬 Видео файл ({file_type}) с кнопкой отправлен пользователю {user_id}")
+                            order_data = json.loads(order.get('order_data', '{}')) if order and order.get('order_data') else {}
 
-                        else:
+                            product = order_data.get('product', '')
 
-                            # Для других типов файлов отправляем как документ
+                            if product == 'Песня':
 
-                            logging.info(f"📄 Отправляю как документ: file_type='{file_type}', user_id={user_id}")
+                                from bot_messages_cache import get_song_demo_ready
+                                full_text = await get_song_demo_ready()
 
-                            await bot.send_document(user_id, input_file, caption=full_text, reply_markup=keyboard)
+                                logging.info(f"🔧 Исправлен текст для демо-аудио песни")
 
-                        
+                            else:
 
-                        await update_outbox_task_status(task_id, 'sent')
+                                # Получаем сообщение из базы данных
+                                from bot_messages_cache import get_book_demo_ready
+                                full_text = await get_book_demo_ready()
 
-                        if is_song_demo:
+                                logging.info(f"🔧 Исправлен текст для демо-контента книги")
 
-                            logging.info(f"✅ Демо-файл песни отправлен успешно")
-                            
-                            # Создаем таймер для этапа demo_received_song (Глава 3: Получение демо-версии)
-                            from db import create_or_update_user_timer
-                            await create_or_update_user_timer(user_id, order_id, "demo_received_song", "Песня")
-                            logging.info(f"✅ Создан таймер для этапа demo_received_song (Глава 3), пользователь {user_id}, заказ {order_id}")
-                            
-                            # Отложенные сообщения для этапа demo_received_song управляются через новую систему шаблонов в админке
+                        else:
 
-                        elif is_book_demo:
+                            # Получаем сообщение из базы данных
+                            from bot_messages_cache import get_book_demo_ready
+                            full_text = await get_book_demo_ready()
 
-                            logging.info(f"✅ Демо-контент книги отправлен с кнопкой перехода к оплате")
+                            logging.info(f"🔧 Исправлен текст для демо-контента (по умолчанию)")
 
-                        elif is_book_draft:
+                    except Exception as e:
 
-                            logging.info(f"✅ Черновик книги отправлен с кнопками успешно")
+                        logging.error(f"❌ Ошибка при определении типа продукта: {e}")
 
-                            logging.info(f"🔘 Кнопки созданы: book_draft_edit, book_draft_ok")
+                        # Получаем сообщение из базы данных
+                        from bot_messages_cache import get_book_demo_ready
+                        full_text = await get_book_demo_ready()
 
-                        else:
+                        logging.info(f"🔧 Исправлен текст для демо-контента (по умолчанию)")
 
-                            logging.info(f"✅ Файл с кнопкой отправлен успешно")
+                else:
 
-                            logging.info(f"🔘 Кнопка создана: {button_callback}")
+                    full_text = text
 
-                    except Exception as e:
+                
 
-                        logging.error(f"Ошибка отправки image_with_text_and_button {task_id}: {e}")
+                # Проверяем тип продукта для правильного текста кнопки
 
-                        await update_outbox_task_status(task_id, 'failed')
+                try:
 
-                elif type_ == 'covers_selection':
+                    order = orders_by_id.get(order_id)
 
-                    try:
+                    if order and order.get('order_data'):
 
-                        # Отправляем каждую обложку отдельно с кнопкой перехода к следующему шагу
+                        order_data = json.loads(order.get('order_data', '{}')) if order and order.get('order_data') else {}
 
-                        logging.info(f"🎨 Обрабатываю outbox задание типа 'covers_selection'")
+                        product = order_data.get('product', '')
 
-                        
+                        if product == 'Песня' and button_callback == "continue_after_demo":
 
-                        # Получаем все обложки
+                            button_text = "Узнать цену"
 
-                        from db import get_cover_templates
+                            logging.info(f"🔧 Исправлен текст кнопки для песни")
 
-                        cover_templates = await get_cover_templates()
+                        elif product == 'Книга' and button_callback == "continue_after_demo":
 
-                        logging.info(f"🔍 ОТЛАДКА: Получено {len(cover_templates) if cover_templates else 0} обложек")
+                            button_text = "Узнать цену"
 
-                        
+                            logging.info(f"🔧 Исправлен текст кнопки для книги")
 
-                        if not cover_templates:
+                except Exception as e:
 
-                            logging.warning(f"⚠️ Нет обложек в базе данных")
+                    logging.error(f"❌ Ошибка при определении типа продукта для кнопки: {e}")
 
-                            await bot.send_message(user_id, "❌ К сожалению, обложки временно недоступны")
+                
 
-                        await update_outbox_task_status(task_id, 'failed')
+                keyboard = InlineKeyboardMarkup(inline_keyboard=[
 
-                        continue
+                    [InlineKeyboardButton(text=button_text, callback_data=button_callback)]
 
-                        
+                ])
 
-                        # Отправляем каждую обложку отдельно с кнопкой
+            
 
-                        for i, template in enumerate(cover_templates[:5]):  # Максимум 5 обложек
+            if file_type in ['jpg', 'jpeg', 'png', 'image']:
 
-                            try:
+                # Проверяем существование файла
 
-                                covers_dir = "covers"
-                                
-                                # Создаем папку covers, если её нет
-                                os.makedirs(covers_dir, exist_ok=True)
+                if not os.path.exists(content):
 
-                                file_path = os.path.join(covers_dir, template['filename'])
+                    logging.error(f"❌ Файл не существует: {content}")
 
-                                
+                    await update_outbox_task_status(task_id, 'failed')
 
-                                if os.path.exists(file_path):
+                    return
 
-                                    logging.info(f"✅ Файл обложки найден: {file_path}")
+                
 
-                                                                        # Создаем кнопку для выбора обложки
+                # Размер файла логируем, но не блокируем отправку
 
-                                    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                try:
 
-                                        [InlineKeyboardButton(text="Выбрать эту обложку", callback_data=f"choose_cover_template_{template['id']}")]
+                    file_size = os.path.getsize(content) / (1024 * 1024)  # в МБ
 
-                                    ])
+                    logging.info(f"🔍 Размер файла {content}: {file_size:.2f} МБ")
 
-                                    
+                except Exception as size_error:
 
-                                    # Отправляем обложку с описанием и кнопкой
+                    logging.error(f"❌ Ошибка проверки размера файла {content}: {size_error}")
 
-                                    caption = f"📖 <b>{template['name']}</b>\n\n"
+                
 
-                                    if template.get('category'):
+                await bot.send_photo(user_id, input_file, caption=full_text, reply_markup=keyboard)
 
-                                        caption += f"Категория: {template['category']}\n"
+            elif file_type == 'mp3':
 
-                                    caption += f"Обложка #{i+1} из {len(cover_templates[:5])}"
+                await bot.send_audio(user_id, input_file, caption=full_text, reply_markup=keyboard)
 
-                                    
+            elif file_type == 'pdf':
 
-                                    await bot.send_photo(
+                # Проверяем существование файла
 
-                                        user_id,
+                if not os.path.exists(content):
 
-                                        photo=FSInputFile(file_path),
+                    logging.error(f"❌ Файл не существует: {content}")
 
-                                        caption=caption,
+                    await update_outbox_task_status(task_id, 'failed')
 
-                                        reply_markup=keyboard,
+                    return
 
-                                        parse_mode="HTML"
+                
 
-                                    )
-                                    
-                                    logging.info(f"✅ Обложка {template['name']} отправлена пользователю {user_id}")
+                # Логируем размер PDF файла, но не блокируем отправку
+                try:
+                    file_size = os.path.getsize(content) / (1024 * 1024)  # в МБ
+                    logging.info(f"🔍 Размер PDF файла {content}: {file_size:.2f} МБ")
+                except Exception as size_error:
+                    logging.error(f"❌ Ошибка проверки размера PDF файла {content}: {size_error}")
 
-                                else:
+                # Отправляем PDF документ с обработкой ошибок
+                try:
+                    await bot.send_document(user_id, input_file, caption=full_text, reply_markup=keyboard)
+                    logging.info(f"✅ PDF документ отправлен успешно пользователю {user_id}")
+                except (TelegramRetryAfter, TelegramNetworkError):
+                    raise
+                except Exception as pdf_error:
+                    error_msg = str(pdf_error)
+                    logging.error(f"❌ Ошибка отправки PDF документа: {pdf_error}")
+                    await update_outbox_task_status(task_id, 'failed')
+                    return
 
-                                    logging.warning(f"⚠️ Файл обложки не найден: {file_path}")
+            elif file_type == 'gif':
 
-                            except Exception as e:
+                # GIF отправляем как анимацию
 
-                                logging.error(f"❌ Ошибка загрузки обложки {template['name']}: {e}")
+                await bot.send_animation(user_id, input_file, caption=full_text, reply_markup=keyboard)
 
-                        
+                logging.info(f"🎬 GIF анимация с кнопкой отправлена пользователю {user_id}")
 
-                        await update_outbox_task_status(task_id, 'sent')
+            elif file_type in ['mov', 'mp4', 'avi', 'mkv', 'webm'] or file_type == 'video':
 
-                        logging.info(f"✅ Отправлено {len(cover_templates[:5])} обложек по отдельности")
+                # Видео файлы отправляем как видео
 
-                    except Exception as e:
+                logging.info(f"🎬 Отправляю видео файл: file_type='{file_type}', user_id={user_id}")
 
-                        logging.error(f"Ошибка отправки covers_selection {task_id}: {e}")
+                await bot.send_video(user_id, input_file, caption=full_text, reply_markup=keyboard)
 
-                        await update_outbox_task_status(task_id, 'failed')
+                logging.info(f"🎬 Видео файл ({file_type}) с кнопкой отправлен пользователю {user_id}")
 
-                elif type_ == 'page_selection':
+            else:
 
-                    try:
+                # Для других типов файлов отправляем как документ
 
-                        # Отправляем страницу с кнопкой выбора
+                logging.info(f"📄 Отправляю как документ: file_type='{file_type}', user_id={user_id}")
 
-                        logging.info(f"📖 Обрабатываю outbox задание типа 'page_selection'")
+                await bot.send_document(user_id, input_file, caption=full_text, reply_markup=keyboard)
 
-                        
+            
 
-                        file_type = (task.get('file_type') or '').lower()
+            await update_outbox_task_status(task_id, 'sent')
 
-                        comment = task.get('comment') or ''
+            if is_song_demo:
 
-                        button_text = task.get('button_text') or '✅ Выбрать'
+                logging.info(f"✅ Демо-файл песни отправлен успешно")
+                
+                # Создаем таймер для этапа demo_received_song (Глава 3: Получение демо-версии)
+                from db import create_or_update_user_timer
+                await create_or_update_user_timer(user_id, order_id, "demo_received_song", "Песня")
+                logging.info(f"✅ Создан таймер для этапа demo_received_song (Глава 3), пользователь {user_id}, заказ {order_id}")
+                
+                # Отложенные сообщения для этапа demo_received_song управляются через новую систему шаблонов в админке
 
-                        button_callback = task.get('button_callback') or 'choose_page'
+            elif is_book_demo:
 
-                        
+                logging.info(f"✅ Демо-контент книги отправлен с кнопкой перехода к оплате")
 
-                        # Устанавливаем правильное состояние пользователя для выбора страниц
+            elif is_book_draft:
 
-                        try:
+                logging.info(f"✅ Черновик книги отправлен с кнопками успешно")
 
-                            from aiogram.fsm.context import FSMContext
+                logging.info(f"🔘 Кнопки созданы: book_draft_edit, book_draft_ok")
 
-                            from aiogram.fsm.storage.memory import MemoryStorage
+            else:
 
-                            
+                logging.info(f"✅ Файл с кнопкой отправлен успешно")
 
-                            # Получаем контекст состояния для пользователя
+                logging.info(f"🔘 Кнопка создана: {button_callback}")
 
-                            storage = dp.storage
+        except (TelegramRetryAfter, TelegramNetworkError):
+            raise
 
-                            state_key = f"{user_id}:{user_id}"
+        except Exception as e:
 
-                            
+            logging.error(f"Ошибка отправки image_with_text_and_button {task_id}: {e}")
 
-                            # Создаем FSMContext для пользователя
+            await update_outbox_task_status(task_id, 'failed')
 
-                            from aiogram.fsm.storage.base import StorageKey
+    elif type_ == 'covers_selection':
 
-                            storage_key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
+        try:
 
-                            user_state = FSMContext(storage=storage, key=storage_key)
+            # Отправляем каждую обложку отдельно с кнопкой перехода к следующему шагу
 
-                            
+            logging.info(f"🎨 Обрабатываю outbox задание типа 'covers_selection'")
 
-                            # Устанавливаем состояние выбора страниц
+            
 
-                            await user_state.set_state(BookFinalStates.choosing_pages)
+            # Получаем все обложки
 
-                            
+            from db import get_cover_templates
 
-                            # Инициализируем данные заказа если их нет
+            cover_templates = await get_cover_templates()
 
-                            current_data = await user_state.get_data()
+            logging.info(f"🔍 ОТЛАДКА: Получено {len(cover_templates) if cover_templates else 0} обложек")
 
-                            order_id = task.get('order_id')
+            
 
-                            if order_id and 'order_id' not in current_data:
+            if not cover_templates:
 
-                                await user_state.update_data(order_id=order_id)
+                logging.warning(f"⚠️ Нет обложек в базе данных")
 
-                            
+                await bot.send_message(user_id, "❌ К сожалению, обложки временно недоступны")
 
-                            # ОЧИЩАЕМ данные о выбранных страницах при восстановлении состояния
+            await update_outbox_task_status(task_id, 'failed')
 
-                            # чтобы пользователь мог заново выбрать страницы
+            return
 
-                            if 'selected_pages' in current_data:
+            
 
-                                await user_state.update_data(selected_pages=[])
+            # Отправляем каждую обложку отдельно с кнопкой
 
-                                logging.info(f"🧹 Очищены выбранные страницы для пользователя {user_id}")
+            for i, template in enumerate(cover_templates[:5]):  # Максимум 5 обложек
 
-                            
+                try:
 
-                            # Очищаем флаги состояния
+                    covers_dir = "covers"
+                    
+                    # Создаем папку covers, если её нет
+                    os.makedirs(covers_dir, exist_ok=True)
 
-                            await user_state.update_data(
+                    file_path = os.path.join(covers_dir, template['filename'])
 
-                                minimum_processed=False,
+                    
 
-                                continue_message_sent=False
+                    if os.path.exists(file_path):
 
-                            )
+                        logging.info(f"✅ Файл обложки найден: {file_path}")
 
-                            
+                                                            # Создаем кнопку для выбора обложки
 
-                            logging.info(f"✅ Установлено состояние choosing_pages для пользователя {user_id}")
+                        keyboard = InlineKeyboardMarkup(inline_keyboard=[
 
-                        except Exception as state_error:
+                            [InlineKeyboardButton(text="Выбрать эту обложку", callback_data=f"choose_cover_template_{template['id']}")]
 
-                            logging.error(f"❌ Ошибка установки состояния: {state_error}")
+                        ])
 
                         
 
-                        # Создаем клавиатуру
+                        # Отправляем обложку с описанием и кнопкой
 
-                        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                        caption = f"📖 <b>{template['name']}</b>\n\n"
 
-                            [InlineKeyboardButton(text=button_text, callback_data=button_callback)]
+                        if template.get('category'):
 
-                        ])
+                            caption += f"Категория: {template['category']}\n"
+
+                        caption += f"Обложка #{i+1} из {len(cover_templates[:5])}"
 
                         
 
-                        # Отправляем страницу
+                        await bot.send_photo(
 
-                        if file_type in ['jpg', 'jpeg', 'png', 'image']:
+                            user_id,
 
-                            # Проверяем существование файла
+                            photo=CachedInputFile(file_path),
 
-                            if not os.path.exists(content):
+                            caption=caption,
 
-                                logging.error(f"❌ Файл не существует: {content}")
+                            reply_markup=keyboard,
 
-                                await update_outbox_task_status(task_id, 'failed')
+                            parse_mode="HTML"
 
-                                continue
+                        )
+                        
+                        logging.info(f"✅ Обложка {template['name']} отправлена пользователю {user_id}")
 
-                            
+                    else:
 
-                            # Проверяем текущее состояние FSM - если пользователь уже перешел к следующему этапу
+                        logging.warning(f"⚠️ Файл обложки не найден: {file_path}")
 
-                            try:
+                except (TelegramRetryAfter, TelegramNetworkError):
+                    raise
 
-                                current_state = await user_state.get_state()
+                except Exception as e:
 
-                                if current_state and current_state != "BookFinalStates:choosing_pages":
+                    logging.error(f"❌ Ошибка загрузки обложки {template['name']}: {e}")
 
-                                    logging.info(f"⚠️ Пользователь {user_id} уже перешел к следующему этапу, пропускаем отправку страницы")
+            
 
-                                    await update_outbox_task_status(task_id, 'sent')
+            await update_outbox_task_status(task_id, 'sent')
 
-                                    continue
+            logging.info(f"✅ Отправлено {len(cover_templates[:5])} обложек по отдельности")
 
-                            except Exception as state_check_error:
+        except (TelegramRetryAfter, TelegramNetworkError):
+            raise
 
-                                logging.error(f"❌ Ошибка проверки состояния: {state_check_error}")
+        except Exception as e:
 
-                            
+            logging.error(f"Ошибка отправки covers_selection {task_id}: {e}")
 
-                            input_file = FSInputFile(content)
+            await update_outbox_task_status(task_id, 'failed')
 
-                            caption = f"📖 {comment}\n\nЕсли этот сюжет про вас, то выбери его:"
+    elif type_ == 'page_selection':
 
-                            
+        try:
 
-                            await bot.send_photo(user_id, input_file, caption=caption, reply_markup=keyboard)
+            # Отправляем страницу с кнопкой выбора
 
-                            logging.info(f"✅ Страница отправлена с кнопкой выбора")
+            logging.info(f"📖 Обрабатываю outbox задание типа 'page_selection'")
 
-                        else:
+            
 
-                            logging.error(f"❌ Неподдерживаемый тип файла для page_selection: {file_type}")
+            file_type = (task.get('file_type') or '').lower()
 
-                        await update_outbox_task_status(task_id, 'failed')
+            comment = task.get('comment') or ''
 
-                        continue
+            button_text = task.get('button_text') or '✅ Выбрать'
 
-                        
+            button_callback = task.get('button_callback') or 'choose_page'
 
-                        await update_outbox_task_status(task_id, 'sent')
+            
 
-                    except Exception as e:
+            # Устанавливаем правильное состояние пользователя для выбора страниц
 
-                        logging.error(f"Ошибка отправки page_selection {task_id}: {e}")
+            try:
 
-                        await update_outbox_task_status(task_id, 'failed')
+                from aiogram.fsm.context import FSMContext
 
-                elif type_ == 'text_with_buttons':
-                    
-                    try:
-                        # Отправляем текстовое сообщение с кнопками
-                        logging.info(f"📝 OUTBOX: Обрабатываю text_with_buttons для user_id={user_id}, task_id={task_id}, content='{text[:50]}...'")
-                        
-                        text = content
-                        button_text = task.get('button_text', '')
-                        button_callback = task.get('button_callback', '')
-                        
-                        # Парсим кнопки (разделенные |)
-                        button_texts = button_text.split('|') if button_text else []
-                        button_callbacks = button_callback.split('|') if button_callback else []
-                        
-                        if button_texts and button_callbacks and len(button_texts) == len(button_callbacks):
-                            # Создаем клавиатуру
-                            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                                [InlineKeyboardButton(text=btn_text.strip(), callback_data=btn_callback.strip())]
-                                for btn_text, btn_callback in zip(button_texts, button_callbacks)
-                            ])
-                            
-                            await bot.send_message(user_id, text, parse_mode="HTML", reply_markup=keyboard)
-                        else:
-                            # Если кнопки не настроены правильно, отправляем без них
-                            await bot.send_message(user_id, text, parse_mode="HTML")
-                        
-                        await update_outbox_task_status(task_id, 'sent')
-                        logging.info(f"✅ Текстовое сообщение с кнопками отправлено успешно")
-                        
-                    except Exception as e:
-                        logging.error(f"Ошибка отправки text_with_buttons {task_id}: {e}")
-                        await update_outbox_task_status(task_id, 'failed')
+                
 
-                elif type_ == 'text':
+                # Получаем контекст состояния для пользователя
 
-                    try:
+                storage = dp.storage
 
-                        # Отправляем текстовое сообщение
+                state_key = f"{user_id}:{user_id}"
 
-                        logging.info(f"📝 Обрабатываю outbox задание типа 'text'")
+                
 
-                        
+                # Создаем FSMContext для пользователя
 
-                        # Если это инструкции для выбора страниц, устанавливаем состояние
+                from aiogram.fsm.storage.base import StorageKey
 
-                        comment = task.get('comment') or ''
+                storage_key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
 
-                        if 'выбор страниц' in comment.lower() or 'выберите страницы' in content.lower():
+                user_state = FSMContext(storage=storage, key=storage_key)
 
-                            try:
+                
 
-                                from aiogram.fsm.context import FSMContext
+                # Устанавливаем состояние выбора страниц
 
-                                
+                await user_state.set_state(BookFinalStates.choosing_pages)
 
-                                # Создаем FSMContext для пользователя
+                
 
-                                from aiogram.fsm.storage.base import StorageKey
+                # Инициализируем данные заказа если их нет
 
-                                storage_key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
+                current_data = await user_state.get_data()
 
-                                user_state = FSMContext(storage=dp.storage, key=storage_key)
+                order_id = task.get('order_id')
 
-                                
+                if order_id and 'order_id' not in current_data:
 
-                                # Устанавливаем состояние выбора страниц
+                    await user_state.update_data(order_id=order_id)
 
-                                await user_state.set_state(BookFinalStates.choosing_pages)
+                
 
-                                
+                # ОЧИЩАЕМ данные о выбранных страницах при восстановлении состояния
 
-                                # Инициализируем данные заказа
+                # чтобы пользователь мог заново выбрать страницы
 
-                                order_id = task.get('order_id')
+                if 'selected_pages' in current_data:
 
-                                if order_id:
+                    await user_state.update_data(selected_pages=[])
 
-                                    await user_state.update_data(order_id=order_id)
+                    logging.info(f"🧹 Очищены выбранные страницы для пользователя {user_id}")
 
-                                
+                
 
-                                logging.info(f"✅ Установлено состояние choosing_pages для инструкций пользователю {user_id}")
+                # Очищаем флаги состояния
 
-                            except Exception as state_error:
+                await user_state.update_data(
 
-                                logging.error(f"❌ Ошибка установки состояния для инструкций: {state_error}")
+                    minimum_processed=False,
 
-                        
+                    continue_message_sent=False
 
-                        await bot.send_message(user_id, content, parse_mode="HTML")
+                )
 
-                        logging.info(f"✅ Текстовое сообщение отправлено")
+                
 
-                        
+                logging.info(f"✅ Установлено состояние choosing_pages для пользователя {user_id}")
 
-                        await update_outbox_task_status(task_id, 'sent')
+            except Exception as state_error:
 
-                    except Exception as e:
+                logging.error(f"❌ Ошибка установки состояния: {state_error}")
 
-                        logging.error(f"Ошибка отправки text {task_id}: {e}")
+            
 
-                        await update_outbox_task_status(task_id, 'failed')
+            # Создаем клавиатуру
 
-                elif type_ == 'manager_notification':
+            keyboard = InlineKeyboardMarkup(inline_keyboard=[
 
-                    # Уведомления для менеджера - пропускаем
+                [InlineKeyboardButton(text=button_text, callback_data=button_callback)]
 
-                    await update_outbox_task_status(task_id, 'sent')
+            ])
 
-                elif type_ == 'set_state':
+            
 
-                    try:
+            # Отправляем страницу
 
-                        logging.info(f"🔄 Устанавливаем состояние для пользователя {user_id}: {content}")
+            if file_type in ['jpg', 'jpeg', 'png', 'image']:
 
-                        # Получаем состояние пользователя
-                        from aiogram.fsm.storage.base import StorageKey
-                        storage_key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
-                        
-                        # Создаем контекст состояния
-                        from aiogram.fsm.context import FSMContext
-                        state = FSMContext(storage=storage, key=storage_key)
-                        
-                        # Устанавливаем состояние
-                        if content == "DeliveryStates.waiting_for_address":
-                            from aiogram.fsm.state import StatesGroup, State
-                            class DeliveryStates(StatesGroup):
-                                waiting_for_address = State()
-                            await state.set_state(DeliveryStates.waiting_for_address)
-                        else:
-                            # Для других состояний можно добавить обработку
-                            logging.warning(f"⚠️ Неизвестное состояние для установки: {content}")
-                        
-                        await update_outbox_task_status(task_id, 'sent')
-                        logging.info(f"✅ Состояние установлено успешно")
+                # Проверяем существование файла
 
-                    except Exception as e:
-                        logging.error(f"❌ Ошибка установки состояния {task_id}: {e}")
-                        await update_outbox_task_status(task_id, 'failed')
+                if not os.path.exists(content):
 
-                else:
+                    logging.error(f"❌ Файл не существует: {content}")
 
                     await update_outbox_task_status(task_id, 'failed')
 
-        except Exception as e:
+                    return
 
-            error_msg = str(e)
-            
-            # Безопасное получение task_id и user_id
-            safe_task_id = locals().get('task_id', 'неизвестно')
-            safe_user_id = locals().get('user_id', 'неизвестно')
+                
 
-            logging.error(f"Ошибка отправки задания {safe_task_id}: {error_msg}")
-            
-            # Добавляем полный traceback для диагностики
-            import traceback
-            logging.error(f"🔍 ПОЛНЫЙ TRACEBACK ОШИБКИ: {traceback.format_exc()}")
+                # Проверяем текущее состояние FSM - если пользователь уже перешел к следующему этапу
 
-            
+                try:
 
-            # Определяем тип ошибки для лучшей диагностики
+                    current_state = await user_state.get_state()
 
-            if "Forbidden" in error_msg or "bot was blocked" in error_msg.lower():
+                    if current_state and current_state != "BookFinalStates:choosing_pages":
 
-                logging.error(f"Пользователь {safe_user_id} заблокировал бота")
+                        logging.info(f"⚠️ Пользователь {user_id} уже перешел к следующему этапу, пропускаем отправку страницы")
 
-                # Для заблокированных пользователей помечаем задачу как failed и не повторяем
-                if safe_task_id != 'неизвестно':
-                    await update_outbox_task_status(safe_task_id, 'failed')
+                        await update_outbox_task_status(task_id, 'sent')
 
-                # Добавляем комментарий о том, что пользователь заблокировал бота
+                        return
 
-                # Добавляем уведомление менеджеру только если есть данные задачи
-                if 'task' in locals() and task:
-                    await add_outbox_task(
-                        order_id=task.get('order_id'),
-                        user_id=0,  # Системное сообщение
-                        type_="manager_notification",
-                        content=f"⚠️ ВНИМАНИЕ: Пользователь {safe_user_id} заблокировал бота. Демо-контент не доставлен. Необходимо связаться с пользователем другим способом."
-                    )
+                except Exception as state_check_error:
 
-            elif "chat not found" in error_msg.lower():
+                    logging.error(f"❌ Ошибка проверки состояния: {state_check_error}")
 
-                logging.error(f"Чат с пользователем {safe_user_id} не найден (возможно, пользователь не взаимодействовал с ботом)")
+                
 
-                if safe_task_id != 'неизвестно':
-                    await update_outbox_task_status(safe_task_id, 'failed')
+                input_file = FSInputFile(content)
 
-            elif "user not found" in error_msg.lower():
+                caption = f"📖 {comment}\n\nЕсли этот сюжет про вас, то выбери его:"
 
-                logging.error(f"Пользователь {safe_user_id} не найден в Telegram")
+                
 
-                if safe_task_id != 'неизвестно':
-                    await update_outbox_task_status(safe_task_id, 'failed')
+                await bot.send_photo(user_id, input_file, caption=caption, reply_markup=keyboard)
 
-            else:
+                logging.info(f"✅ Страница отправлена с кнопкой выбора")
 
-                # Для других ошибок оставляем задачу в pending для повторной попытки
+            else:
 
-                logging.error(f"Неизвестная ошибка для пользователя {safe_user_id}: {error_msg}")
+                logging.error(f"❌ Неподдерживаемый тип файла для page_selection: {file_type}")
 
-                if safe_task_id != 'неизвестно':
-                    await update_outbox_task_status(safe_task_id, 'pending')
+                await update_outbox_task_status(task_id, 'failed')
 
-        except Exception as e:
-            logging.error(f"❌ КРИТИЧЕСКАЯ ОШИБКА В PROCESS_OUTBOX_TASKS: {e}")
-            import traceback
-            logging.error(f"❌ ПОЛНЫЙ TRACEBACK: {traceback.format_exc()}")
+                return
 
-        await asyncio.sleep(2)  # Уменьшаем интервал для более быстрой обработки задач
+            
 
+            await update_outbox_task_status(task_id, 'sent')
 
+        except (TelegramRetryAfter, TelegramNetworkError):
 
-async def compress_image(image_path: str, max_size_mb: float = 5.0, quality: int = 85):
+            # Flood control и сетевые сбои разбирает deliver_outbox_task: страница будет отправлена повторно
 
-    """
+            raise
 
-    Сжимает изображение до указанного размера
+        except Exception as e:
 
-    """
+            logging.error(f"Ошибка отправки page_selection {task_id}: {e}")
 
-    try:
+            await update_outbox_task_status(task_id, 'failed')
 
-        from PIL import Image
+    elif type_ == 'page_upload':
+        try:
+            # Страница, загруженная менеджером в админке (задание доставки pages_upload).
+            # В отличие от page_selection состояние FSM и уже выбранные страницы не трогаем:
+            # страницы одного задания уходят около секунды каждая, и пользователь выбирает их по мере прихода
+            if not os.path.exists(content):
+                logging.error(f"❌ Файл не существует: {content}")
+                await update_outbox_task_status(task_id, 'failed')
+                return
 
-        import io
+            keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text=task.get('button_text') or '✅ Выбрать',
+                                      callback_data=task.get('button_callback') or 'choose_page')]
+            ])
+            caption = f"📖 {task.get('comment') or ''}\n\nВыберите эту страницу для вашей книги:"
+            await bot.send_photo(user_id, FSInputFile(content), caption=caption, reply_markup=keyboard)
+            logging.info(f"✅ Страница {content} отправлена с кнопкой выбора")
+
+            await update_outbox_task_status(task_id, 'sent')
+        except (TelegramRetryAfter, TelegramNetworkError):
+            # Flood control и сетевые сбои разбирает deliver_outbox_task: страница будет отправлена повторно
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка отправки page_upload {task_id}: {e}")
+            await update_outbox_task_status(task_id, 'failed')
 
+    elif type_ == 'text_with_buttons':
         
+        try:
+            # Отправляем текстовое сообщение с кнопками
+            logging.info(f"📝 OUTBOX: Обрабатываю text_with_buttons для user_id={user_id}, task_id={task_id}, content='{content[:50]}...'")
+            
+            text = content
+            button_text = task.get('button_text', '')
+            button_callback = task.get('button_callback', '')
+            
+            # Парсим кнопки (разделенные |)
+            button_texts = button_text.split('|') if button_text else []
+            button_callbacks = button_callback.split('|') if button_callback else []
+            
+            if button_texts and button_callbacks and len(button_texts) == len(button_callbacks):
+                # Создаем клавиатуру
+                keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text=btn_text.strip(), callback_data=btn_callback.strip())]
+                    for btn_text, btn_callback in zip(button_texts, button_callbacks)
+                ])
+                
+                await bot.send_message(user_id, text, parse_mode="HTML", reply_markup=keyboard)
+            else:
+                # Если кнопки не настроены правильно, отправляем без них
+                await bot.send_message(user_id, text, parse_mode="HTML")
+            
+            await update_outbox_task_status(task_id, 'sent')
+            logging.info(f"✅ Текстовое сообщение с кнопками отправлено успешно")
+            
+        except (TelegramRetryAfter, TelegramNetworkError):
+            raise
 
-        # Открываем изображение
+        except Exception as e:
+            logging.error(f"Ошибка отправки text_with_buttons {task_id}: {e}")
+            await update_outbox_task_status(task_id, 'failed')
 
-        with Image.open(image_path) as img:
+    elif type_ == 'text':
 
-            # Конвертируем в RGB если нужно
+        try:
 
-            if img.mode in ('RGBA', 'LA', 'P'):
+            # Отправляем текстовое сообщение
 
-                img = img.convert('RGB')
+            logging.info(f"📝 Обрабатываю outbox задание типа 'text'")
 
             
 
-            # Проверяем размер файла
+            # Если это инструкции для выбора страниц, устанавливаем состояние
 
-            file_size = os.path.getsize(image_path) / (1024 * 1024)  # в МБ
+            comment = task.get('comment') or ''
 
-            
+            if 'выбор страниц' in comment.lower() or 'выберите страницы' in content.lower():
 
-            if file_size <= max_size_mb:
+                try:
 
-                logging.info(f"📸 Файл {image_path} уже подходящего размера ({file_size:.2f} МБ)")
+                    from aiogram.fsm.context import FSMContext
 
-                return
+                    
 
-            
+                    # Создаем FSMContext для пользователя
 
-            # Сжимаем изображение
+                    from aiogram.fsm.storage.base import StorageKey
 
-            output = io.BytesIO()
+                    storage_key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
 
-            
+                    user_state = FSMContext(storage=dp.storage, key=storage_key)
 
-            # Определяем формат
+                    
 
-            if image_path.lower().endswith('.png'):
+                    # Устанавливаем состояние выбора страниц
 
-                img.save(output, format='PNG', optimize=True)
+                    await user_state.set_state(BookFinalStates.choosing_pages)
 
-            else:
+                    
 
-                img.save(output, format='JPEG', quality=quality, optimize=True)
+                    # Инициализируем данные заказа
 
-            
+                    order_id = task.get('order_id')
+
+                    if order_id:
+
+                        await user_state.update_data(order_id=order_id)
 
-            # Проверяем размер после сжатия
+                    
+
+                    logging.info(f"✅ Установлено состояние choosing_pages для инструкций пользователю {user_id}")
 
-            compressed_size = len(output.getvalue()) / (1024 * 1024)  # в МБ
+                except Exception as state_error:
+
+                    logging.error(f"❌ Ошибка установки состояния для инструкций: {state_error}")
 
             
 
-            if compressed_size <= max_size_mb:
+            await bot.send_message(user_id, content, parse_mode="HTML")
 
-                # Сохраняем сжатое изображение
+            logging.info(f"✅ Текстовое сообщение отправлено")
 
-                with open(image_path, 'wb') as f:
+            
 
-                    f.write(output.getvalue())
+            await update_outbox_task_status(task_id, 'sent')
 
-                logging.info(f"📸 Изображение сжато: {file_size:.2f} МБ → {compressed_size:.2f} МБ")
+        except (TelegramRetryAfter, TelegramNetworkError):
+            raise
 
-            else:
+        except Exception as e:
 
-                # Если все еще слишком большое, уменьшаем качество
+            logging.error(f"Ошибка отправки text {task_id}: {e}")
 
-                while compressed_size > max_size_mb and quality > 30:
+            await update_outbox_task_status(task_id, 'failed')
 
-                    quality -= 10
+    elif type_ == 'manager_notification':
 
-                    output = io.BytesIO()
+        # Уведомления для менеджера - пропускаем
 
-                    img.save(output, format='JPEG', quality=quality, optimize=True)
+        await update_outbox_task_status(task_id, 'sent')
 
-                    compressed_size = len(output.getvalue()) / (1024 * 1024)
+    elif type_ == 'set_state':
 
-                
+        try:
 
-                if compressed_size <= max_size_mb:
+            logging.info(f"🔄 Устанавливаем состояние для пользователя {user_id}: {content}")
 
-                    with open(image_path, 'wb') as f:
+            # Получаем состояние пользователя
+            from aiogram.fsm.storage.base import StorageKey
+            storage_key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
+            
+            # Создаем контекст состояния
+            from aiogram.fsm.context import FSMContext
+            state = FSMContext(storage=storage, key=storage_key)
+            
+            # Устанавливаем состояние
+            if content == "DeliveryStates.waiting_for_address":
+                from aiogram.fsm.state import StatesGroup, State
+                class DeliveryStates(StatesGroup):
+                    waiting_for_address = State()
+                await state.set_state(DeliveryStates.waiting_for_address)
+            else:
+                # Для других состояний можно добавить обработку
+                logging.warning(f"⚠️ Неизвестное состояние для установки: {content}")
+            
+            await update_outbox_task_status(task_id, 'sent')
+            logging.info(f"✅ Состояние установлено успешно")
 
-                        f.write(output.getvalue())
+        except Exception as e:
+            logging.error(f"❌ Ошибка установки состояния {task_id}: {e}")
+            await update_outbox_task_status(task_id, 'failed')
 
-                    logging.info(f"📸 Изображение сжато с качеством {quality}: {file_size:.2f} МБ → {compressed_size:.2f} МБ")
+    else:
 
-                else:
+        await update_outbox_task_status(task_id, 'failed')
 
-                    logging.warning(f"⚠️ Не удалось сжать изображение {image_path} до {max_size_mb} МБ")
 
-                    
 
-    except ImportError:
 
-        logging.warning("⚠️ PIL не установлен, сжатие изображений недоступно")
 
-    except Exception as e:
+async def compress_image(image_path: str, max_size_mb: float = 5.0, quality: int = 85):
+
+    """
+    Сжимает изображение до указанного размера и строит миниатюры для админки.
+    PIL работает в пуле процессов (image_pipeline), цикл событий бота не блокируется
+    """
 
-        logging.error(f"❌ Ошибка сжатия изображения {image_path}: {e}")
+    await process_image(image_path, max_size_mb, quality)
 
 
 
@@ -20737,101 +20895,112 @@ async def download_and_save_photo(bot: Bot, file_id: str, save_dir: str, filenam
 
 async def send_payment_reminders(bot: Bot):
 
-    """Отправляет напоминания об оплате через 24 часа"""
+    """
+    Отправляет напоминания об оплате: первое — заказу, ожидающему оплаты, второе — через минуту
+    после первого (для тестирования). Следующий шаг определяется по статусу и updated_at заказа
+    на очередной проверке, а не ожиданием внутри цикла; отправки идут через delivery_scheduler,
+    так что медленный пользователь задерживает только свои напоминания.
+    """
+
+    from db import db_connection, shift_order_metrics, record_order_event, notify_order_events
 
-    while True:
+    # Шаги напоминаний: статус заказа -> (текст, следующий статус)
+    reminder_steps = {
 
-        try:
+        'waiting_payment': (
+            "Возможно, цена вас смутила? Мы можем предложить другие варианты — напишите нам.",
+            'reminder_sent'
+        ),
 
-            # Получаем заказы, которые ожидают оплаты более 1 минуты (для тестирования)
+        'reminder_sent': (
+            "Готовы сделать книгу проще, но не менее искренней. Дайте знать, если вам это интересно.",
+            'final_reminder_sent'
+        ),
 
-            from db import aiosqlite, DB_PATH
+    }
 
-            import datetime
+    # Заказы, напоминание которым уже в очереди планировщика
+    in_flight = set()
 
-            
 
-            async with aiosqlite.connect(DB_PATH) as db:
 
-                # Заказы со статусом "waiting_payment" старше 1 минуты (для тестирования)
+    async def set_reminder_status(order_id: int, status: str):
 
-                one_minute_ago = datetime.now() - timedelta(minutes=1)
+        # Короткая запись на каждое изменение: слот писателя не держится во время отправок
 
-                cursor = await db.execute('''
+        async with db_connection() as db:
 
-                    SELECT id, user_id, order_data FROM orders 
+            await shift_order_metrics(db, order_id, -1)
 
-                    WHERE status = 'waiting_payment' 
+            await db.execute(
 
-                    AND updated_at < ?
+                "UPDATE orders SET status = ?, updated_at = datetime('now') WHERE id = ?",
 
-                ''', (one_minute_ago,))
+                (status, order_id)
 
-                orders = await cursor.fetchall()
+            )
 
-                
+            await shift_order_metrics(db, order_id, 1)
 
-                for order_id, user_id, order_data in orders:
+            await record_order_event(db, order_id, 'order_changed')
 
-                    try:
+            await db.commit()
 
-                        # Первое напоминание
+        notify_order_events()
 
-                        await bot.send_message(
 
-                            user_id,
 
-                            "Возможно, цена вас смутила? Мы можем предложить другие варианты — напишите нам."
+    async def remind(order_id: int, user_id: int, text: str, next_status: str):
 
-                        )
+        try:
 
-                        
+            await bot.send_message(user_id, text)
 
-                        # Обновляем статус заказа
+            await set_reminder_status(order_id, next_status)
 
-                        await db.execute(
+        except Exception as e:
 
-                            'UPDATE orders SET status = ? WHERE id = ?',
+            logging.error(f"Ошибка отправки напоминания для заказа {order_id}: {e}")
 
-                            ('reminder_sent', order_id)
 
-                        )
 
-                        await db.commit()
+    while True:
 
-                        
+        try:
 
-                        # Второе напоминание через 1 минуту (для тестирования)
+            # Заказы, у которых с последнего изменения статуса прошло больше 1 минуты (для тестирования)
 
-                        await asyncio.sleep(60)  # 1 минута для тестирования
+            async with db_connection(readonly=True) as db:
 
-                        await bot.send_message(
+                placeholders = ','.join('?' * len(reminder_steps))
 
-                            user_id,
+                cursor = await db.execute(f'''
 
-                            "Готовы сделать книгу проще, но не менее искренней. Дайте знать, если вам это интересно."
+                    SELECT id, user_id, status FROM orders 
 
-                        )
+                    WHERE status IN ({placeholders})
 
-                        
+                    AND updated_at < datetime('now', '-1 minutes')
 
-                        # Обновляем статус заказа
+                ''', list(reminder_steps))
+
+                orders = await cursor.fetchall()
 
-                        await db.execute(
+            
 
-                            'UPDATE orders SET status = ? WHERE id = ?',
+            for order_id, user_id, status in orders:
 
-                            ('final_reminder_sent', order_id)
+                if order_id in in_flight:
 
-                        )
+                    continue
 
-                        await db.commit()
+                text, next_status = reminder_steps[status]
 
-                        
+                in_flight.add(order_id)
 
-                    except Exception as e:
+                future = delivery_scheduler.submit(user_id, functools.partial(remind, order_id, user_id, text, next_status))
 
-                        logging.error(f"Ошибка отправки напоминания для заказа {order_id}: {e}")
+                future.add_done_callback(lambda _future, order_id=order_id: in_flight.discard(order_id))
 
                         
 
@@ -21112,6 +21281,84 @@ async def process_message_templates(bot: Bot):
 
 
 
+async def send_timer_message(bot: Bot, user_data: dict):
+    """Отправляет одно сообщение по таймеру; выполняется в очереди пользователя планировщика доставки"""
+    from db import is_timer_message_sent, log_timer_message_sent, get_order
+
+    timer_id = user_data['timer_id']
+    user_id = user_data['user_id']
+    order_id = user_data['order_id']
+    template_id = user_data['template_id']
+    message_type = user_data['message_type']
+    content = user_data['content']
+    delay_minutes = user_data['delay_minutes']
+    template_name = user_data['template_name']
+    
+    logging.info(f"🔍 Проверяю отправку '{template_name}' (задержка {delay_minutes}м) пользователю {user_id}")
+    logging.info(f"📝 Содержимое сообщения из таблицы 'message_templates' (ID: {template_id}): {content[:100]}...")
+    
+    # Проверяем, не было ли уже отправлено это сообщение для данного таймера
+    if await is_timer_message_sent(timer_id, template_id, delay_minutes):
+        logging.info(f"ℹ️ Сообщение уже отправлено для таймера {timer_id}, шаблон {template_id}")
+        return
+    
+    # Получаем данные заказа для дополнительных проверок
+    order = await get_order(order_id)
+    if not order:
+        logging.warning(f"Заказ {order_id} не найден для пользователя {user_id}")
+        return
+    
+    # Проверяем, что заказ все еще в подходящем статусе
+    order_status = order.get('status')
+    logging.info(f"🔍 Статус заказа {order_id}: {order_status}, этап: {user_data['order_step']}")
+    # Блокируем только полностью завершенные заказы, НЕ оплаченные!
+    if order_status in ['completed', 'cancelled', 'failed', 'delivered']:
+        logging.info(f"❌ Заказ {order_id} в финальном статусе {order_status}, пропускаем сообщение")
+        return
+    
+    try:
+        # Получаем файлы для этого шаблона сообщения
+        from db import get_message_template_files
+        files = await get_message_template_files(template_id)
+        
+        logging.info(f"📁 Файлы для шаблона '{template_name}' (ID: {template_id}): найдено {len(files)} файлов")
+        if files:
+            for i, file_info in enumerate(files):
+                logging.info(f"  📎 Файл {i+1}: {file_info.get('file_name', 'unknown')} ({file_info.get('file_type', 'unknown')})")
+        
+        if files:
+            # Создаем медиагруппу из всех файлов
+            media_group = await create_mixed_media_group(files, content)
+            
+            if media_group:
+                # Отправляем медиагруппу
+                await bot.send_media_group(user_id, media_group)
+                logging.info(f"✅ Отправлена медиагруппа с {len(files)} файлами '{template_name}' пользователю {user_id} (заказ {order_id})")
+            else:
+                # Если не удалось создать медиагруппу, отправляем файлы по отдельности
+                for file_info in files:
+                    await send_file_by_type(
+                        bot, user_id, 
+                        file_info['file_path'], 
+                        file_info['file_type'],
+                        content if files.index(file_info) == 0 else None
+                    )
+                logging.info(f"✅ Отправлены файлы по отдельности '{template_name}' пользователю {user_id} (заказ {order_id})")
+        else:
+            # Если нет файлов, отправляем только текст
+            await bot.send_message(user_id, content, parse_mode="HTML")
+            logging.info(f"✅ Отправлено сообщение '{template_name}' пользователю {user_id} (заказ {order_id})")
+        
+        # Записываем факт отправки в новую систему
+        await log_timer_message_sent(timer_id, template_id, user_id, order_id, message_type, delay_minutes)
+        
+        # Также записываем в старую систему для совместимости
+        from db import log_message_sent
+        await log_message_sent(template_id, user_id, order_id)
+        
+    except Exception as e:
+        logging.error(f"❌ Ошибка отправки сообщения '{template_name}' пользователю {user_id}: {e}")
+
 async def process_timer_based_messages(bot: Bot):
     """
     Новая система обработки отложенных сообщений на основе индивидуальных таймеров
@@ -21120,7 +21367,7 @@ async def process_timer_based_messages(bot: Bot):
 
     while True:
         try:
-            from db import get_users_ready_for_messages, is_timer_message_sent, log_timer_message_sent, get_order
+            from db import get_users_ready_for_messages
             
             # Получаем пользователей, готовых для получения сообщений по таймерам
             ready_users = await get_users_ready_for_messages()
@@ -21128,80 +21375,14 @@ async def process_timer_based_messages(bot: Bot):
             if ready_users:
                 logging.info(f"🔍 Найдено {len(ready_users)} готовых к отправке сообщений")
             
-            for user_data in ready_users:
-                timer_id = user_data['timer_id']
-                user_id = user_data['user_id']
-                order_id = user_data['order_id']
-                template_id = user_data['template_id']
-                message_type = user_data['message_type']
-                content = user_data['content']
-                delay_minutes = user_data['delay_minutes']
-                template_name = user_data['template_name']
-                
-                logging.info(f"🔍 Проверяю отправку '{template_name}' (задержка {delay_minutes}м) пользователю {user_id}")
-                logging.info(f"📝 Содержимое сообщения из таблицы 'message_templates' (ID: {template_id}): {content[:100]}...")
-                
-                # Проверяем, не было ли уже отправлено это сообщение для данного таймера
-                if await is_timer_message_sent(timer_id, template_id, delay_minutes):
-                    logging.info(f"ℹ️ Сообщение уже отправлено для таймера {timer_id}, шаблон {template_id}")
-                    continue
-                
-                # Получаем данные заказа для дополнительных проверок
-                order = await get_order(order_id)
-                if not order:
-                    logging.warning(f"Заказ {order_id} не найден для пользователя {user_id}")
-                    continue
-                
-                # Проверяем, что заказ все еще в подходящем статусе
-                order_status = order.get('status')
-                logging.info(f"🔍 Статус заказа {order_id}: {order_status}, этап: {user_data['order_step']}")
-                # Блокируем только полностью завершенные заказы, НЕ оплаченные!
-                if order_status in ['completed', 'cancelled', 'failed', 'delivered']:
-                    logging.info(f"❌ Заказ {order_id} в финальном статусе {order_status}, пропускаем сообщение")
-                    continue
-                
-                try:
-                    # Получаем файлы для этого шаблона сообщения
-                    from db import get_message_template_files
-                    files = await get_message_template_files(template_id)
-                    
-                    logging.info(f"📁 Файлы для шаблона '{template_name}' (ID: {template_id}): найдено {len(files)} файлов")
-                    if files:
-                        for i, file_info in enumerate(files):
-                            logging.info(f"  📎 Файл {i+1}: {file_info.get('file_name', 'unknown')} ({file_info.get('file_type', 'unknown')})")
-                    
-                    if files:
-                        # Создаем медиагруппу из всех файлов
-                        media_group = await create_mixed_media_group(files, content)
-                        
-                        if media_group:
-                            # Отправляем медиагруппу
-                            await bot.send_media_group(user_id, media_group)
-                            logging.info(f"✅ Отправлена медиагруппа с {len(files)} файлами '{template_name}' пользователю {user_id} (заказ {order_id})")
-                        else:
-                            # Если не удалось создать медиагруппу, отправляем файлы по отдельности
-                            for file_info in files:
-                                await send_file_by_type(
-                                    bot, user_id, 
-                                    file_info['file_path'], 
-                                    file_info['file_type'],
-                                    content if files.index(file_info) == 0 else None
-                                )
-                            logging.info(f"✅ Отправлены файлы по отдельности '{template_name}' пользователю {user_id} (заказ {order_id})")
-                    else:
-                        # Если нет файлов, отправляем только текст
-                        await bot.send_message(user_id, content, parse_mode="HTML")
-                        logging.info(f"✅ Отправлено сообщение '{template_name}' пользователю {user_id} (заказ {order_id})")
-                    
-                    # Записываем факт отправки в новую систему
-                    await log_timer_message_sent(timer_id, template_id, user_id, order_id, message_type, delay_minutes)
-                    
-                    # Также записываем в старую систему для совместимости
-                    from db import log_message_sent
-                    await log_message_sent(template_id, user_id, order_id)
-                    
-                except Exception as e:
-                    logging.error(f"❌ Ошибка отправки сообщения '{template_name}' пользователю {user_id}: {e}")
+            # Разные пользователи обслуживаются параллельно, сообщения одного пользователя — по порядку;
+            # ждем весь проход, чтобы следующий опрос не отправил те же сообщения повторно
+            deliveries = [
+                delivery_scheduler.submit(user_data['user_id'], functools.partial(send_timer_message, bot, user_data))
+                for user_data in ready_users
+            ]
+            if deliveries:
+                await asyncio.gather(*deliveries, return_exceptions=True)
             
         except Exception as e:
             logging.error(f"❌ Ошибка в process_timer_based_messages: {e}")
@@ -23403,6 +23584,10 @@ async def main():
     # Запуск автоматической проверки платежей
     asyncio.create_task(auto_check_payments())  # Включаем автоматическую проверку
 
+    # Гистограммы времени ответа ЮKassa — в лог
+    from payment_gateway import log_gateway_stats
+    asyncio.create_task(log_gateway_stats())
+
     
 
     # Добавляем логирование для отладки
@@ -23427,6 +23612,20 @@ async def main():
 
         raise
 
+    finally:
+
+        from payment_gateway import shutdown_gateway
+
+        shutdown_gateway()
+
+        from image_pipeline import shutdown_image_pipeline
+
+        shutdown_image_pipeline()
+
+        from db import close_db_pool
+
+        await close_db_pool()
+
 
 if __name__ == '__main__':
 
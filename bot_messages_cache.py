@@ -1,94 +1,104 @@
 #!/usr/bin/env python3
 """
 Модуль для кэширования и получения сообщений бота из базы данных
+
+Все активные сообщения держатся в памяти, и get_message_content читает только словарь.
+Актуальность проверяется по версии bot_messages в таблице cache_versions: ее увеличивают
+update_bot_message/upsert_bot_message/delete_bot_message (в том числе из процесса админки).
+Версия сверяется в фоне не чаще раза в BOT_MESSAGES_VERSION_CHECK_INTERVAL секунд,
+и при изменении кэш перечитывается целиком.
 """
 
 import asyncio
 import logging
+import os
+import time
 from typing import Optional, Dict
 from db import get_bot_message_by_key
 
+# Как часто сверять версию сообщений с базой (правки из админки видны не позже чем через столько секунд)
+BOT_MESSAGES_VERSION_CHECK_INTERVAL = float(os.getenv('BOT_MESSAGES_VERSION_CHECK_INTERVAL', '5'))
+
 # Кэш сообщений
 _messages_cache: Dict[str, str] = {}
 _cache_loaded = False
+_cache_version = -1
+_version_checked_at = 0.0
+_version_check_task: Optional[asyncio.Task] = None
 
 async def get_message_content(message_key: str, fallback: str = None, force_refresh: bool = False) -> str:
     """
-    Получает содержимое сообщения по ключу из базы данных
+    Получает содержимое сообщения по ключу из кэша (без обращения к базе)
     Если сообщение не найдено или неактивно, возвращает fallback
     
     Args:
         message_key: Ключ сообщения
         fallback: Резервный текст
-        force_refresh: Принудительно обновить из базы (игнорировать кэш)
+        force_refresh: Оставлен для совместимости — свежесть обеспечивает проверка версии
     """
-    global _cache_loaded
-    
     # Загружаем кэш при первом обращении
     if not _cache_loaded:
         await _load_messages_cache()
+    else:
+        _schedule_version_check()
     
-    # ВСЕГДА проверяем базу данных для актуальных данных
-    # Это обеспечивает работу в реальном времени при изменениях в админке
-    try:
-        message_data = await get_bot_message_by_key(message_key)
-        if message_data and message_data.get('is_active', False):
-            content = message_data.get('content', '')
-            # Обновляем кэш актуальными данными
-            _messages_cache[message_key] = content
-            logging.info(f"Загружено сообщение {message_key} из базы (реальное время): {content[:50]}...")
-            return content
-        elif message_data and not message_data.get('is_active', False):
-            # Сообщение неактивно - удаляем из кэша
-            if message_key in _messages_cache:
-                del _messages_cache[message_key]
-            logging.warning(f"Сообщение {message_key} неактивно, удалено из кэша")
-            return fallback if fallback else f"❌ Сообщение {message_key} неактивно"
-        else:
-            logging.warning(f"Сообщение {message_key} не найдено в базе данных")
-            # Если сообщение не найдено в базе, удаляем из кэша
-            if message_key in _messages_cache:
-                del _messages_cache[message_key]
-    except Exception as e:
-        logging.error(f"Ошибка получения сообщения {message_key}: {e}")
-        # В случае ошибки, не прерываем выполнение, продолжаем с кэшем
-    
-    # Если не удалось получить из базы, проверяем кэш
-    if message_key in _messages_cache:
-        cached_content = _messages_cache[message_key]
-        logging.info(f"Использовано сообщение {message_key} из кэша: {cached_content[:50]}...")
-        return cached_content
+    content = _messages_cache.get(message_key)
+    if content is not None:
+        return content
     
     # Возвращаем fallback или сообщение об ошибке
     if fallback:
         return fallback
     
+    logging.warning(f"Сообщение {message_key} не найдено или неактивно")
     return f"❌ Сообщение {message_key} не найдено"
 
+def _schedule_version_check():
+    """Запускает фоновую сверку версии, если с прошлой прошло больше интервала"""
+    global _version_check_task
+    if time.monotonic() - _version_checked_at < BOT_MESSAGES_VERSION_CHECK_INTERVAL:
+        return
+    if _version_check_task is not None and not _version_check_task.done():
+        return
+    _version_check_task = asyncio.create_task(_check_version())
+
+async def _check_version():
+    """Перечитывает кэш, если версия сообщений в базе изменилась"""
+    global _version_checked_at
+    _version_checked_at = time.monotonic()
+    try:
+        from db import get_cache_version
+        if await get_cache_version('bot_messages') != _cache_version:
+            await _load_messages_cache()
+    except Exception as e:
+        logging.error(f"Ошибка проверки версии кэша сообщений: {e}")
+
 async def _load_messages_cache():
     """Загружает все активные сообщения в кэш"""
-    global _cache_loaded, _messages_cache
+    global _cache_loaded, _messages_cache, _cache_version, _version_checked_at
     
     try:
-        from db import get_bot_messages
-        messages = await get_bot_messages()
-        
-        for message in messages:
-            if message.get('is_active', False):
-                _messages_cache[message['message_key']] = message['content']
+        from db import get_active_bot_message_contents
+        version, messages = await get_active_bot_message_contents()
         
+        # Подменяем словарь целиком, чтобы читатели не видели частично загруженный кэш
+        _messages_cache = messages
+        _cache_version = version
+        _version_checked_at = time.monotonic()
         _cache_loaded = True
-        logging.info(f"Загружено {len(_messages_cache)} сообщений в кэш")
+        logging.info(f"Загружено {len(_messages_cache)} сообщений в кэш (версия {version})")
         
     except Exception as e:
         logging.error(f"Ошибка загрузки кэша сообщений: {e}")
         _cache_loaded = True  # Помечаем как загруженный, чтобы не пытаться снова
+        _version_checked_at = time.monotonic()
 
 def clear_cache():
     """Очищает кэш сообщений (для обновления после редактирования)"""
-    global _messages_cache, _cache_loaded
-    _messages_cache.clear()
+    global _messages_cache, _cache_loaded, _cache_version
+    _messages_cache = {}
     _cache_loaded = False
+    _cache_version = -1
     logging.info("Кэш сообщений очищен")
 
 async def refresh_cache():
@@ -103,11 +113,12 @@ async def update_message_in_cache(message_key: str, new_content: str):
     logging.info(f"Обновлено сообщение {message_key} в кэше: {new_content[:50]}...")
 
 async def invalidate_message_cache(message_key: str):
-    """Удаляет сообщение из кэша (заставит перезагрузить из базы)"""
-    global _messages_cache
+    """Удаляет сообщение из кэша и запрашивает сверку версии при следующем обращении"""
+    global _messages_cache, _version_checked_at
     if message_key in _messages_cache:
         del _messages_cache[message_key]
         logging.info(f"Удалено сообщение {message_key} из кэша")
+    _version_checked_at = 0.0
 
 async def force_refresh_message(message_key: str):
     """Принудительно обновляет конкретное сообщение из базы данных"""
@@ -131,10 +142,11 @@ async def force_refresh_message(message_key: str):
 
 async def get_message_content_realtime(message_key: str, fallback: str = None) -> str:
     """Получает сообщение с принудительным обновлением из базы данных (как get_welcome_message)"""
-    # Принудительно обновляем кэш
-    await invalidate_message_cache(message_key)
+    content = await force_refresh_message(message_key)
+    if content is not None:
+        return content
     
-    return await get_message_content(message_key, fallback, True)
+    return await get_message_content(message_key, fallback)
 
 # Предопределенные ключи сообщений для удобства
 MESSAGE_KEYS = {
@@ -159,18 +171,11 @@ MESSAGE_KEYS = {
 
 # Удобные функции для получения конкретных сообщений
 async def get_welcome_message(force_refresh: bool = False) -> str:
-    # Принудительно обновляем кэш
-    await invalidate_message_cache(MESSAGE_KEYS['WELCOME'])
-    
     return await get_message_content(MESSAGE_KEYS['WELCOME'], 
         None,  # Убираем hardcoded fallback
-        True)  # Всегда принудительно обновляем
+        force_refresh)
 
 async def get_phone_request(force_refresh: bool = False) -> str:
-    # Принудительно обновляем кэш для актуальных данных
-    if force_refresh:
-        await invalidate_message_cache(MESSAGE_KEYS['PHONE_REQUEST'])
-    
     return await get_message_content(MESSAGE_KEYS['PHONE_REQUEST'],
         None,  # Убираем hardcoded fallback
         force_refresh)
@@ -33,6 +33,7 @@ async def cleanup_all_order_photos():
         await db.execute('DELETE FROM main_hero_photos')
         await db.execute('DELETE FROM hero_photos')
         await db.execute('DELETE FROM joint_photos')
+        await db.execute("DELETE FROM photo_catalog WHERE source IN ('main_hero', 'hero', 'joint')")
         
         await db.commit()
         
@@ -69,12 +69,15 @@ async def clear_orders_table():
                 'sent_messages_log',
                 'delayed_messages', 
                 'timer_messages_sent',
-                'early_user_messages'
+                'early_user_messages',
+                'photo_catalog',
+                'delivery_jobs'
             ]
             
             # Таблицы с метриками, которые нужно очистить
             metrics_tables = [
-                'event_metrics'  # Основная таблица метрик (клики, выручка и т.д.)
+                'event_metrics',  # Основная таблица метрик (клики, выручка и т.д.)
+                'metrics_daily'  # Дневные сводки метрик
             ]
             
             for table in related_tables:
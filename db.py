@@ -1,12 +1,14 @@
 import aiosqlite
+import base64
 import json
 import os
 import glob
 import logging
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
 import asyncio
 from passlib.context import CryptContext
+from db_pool import configure_db_connection, get_pool, get_pool_stats, close_pools
 
 def get_moscow_time():
     """Возвращает текущее время в московском часовом поясе"""
@@ -19,6 +21,21 @@ def get_password_hash(password: str) -> str:
 
 DB_PATH = 'bookai.db'
 
+def db_connection(readonly: bool = False):
+    """
+    Берет соединение из общего пула процесса (см. db_pool.py).
+    readonly=True — одно из соединений на чтение, иначе — единственное соединение на запись.
+    """
+    return get_pool(DB_PATH).connection(readonly)
+
+def get_db_pool_stats() -> Dict:
+    """Размер пула соединений и счетчики ожидания/удержания"""
+    return get_pool_stats()
+
+async def close_db_pool():
+    """Закрывает соединения пула (при остановке процесса)"""
+    await close_pools()
+
 # Константа для списка оплаченных статусов (используется в метриках, аналитике и выгрузке)
 # Все статусы после 'paid' считаются оплаченными
 # ВАЖНО: 
@@ -64,758 +81,1044 @@ PAID_ORDER_STATUSES = [
     'additional_payment_paid'    # Дополнительная оплата получена
 ]
 
-async def init_db():
-    """Инициализирует базу данных, создавая все необходимые таблицы"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Настройки SQLite для лучшей производительности и предотвращения блокировок
-        await configure_db_connection(db)
-        
-        # Автоматически назначаем менеджеров к существующим заказам при инициализации
-        try:
-            print("🔧 Автоматическое назначение менеджеров к существующим заказам...")
-            result = await assign_managers_to_all_orders()
-            print(f"✅ {result['message']}")
-        except Exception as e:
-            print(f"❌ Ошибка автоматического назначения менеджеров: {e}")
-        
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS user_profiles (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                product TEXT,
-                relation TEXT,
-                main_hero_intro TEXT,
-                main_hero_photos TEXT,
-                heroes TEXT,
-                generated_book TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                status TEXT DEFAULT 'created',
-                order_data TEXT,
-                pdf_path TEXT,
-                mp3_path TEXT,
-                assigned_manager_id INTEGER,
-                first_last_design TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(user_id) REFERENCES user_profiles(user_id),
-                FOREIGN KEY(assigned_manager_id) REFERENCES managers(id)
-            )
-        ''')
-        
-        # Добавляем колонку first_last_design если её нет
-        try:
-            await db.execute('ALTER TABLE orders ADD COLUMN first_last_design TEXT')
-            print("✅ Колонка first_last_design добавлена в таблицу orders")
-        except aiosqlite.OperationalError as e:
-            if "duplicate column name" in str(e):
-                print("ℹ️ Колонка first_last_design уже существует")
-            else:
-                print(f"ℹ️ Колонка first_last_design: {e}")
-        
-        # Добавляем колонку first_page_text если её нет
-        try:
-            await db.execute('ALTER TABLE orders ADD COLUMN first_page_text TEXT')
-            print("✅ Колонка first_page_text добавлена в таблицу orders")
-        except aiosqlite.OperationalError as e:
-            if "duplicate column name" in str(e):
-                print("ℹ️ Колонка first_page_text уже существует")
-            else:
-                print(f"ℹ️ Колонка first_page_text: {e}")
-        
-        # Добавляем колонку last_page_text если её нет
-        try:
-            await db.execute('ALTER TABLE orders ADD COLUMN last_page_text TEXT')
-            print("✅ Колонка last_page_text добавлена в таблицу orders")
-        except aiosqlite.OperationalError as e:
-            if "duplicate column name" in str(e):
-                print("ℹ️ Колонка last_page_text уже существует")
-            else:
-                print(f"ℹ️ Колонка last_page_text: {e}")
-        
-        # Добавляем колонку total_amount если её нет
-        try:
-            await db.execute('ALTER TABLE orders ADD COLUMN total_amount REAL')
-            print("✅ Колонка total_amount добавлена в таблицу orders")
-        except aiosqlite.OperationalError as e:
-            if "duplicate column name" in str(e):
-                print("ℹ️ Колонка total_amount уже существует")
-            else:
-                print(f"ℹ️ Колонка total_amount: {e}")
-        
-        # Добавляем колонку sender_name если её нет
-        try:
-            await db.execute('ALTER TABLE orders ADD COLUMN sender_name TEXT')
-            print("✅ Колонка sender_name добавлена в таблицу orders")
-        except aiosqlite.OperationalError as e:
-            if "duplicate column name" in str(e):
-                print("ℹ️ Колонка sender_name уже существует")
-            else:
-                print(f"ℹ️ Колонка sender_name: {e}")
-        
-        # Добавляем колонку email если её нет
-        try:
-            await db.execute('ALTER TABLE orders ADD COLUMN email TEXT')
-            print("✅ Колонка email добавлена в таблицу orders")
-        except aiosqlite.OperationalError as e:
-            if "duplicate column name" in str(e):
-                print("ℹ️ Колонка email уже существует")
-            else:
-                print(f"ℹ️ Колонка email: {e}")
-        
-        # Добавляем колонку song_style_message_sent если её нет
-        try:
-            await db.execute('ALTER TABLE orders ADD COLUMN song_style_message_sent INTEGER DEFAULT 0')
-            print("✅ Колонка song_style_message_sent добавлена в таблицу orders")
-        except aiosqlite.OperationalError as e:
-            if "duplicate column name" in str(e):
-                print("ℹ️ Колонка song_style_message_sent уже существует")
-            else:
-                print(f"ℹ️ Колонка song_style_message_sent: {e}")
-        
-        # Добавляем колонку files если её нет в message_templates
-        try:
-            await db.execute('ALTER TABLE message_templates ADD COLUMN files TEXT')
-            print("✅ Колонка files добавлена в таблицу message_templates")
-        except aiosqlite.OperationalError as e:
-            if "duplicate column name" in str(e):
-                print("ℹ️ Колонка files уже существует")
-            else:
-                print(f"ℹ️ Колонка files: {e}")
-        
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS outbox (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER,
-                user_id INTEGER,
-                type TEXT, -- 'file', 'text', 'image_with_text_and_button' или 'manager_notification'
-                content TEXT, -- путь к файлу или текст сообщения
-                file_type TEXT, -- тип файла (если есть): pdf/mp3/jpg/итд
-                comment TEXT, -- комментарий к файлу (если есть)
-                button_text TEXT, -- текст кнопки (для image_with_text_and_button)
-                button_callback TEXT, -- callback_data кнопки (для image_with_text_and_button)
-                is_general_message INTEGER DEFAULT 0, -- флаг для общих сообщений (0=обычный файл, 1=общее сообщение)
-                status TEXT DEFAULT 'pending', -- pending/sent/failed
-                retry_count INTEGER DEFAULT 0, -- количество попыток отправки
-                max_retries INTEGER DEFAULT 5, -- максимальное количество попыток
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                sent_at DATETIME,
-                FOREIGN KEY(order_id) REFERENCES orders(id),
-                FOREIGN KEY(user_id) REFERENCES user_profiles(user_id)
-            )
-        ''')
-        
-        # Добавляем колонки retry_count и max_retries если их нет
-        try:
-            await db.execute('ALTER TABLE outbox ADD COLUMN retry_count INTEGER DEFAULT 0')
-        except Exception as e:
-            if "duplicate column name" not in str(e).lower():
-                print(f"ℹ️ Колонка retry_count: {e}")
-        
-        try:
-            await db.execute('ALTER TABLE outbox ADD COLUMN max_retries INTEGER DEFAULT 5')
-        except Exception as e:
-            if "duplicate column name" not in str(e).lower():
-                print(f"ℹ️ Колонка max_retries: {e}")
-        
-        try:
-            await db.execute('ALTER TABLE outbox ADD COLUMN is_general_message INTEGER DEFAULT 0')
-        except Exception as e:
-            if "duplicate column name" not in str(e).lower():
-                print(f"ℹ️ Колонка is_general_message: {e}")
-        # Новые таблицы для структуры заказа
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS characters (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER,
-                name TEXT,
-                intro TEXT,
-                face_1 TEXT,
-                face_2 TEXT,
-                full TEXT,
-                FOREIGN KEY(order_id) REFERENCES orders(id)
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS answers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER,
-                question TEXT,
-                answer TEXT,
-                FOREIGN KEY(order_id) REFERENCES orders(id)
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS main_hero_photos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER,
-                filename TEXT,
-                FOREIGN KEY(order_id) REFERENCES orders(id)
-            )
-        ''')
-        
-        # Таблица для фотографий других героев
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS hero_photos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER,
-                filename TEXT,
-                photo_type TEXT,
-                hero_name TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(order_id) REFERENCES orders(id)
-            )
-        ''')
-        
-        # Таблица для загруженных файлов
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS uploads (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER,
-                filename TEXT,
-                file_type TEXT,
-                uploaded_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(order_id) REFERENCES orders(id)
-            )
-        ''')
-        
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS joint_photos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER,
-                filename TEXT,
-                FOREIGN KEY(order_id) REFERENCES orders(id)
-            )
-        ''')
-        
-        # Таблица для предложений сюжетов
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS story_proposals (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER,
-                story_batch INTEGER,
-                stories TEXT, -- JSON с массивом сюжетов
-                pages TEXT, -- JSON с номерами страниц
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(order_id) REFERENCES orders(id)
-            )
-        ''')
-        
-        # Таблица для отслеживания номеров страниц
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS order_pages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER,
-                page_number INTEGER,
-                filename TEXT,
-                description TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(order_id) REFERENCES orders(id)
-            )
-        ''')
-        
-        # Таблица для шаблонов отложенных сообщений (новая система)
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS message_templates (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL, -- название шаблона
-                message_type TEXT NOT NULL, -- тип сообщения
-                content TEXT NOT NULL, -- текст сообщения
-                order_step TEXT, -- шаг заказа, на котором отправляется
-                delay_minutes INTEGER DEFAULT 0, -- задержка в минутах от начала шага
-                is_active BOOLEAN DEFAULT 1, -- активен ли шаблон
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                manager_id INTEGER, -- ID менеджера, создавшего шаблон
-                FOREIGN KEY(manager_id) REFERENCES managers(id)
-            )
-        ''')
-        
-        # Таблица для файлов шаблонов сообщений
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS message_template_files (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                template_id INTEGER, -- ID шаблона сообщения
-                file_path TEXT, -- путь к файлу
-                file_type TEXT, -- тип файла (photo, audio, document, video, gif)
-                file_name TEXT, -- оригинальное имя файла
-                file_size INTEGER, -- размер файла в байтах
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(template_id) REFERENCES message_templates(id) ON DELETE CASCADE
-            )
-        ''')
-        
-        # Таблица для отслеживания отправленных сообщений пользователям
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS sent_messages_log (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                template_id INTEGER, -- ID шаблона сообщения
-                user_id INTEGER, -- ID пользователя
-                order_id INTEGER, -- ID заказа
-                sent_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(template_id) REFERENCES message_templates(id),
-                FOREIGN KEY(user_id) REFERENCES user_profiles(user_id),
-                FOREIGN KEY(order_id) REFERENCES orders(id)
-            )
-        ''')
-        
-        # Старая таблица для отложенных сообщений (оставляем для совместимости)
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS delayed_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER,
-                user_id INTEGER,
-                manager_id INTEGER, -- ID менеджера, создавшего сообщение
-                message_type TEXT, -- 'demo_example', 'payment_reminder', 'final_reminder', 'auto_order_created', 'story_proposal', 'story_selection'
-                content TEXT, -- текст сообщения
-                delay_minutes INTEGER, -- задержка в минутах
-                status TEXT DEFAULT 'pending', -- pending/sent/failed
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                scheduled_at DATETIME,
-                sent_at DATETIME,
-                is_automatic BOOLEAN DEFAULT 0, -- автоматическое сообщение при создании заказа
-                order_step TEXT, -- шаг заказа для общих сообщений
-                story_batch INTEGER DEFAULT 0, -- номер партии сюжетов (1-5)
-                story_pages TEXT, -- номера страниц для сюжетов (JSON)
-                selected_stories TEXT, -- выбранные пользователем сюжеты (JSON)
-                is_active BOOLEAN DEFAULT 1, -- активен ли шаблон
-                usage_count INTEGER DEFAULT 0, -- количество использований
-                last_used DATETIME, -- последнее использование
-                FOREIGN KEY(order_id) REFERENCES orders(id),
-                FOREIGN KEY(user_id) REFERENCES user_profiles(user_id),
-                FOREIGN KEY(manager_id) REFERENCES managers(id)
-            )
-        ''')
-        
-        # Добавляем поле order_step, если его нет
-        try:
-            await db.execute('ALTER TABLE delayed_messages ADD COLUMN order_step TEXT')
-        except:
-            pass  # Поле уже существует
-        
-        # Добавляем новые поля для системы шаблонов
-        try:
-            await db.execute('ALTER TABLE delayed_messages ADD COLUMN is_active BOOLEAN DEFAULT 1')
-        except:
-            pass  # Поле уже существует
-        
-        try:
-            await db.execute('ALTER TABLE delayed_messages ADD COLUMN usage_count INTEGER DEFAULT 0')
-        except:
-            pass  # Поле уже существует
-        
-        try:
-            await db.execute('ALTER TABLE delayed_messages ADD COLUMN last_used DATETIME')
-        except:
-            pass  # Поле уже существует
-        
-        # Таблица для файлов отложенных сообщений
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS delayed_message_files (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                delayed_message_id INTEGER,
-                file_path TEXT, -- путь к файлу
-                file_type TEXT, -- тип файла (photo, audio, document)
-                file_name TEXT, -- оригинальное имя файла
-                file_size INTEGER, -- размер файла в байтах
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(delayed_message_id) REFERENCES delayed_messages(id) ON DELETE CASCADE
-            )
-        ''')
-        
-        # Таблица для отслеживания времени пользователей на этапах
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS user_step_timers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                order_id INTEGER NOT NULL,
-                order_step TEXT NOT NULL, -- этап на котором находится пользователь
-                product_type TEXT, -- тип продукта (Песня/Книга)
-                step_started_at DATETIME DEFAULT CURRENT_TIMESTAMP, -- когда пользователь попал на этап
-                step_updated_at DATETIME DEFAULT CURRENT_TIMESTAMP, -- последнее обновление
-                is_active BOOLEAN DEFAULT 1, -- активен ли таймер
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(user_id, order_id, order_step), -- один таймер на пользователя/заказ/этап
-                FOREIGN KEY(user_id) REFERENCES user_profiles(user_id),
-                FOREIGN KEY(order_id) REFERENCES orders(id) ON DELETE CASCADE
-            )
-        ''')
-        
-        # Таблица для отслеживания отправленных сообщений по таймерам
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS timer_messages_sent (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timer_id INTEGER NOT NULL,
-                template_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                order_id INTEGER NOT NULL,
-                message_type TEXT NOT NULL,
-                delay_minutes INTEGER NOT NULL,
-                sent_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(timer_id, template_id, delay_minutes), -- одно сообщение на таймер/шаблон/задержку
-                FOREIGN KEY(timer_id) REFERENCES user_step_timers(id) ON DELETE CASCADE,
-                FOREIGN KEY(template_id) REFERENCES message_templates(id),
-                FOREIGN KEY(user_id) REFERENCES user_profiles(user_id),
-                FOREIGN KEY(order_id) REFERENCES orders(id) ON DELETE CASCADE
-            )
-        ''')
-        
-        # Таблица для отслеживания отправленных общих сообщений
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS general_message_sent_log (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                delayed_message_id INTEGER,
-                user_id INTEGER,
-                order_id INTEGER,
-                sent_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(delayed_message_id) REFERENCES delayed_messages(id) ON DELETE CASCADE,
-                FOREIGN KEY(user_id) REFERENCES user_profiles(user_id),
-                FOREIGN KEY(order_id) REFERENCES orders(id),
-                UNIQUE(delayed_message_id, user_id, order_id)
-            )
-        ''')
-        
-        # Таблица для адресов доставки
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS delivery_addresses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER,
-                user_id INTEGER,
-                address TEXT,
-                recipient_name TEXT,
-                phone TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(order_id) REFERENCES orders(id),
-                FOREIGN KEY(user_id) REFERENCES user_profiles(user_id)
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS order_status_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER,
-                old_status TEXT,
-                new_status TEXT,
-                changed_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(order_id) REFERENCES orders(id)
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS message_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER,
-                sender TEXT, -- 'manager' или 'user'
-                message TEXT,
-                sent_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(order_id) REFERENCES orders(id)
-            )
-        ''')
-        
-        # Таблица для ранних сообщений пользователей (до создания заказа)
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS early_user_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                message TEXT,
-                sent_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS managers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                email TEXT UNIQUE NOT NULL,
-                hashed_password TEXT NOT NULL,
-                full_name TEXT NOT NULL,
-                is_super_admin BOOLEAN DEFAULT 0,
-                is_active BOOLEAN DEFAULT 1
-            )
-        ''')
+# --- Миграции схемы (PRAGMA user_version) ---
+# Каждый шаг выполняется один раз: после него номер шага записывается в user_version той же
+# транзакцией. Изменения схемы и разовые правки данных добавляются новым шагом в конец
+# SCHEMA_MIGRATIONS; уже выпущенные шаги не редактируются.
 
-        # Таблица для шаблонов обложек
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS cover_templates (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                filename TEXT NOT NULL,
-                category TEXT NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Таблица для стилей книг
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS book_styles (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                description TEXT NOT NULL,
-                filename TEXT NOT NULL,
-                category TEXT NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Таблица для стилей голоса
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS voice_styles (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                description TEXT NOT NULL,
-                filename TEXT NOT NULL,
-                gender TEXT DEFAULT 'male',
-                category TEXT NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Таблица для шаблона сводки заказа
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS order_summary_templates (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                gender_label TEXT DEFAULT 'Пол отправителя',
-                recipient_name_label TEXT DEFAULT 'Имя получателя',
-                gift_reason_label TEXT DEFAULT 'Повод',
-                relation_label TEXT DEFAULT 'Отношение',
-                style_label TEXT DEFAULT 'Стиль',
-                format_label TEXT DEFAULT 'Формат',
-                sender_name_label TEXT DEFAULT 'От кого',
-                song_gender_label TEXT DEFAULT 'Пол отправителя',
-                song_recipient_name_label TEXT DEFAULT 'Имя получателя',
-                song_gift_reason_label TEXT DEFAULT 'Повод',
-                song_relation_label TEXT DEFAULT 'Отношение',
-                song_style_label TEXT DEFAULT 'Стиль',
-                song_voice_label TEXT DEFAULT 'Голос',
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Добавляем поле gender, если его нет
-        try:
-            await db.execute('ALTER TABLE voice_styles ADD COLUMN gender TEXT DEFAULT "male"')
-        except:
-            pass  # Поле уже существует
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS manager_queue (
-                id INTEGER PRIMARY KEY,
-                last_manager_id INTEGER DEFAULT 0
-            )
-        ''')
-        
-        # Таблица для цен
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS pricing_items (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                product TEXT NOT NULL,
-                price REAL NOT NULL,
-                currency TEXT DEFAULT 'RUB',
-                description TEXT,
-                upgrade_price_difference REAL DEFAULT 0, -- Разница в цене при апгрейде
-                is_active BOOLEAN DEFAULT 1,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Добавляем колонку upgrade_price_difference если её нет
-        try:
-            await db.execute('ALTER TABLE pricing_items ADD COLUMN upgrade_price_difference REAL DEFAULT 0')
-            print("✅ Колонка upgrade_price_difference добавлена в таблицу pricing_items")
-        except aiosqlite.OperationalError as e:
-            if "duplicate column name" in str(e):
-                print("ℹ️ Колонка upgrade_price_difference уже существует")
-            else:
-                print(f"ℹ️ Колонка upgrade_price_difference: {e}")
-        
-        # Таблица для шагов контента
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS content_steps (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                step_key TEXT NOT NULL UNIQUE,
-                step_name TEXT NOT NULL,
-                content_type TEXT DEFAULT 'text',
-                content TEXT NOT NULL,
-                materials TEXT,
-                is_active BOOLEAN DEFAULT 1,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Таблица квиза для песни (редактируемые тексты вопросов по связям)
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS song_quiz (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                relation_key TEXT NOT NULL,
-                author_gender TEXT NOT NULL, -- 'male' | 'female'
-                title TEXT DEFAULT '',
-                intro TEXT NOT NULL,
-                phrases_hint TEXT DEFAULT '',
-                questions_json TEXT NOT NULL, -- JSON массив из 8 пунктов
-                outro TEXT DEFAULT '',
-                is_active BOOLEAN DEFAULT 1,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(relation_key, author_gender)
-            )
-        ''')
-        
-        # Таблица для автоматического сбора всех сообщений бота
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS bot_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                message_key TEXT UNIQUE NOT NULL,
-                message_name TEXT NOT NULL,
-                content TEXT NOT NULL,
-                context TEXT, -- Контекст сообщения (например: "welcome", "photo_upload", "payment")
-                stage TEXT, -- Этап бота (например: "start", "character_creation", "payment")
-                sort_order INTEGER DEFAULT 0, -- Порядок сортировки
-                is_editable BOOLEAN NOT NULL DEFAULT 1,
-                is_active BOOLEAN NOT NULL DEFAULT 1,
-                usage_count INTEGER DEFAULT 0, -- Сколько раз использовалось
-                last_used DATETIME,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        # Таблица для трекинга метрик событий
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS event_metrics (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                event_type TEXT NOT NULL,
-                event_data TEXT, -- JSON данные события
-                step_name TEXT, -- Название шага (для отвалов)
-                product_type TEXT, -- Тип продукта (книга/песня)
-                order_id INTEGER, -- ID заказа (если применимо)
-                amount REAL, -- Сумма (для покупок)
-                source TEXT, -- Источник (канал/кампания)
-                utm_source TEXT, -- UTM source
-                utm_medium TEXT, -- UTM medium
-                utm_campaign TEXT, -- UTM campaign
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Добавляем UTM-колонки если их нет
-        try:
-            await db.execute('ALTER TABLE event_metrics ADD COLUMN utm_source TEXT')
-            print("✅ Колонка utm_source добавлена в таблицу event_metrics")
-        except aiosqlite.OperationalError as e:
-            if "duplicate column name" not in str(e):
-                print(f"⚠️ Ошибка добавления utm_source: {e}")
-        
-        try:
-            await db.execute('ALTER TABLE event_metrics ADD COLUMN utm_medium TEXT')
-            print("✅ Колонка utm_medium добавлена в таблицу event_metrics")
-        except aiosqlite.OperationalError as e:
-            if "duplicate column name" not in str(e):
-                print(f"⚠️ Ошибка добавления utm_medium: {e}")
-        
-        try:
-            await db.execute('ALTER TABLE event_metrics ADD COLUMN utm_campaign TEXT')
-            print("✅ Колонка utm_campaign добавлена в таблицу event_metrics")
-        except aiosqlite.OperationalError as e:
-            if "duplicate column name" not in str(e):
-                print(f"⚠️ Ошибка добавления utm_campaign: {e}")
-        
-        # Добавляем UTM-колонки в таблицу orders если их нет
-        try:
-            await db.execute('ALTER TABLE orders ADD COLUMN source TEXT')
-            print("✅ Колонка source добавлена в таблицу orders")
-        except aiosqlite.OperationalError as e:
-            if "duplicate column name" not in str(e):
-                print(f"⚠️ Ошибка добавления source: {e}")
-        
-        try:
-            await db.execute('ALTER TABLE orders ADD COLUMN utm_source TEXT')
-            print("✅ Колонка utm_source добавлена в таблицу orders")
-        except aiosqlite.OperationalError as e:
-            if "duplicate column name" not in str(e):
-                print(f"⚠️ Ошибка добавления utm_source: {e}")
-        
-        try:
-            await db.execute('ALTER TABLE orders ADD COLUMN utm_medium TEXT')
-            print("✅ Колонка utm_medium добавлена в таблицу orders")
-        except aiosqlite.OperationalError as e:
-            if "duplicate column name" not in str(e):
-                print(f"⚠️ Ошибка добавления utm_medium: {e}")
-        
-        try:
-            await db.execute('ALTER TABLE orders ADD COLUMN utm_campaign TEXT')
-            print("✅ Колонка utm_campaign добавлена в таблицу orders")
-        except aiosqlite.OperationalError as e:
-            if "duplicate column name" not in str(e):
-                print(f"⚠️ Ошибка добавления utm_campaign: {e}")
+async def _migration_base_schema(db):
+    """Таблицы, колонки и индексы на момент перехода на версии схемы (идемпотентно и для старых баз)"""
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS user_profiles (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            product TEXT,
+            relation TEXT,
+            main_hero_intro TEXT,
+            main_hero_photos TEXT,
+            heroes TEXT,
+            generated_book TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            status TEXT DEFAULT 'created',
+            order_data TEXT,
+            pdf_path TEXT,
+            mp3_path TEXT,
+            assigned_manager_id INTEGER,
+            first_last_design TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(user_id) REFERENCES user_profiles(user_id),
+            FOREIGN KEY(assigned_manager_id) REFERENCES managers(id)
+        )
+    ''')
+    
+    # Добавляем колонку first_last_design если её нет
+    try:
+        await db.execute('ALTER TABLE orders ADD COLUMN first_last_design TEXT')
+        print("✅ Колонка first_last_design добавлена в таблицу orders")
+    except aiosqlite.OperationalError as e:
+        if "duplicate column name" in str(e):
+            print("ℹ️ Колонка first_last_design уже существует")
+        else:
+            print(f"ℹ️ Колонка first_last_design: {e}")
+    
+    # Добавляем колонку first_page_text если её нет
+    try:
+        await db.execute('ALTER TABLE orders ADD COLUMN first_page_text TEXT')
+        print("✅ Колонка first_page_text добавлена в таблицу orders")
+    except aiosqlite.OperationalError as e:
+        if "duplicate column name" in str(e):
+            print("ℹ️ Колонка first_page_text уже существует")
+        else:
+            print(f"ℹ️ Колонка first_page_text: {e}")
+    
+    # Добавляем колонку last_page_text если её нет
+    try:
+        await db.execute('ALTER TABLE orders ADD COLUMN last_page_text TEXT')
+        print("✅ Колонка last_page_text добавлена в таблицу orders")
+    except aiosqlite.OperationalError as e:
+        if "duplicate column name" in str(e):
+            print("ℹ️ Колонка last_page_text уже существует")
+        else:
+            print(f"ℹ️ Колонка last_page_text: {e}")
+    
+    # Добавляем колонку total_amount если её нет
+    try:
+        await db.execute('ALTER TABLE orders ADD COLUMN total_amount REAL')
+        print("✅ Колонка total_amount добавлена в таблицу orders")
+    except aiosqlite.OperationalError as e:
+        if "duplicate column name" in str(e):
+            print("ℹ️ Колонка total_amount уже существует")
+        else:
+            print(f"ℹ️ Колонка total_amount: {e}")
+    
+    # Добавляем колонку sender_name если её нет
+    try:
+        await db.execute('ALTER TABLE orders ADD COLUMN sender_name TEXT')
+        print("✅ Колонка sender_name добавлена в таблицу orders")
+    except aiosqlite.OperationalError as e:
+        if "duplicate column name" in str(e):
+            print("ℹ️ Колонка sender_name уже существует")
+        else:
+            print(f"ℹ️ Колонка sender_name: {e}")
+    
+    # Добавляем колонку email если её нет
+    try:
+        await db.execute('ALTER TABLE orders ADD COLUMN email TEXT')
+        print("✅ Колонка email добавлена в таблицу orders")
+    except aiosqlite.OperationalError as e:
+        if "duplicate column name" in str(e):
+            print("ℹ️ Колонка email уже существует")
+        else:
+            print(f"ℹ️ Колонка email: {e}")
+    
+    # Добавляем колонку song_style_message_sent если её нет
+    try:
+        await db.execute('ALTER TABLE orders ADD COLUMN song_style_message_sent INTEGER DEFAULT 0')
+        print("✅ Колонка song_style_message_sent добавлена в таблицу orders")
+    except aiosqlite.OperationalError as e:
+        if "duplicate column name" in str(e):
+            print("ℹ️ Колонка song_style_message_sent уже существует")
+        else:
+            print(f"ℹ️ Колонка song_style_message_sent: {e}")
 
-        # Создаем индексы для быстрого поиска
-        await db.execute('''
-            CREATE INDEX IF NOT EXISTS idx_event_metrics_user_id ON event_metrics(user_id)
-        ''')
-        await db.execute('''
-            CREATE INDEX IF NOT EXISTS idx_event_metrics_event_type ON event_metrics(event_type)
-        ''')
-        await db.execute('''
-            CREATE INDEX IF NOT EXISTS idx_event_metrics_timestamp ON event_metrics(timestamp)
-        ''')
-        await db.execute('''
-            CREATE INDEX IF NOT EXISTS idx_event_metrics_order_id ON event_metrics(order_id)
-        ''')
-        
-        # Таблица для уведомлений о новых сообщениях от пользователей
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS order_notifications (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER NOT NULL,
-                manager_id INTEGER, -- ID менеджера, которому назначен заказ
-                is_read BOOLEAN DEFAULT 0, -- прочитано ли уведомление
-                last_user_message_at DATETIME, -- время последнего сообщения от пользователя
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(order_id) REFERENCES orders(id) ON DELETE CASCADE,
-                FOREIGN KEY(manager_id) REFERENCES managers(id) ON DELETE SET NULL,
-                UNIQUE(order_id) -- один заказ = одно уведомление
-            )
-        ''')
-        
-        # Создаем индексы для быстрого поиска уведомлений
-        await db.execute('''
-            CREATE INDEX IF NOT EXISTS idx_order_notifications_manager_id ON order_notifications(manager_id)
-        ''')
-        await db.execute('''
-            CREATE INDEX IF NOT EXISTS idx_order_notifications_is_read ON order_notifications(is_read)
-        ''')
-        await db.execute('''
-            CREATE INDEX IF NOT EXISTS idx_order_notifications_order_id ON order_notifications(order_id)
-        ''')
-        
-        # Вставляем начальную запись, если её нет
-        await db.execute('''
-            INSERT OR IGNORE INTO manager_queue (id, last_manager_id) VALUES (1, 0)
-        ''')
-        await db.commit()
+    # Индексы постраничного списка заказов: ORDER BY created_at DESC, id DESC с курсором (created_at, id)
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders(created_at, id)
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_orders_manager_created_at ON orders(assigned_manager_id, created_at, id)
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_orders_status_created_at ON orders(status, created_at, id)
+    ''')
 
-async def save_user_profile(user_data: dict, generated_book: str = None):
-    """Сохраняет профиль пользователя и сгенерированную книгу"""
-    async def _save_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Настраиваем соединение
-            await configure_db_connection(db)
-            
-            # Очищаем None значения
-            username = user_data.get('username') if user_data.get('username') and user_data.get('username') != "None" else None
-            first_name = user_data.get('first_name') if user_data.get('first_name') and user_data.get('first_name') != "None" else None
-            last_name = user_data.get('last_name') if user_data.get('last_name') and user_data.get('last_name') != "None" else None
-            
-            await db.execute('''
-                INSERT OR REPLACE INTO user_profiles 
-                (user_id, username, first_name, last_name, product, relation, 
+    # Индексы для дельта-синхронизации списка заказов (since=<cursor> по updated_at)
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_orders_updated_at ON orders(updated_at)
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_orders_manager_updated_at ON orders(assigned_manager_id, updated_at)
+    ''')
+
+    # Добавляем колонку files если её нет в message_templates
+    try:
+        await db.execute('ALTER TABLE message_templates ADD COLUMN files TEXT')
+        print("✅ Колонка files добавлена в таблицу message_templates")
+    except aiosqlite.OperationalError as e:
+        if "duplicate column name" in str(e):
+            print("ℹ️ Колонка files уже существует")
+        else:
+            print(f"ℹ️ Колонка files: {e}")
+    
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            user_id INTEGER,
+            type TEXT, -- 'file', 'text', 'image_with_text_and_button' или 'manager_notification'
+            content TEXT, -- путь к файлу или текст сообщения
+            file_type TEXT, -- тип файла (если есть): pdf/mp3/jpg/итд
+            comment TEXT, -- комментарий к файлу (если есть)
+            button_text TEXT, -- текст кнопки (для image_with_text_and_button)
+            button_callback TEXT, -- callback_data кнопки (для image_with_text_and_button)
+            is_general_message INTEGER DEFAULT 0, -- флаг для общих сообщений (0=обычный файл, 1=общее сообщение)
+            status TEXT DEFAULT 'pending', -- pending/sent/failed
+            retry_count INTEGER DEFAULT 0, -- количество попыток отправки
+            max_retries INTEGER DEFAULT 5, -- максимальное количество попыток
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            sent_at DATETIME,
+            FOREIGN KEY(order_id) REFERENCES orders(id),
+            FOREIGN KEY(user_id) REFERENCES user_profiles(user_id)
+        )
+    ''')
+    
+    # Добавляем колонки retry_count и max_retries если их нет
+    try:
+        await db.execute('ALTER TABLE outbox ADD COLUMN retry_count INTEGER DEFAULT 0')
+    except Exception as e:
+        if "duplicate column name" not in str(e).lower():
+            print(f"ℹ️ Колонка retry_count: {e}")
+    
+    try:
+        await db.execute('ALTER TABLE outbox ADD COLUMN max_retries INTEGER DEFAULT 5')
+    except Exception as e:
+        if "duplicate column name" not in str(e).lower():
+            print(f"ℹ️ Колонка max_retries: {e}")
+    
+    try:
+        await db.execute('ALTER TABLE outbox ADD COLUMN is_general_message INTEGER DEFAULT 0')
+    except Exception as e:
+        if "duplicate column name" not in str(e).lower():
+            print(f"ℹ️ Колонка is_general_message: {e}")
+
+    # Аренда задачи диспетчером: до lease_until задачу повторно никто не забирает
+    try:
+        await db.execute('ALTER TABLE outbox ADD COLUMN lease_until DATETIME')
+    except Exception as e:
+        if "duplicate column name" not in str(e).lower():
+            print(f"ℹ️ Колонка lease_until: {e}")
+
+    # Задание доставки из админки (delivery_jobs), к которому относится задача
+    try:
+        await db.execute('ALTER TABLE outbox ADD COLUMN job_id INTEGER')
+    except Exception as e:
+        if "duplicate column name" not in str(e).lower():
+            print(f"ℹ️ Колонка job_id: {e}")
+
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_outbox_status_created_at ON outbox(status, created_at)
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_outbox_job_id ON outbox(job_id)
+    ''')
+
+    # Массовые отправки менеджера (страницы, демо-контент, обложки): HTTP-запрос только сохраняет
+    # файлы и ставит задачи в outbox, а прогресс задания считается по статусам этих задач
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS delivery_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            kind TEXT, -- covers, demo_content, pages_selection, pages_upload
+            total INTEGER DEFAULT 0, -- число задач outbox в задании
+            created_by TEXT, -- менеджер, создавший задание
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(order_id) REFERENCES orders(id)
+        )
+    ''')
+    # Новые таблицы для структуры заказа
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS characters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            name TEXT,
+            intro TEXT,
+            face_1 TEXT,
+            face_2 TEXT,
+            full TEXT,
+            FOREIGN KEY(order_id) REFERENCES orders(id)
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS answers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            question TEXT,
+            answer TEXT,
+            FOREIGN KEY(order_id) REFERENCES orders(id)
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS main_hero_photos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            filename TEXT,
+            FOREIGN KEY(order_id) REFERENCES orders(id)
+        )
+    ''')
+    
+    # Таблица для фотографий других героев
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS hero_photos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            filename TEXT,
+            photo_type TEXT,
+            hero_name TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(order_id) REFERENCES orders(id)
+        )
+    ''')
+    
+    # Таблица для загруженных файлов
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS uploads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            filename TEXT,
+            file_type TEXT,
+            uploaded_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(order_id) REFERENCES orders(id)
+        )
+    ''')
+    
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS joint_photos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            filename TEXT,
+            FOREIGN KEY(order_id) REFERENCES orders(id)
+        )
+    ''')
+    
+    # Таблица для предложений сюжетов
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS story_proposals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            story_batch INTEGER,
+            stories TEXT, -- JSON с массивом сюжетов
+            pages TEXT, -- JSON с номерами страниц
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(order_id) REFERENCES orders(id)
+        )
+    ''')
+    
+    # Таблица для отслеживания номеров страниц
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS order_pages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            page_number INTEGER,
+            filename TEXT,
+            description TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(order_id) REFERENCES orders(id)
+        )
+    ''')
+    
+    # Таблица для шаблонов отложенных сообщений (новая система)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS message_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL, -- название шаблона
+            message_type TEXT NOT NULL, -- тип сообщения
+            content TEXT NOT NULL, -- текст сообщения
+            order_step TEXT, -- шаг заказа, на котором отправляется
+            delay_minutes INTEGER DEFAULT 0, -- задержка в минутах от начала шага
+            is_active BOOLEAN DEFAULT 1, -- активен ли шаблон
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            manager_id INTEGER, -- ID менеджера, создавшего шаблон
+            FOREIGN KEY(manager_id) REFERENCES managers(id)
+        )
+    ''')
+    
+    # Таблица для файлов шаблонов сообщений
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS message_template_files (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            template_id INTEGER, -- ID шаблона сообщения
+            file_path TEXT, -- путь к файлу
+            file_type TEXT, -- тип файла (photo, audio, document, video, gif)
+            file_name TEXT, -- оригинальное имя файла
+            file_size INTEGER, -- размер файла в байтах
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(template_id) REFERENCES message_templates(id) ON DELETE CASCADE
+        )
+    ''')
+    
+    # Таблица для отслеживания отправленных сообщений пользователям
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS sent_messages_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            template_id INTEGER, -- ID шаблона сообщения
+            user_id INTEGER, -- ID пользователя
+            order_id INTEGER, -- ID заказа
+            sent_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(template_id) REFERENCES message_templates(id),
+            FOREIGN KEY(user_id) REFERENCES user_profiles(user_id),
+            FOREIGN KEY(order_id) REFERENCES orders(id)
+        )
+    ''')
+    
+    # Старая таблица для отложенных сообщений (оставляем для совместимости)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS delayed_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            user_id INTEGER,
+            manager_id INTEGER, -- ID менеджера, создавшего сообщение
+            message_type TEXT, -- 'demo_example', 'payment_reminder', 'final_reminder', 'auto_order_created', 'story_proposal', 'story_selection'
+            content TEXT, -- текст сообщения
+            delay_minutes INTEGER, -- задержка в минутах
+            status TEXT DEFAULT 'pending', -- pending/sent/failed
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            scheduled_at DATETIME,
+            sent_at DATETIME,
+            is_automatic BOOLEAN DEFAULT 0, -- автоматическое сообщение при создании заказа
+            order_step TEXT, -- шаг заказа для общих сообщений
+            story_batch INTEGER DEFAULT 0, -- номер партии сюжетов (1-5)
+            story_pages TEXT, -- номера страниц для сюжетов (JSON)
+            selected_stories TEXT, -- выбранные пользователем сюжеты (JSON)
+            is_active BOOLEAN DEFAULT 1, -- активен ли шаблон
+            usage_count INTEGER DEFAULT 0, -- количество использований
+            last_used DATETIME, -- последнее использование
+            FOREIGN KEY(order_id) REFERENCES orders(id),
+            FOREIGN KEY(user_id) REFERENCES user_profiles(user_id),
+            FOREIGN KEY(manager_id) REFERENCES managers(id)
+        )
+    ''')
+    
+    # Добавляем поле order_step, если его нет
+    try:
+        await db.execute('ALTER TABLE delayed_messages ADD COLUMN order_step TEXT')
+    except:
+        pass  # Поле уже существует
+    
+    # Добавляем новые поля для системы шаблонов
+    try:
+        await db.execute('ALTER TABLE delayed_messages ADD COLUMN is_active BOOLEAN DEFAULT 1')
+    except:
+        pass  # Поле уже существует
+    
+    try:
+        await db.execute('ALTER TABLE delayed_messages ADD COLUMN usage_count INTEGER DEFAULT 0')
+    except:
+        pass  # Поле уже существует
+    
+    try:
+        await db.execute('ALTER TABLE delayed_messages ADD COLUMN last_used DATETIME')
+    except:
+        pass  # Поле уже существует
+    
+    # Таблица для файлов отложенных сообщений
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS delayed_message_files (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            delayed_message_id INTEGER,
+            file_path TEXT, -- путь к файлу
+            file_type TEXT, -- тип файла (photo, audio, document)
+            file_name TEXT, -- оригинальное имя файла
+            file_size INTEGER, -- размер файла в байтах
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(delayed_message_id) REFERENCES delayed_messages(id) ON DELETE CASCADE
+        )
+    ''')
+    
+    # Таблица для отслеживания времени пользователей на этапах
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS user_step_timers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            order_id INTEGER NOT NULL,
+            order_step TEXT NOT NULL, -- этап на котором находится пользователь
+            product_type TEXT, -- тип продукта (Песня/Книга)
+            step_started_at DATETIME DEFAULT CURRENT_TIMESTAMP, -- когда пользователь попал на этап
+            step_updated_at DATETIME DEFAULT CURRENT_TIMESTAMP, -- последнее обновление
+            is_active BOOLEAN DEFAULT 1, -- активен ли таймер
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_id, order_id, order_step), -- один таймер на пользователя/заказ/этап
+            FOREIGN KEY(user_id) REFERENCES user_profiles(user_id),
+            FOREIGN KEY(order_id) REFERENCES orders(id) ON DELETE CASCADE
+        )
+    ''')
+    
+    # Таблица для отслеживания отправленных сообщений по таймерам
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS timer_messages_sent (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timer_id INTEGER NOT NULL,
+            template_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            order_id INTEGER NOT NULL,
+            message_type TEXT NOT NULL,
+            delay_minutes INTEGER NOT NULL,
+            sent_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(timer_id, template_id, delay_minutes), -- одно сообщение на таймер/шаблон/задержку
+            FOREIGN KEY(timer_id) REFERENCES user_step_timers(id) ON DELETE CASCADE,
+            FOREIGN KEY(template_id) REFERENCES message_templates(id),
+            FOREIGN KEY(user_id) REFERENCES user_profiles(user_id),
+            FOREIGN KEY(order_id) REFERENCES orders(id) ON DELETE CASCADE
+        )
+    ''')
+    
+    # Таблица для отслеживания отправленных общих сообщений
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS general_message_sent_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            delayed_message_id INTEGER,
+            user_id INTEGER,
+            order_id INTEGER,
+            sent_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(delayed_message_id) REFERENCES delayed_messages(id) ON DELETE CASCADE,
+            FOREIGN KEY(user_id) REFERENCES user_profiles(user_id),
+            FOREIGN KEY(order_id) REFERENCES orders(id),
+            UNIQUE(delayed_message_id, user_id, order_id)
+        )
+    ''')
+    
+    # Таблица для адресов доставки
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS delivery_addresses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            user_id INTEGER,
+            address TEXT,
+            recipient_name TEXT,
+            phone TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(order_id) REFERENCES orders(id),
+            FOREIGN KEY(user_id) REFERENCES user_profiles(user_id)
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS order_status_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            old_status TEXT,
+            new_status TEXT,
+            changed_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(order_id) REFERENCES orders(id)
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS message_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            sender TEXT, -- 'manager' или 'user'
+            message TEXT,
+            sent_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(order_id) REFERENCES orders(id)
+        )
+    ''')
+    
+    # Таблица для ранних сообщений пользователей (до создания заказа)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS early_user_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            message TEXT,
+            sent_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS managers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            hashed_password TEXT NOT NULL,
+            full_name TEXT NOT NULL,
+            is_super_admin BOOLEAN DEFAULT 0,
+            is_active BOOLEAN DEFAULT 1
+        )
+    ''')
+
+    # Таблица для шаблонов обложек
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS cover_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            category TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Таблица для стилей книг
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS book_styles (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            description TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            category TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Таблица для стилей голоса
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS voice_styles (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            description TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            gender TEXT DEFAULT 'male',
+            category TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Таблица для шаблона сводки заказа
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS order_summary_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            gender_label TEXT DEFAULT 'Пол отправителя',
+            recipient_name_label TEXT DEFAULT 'Имя получателя',
+            gift_reason_label TEXT DEFAULT 'Повод',
+            relation_label TEXT DEFAULT 'Отношение',
+            style_label TEXT DEFAULT 'Стиль',
+            format_label TEXT DEFAULT 'Формат',
+            sender_name_label TEXT DEFAULT 'От кого',
+            song_gender_label TEXT DEFAULT 'Пол отправителя',
+            song_recipient_name_label TEXT DEFAULT 'Имя получателя',
+            song_gift_reason_label TEXT DEFAULT 'Повод',
+            song_relation_label TEXT DEFAULT 'Отношение',
+            song_style_label TEXT DEFAULT 'Стиль',
+            song_voice_label TEXT DEFAULT 'Голос',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Добавляем поле gender, если его нет
+    try:
+        await db.execute('ALTER TABLE voice_styles ADD COLUMN gender TEXT DEFAULT "male"')
+    except:
+        pass  # Поле уже существует
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS manager_queue (
+            id INTEGER PRIMARY KEY,
+            last_manager_id INTEGER DEFAULT 0
+        )
+    ''')
+    
+    # Таблица для цен
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS pricing_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product TEXT NOT NULL,
+            price REAL NOT NULL,
+            currency TEXT DEFAULT 'RUB',
+            description TEXT,
+            upgrade_price_difference REAL DEFAULT 0, -- Разница в цене при апгрейде
+            is_active BOOLEAN DEFAULT 1,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Добавляем колонку upgrade_price_difference если её нет
+    try:
+        await db.execute('ALTER TABLE pricing_items ADD COLUMN upgrade_price_difference REAL DEFAULT 0')
+        print("✅ Колонка upgrade_price_difference добавлена в таблицу pricing_items")
+    except aiosqlite.OperationalError as e:
+        if "duplicate column name" in str(e):
+            print("ℹ️ Колонка upgrade_price_difference уже существует")
+        else:
+            print(f"ℹ️ Колонка upgrade_price_difference: {e}")
+    
+    # Таблица для шагов контента
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS content_steps (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            step_key TEXT NOT NULL UNIQUE,
+            step_name TEXT NOT NULL,
+            content_type TEXT DEFAULT 'text',
+            content TEXT NOT NULL,
+            materials TEXT,
+            is_active BOOLEAN DEFAULT 1,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Таблица квиза для песни (редактируемые тексты вопросов по связям)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS song_quiz (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            relation_key TEXT NOT NULL,
+            author_gender TEXT NOT NULL, -- 'male' | 'female'
+            title TEXT DEFAULT '',
+            intro TEXT NOT NULL,
+            phrases_hint TEXT DEFAULT '',
+            questions_json TEXT NOT NULL, -- JSON массив из 8 пунктов
+            outro TEXT DEFAULT '',
+            is_active BOOLEAN DEFAULT 1,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(relation_key, author_gender)
+        )
+    ''')
+    
+    # Таблица для автоматического сбора всех сообщений бота
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS bot_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_key TEXT UNIQUE NOT NULL,
+            message_name TEXT NOT NULL,
+            content TEXT NOT NULL,
+            context TEXT, -- Контекст сообщения (например: "welcome", "photo_upload", "payment")
+            stage TEXT, -- Этап бота (например: "start", "character_creation", "payment")
+            sort_order INTEGER DEFAULT 0, -- Порядок сортировки
+            is_editable BOOLEAN NOT NULL DEFAULT 1,
+            is_active BOOLEAN NOT NULL DEFAULT 1,
+            usage_count INTEGER DEFAULT 0, -- Сколько раз использовалось
+            last_used DATETIME,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Версии кэшируемых в памяти таблиц: процессы бота и админки сверяют их,
+    # чтобы узнать об изменениях без перечитывания самих таблиц
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Журнал изменений заказов (пишут и бот, и админка): по нему админка рассылает
+    # события открытым вкладкам через /admin/events вместо опроса списка заказов
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS order_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            event_type TEXT NOT NULL, -- order_changed, message, notification
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Таблица для трекинга метрик событий
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS event_metrics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            event_type TEXT NOT NULL,
+            event_data TEXT, -- JSON данные события
+            step_name TEXT, -- Название шага (для отвалов)
+            product_type TEXT, -- Тип продукта (книга/песня)
+            order_id INTEGER, -- ID заказа (если применимо)
+            amount REAL, -- Сумма (для покупок)
+            source TEXT, -- Источник (канал/кампания)
+            utm_source TEXT, -- UTM source
+            utm_medium TEXT, -- UTM medium
+            utm_campaign TEXT, -- UTM campaign
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Добавляем UTM-колонки если их нет
+    try:
+        await db.execute('ALTER TABLE event_metrics ADD COLUMN utm_source TEXT')
+        print("✅ Колонка utm_source добавлена в таблицу event_metrics")
+    except aiosqlite.OperationalError as e:
+        if "duplicate column name" not in str(e):
+            print(f"⚠️ Ошибка добавления utm_source: {e}")
+    
+    try:
+        await db.execute('ALTER TABLE event_metrics ADD COLUMN utm_medium TEXT')
+        print("✅ Колонка utm_medium добавлена в таблицу event_metrics")
+    except aiosqlite.OperationalError as e:
+        if "duplicate column name" not in str(e):
+            print(f"⚠️ Ошибка добавления utm_medium: {e}")
+    
+    try:
+        await db.execute('ALTER TABLE event_metrics ADD COLUMN utm_campaign TEXT')
+        print("✅ Колонка utm_campaign добавлена в таблицу event_metrics")
+    except aiosqlite.OperationalError as e:
+        if "duplicate column name" not in str(e):
+            print(f"⚠️ Ошибка добавления utm_campaign: {e}")
+    
+    # Добавляем UTM-колонки в таблицу orders если их нет
+    try:
+        await db.execute('ALTER TABLE orders ADD COLUMN source TEXT')
+        print("✅ Колонка source добавлена в таблицу orders")
+    except aiosqlite.OperationalError as e:
+        if "duplicate column name" not in str(e):
+            print(f"⚠️ Ошибка добавления source: {e}")
+    
+    try:
+        await db.execute('ALTER TABLE orders ADD COLUMN utm_source TEXT')
+        print("✅ Колонка utm_source добавлена в таблицу orders")
+    except aiosqlite.OperationalError as e:
+        if "duplicate column name" not in str(e):
+            print(f"⚠️ Ошибка добавления utm_source: {e}")
+    
+    try:
+        await db.execute('ALTER TABLE orders ADD COLUMN utm_medium TEXT')
+        print("✅ Колонка utm_medium добавлена в таблицу orders")
+    except aiosqlite.OperationalError as e:
+        if "duplicate column name" not in str(e):
+            print(f"⚠️ Ошибка добавления utm_medium: {e}")
+    
+    try:
+        await db.execute('ALTER TABLE orders ADD COLUMN utm_campaign TEXT')
+        print("✅ Колонка utm_campaign добавлена в таблицу orders")
+    except aiosqlite.OperationalError as e:
+        if "duplicate column name" not in str(e):
+            print(f"⚠️ Ошибка добавления utm_campaign: {e}")
+
+    # Создаем индексы для быстрого поиска
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_event_metrics_user_id ON event_metrics(user_id)
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_event_metrics_event_type ON event_metrics(event_type)
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_event_metrics_timestamp ON event_metrics(timestamp)
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_event_metrics_order_id ON event_metrics(order_id)
+    ''')
+
+    # Атрибуция заказов (источник, UTM, продукт, допродажа), поддерживается track_event
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS order_attribution (
+            order_id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            order_source TEXT, -- первый источник из событий заказа
+            user_source TEXT, -- первый источник из событий пользователя (запасной вариант)
+            has_order_utm INTEGER DEFAULT 0, -- 1, если UTM взяты из событий самого заказа
+            utm_source TEXT,
+            utm_medium TEXT,
+            utm_campaign TEXT,
+            event_product_type TEXT, -- первый product_type из событий заказа
+            has_upsell INTEGER DEFAULT 0,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_order_attribution_user_id ON order_attribution(user_id)
+    ''')
+
+    # Первичное заполнение атрибуции для уже существующих заказов
+    async with db.execute('SELECT NOT EXISTS (SELECT 1 FROM order_attribution) AND EXISTS (SELECT 1 FROM orders)') as cursor:
+        needs_backfill = (await cursor.fetchone())[0]
+    if needs_backfill:
+        await _refresh_order_attribution(db)
+        print("✅ Таблица order_attribution заполнена по существующим событиям")
+
+    # Таблица для уведомлений о новых сообщениях от пользователей
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS order_notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            manager_id INTEGER, -- ID менеджера, которому назначен заказ
+            is_read BOOLEAN DEFAULT 0, -- прочитано ли уведомление
+            last_user_message_at DATETIME, -- время последнего сообщения от пользователя
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(order_id) REFERENCES orders(id) ON DELETE CASCADE,
+            FOREIGN KEY(manager_id) REFERENCES managers(id) ON DELETE SET NULL,
+            UNIQUE(order_id) -- один заказ = одно уведомление
+        )
+    ''')
+    
+    # Создаем индексы для быстрого поиска уведомлений
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_order_notifications_manager_id ON order_notifications(manager_id)
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_order_notifications_is_read ON order_notifications(is_read)
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_order_notifications_order_id ON order_notifications(order_id)
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_order_notifications_updated_at ON order_notifications(updated_at)
+    ''')
+
+    # Кэш file_id Telegram для повторно отправляемых файлов (обложки, стили, примеры голосов, вложения шаблонов).
+    # Запись действительна, пока у файла не изменились mtime и размер
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS telegram_file_ids (
+            path TEXT NOT NULL,
+            kind TEXT NOT NULL, -- photo, audio, video, animation, document, voice
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            file_id TEXT NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (path, kind)
+        )
+    ''')
+    
+    # Состояния FSM бота (см. fsm_storage.py), переживают перезапуск процесса
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY, -- bot_id:chat_id:user_id:thread_id:destiny
+            state TEXT,
+            data TEXT, -- JSON
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Каталог фотографий заказов для галереи админки: заполняется функциями save_* при загрузке,
+    # чтобы /admin/photos не разбирал order_data всех заказов и не проверял каждый файл на диске
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS photo_catalog (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            filename TEXT NOT NULL,
+            path TEXT NOT NULL, -- путь от корня проекта: uploads/..., uploads/order_{id}_pages/...
+            photo_type TEXT, -- main_face_1, {hero_name}_face_1, joint_photo, page_3, first_page_photo, ...
+            source TEXT, -- main_hero, hero, joint, upload, page, custom_photo, cover
+            page_number INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (order_id, path)
+        )
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_photo_catalog_created_at ON photo_catalog(created_at, id)
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_photo_catalog_order_id ON photo_catalog(order_id, created_at, id)
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_photo_catalog_photo_type ON photo_catalog(photo_type, created_at, id)
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_photo_catalog_source ON photo_catalog(source, created_at, id)
+    ''')
+
+    # Первичное заполнение каталога фотографиями уже существующих заказов
+    async with db.execute('SELECT NOT EXISTS (SELECT 1 FROM photo_catalog) AND EXISTS (SELECT 1 FROM orders)') as cursor:
+        needs_backfill = (await cursor.fetchone())[0]
+    if needs_backfill:
+        added = await _backfill_photo_catalog(db)
+        print(f"✅ Таблица photo_catalog заполнена: {added} фотографий")
+    
+    # Вставляем начальную запись, если её нет
+    await db.execute('''
+        INSERT OR IGNORE INTO manager_queue (id, last_manager_id) VALUES (1, 0)
+    ''')
+
+
+async def _migration_assign_managers(db):
+    """Назначение менеджеров заказам без менеджера (раньше выполнялось при каждом запуске)"""
+    result = await assign_managers_to_all_orders()
+    print(f"✅ {result['message']}")
+
+async def _migration_legacy_columns(db):
+    """Колонка voice_styles.category и is_active старых отложенных сообщений (бывшие migrate_add_category_to_voice_styles.py и migrate_database.py)"""
+    try:
+        await db.execute('ALTER TABLE voice_styles ADD COLUMN category TEXT DEFAULT "gentle"')
+        print("✅ Колонка category добавлена в таблицу voice_styles")
+    except aiosqlite.OperationalError as e:
+        if "duplicate column name" not in str(e):
+            raise
+    await db.execute('UPDATE delayed_messages SET is_active = 1 WHERE is_active IS NULL')
+
+async def _migration_order_amounts(db):
+    """total_amount оплаченных заказов из успешного платежа или order_data (бывший migrate_order_amounts.py)"""
+    placeholders = ','.join('?' * len(PAID_ORDER_STATUSES))
+    async with db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'payments'") as cursor:
+        has_payments = await cursor.fetchone() is not None
+    if has_payments:
+        await db.execute(f'''
+            UPDATE orders
+            SET total_amount = (
+                    SELECT p.amount FROM payments p
+                    WHERE p.order_id = orders.id AND p.status = 'succeeded'
+                    ORDER BY p.created_at DESC
+                    LIMIT 1
+                ),
+                updated_at = datetime('now')
+            WHERE status IN ({placeholders})
+            AND (total_amount IS NULL OR total_amount = 0)
+            AND EXISTS (SELECT 1 FROM payments p WHERE p.order_id = orders.id AND p.status = 'succeeded')
+        ''', PAID_ORDER_STATUSES)
+
+    async with db.execute(f'''
+        SELECT id, order_data FROM orders
+        WHERE status IN ({placeholders})
+        AND (total_amount IS NULL OR total_amount = 0)
+    ''', PAID_ORDER_STATUSES) as cursor:
+        orders = await cursor.fetchall()
+    updated = 0
+    for order_id, order_data_json in orders:
+        try:
+            order_data = json.loads(order_data_json) if order_data_json else {}
+            amount = float(order_data.get('amount') or order_data.get('price') or 0)
+        except (ValueError, TypeError, AttributeError):
+            continue
+        if amount:
+            await db.execute(
+                "UPDATE orders SET total_amount = ?, updated_at = datetime('now') WHERE id = ?",
+                (amount, order_id)
+            )
+            updated += 1
+    if updated:
+        print(f"✅ Суммы из данных заказа заполнены для {updated} заказов")
+
+async def _migration_template_files(db):
+    """Файлы ожидающих отложенных сообщений в message_template_files их шаблонов (бывший migrate_files_to_templates.py)"""
+    await db.execute('''
+        INSERT INTO message_template_files (template_id, file_path, file_type, file_name, file_size, created_at)
+        SELECT t.template_id, dmf.file_path, dmf.file_type, dmf.file_name, dmf.file_size, dmf.created_at
+        FROM delayed_message_files dmf
+        JOIN delayed_messages dm ON dmf.delayed_message_id = dm.id
+        JOIN (
+            SELECT MIN(id) AS template_id, message_type, content
+            FROM message_templates
+            WHERE is_active = 1
+            GROUP BY message_type, content
+        ) t ON t.message_type = dm.message_type AND t.content = dm.content
+        WHERE dm.status = 'pending'
+        AND NOT EXISTS (
+            SELECT 1 FROM message_template_files f
+            WHERE f.template_id = t.template_id AND f.file_name = dmf.file_name AND f.file_path = dmf.file_path
+        )
+    ''')
+
+async def _migration_metrics_daily(db):
+    """Дневные сводки метрик (metrics_daily), заполняются по уже накопленным событиям и заказам"""
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS metrics_daily (
+            day TEXT NOT NULL,
+            event_type TEXT NOT NULL,
+            product_type TEXT NOT NULL DEFAULT '',
+            source TEXT NOT NULL DEFAULT '',
+            event_count INTEGER NOT NULL DEFAULT 0,
+            amount_count INTEGER NOT NULL DEFAULT 0,
+            amount_total REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, event_type, product_type, source)
+        ) WITHOUT ROWID
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_event_metrics_type_timestamp ON event_metrics(event_type, timestamp)')
+    rows = await _rebuild_metrics_daily(db)
+    print(f"✅ Сводка metrics_daily заполнена: {rows} строк")
+
+# (номер, описание, шаг) — номера идут подряд с 1
+SCHEMA_MIGRATIONS = [
+    (1, "базовая схема", _migration_base_schema),
+    (2, "назначение менеджеров заказам без менеджера", _migration_assign_managers),
+    (3, "старые колонки voice_styles и delayed_messages", _migration_legacy_columns),
+    (4, "суммы оплаченных заказов", _migration_order_amounts),
+    (5, "файлы отложенных сообщений в шаблонах", _migration_template_files),
+    (6, "дневные сводки метрик", _migration_metrics_daily),
+]
+
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+async def get_schema_version() -> int:
+    async with db_connection(readonly=True) as db:
+        async with db.execute('PRAGMA user_version') as cursor:
+            return (await cursor.fetchone())[0]
+
+async def init_db():
+    """
+    Доводит базу данных до последней версии схемы (SCHEMA_MIGRATIONS).
+    Если база уже актуальна, это одно чтение PRAGMA user_version.
+    """
+    if await get_schema_version() >= SCHEMA_VERSION:
+        return
+
+    # Соединение на запись держит BEGIN IMMEDIATE: бот и админка, запущенные одновременно,
+    # выполняют миграции по очереди, и второй процесс видит уже записанную версию
+    async with db_connection() as db:
+        async with db.execute('PRAGMA user_version') as cursor:
+            version = (await cursor.fetchone())[0]
+        for number, description, migrate in SCHEMA_MIGRATIONS:
+            if number <= version:
+                continue
+            print(f"🔧 Миграция схемы БД {number}: {description}")
+            await migrate(db)
+            await db.execute(f'PRAGMA user_version = {number}')
+            await db.commit()
+            print(f"✅ Схема БД обновлена до версии {number}")
+
+async def save_user_profile(user_data: dict, generated_book: str = None):
+    """Сохраняет профиль пользователя и сгенерированную книгу"""
+    async def _save_operation():
+        async with db_connection() as db:
+            # Очищаем None значения
+            username = user_data.get('username') if user_data.get('username') and user_data.get('username') != "None" else None
+            first_name = user_data.get('first_name') if user_data.get('first_name') and user_data.get('first_name') != "None" else None
+            last_name = user_data.get('last_name') if user_data.get('last_name') and user_data.get('last_name') != "None" else None
+            
+            await db.execute('''
+                INSERT OR REPLACE INTO user_profiles 
+                (user_id, username, first_name, last_name, product, relation, 
                  main_hero_intro, main_hero_photos, heroes, generated_book, created_at)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
             ''', (
@@ -836,10 +1139,7 @@ async def save_user_profile(user_data: dict, generated_book: str = None):
 async def get_user_book(user_id: int) -> Dict:
     """Получает книгу пользователя из базы данных"""
     async def _get_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Настраиваем соединение
-            await configure_db_connection(db)
-            
+        async with db_connection(readonly=True) as db:
             async with db.execute('''
                 SELECT generated_book, created_at FROM user_profiles 
                 WHERE user_id = ?
@@ -859,7 +1159,7 @@ async def get_user_book(user_id: int) -> Dict:
 async def create_order(user_id: int, order_data: dict) -> int:
     print(f"🔍 ОТЛАДКА: create_order вызвана с user_id={user_id}, order_data={order_data}")
     
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         # Если username не передан, подтягиваем из профиля пользователя (НЕ из предыдущих заказов)
         if not order_data.get('username'):
             try:
@@ -883,7 +1183,11 @@ async def create_order(user_id: int, order_data: dict) -> int:
         
         order_id = cursor.lastrowid
         print(f"🔍 ОТЛАДКА: Создан заказ #{order_id} для пользователя {user_id}")
-        
+        await shift_order_metrics(db, order_id, 1)
+
+        # Заводим строку атрибуции (запасные источник и UTM берутся из прошлых событий пользователя)
+        await _refresh_order_attribution(db, order_id)
+
         # Сохраняем профиль пользователя в таблицу user_profiles
         try:
             print(f"🔍 ОТЛАДКА: Сохраняем профиль для заказа #{order_id}")
@@ -928,7 +1232,7 @@ async def create_order(user_id: int, order_data: dict) -> int:
                 
                 await db.execute('''
                     UPDATE orders
-                    SET assigned_manager_id = ?
+                    SET assigned_manager_id = ?, updated_at = datetime('now')
                     WHERE id = ?
                 ''', (selected_manager_id, order_id))
                 print(f"🔍 ОТЛАДКА: Менеджер ID {selected_manager_id} назначен к заказу #{order_id}")
@@ -942,10 +1246,7 @@ async def create_order(user_id: int, order_data: dict) -> int:
 
 async def get_orders(status: Optional[str] = None) -> List[Dict]:
     async def _get_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Настраиваем соединение
-            await configure_db_connection(db)
-            
+        async with db_connection(readonly=True) as db:
             if status:
                 query = '''
                     SELECT o.*, o.user_id as telegram_id, u.username, m.email as manager_email, m.full_name as manager_name 
@@ -979,7 +1280,7 @@ async def get_orders_filtered(
     sort_by: str = 'created_at',
     sort_dir: str = 'desc',
 ) -> List[Dict]:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         query = '''
             SELECT o.*, o.user_id as telegram_id, u.product, u.username, m.email as manager_email, m.full_name as manager_name, d.phone
             FROM orders o 
@@ -1012,10 +1313,7 @@ async def get_orders_filtered(
 
 async def get_order(order_id: int) -> Optional[Dict]:
     async def _get_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Настраиваем соединение
-            await configure_db_connection(db)
-            
+        async with db_connection(readonly=True) as db:
             async with db.execute('''
                 SELECT o.*, o.user_id as telegram_id, u.username, u.first_name, u.last_name, m.email as manager_email, m.full_name as manager_name 
                 FROM orders o 
@@ -1030,13 +1328,29 @@ async def get_order(order_id: int) -> Optional[Dict]:
     
     return await safe_db_operation(_get_operation)
 
+async def get_orders_by_ids(order_ids: List[int]) -> Dict[int, Dict]:
+    """Получает заказы (в том же виде, что get_order) одним запросом, словарем по id"""
+    order_ids = list({order_id for order_id in order_ids if order_id})
+    if not order_ids:
+        return {}
+    async with db_connection(readonly=True) as db:
+        placeholders = ','.join('?' * len(order_ids))
+        async with db.execute(f'''
+            SELECT o.*, o.user_id as telegram_id, u.username, u.first_name, u.last_name, m.email as manager_email, m.full_name as manager_name 
+            FROM orders o 
+            LEFT JOIN user_profiles u ON o.user_id = u.user_id 
+            LEFT JOIN managers m ON o.assigned_manager_id = m.id 
+            WHERE o.id IN ({placeholders})
+        ''', order_ids) as cursor:
+            rows = await cursor.fetchall()
+            columns = [column[0] for column in cursor.description]
+            orders = [dict(zip(columns, row)) for row in rows]
+            return {order['id']: order for order in orders}
+
 async def get_user_active_order_by_user_id(user_id: int) -> Optional[Dict]:
     """Получает последний активный заказ пользователя (любого типа)"""
     async def _get_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Настраиваем соединение
-            await configure_db_connection(db)
-            
+        async with db_connection(readonly=True) as db:
             # Ищем последний заказ пользователя, который не завершен
             async with db.execute('''
                 SELECT o.*, o.user_id as telegram_id, u.username, u.first_name, u.last_name, m.email as manager_email, m.full_name as manager_name 
@@ -1058,10 +1372,7 @@ async def get_user_active_order_by_user_id(user_id: int) -> Optional[Dict]:
 async def get_user_active_order(user_id: int, product: str) -> Optional[Dict]:
     """Получает активный заказ пользователя для указанного продукта"""
     async def _get_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Настраиваем соединение
-            await configure_db_connection(db)
-            
+        async with db_connection(readonly=True) as db:
             # Ищем заказ с указанным продуктом и статусом, который не является завершенным
             async with db.execute('''
                 SELECT o.*, o.user_id as telegram_id, u.username, u.first_name, u.last_name, m.email as manager_email, m.full_name as manager_name 
@@ -1084,10 +1395,7 @@ async def get_user_active_order(user_id: int, product: str) -> Optional[Dict]:
 async def get_last_order_by_user_and_product(user_id: int, product: str) -> Optional[Dict]:
     """Получает последний заказ пользователя для указанного продукта (включая завершенные)"""
     async def _get_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Настраиваем соединение
-            await configure_db_connection(db)
-            
+        async with db_connection(readonly=True) as db:
             # Ищем последний заказ с указанным продуктом (включая завершенные)
             async with db.execute('''
                 SELECT o.*, o.user_id as telegram_id, u.username, u.first_name, u.last_name, m.email as manager_email, m.full_name as manager_name 
@@ -1107,7 +1415,7 @@ async def get_last_order_by_user_and_product(user_id: int, product: str) -> Opti
     return await safe_db_operation(_get_operation)
 
 async def update_order_status(order_id: int, status: str, total_amount: float = None):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         # Получаем данные заказа до обновления
         cursor = await db.execute('''
             SELECT user_id, order_data, status as old_status FROM orders WHERE id = ?
@@ -1119,6 +1427,7 @@ async def update_order_status(order_id: int, status: str, total_amount: float =
         
         user_id, order_json, old_status = order_data
         
+        await shift_order_metrics(db, order_id, -1)
         # Обновляем статус заказа и total_amount если передан
         if total_amount is not None:
             await db.execute('''
@@ -1128,6 +1437,8 @@ async def update_order_status(order_id: int, status: str, total_amount: float =
             await db.execute('''
                 UPDATE orders SET status = ?, updated_at = datetime('now') WHERE id = ?
             ''', (status, order_id))
+        await shift_order_metrics(db, order_id, 1)
+        await record_order_event(db, order_id, 'order_changed')
         await db.commit()
         
         # Если статус изменился, обрабатываем таймеры
@@ -1157,6 +1468,7 @@ async def update_order_status(order_id: int, status: str, total_amount: float =
                 
             except Exception as e:
                 print(f"❌ Ошибка обработки таймеров для заказа {order_id}: {e}")
+    notify_order_events()
 
 async def cleanup_trigger_messages_for_order(db, order_id: int, new_status: str):
     """
@@ -1210,39 +1522,31 @@ async def cleanup_trigger_messages_for_order(db, order_id: int, new_status: str)
 # Словарь для хранения локов для каждого заказа
 _order_locks = {}
 
-# Глобальный лок для базы данных
-_db_lock = asyncio.Lock()
-
-async def configure_db_connection(db):
-    """Настраивает соединение с базой данных для лучшей производительности"""
-    await db.execute('PRAGMA journal_mode=WAL')
-    await db.execute('PRAGMA synchronous=NORMAL')
-    await db.execute('PRAGMA cache_size=10000')
-    await db.execute('PRAGMA temp_store=MEMORY')
-    await db.execute('PRAGMA mmap_size=268435456')  # 256MB
-    await db.execute('PRAGMA busy_timeout=30000')  # 30 секунд таймаут
-
-async def safe_db_operation(operation, max_retries=3, delay=0.1):
-    """Безопасно выполняет операцию с базой данных с повторными попытками"""
-    for attempt in range(max_retries):
-        try:
-            async with _db_lock:
-                return await operation()
-        except aiosqlite.OperationalError as e:
-            if "database is locked" in str(e) and attempt < max_retries - 1:
-                print(f"⚠️ База данных заблокирована, повторная попытка {attempt + 1}/{max_retries}")
-                await asyncio.sleep(delay * (attempt + 1))
-                continue
-            else:
-                print(f"❌ Ошибка базы данных: {e}")
-                raise e
-        except Exception as e:
-            print(f"❌ Неожиданная ошибка: {e}")
-            raise e
+async def safe_db_operation(operation):
+    """
+    Выполняет операцию с базой данных.
+    Записи внутри операции сериализует и пакетно фиксирует очередь писателя пула
+    (см. db_pool.py), поэтому глобальный лок и повторы при "database is locked" не нужны.
+    """
+    try:
+        return await operation()
+    except aiosqlite.OperationalError as e:
+        print(f"❌ Ошибка базы данных: {e}")
+        raise e
+    except Exception as e:
+        print(f"❌ Неожиданная ошибка: {e}")
+        raise e
+
+async def run_write(operation):
+    """
+    Ставит операцию operation(db) в очередь писателя и возвращает ее результат
+    после фиксации пакета, в который она попала.
+    """
+    return await get_pool(DB_PATH).run_write(operation)
 
 async def update_order_data(order_id: int, order_data: dict):
     """Обновляет данные заказа, мерджа с существующими данными"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         # Получаем существующие данные
         cursor = await db.execute('SELECT order_data FROM orders WHERE id = ?', (order_id,))
         row = await cursor.fetchone()
@@ -1269,12 +1573,28 @@ async def update_order_data(order_id: int, order_data: dict):
         
         update_query += ' WHERE id = ?'
         
+        # Продукт мог измениться — заказ переходит в другую строку сводки
+        await shift_order_metrics(db, order_id, -1)
         await db.execute(update_query, update_data)
+        await shift_order_metrics(db, order_id, 1)
+        
+        # Выбранная обложка показывается в галерее фотографий; прежний выбор из каталога убираем
+        if 'selected_cover' in order_data:
+            await db.execute(
+                "DELETE FROM photo_catalog WHERE order_id = ? AND photo_type = 'selected_cover'", (order_id,)
+            )
+            cover_photos = _order_data_photos(order_id, {'selected_cover': order_data['selected_cover']})
+            for filename, photo_type, source, base_dir in cover_photos:
+                if os.path.isfile(os.path.join(base_dir, filename)):
+                    await _add_to_photo_catalog(db, order_id, filename, photo_type, source, base_dir)
+        
+        await record_order_event(db, order_id, 'order_changed')
         await db.commit()
+    notify_order_events()
 
 async def get_order_data_debug(order_id: int) -> dict:
     """Функция для отладки - возвращает данные заказа с информацией о пользователе"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         # Получаем данные заказа и пользователя, включая отдельные колонки
         cursor = await db.execute('''
             SELECT o.order_data, o.first_page_text, o.last_page_text, o.first_last_design, o.sender_name,
@@ -1317,7 +1637,7 @@ async def get_order_data_debug(order_id: int) -> dict:
         return {}
 async def save_selected_pages(order_id: int, selected_pages: list):
     """Сохраняет выбранные пользователем страницы в базу данных"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         # Получаем текущие данные заказа
         cursor = await db.execute('SELECT order_data FROM orders WHERE id = ?', (order_id,))
         row = await cursor.fetchone()
@@ -1345,10 +1665,7 @@ async def save_selected_pages(order_id: int, selected_pages: list):
 
 async def update_order_files(order_id: int, pdf_path: str = None, mp3_path: str = None):
     async def _update_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Настраиваем соединение
-            await configure_db_connection(db)
-            
+        async with db_connection() as db:
             if pdf_path:
                 await db.execute("UPDATE orders SET pdf_path = ?, updated_at = datetime('now') WHERE id = ?", (pdf_path, order_id))
             if mp3_path:
@@ -1359,12 +1676,33 @@ async def update_order_files(order_id: int, pdf_path: str = None, mp3_path: str
 
 # --- Работа с outbox (очередь отправки) ---
 
+# На сколько секунд диспетчер берет задачу в аренду (если процесс упадет, задача вернется в очередь)
+OUTBOX_LEASE_SECONDS = int(os.getenv('OUTBOX_LEASE_SECONDS', '300'))
+# Через сколько секунд повторять задачу, возвращенную в статус pending
+OUTBOX_RETRY_DELAY_SECONDS = int(os.getenv('OUTBOX_RETRY_DELAY_SECONDS', '5'))
+
+# Колбэки, которые вызываются после добавления задачи в outbox в этом процессе (будят диспетчер бота)
+_outbox_listeners: List[Callable[[], None]] = []
+
+def add_outbox_listener(callback: Callable[[], None]):
+    """Подписывает колбэк на появление новых задач outbox в текущем процессе"""
+    _outbox_listeners.append(callback)
+
+def remove_outbox_listener(callback: Callable[[], None]):
+    if callback in _outbox_listeners:
+        _outbox_listeners.remove(callback)
+
+def notify_outbox():
+    """Сообщает подписчикам, что в outbox появились задачи"""
+    for callback in list(_outbox_listeners):
+        try:
+            callback()
+        except Exception as e:
+            print(f"❌ Ошибка уведомления о задаче outbox: {e}")
+
 async def add_outbox_task(order_id: int, user_id: int, type_: str, content: str, file_type: str = None, comment: str = None, button_text: str = None, button_callback: str = None, is_general_message: bool = False):
     async def _add_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Настраиваем соединение
-            await configure_db_connection(db)
-            
+        async with db_connection() as db:
             await db.execute('''
                 INSERT INTO outbox (order_id, user_id, type, content, file_type, comment, button_text, button_callback, is_general_message, status, created_at, retry_count, max_retries)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending', datetime('now'), 0, 3)
@@ -1372,52 +1710,94 @@ async def add_outbox_task(order_id: int, user_id: int, type_: str, content: str,
             await db.commit()
     
     await safe_db_operation(_add_operation)
+    notify_outbox()
+
+_OUTBOX_TASK_COLUMNS = '''
+    id, order_id, user_id, type, content, file_type, comment, button_text, button_callback, 
+    COALESCE(is_general_message, 0) as is_general_message, created_at, COALESCE(retry_count, 0) as retry_count, COALESCE(max_retries, 3) as max_retries
+'''
 
 async def get_pending_outbox_tasks():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         db.row_factory = aiosqlite.Row
-        # Логируем все задачи в outbox для диагностики
-        debug_cursor = await db.execute('''
-            SELECT id, order_id, user_id, type, status, retry_count, max_retries, created_at 
-            FROM outbox 
-            ORDER BY created_at DESC 
-            LIMIT 10
-        ''')
-        debug_tasks = await debug_cursor.fetchall()
-        print(f"🔍 ДИАГНОСТИКА OUTBOX: всего последних 10 задач:")
-        for task in debug_tasks:
-            print(f"   ID={task['id']}, status={task['status']}, retry={task['retry_count']}, max={task['max_retries']}, type={task['type']}")
-        
-        cursor = await db.execute('''
-            SELECT id, order_id, user_id, type, content, file_type, comment, button_text, button_callback, 
-                   COALESCE(is_general_message, 0) as is_general_message, created_at, COALESCE(retry_count, 0) as retry_count, COALESCE(max_retries, 3) as max_retries
+        cursor = await db.execute(f'''
+            SELECT {_OUTBOX_TASK_COLUMNS}
             FROM outbox 
             WHERE status = 'pending' AND (COALESCE(retry_count, 0) < COALESCE(max_retries, 3))
             ORDER BY created_at ASC
         ''')
         tasks = await cursor.fetchall()
-        print(f"🔍 НАЙДЕНО PENDING ЗАДАЧ: {len(tasks)}")
         return [dict(task) for task in tasks]
 
+async def claim_outbox_tasks(limit: int, lease_seconds: int = OUTBOX_LEASE_SECONDS) -> List[Dict]:
+    """
+    Забирает до limit готовых к отправке задач outbox в аренду и возвращает их.
+    Выборка и продление аренды идут в одной транзакции писателя, поэтому
+    одну задачу не заберут два обработчика одновременно.
+    """
+    async def _claim_operation(db) -> List[Dict]:
+        db.row_factory = aiosqlite.Row
+        async with db.execute(f'''
+            SELECT {_OUTBOX_TASK_COLUMNS}
+            FROM outbox 
+            WHERE status = 'pending' AND (COALESCE(retry_count, 0) < COALESCE(max_retries, 3))
+            AND (lease_until IS NULL OR lease_until <= datetime('now'))
+            ORDER BY created_at ASC, id ASC
+            LIMIT ?
+        ''', (limit,)) as cursor:
+            tasks = [dict(row) for row in await cursor.fetchall()]
+        if tasks:
+            placeholders = ','.join('?' * len(tasks))
+            await db.execute(
+                f"UPDATE outbox SET lease_until = datetime('now', ?) WHERE id IN ({placeholders})",
+                (f'+{lease_seconds} seconds', *[task['id'] for task in tasks])
+            )
+        return tasks
+
+    return await run_write(_claim_operation)
+
+async def release_outbox_tasks(task_ids: List[int]):
+    """Снимает аренду с еще не обработанных задач, чтобы их сразу забрал следующий проход"""
+    if not task_ids:
+        return
+    async def _release_operation():
+        async with db_connection() as db:
+            placeholders = ','.join('?' * len(task_ids))
+            await db.execute(f'''
+                UPDATE outbox SET lease_until = NULL WHERE id IN ({placeholders}) AND status = 'pending'
+            ''', task_ids)
+            await db.commit()
+    
+    await safe_db_operation(_release_operation)
+
 async def update_outbox_task_status(task_id: int, status: str):
     async def _update_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Настраиваем соединение
-            await configure_db_connection(db)
-            
+        async with db_connection() as db:
+            # Возвращенная в pending задача повторяется не сразу, а через OUTBOX_RETRY_DELAY_SECONDS
             await db.execute('''
-                UPDATE outbox SET status = ?, sent_at = datetime('now') WHERE id = ?
-            ''', (status, task_id))
+                UPDATE outbox SET status = ?, sent_at = datetime('now'),
+                       lease_until = CASE WHEN ? = 'pending' THEN datetime('now', ?) ELSE NULL END
+                WHERE id = ?
+            ''', (status, status, f'+{OUTBOX_RETRY_DELAY_SECONDS} seconds', task_id))
             await db.commit()
     
     await safe_db_operation(_update_operation)
 
+async def reschedule_outbox_task(task_id: int, delay_seconds: float):
+    """Возвращает задачу в очередь через delay_seconds, не увеличивая retry_count (flood control Telegram)"""
+    async def _reschedule_operation():
+        async with db_connection() as db:
+            await db.execute('''
+                UPDATE outbox SET status = 'pending', lease_until = datetime('now', ?) WHERE id = ?
+            ''', (f'+{int(delay_seconds) + 1} seconds', task_id))
+            await db.commit()
+    
+    await safe_db_operation(_reschedule_operation)
+
 async def increment_outbox_retry_count(task_id: int):
     """Увеличивает счетчик попыток для задачи"""
     async def _increment_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            await configure_db_connection(db)
-            
+        async with db_connection() as db:
             await db.execute('''
                 UPDATE outbox SET retry_count = retry_count + 1 WHERE id = ?
             ''', (task_id,))
@@ -1425,30 +1805,149 @@ async def increment_outbox_retry_count(task_id: int):
     
     await safe_db_operation(_increment_operation)
 
-# --- Работа с шаблонами сообщений (новая система) ---
+# --- Задания доставки из админки (delivery_jobs) ---
 
-async def create_message_template(name: str, message_type: str, content: str, order_step: str, delay_minutes: int = 0, manager_id: int = None):
-    """Создает новый шаблон сообщения"""
-    async def _create_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            await configure_db_connection(db)
-            
+async def create_delivery_job(
+    order_id: int,
+    user_id: int,
+    kind: str,
+    tasks: List[Dict],
+    created_by: str = None,
+    pages: List[Tuple[int, str, str, str]] = (),
+    uploads: List[Tuple[str, str, str]] = (),
+) -> int:
+    """
+    Создает задание доставки и его задачи outbox одной транзакцией и возвращает id задания.
+    tasks — поля задач outbox (type, content, file_type, comment, button_text, button_callback) в порядке отправки.
+    В той же транзакции записываются страницы заказа pages — (номер, имя файла, описание, путь)
+    и загруженные файлы uploads — (имя файла, тип, путь).
+    """
+    async def _create_operation(db) -> int:
+        cursor = await db.execute('''
+            INSERT INTO delivery_jobs (order_id, kind, total, created_by, created_at)
+            VALUES (?, ?, ?, ?, datetime('now'))
+        ''', (order_id, kind, len(tasks), created_by))
+        job_id = cursor.lastrowid
+
+        for page_number, filename, description, file_path in pages:
             await db.execute('''
-                INSERT INTO message_templates 
-                (name, message_type, content, order_step, delay_minutes, manager_id)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (name, message_type, content, order_step, delay_minutes, manager_id))
-            await db.commit()
-            
-            cursor = await db.execute('SELECT last_insert_rowid()')
-            result = await cursor.fetchone()
+                INSERT INTO order_pages (order_id, page_number, filename, description, created_at)
+                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (order_id, page_number, filename, description))
+            await _add_to_photo_catalog(db, order_id, filename, f"page_{page_number}", 'page',
+                                        file_path=file_path, page_number=page_number)
+
+        for filename, file_type, file_path in uploads:
+            await db.execute('''
+                INSERT INTO uploads (order_id, filename, file_type, uploaded_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (order_id, filename, file_type))
+            await _add_to_photo_catalog(db, order_id, filename, file_type, 'upload', file_path=file_path)
+
+        # Задачи одного пользователя диспетчер отправляет по порядку (created_at, id)
+        await db.executemany('''
+            INSERT INTO outbox (order_id, user_id, type, content, file_type, comment, button_text, button_callback,
+                                is_general_message, status, created_at, retry_count, max_retries, job_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, 'pending', datetime('now'), 0, 3, ?)
+        ''', [
+            (order_id, user_id, task['type'], task.get('content', ''), task.get('file_type'), task.get('comment'),
+             task.get('button_text'), task.get('button_callback'), job_id)
+            for task in tasks
+        ])
+        return job_id
+
+    job_id = await run_write(_create_operation)
+    notify_outbox()
+    return job_id
+
+async def get_delivery_job(job_id: int) -> Optional[Dict]:
+    """
+    Задание доставки с прогрессом: sent — отправлено, failed — не отправлено (в том числе исчерпаны попытки),
+    pending — ждет отправки или повтора. status: queued, sending, completed или completed_with_errors.
+    """
+    async with db_connection(readonly=True) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute('''
+            SELECT j.id, j.order_id, j.kind, j.total, j.created_by, j.created_at,
+                   COALESCE(SUM(o.status = 'sent'), 0) AS sent,
+                   COALESCE(SUM(o.status = 'failed' OR (o.status = 'pending'
+                       AND COALESCE(o.retry_count, 0) >= COALESCE(o.max_retries, 3))), 0) AS failed,
+                   MAX(o.sent_at) AS last_update_at
+            FROM delivery_jobs j
+            LEFT JOIN outbox o ON o.job_id = j.id
+            WHERE j.id = ?
+            GROUP BY j.id
+        ''', (job_id,)) as cursor:
+            row = await cursor.fetchone()
+    if not row:
+        return None
+
+    job = dict(row)
+    done = job['sent'] + job['failed']
+    job['pending'] = max(job['total'] - done, 0)
+    if done == 0 and job['pending']:
+        job['status'] = 'queued'
+    elif job['pending']:
+        job['status'] = 'sending'
+    elif job['failed']:
+        job['status'] = 'completed_with_errors'
+    else:
+        job['status'] = 'completed'
+    return job
+
+# --- Кэш file_id Telegram ---
+
+async def get_telegram_file_ids() -> List[Dict]:
+    """Возвращает все сохраненные file_id Telegram"""
+    async with db_connection(readonly=True) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute('SELECT path, kind, mtime_ns, size, file_id FROM telegram_file_ids') as cursor:
+            rows = await cursor.fetchall()
+            return [dict(row) for row in rows]
+
+async def save_telegram_file_id(path: str, kind: str, mtime_ns: int, size: int, file_id: str):
+    """Сохраняет file_id, полученный после загрузки файла в Telegram"""
+    async def _save_operation():
+        async with db_connection() as db:
+            await db.execute('''
+                INSERT OR REPLACE INTO telegram_file_ids (path, kind, mtime_ns, size, file_id, updated_at)
+                VALUES (?, ?, ?, ?, ?, datetime('now'))
+            ''', (path, kind, mtime_ns, size, file_id))
+            await db.commit()
+    
+    await safe_db_operation(_save_operation)
+
+async def delete_telegram_file_id(path: str, kind: str):
+    """Удаляет file_id, который Telegram перестал принимать"""
+    async def _delete_operation():
+        async with db_connection() as db:
+            await db.execute('DELETE FROM telegram_file_ids WHERE path = ? AND kind = ?', (path, kind))
+            await db.commit()
+    
+    await safe_db_operation(_delete_operation)
+
+# --- Работа с шаблонами сообщений (новая система) ---
+
+async def create_message_template(name: str, message_type: str, content: str, order_step: str, delay_minutes: int = 0, manager_id: int = None):
+    """Создает новый шаблон сообщения"""
+    async def _create_operation():
+        async with db_connection() as db:
+            await db.execute('''
+                INSERT INTO message_templates 
+                (name, message_type, content, order_step, delay_minutes, manager_id)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (name, message_type, content, order_step, delay_minutes, manager_id))
+            await db.commit()
+            
+            cursor = await db.execute('SELECT last_insert_rowid()')
+            result = await cursor.fetchone()
             return result[0] if result else None
     
     return await safe_db_operation(_create_operation)
 
 async def get_message_templates() -> List[Dict]:
     """Получает все активные шаблоны сообщений"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute('''
             SELECT mt.*, m.email as manager_email, m.full_name as manager_name
@@ -1462,7 +1961,7 @@ async def get_message_templates() -> List[Dict]:
 
 async def get_message_template_by_id(template_id: int) -> Optional[Dict]:
     """Получает шаблон сообщения по ID"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute('''
             SELECT mt.*, m.email as manager_email, m.full_name as manager_name
@@ -1476,9 +1975,7 @@ async def get_message_template_by_id(template_id: int) -> Optional[Dict]:
 async def update_message_template(template_id: int, name: str, content: str, delay_minutes: int, message_type: str, order_step: str = None) -> bool:
     """Обновляет шаблон сообщения"""
     async def _update_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            await configure_db_connection(db)
-            
+        async with db_connection() as db:
             if order_step is not None:
                 await db.execute('''
                     UPDATE message_templates 
@@ -1500,9 +1997,7 @@ async def update_message_template(template_id: int, name: str, content: str, del
 async def delete_message_template(template_id: int) -> bool:
     """Удаляет шаблон сообщения"""
     async def _delete_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            await configure_db_connection(db)
-            
+        async with db_connection() as db:
             await db.execute('DELETE FROM message_templates WHERE id = ?', (template_id,))
             await db.commit()
             
@@ -1512,7 +2007,7 @@ async def delete_message_template(template_id: int) -> bool:
 
 async def get_template_by_step_and_delay(order_step: str, delay_minutes: int) -> Optional[Dict]:
     """Получает шаблон сообщения для определенного шага и задержки"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute('''
             SELECT * FROM message_templates 
@@ -1524,7 +2019,7 @@ async def get_template_by_step_and_delay(order_step: str, delay_minutes: int) ->
 
 async def is_message_sent_to_user(template_id: int, user_id: int, order_id: int) -> bool:
     """Проверяет, было ли сообщение уже отправлено пользователю"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         cursor = await db.execute('''
             SELECT COUNT(*) FROM sent_messages_log 
             WHERE template_id = ? AND user_id = ? AND order_id = ?
@@ -1535,9 +2030,7 @@ async def is_message_sent_to_user(template_id: int, user_id: int, order_id: int)
 async def log_message_sent(template_id: int, user_id: int, order_id: int):
     """Записывает факт отправки сообщения пользователю"""
     async def _log_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            await configure_db_connection(db)
-            
+        async with db_connection() as db:
             await db.execute('''
                 INSERT INTO sent_messages_log (template_id, user_id, order_id)
                 VALUES (?, ?, ?)
@@ -1548,7 +2041,7 @@ async def log_message_sent(template_id: int, user_id: int, order_id: int):
 
 async def get_users_on_step(order_step: str, delay_minutes: int = 0) -> List[Dict]:
     """Получает всех пользователей, которые находятся на определенном шаге заказа указанное время"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         db.row_factory = aiosqlite.Row
         
         # Вычисляем время, когда пользователь должен был попасть на этот шаг
@@ -1599,10 +2092,7 @@ async def add_delayed_message(order_id: Optional[int], user_id: Optional[int], m
     print(f"🔍 delay_minutes: {delay_minutes}, content: {content[:100]}...")
     
     async def _add_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Настраиваем соединение
-            await configure_db_connection(db)
-            
+        async with db_connection() as db:
             # Вычисляем scheduled_at на основе delay_minutes
             if delay_minutes > 0:
                 scheduled_time = datetime.now() + timedelta(minutes=delay_minutes)
@@ -1629,7 +2119,7 @@ async def add_delayed_message(order_id: Optional[int], user_id: Optional[int], m
     return await safe_db_operation(_add_operation)
 async def add_delayed_message_file(delayed_message_id: int, file_path: str, file_type: str, file_name: str, file_size: int):
     """Добавляет файл к отложенному сообщению (сохраняет в обе таблицы)"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         # Сохраняем в delayed_message_files (старая система)
         await db.execute('''
             INSERT INTO delayed_message_files (delayed_message_id, file_path, file_type, file_name, file_size, created_at)
@@ -1748,7 +2238,7 @@ async def create_payment_reminder_messages(order_id: int, user_id: int):
 
 async def get_delayed_message_files(delayed_message_id: int) -> List[Dict]:
     """Получает все файлы отложенного сообщения"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT * FROM delayed_message_files WHERE delayed_message_id = ? ORDER BY created_at ASC
         ''', (delayed_message_id,)) as cursor:
@@ -1757,7 +2247,7 @@ async def get_delayed_message_files(delayed_message_id: int) -> List[Dict]:
 
 async def get_delayed_message_files_by_type(message_type: str) -> List[Dict]:
     """Получает все файлы отложенных сообщений по типу сообщения"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT dmf.* FROM delayed_message_files dmf
             JOIN delayed_messages dm ON dmf.delayed_message_id = dm.id
@@ -1769,7 +2259,7 @@ async def get_delayed_message_files_by_type(message_type: str) -> List[Dict]:
 
 async def get_delayed_messages_by_type(message_type: str) -> List[Dict]:
     """Получает все отложенные сообщения по типу сообщения"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT * FROM delayed_messages WHERE message_type = ? AND status = 'pending'
             ORDER BY created_at ASC
@@ -1779,7 +2269,7 @@ async def get_delayed_messages_by_type(message_type: str) -> List[Dict]:
 
 async def get_delayed_message_files_by_content(content: str) -> List[Dict]:
     """Получает файлы отложенного сообщения по содержимому"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT dmf.* FROM delayed_message_files dmf
             JOIN delayed_messages dm ON dmf.delayed_message_id = dm.id
@@ -1791,7 +2281,7 @@ async def get_delayed_message_files_by_content(content: str) -> List[Dict]:
 
 async def get_delayed_message_files_by_message_type(message_type: str) -> List[Dict]:
     """Получает файлы отложенного сообщения по типу сообщения"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT dmf.* FROM delayed_message_files dmf
             JOIN delayed_messages dm ON dmf.delayed_message_id = dm.id
@@ -1806,7 +2296,7 @@ async def add_message_template_file(template_id: int, file_path: str, file_type:
     import logging
     logging.info(f"🔧 Добавляем файл к шаблону {template_id}: {file_name} ({file_type})")
     
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         # Получаем текущие файлы из колонки files
         cursor = await db.execute('SELECT files FROM message_templates WHERE id = ?', (template_id,))
         row = await cursor.fetchone()
@@ -1863,7 +2353,7 @@ async def add_message_template_file(template_id: int, file_path: str, file_type:
 
 async def get_message_template_files(template_id: int) -> List[Dict]:
     """Получает все файлы шаблона сообщения (объединяет из новой колонки и старой таблицы)"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         all_files = []
         
         # Получаем файлы из новой колонки files
@@ -1952,7 +2442,7 @@ async def get_message_template_files(template_id: int) -> List[Dict]:
 
 async def delete_message_template_files(template_id: int):
     """Удаляет все файлы шаблона сообщения"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         # Сначала удаляем физические файлы
         files = await get_message_template_files(template_id)
         for file_info in files:
@@ -1971,14 +2461,14 @@ async def delete_message_template_files(template_id: int):
 
 async def delete_message_template_file(file_id: int) -> bool:
     """Удаляет файл шаблона сообщения по ID"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         await db.execute('DELETE FROM message_template_files WHERE id = ?', (file_id,))
         await db.commit()
         return True
 
 async def delete_message_template_file_by_name(template_id: int, file_name: str) -> bool:
     """Удаляет файл шаблона сообщения по имени файла"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         # Получаем текущие файлы из колонки files
         cursor = await db.execute('SELECT files FROM message_templates WHERE id = ?', (template_id,))
         row = await cursor.fetchone()
@@ -2011,9 +2501,7 @@ async def delete_message_template_file_by_name(template_id: int, file_name: str)
 async def delete_delayed_message_file(file_id: int) -> bool:
     """Удаляет файл отложенного сообщения"""
     async def _delete_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            await configure_db_connection(db)
-            
+        async with db_connection() as db:
             # Сначала получаем информацию о файле для удаления с диска
             cursor = await db.execute('''
                 SELECT file_path FROM delayed_message_files WHERE id = ?
@@ -2043,9 +2531,7 @@ async def delete_delayed_message_file(file_id: int) -> bool:
 async def delete_delayed_message_file_by_name(delayed_message_id: int, file_name: str) -> bool:
     """Удаляет файл отложенного сообщения по имени"""
     async def _delete_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            await configure_db_connection(db)
-            
+        async with db_connection() as db:
             # Сначала получаем информацию о файле для удаления с диска
             cursor = await db.execute('''
                 SELECT id, file_path FROM delayed_message_files 
@@ -2078,9 +2564,7 @@ async def delete_delayed_message_file_by_name(delayed_message_id: int, file_name
 async def create_or_update_user_timer(user_id: int, order_id: int, order_step: str, product_type: str = None) -> bool:
     """Создает или обновляет таймер пользователя на этапе"""
     async def _timer_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            await configure_db_connection(db)
-            
+        async with db_connection() as db:
             # Проверяем, есть ли уже таймер для этого пользователя/заказа/этапа (активный или нет)
             cursor = await db.execute('''
                 SELECT id, is_active FROM user_step_timers 
@@ -2122,7 +2606,7 @@ async def create_or_update_user_timer(user_id: int, order_id: int, order_step: s
 
 async def get_users_ready_for_messages() -> List[Dict]:
     """Получает пользователей, готовых для получения отложенных сообщений"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         db.row_factory = aiosqlite.Row
         
         # Получаем все активные таймеры с шаблонами сообщений, исключая уже отправленные
@@ -2171,7 +2655,7 @@ async def get_users_ready_for_messages() -> List[Dict]:
 
 async def is_timer_message_sent(timer_id: int, template_id: int, delay_minutes: int) -> bool:
     """Проверяет, было ли уже отправлено сообщение для данного таймера/шаблона/задержки"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         cursor = await db.execute('''
             SELECT id FROM timer_messages_sent 
             WHERE timer_id = ? AND template_id = ? AND delay_minutes = ?
@@ -2182,9 +2666,7 @@ async def is_timer_message_sent(timer_id: int, template_id: int, delay_minutes:
 async def log_timer_message_sent(timer_id: int, template_id: int, user_id: int, order_id: int, message_type: str, delay_minutes: int) -> bool:
     """Записывает факт отправки сообщения по таймеру"""
     async def _log_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            await configure_db_connection(db)
-            
+        async with db_connection() as db:
             await db.execute('''
                 INSERT OR IGNORE INTO timer_messages_sent 
                 (timer_id, template_id, user_id, order_id, message_type, delay_minutes)
@@ -2198,9 +2680,7 @@ async def log_timer_message_sent(timer_id: int, template_id: int, user_id: int,
 async def deactivate_user_timers(user_id: int, order_id: int) -> bool:
     """Деактивирует все таймеры пользователя для заказа (при оплате или завершении)"""
     async def _deactivate_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            await configure_db_connection(db)
-            
+        async with db_connection() as db:
             await db.execute('''
                 UPDATE user_step_timers 
                 SET is_active = 0 
@@ -2217,7 +2697,7 @@ async def deactivate_user_timers(user_id: int, order_id: int) -> bool:
 
 async def get_active_timers_for_order(order_id: int) -> List[Dict]:
     """Получает все активные таймеры для заказа"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute('''
             SELECT id, user_id, order_id, order_step, product_type, step_started_at, is_active
@@ -2229,7 +2709,7 @@ async def get_active_timers_for_order(order_id: int) -> List[Dict]:
         return [dict(row) for row in rows]
 
 async def get_pending_delayed_messages():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute('''
             SELECT id, order_id, user_id, message_type, content, delay_minutes, created_at, scheduled_at, is_automatic, order_step, is_active, usage_count, last_used
@@ -2245,7 +2725,7 @@ async def get_pending_delayed_messages():
 
 async def get_delayed_message_templates() -> List[Dict]:
     """Получает все шаблоны отложенных сообщений из новой таблицы message_templates"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         db.row_factory = aiosqlite.Row
         
         # Сначала проверяем, существует ли таблица message_templates
@@ -2296,7 +2776,7 @@ async def get_delayed_message_templates() -> List[Dict]:
 
 async def toggle_template_active(template_id: int, is_active: bool) -> bool:
     """Переключает активность шаблона"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         await db.execute('''
             UPDATE delayed_messages 
             SET is_active = ? 
@@ -2307,7 +2787,7 @@ async def toggle_template_active(template_id: int, is_active: bool) -> bool:
 
 async def increment_template_usage(template_id: int) -> bool:
     """Увеличивает счетчик использований шаблона"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         await db.execute('''
             UPDATE delayed_messages 
             SET usage_count = usage_count + 1, last_used = datetime('now')
@@ -2318,7 +2798,7 @@ async def increment_template_usage(template_id: int) -> bool:
 
 async def get_all_orders() -> List[Dict]:
     """Получает все заказы для диагностики"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute('''
             SELECT id, user_id, status, order_data, created_at
@@ -2330,7 +2810,7 @@ async def get_all_orders() -> List[Dict]:
 
 async def get_active_orders_by_step(order_step: str) -> List[Dict]:
     """Получает все активные заказы на определенном шаге"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         db.row_factory = aiosqlite.Row
         
         # Маппинг шагов заказа на статусы
@@ -2376,10 +2856,7 @@ async def get_active_orders_by_step(order_step: str) -> List[Dict]:
 
 async def update_delayed_message_status(message_id: int, status: str):
     async def _update_operation():
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Настраиваем соединение
-            await configure_db_connection(db)
-            
+        async with db_connection() as db:
             await db.execute('''
                 UPDATE delayed_messages SET status = ?, sent_at = datetime('now') WHERE id = ?
             ''', (status, message_id))
@@ -2389,7 +2866,7 @@ async def update_delayed_message_status(message_id: int, status: str):
 
 async def log_general_message_sent(delayed_message_id: int, user_id: int, order_id: int):
     """Записывает в лог отправку общего сообщения пользователю"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         try:
             await db.execute('''
                 INSERT OR IGNORE INTO general_message_sent_log (delayed_message_id, user_id, order_id)
@@ -2401,7 +2878,7 @@ async def log_general_message_sent(delayed_message_id: int, user_id: int, order_
 
 async def is_general_message_sent_to_user(delayed_message_id: int, user_id: int, order_id: int) -> bool:
     """Проверяет, было ли общее сообщение уже отправлено пользователю"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute('''
             SELECT id FROM general_message_sent_log 
@@ -2413,7 +2890,7 @@ async def is_general_message_sent_to_user(delayed_message_id: int, user_id: int,
 # --- Работа с адресами доставки ---
 
 async def save_delivery_address(order_id: int, user_id: int, address: str, recipient_name: str = None, phone: str = None):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         await db.execute('''
             INSERT INTO delivery_addresses (order_id, user_id, address, recipient_name, phone, created_at)
             VALUES (?, ?, ?, ?, ?, datetime('now'))
@@ -2421,7 +2898,7 @@ async def save_delivery_address(order_id: int, user_id: int, address: str, recip
         await db.commit()
 
 async def get_delivery_address(order_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         db.row_factory = aiosqlite.Row
         
         # Сначала проверяем, существует ли заказ
@@ -2442,7 +2919,7 @@ async def get_delivery_address(order_id: int):
         return dict(address) if address else None
 
 async def log_order_status_change(order_id: int, old_status: str, new_status: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         await log_order_status_change_with_db(db, order_id, old_status, new_status)
         await db.commit()
 
@@ -2454,7 +2931,7 @@ async def log_order_status_change_with_db(db, order_id: int, old_status: str, ne
     ''', (order_id, old_status, new_status))
 
 async def get_order_status_history(order_id: int) -> List[Dict]:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT * FROM order_status_history WHERE order_id = ? ORDER BY changed_at ASC
         ''', (order_id,)) as cursor:
@@ -2462,15 +2939,17 @@ async def get_order_status_history(order_id: int) -> List[Dict]:
             return [dict(zip([column[0] for column in cursor.description], row)) for row in rows]
 
 async def add_message_history(order_id: int, sender: str, message: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         await db.execute(f'''
             INSERT INTO message_history (order_id, sender, message, sent_at)
             VALUES (?, ?, ?, {get_moscow_time()})
         ''', (order_id, sender, message))
+        await record_order_event(db, order_id, 'message')
         await db.commit()
+    notify_order_events()
 async def save_early_user_message(user_id: int, message: str):
     """Сохраняет ранние сообщения пользователя до создания заказа"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         await db.execute(f'''
             INSERT INTO early_user_messages (user_id, message, sent_at)
             VALUES (?, ?, {get_moscow_time()})
@@ -2479,7 +2958,7 @@ async def save_early_user_message(user_id: int, message: str):
 
 async def get_early_user_messages(user_id: int) -> List[Dict]:
     """Получает ранние сообщения пользователя"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT message, sent_at FROM early_user_messages 
             WHERE user_id = ? 
@@ -2495,14 +2974,14 @@ async def transfer_early_messages_to_order(user_id: int, order_id: int):
         await add_message_history(order_id, "user", msg['message'])
     
     # Удаляем перенесенные сообщения
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         await db.execute('''
             DELETE FROM early_user_messages WHERE user_id = ?
         ''', (user_id,))
         await db.commit()
 
 async def get_message_history(order_id: int) -> List[Dict]:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT * FROM message_history WHERE order_id = ? ORDER BY sent_at ASC
         ''', (order_id,)) as cursor:
@@ -2578,7 +3057,7 @@ async def get_order_timeline(order_id: int) -> dict:
 
 async def get_managers() -> List[Dict]:
     """Получает список всех менеджеров для админки (без паролей)"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT id, email, COALESCE(full_name, '') as full_name, is_super_admin FROM managers ORDER BY id DESC
         ''') as cursor:
@@ -2587,7 +3066,7 @@ async def get_managers() -> List[Dict]:
 
 async def get_managers_for_auth() -> List[Dict]:
     """Получает список всех менеджеров для аутентификации (с хешированными паролями)"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT id, email, hashed_password, full_name, is_super_admin FROM managers ORDER BY id DESC
         ''') as cursor:
@@ -2596,7 +3075,7 @@ async def get_managers_for_auth() -> List[Dict]:
 
 async def get_regular_managers() -> List[Dict]:
     """Получает только обычных менеджеров (не главных админов)"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT id, email, COALESCE(full_name, '') as full_name, is_super_admin FROM managers 
             WHERE is_super_admin = 0 ORDER BY id DESC
@@ -2606,7 +3085,7 @@ async def get_regular_managers() -> List[Dict]:
 
 async def add_manager(email: str, password: str, full_name: str, is_super_admin: bool = False) -> int:
     """Добавляет нового менеджера"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         # Хешируем пароль перед сохранением
         hashed_password = get_password_hash(password)
         cursor = await db.execute('''
@@ -2618,14 +3097,14 @@ async def add_manager(email: str, password: str, full_name: str, is_super_admin:
 
 async def delete_manager(manager_id: int) -> bool:
     """Удаляет менеджера по ID"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('DELETE FROM managers WHERE id = ?', (manager_id,))
         await db.commit()
         return cursor.rowcount > 0
 
 async def get_manager_by_email(email: str) -> Optional[Dict]:
     """Получает менеджера по email"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT id, email, hashed_password, full_name, is_super_admin FROM managers WHERE email = ?
         ''', (email,)) as cursor:
@@ -2636,7 +3115,7 @@ async def get_manager_by_email(email: str) -> Optional[Dict]:
 
 async def get_manager_by_id(manager_id: int) -> Optional[Dict]:
     """Получает менеджера по ID"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT id, email, hashed_password, full_name, is_super_admin FROM managers WHERE id = ?
         ''', (manager_id,)) as cursor:
@@ -2646,7 +3125,7 @@ async def get_manager_by_id(manager_id: int) -> Optional[Dict]:
             return None
 async def update_manager_profile(manager_id: int, full_name: Optional[str] = None, new_password: Optional[str] = None) -> bool:
     """Обновляет профиль менеджера"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         try:
             # Формируем SQL запрос динамически
             updates = []
@@ -2675,7 +3154,7 @@ async def update_manager_profile(manager_id: int, full_name: Optional[str] = Non
 
 async def update_manager_super_admin_status(manager_id: int, is_super_admin: bool) -> bool:
     """Обновляет статус супер-админа для менеджера"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         try:
             await db.execute('''
                 UPDATE managers SET is_super_admin = ? WHERE id = ?
@@ -2689,7 +3168,7 @@ async def update_manager_super_admin_status(manager_id: int, is_super_admin: boo
 async def get_next_manager_in_queue() -> Optional[int]:
     """Получает ID следующего менеджера в очереди для назначения заказа"""
     print("🔍 ОТЛАДКА: get_next_manager_in_queue() вызвана")
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         # Получаем только обычных менеджеров (НЕ супер-админов)
         async with db.execute('''
             SELECT id FROM managers WHERE is_super_admin = 0 ORDER BY id ASC
@@ -2745,7 +3224,7 @@ async def get_next_manager_in_queue() -> Optional[int]:
 
 async def is_super_admin(email: str) -> bool:
     """Проверяет, является ли менеджер главным админом"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT is_super_admin FROM managers WHERE email = ?
         ''', (email,)) as cursor:
@@ -2754,7 +3233,7 @@ async def is_super_admin(email: str) -> bool:
 
 async def get_manager_orders(manager_id: int) -> List[Dict]:
     """Получает заказы конкретного менеджера"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT o.*, o.user_id as telegram_id, u.product, m.email as manager_email, m.full_name as manager_name 
             FROM orders o 
@@ -2766,82 +3245,173 @@ async def get_manager_orders(manager_id: int) -> List[Dict]:
             rows = await cursor.fetchall()
             return [dict(zip([column[0] for column in cursor.description], row)) for row in rows] 
 
-async def get_orders_with_permissions(manager_email: str, status: Optional[str] = None, page: int = 1, limit: int = 50) -> List[Dict]:
-    """Получает заказы с учетом прав доступа менеджера"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Проверяем, является ли менеджер главным админом
-        is_admin = await is_super_admin(manager_email)
-        
-        # Добавляем пагинацию
-        offset = (page - 1) * limit
-        
-        if is_admin:
-            # Главный админ видит все заказы
-            if status:
-                query = '''
-                    SELECT o.*, o.user_id as telegram_id, u.username, u.first_name, u.last_name, m.email as manager_email, m.full_name as manager_name,
-                           notif.id as notification_id, notif.is_read as notification_is_read, notif.last_user_message_at as notification_last_message_at
-                    FROM orders o 
-                    LEFT JOIN user_profiles u ON o.user_id = u.user_id 
-                    LEFT JOIN managers m ON o.assigned_manager_id = m.id 
-                    LEFT JOIN order_notifications notif ON o.id = notif.order_id
-                    WHERE o.status = ? 
-                    ORDER BY o.created_at DESC
-                    LIMIT ? OFFSET ?
-                '''
-                args = (status, limit, offset)
-            else:
-                query = '''
-                    SELECT o.*, o.user_id as telegram_id, u.username, u.first_name, u.last_name, m.email as manager_email, m.full_name as manager_name,
-                           notif.id as notification_id, notif.is_read as notification_is_read, notif.last_user_message_at as notification_last_message_at
-                    FROM orders o 
-                    LEFT JOIN user_profiles u ON o.user_id = u.user_id 
-                    LEFT JOIN managers m ON o.assigned_manager_id = m.id 
-                    LEFT JOIN order_notifications notif ON o.id = notif.order_id
-                    ORDER BY o.created_at DESC
-                    LIMIT ? OFFSET ?
-                '''
-                args = (limit, offset)
-        else:
-            # Обычный менеджер видит только свои заказы
-            manager = await get_manager_by_email(manager_email)
-            if not manager:
-                return []
-            
-            if status:
-                query = '''
-                    SELECT o.*, o.user_id as telegram_id, u.username, u.first_name, u.last_name, m.email as manager_email, m.full_name as manager_name,
-                           notif.id as notification_id, notif.is_read as notification_is_read, notif.last_user_message_at as notification_last_message_at
-                    FROM orders o 
-                    LEFT JOIN managers m ON o.assigned_manager_id = m.id 
-                    LEFT JOIN user_profiles u ON o.user_id = u.user_id 
-                    LEFT JOIN order_notifications notif ON o.id = notif.order_id AND notif.manager_id = ?
-                    WHERE o.assigned_manager_id = ? AND o.status = ? 
-                    ORDER BY o.created_at DESC
-                    LIMIT ? OFFSET ?
-                '''
-                args = (manager["id"], manager["id"], status, limit, offset)
-            else:
-                query = '''
-                    SELECT o.*, o.user_id as telegram_id, u.username, u.first_name, u.last_name, m.email as manager_email, m.full_name as manager_name,
-                           notif.id as notification_id, notif.is_read as notification_is_read, notif.last_user_message_at as notification_last_message_at
-                    FROM orders o 
-                    LEFT JOIN managers m ON o.assigned_manager_id = m.id 
-                    LEFT JOIN user_profiles u ON o.user_id = u.user_id 
-                    LEFT JOIN order_notifications notif ON o.id = notif.order_id AND notif.manager_id = ?
-                    WHERE o.assigned_manager_id = ? 
-                    ORDER BY o.created_at DESC
-                    LIMIT ? OFFSET ?
-                '''
-                args = (manager["id"], manager["id"], limit, offset)
-        
+# Запас для курсора дельта-синхронизации: запись, начатая до чтения, но закоммиченная после,
+# получает updated_at чуть раньше курсора и не должна потеряться
+ORDERS_SYNC_CURSOR_OVERLAP_SECONDS = 5
+
+# Сколько заказов отдает дельта-синхронизация: если изменилось больше, клиенту дешевле перезагрузить список
+ORDERS_DELTA_MAX_ROWS = int(os.getenv('ORDERS_DELTA_MAX_ROWS', '500'))
+
+async def _orders_permission_filter(manager_email: str, status: Optional[str] = None):
+    """
+    Условия WHERE по правам менеджера и статусу для списка заказов.
+    Возвращает (conditions, args, manager_id) или None, если менеджер не найден;
+    manager_id — None для главного админа.
+    """
+    conditions = []
+    args = []
+    manager_id = None
+    if not await is_super_admin(manager_email):
+        # Обычный менеджер видит только свои заказы
+        manager = await get_manager_by_email(manager_email)
+        if not manager:
+            return None
+        manager_id = manager["id"]
+        conditions.append('o.assigned_manager_id = ?')
+        args.append(manager_id)
+    if status:
+        conditions.append('o.status = ?')
+        args.append(status)
+    return conditions, args, manager_id
+
+async def get_orders_with_permissions(manager_email: str, status: Optional[str] = None, page: int = 1, limit: int = 50,
+                                      since: Optional[str] = None, after: Optional[str] = None) -> List[Dict]:
+    """
+    Получает заказы с учетом прав доступа менеджера.
+    after — курсор encode_page_cursor(created_at, id) последнего заказа предыдущей страницы:
+    следующая страница берется по индексу без OFFSET, и ее стоимость не зависит от номера страницы
+    (ValueError, если курсор поврежден).
+    since — курсор из get_orders_sync_state: тогда возвращаются (без пагинации) только заказы,
+    у которых updated_at заказа или уведомления не раньше курсора, — не больше ORDERS_DELTA_MAX_ROWS + 1:
+    лишняя строка означает, что дельта слишком большая. Заказы, пропавшие из видимых
+    менеджеру, дельта не содержит — их отдает get_removed_order_ids.
+    """
+    permission_filter = await _orders_permission_filter(manager_email, status)
+    if permission_filter is None:
+        return []
+    conditions, args, manager_id = permission_filter
+
+    if manager_id is None:
+        notification_join = 'LEFT JOIN order_notifications notif ON o.id = notif.order_id'
+        join_args = []
+    else:
+        notification_join = 'LEFT JOIN order_notifications notif ON o.id = notif.order_id AND notif.manager_id = ?'
+        join_args = [manager_id]
+
+    if since:
+        # Два индексных поиска вместо OR по соединению
+        conditions.append('''o.id IN (
+            SELECT id FROM orders WHERE updated_at >= ?
+            UNION
+            SELECT order_id FROM order_notifications WHERE updated_at >= ?
+        )''')
+        args.extend([since, since])
+    elif after:
+        conditions.append('(o.created_at, o.id) < (?, ?)')
+        args.extend(_decode_page_cursor(after))
+    where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+    query = f'''
+        SELECT o.*, o.user_id as telegram_id, u.username, u.first_name, u.last_name, m.email as manager_email, m.full_name as manager_name,
+               notif.id as notification_id, notif.is_read as notification_is_read, notif.last_user_message_at as notification_last_message_at,
+               COALESCE(a.order_source, a.user_source) as attribution_source, a.utm_source as attribution_utm_source, a.utm_medium as attribution_utm_medium, a.utm_campaign as attribution_utm_campaign, COALESCE(a.has_upsell, 0) as has_upsell
+        FROM orders o 
+        LEFT JOIN user_profiles u ON o.user_id = u.user_id 
+        LEFT JOIN managers m ON o.assigned_manager_id = m.id 
+        {notification_join}
+        LEFT JOIN order_attribution a ON a.order_id = o.id
+        {where}
+        ORDER BY o.created_at DESC, o.id DESC
+    '''
+    args = join_args + args
+    if since:
+        query += ' LIMIT ?'
+        args.append(ORDERS_DELTA_MAX_ROWS + 1)
+    elif after:
+        query += ' LIMIT ?'
+        args.append(limit)
+    elif not since:
+        # Без курсора — прежняя пагинация по номеру страницы
+        query += ' LIMIT ? OFFSET ?'
+        args.extend([limit, (page - 1) * limit])
+
+    async with db_connection(readonly=True) as db:
         async with db.execute(query, args) as cursor:
             rows = await cursor.fetchall()
             return [dict(zip([column[0] for column in cursor.description], row)) for row in rows]
 
+async def get_orders_sync_state(manager_email: str, status: Optional[str] = None) -> Optional[Dict]:
+    """
+    Дешевый снимок списка заказов менеджера для ETag и дельта-синхронизации:
+    количество, последние updated_at заказов и уведомлений, последний id order_events
+    и курсор (время БД в UTC с запасом) для следующего запроса с since.
+    None — менеджер не найден.
+    """
+    permission_filter = await _orders_permission_filter(manager_email, status)
+    if permission_filter is None:
+        return None
+    conditions, args, manager_id = permission_filter
+    where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+    async with db_connection(readonly=True) as db:
+        async with db.execute(f'''
+            SELECT COUNT(*), MAX(o.updated_at), datetime('now', ?)
+            FROM orders o
+            {where}
+        ''', [f'-{ORDERS_SYNC_CURSOR_OVERLAP_SECONDS} seconds'] + args) as cursor:
+            total, max_updated_at, sync_cursor = await cursor.fetchone()
+
+        if manager_id is None:
+            notification_query = 'SELECT MAX(updated_at) FROM order_notifications'
+            notification_args = ()
+        else:
+            notification_query = 'SELECT MAX(updated_at) FROM order_notifications WHERE manager_id = ?'
+            notification_args = (manager_id,)
+        async with db.execute(notification_query, notification_args) as cursor:
+            max_notification_at = (await cursor.fetchone())[0]
+
+        # Ловит изменения в пределах одной секунды updated_at
+        async with db.execute('SELECT MAX(id) FROM order_events') as cursor:
+            last_event_id = (await cursor.fetchone())[0] or 0
+
+    return {
+        'total': total,
+        'max_updated_at': max_updated_at,
+        'max_notification_at': max_notification_at,
+        'last_event_id': last_event_id,
+        'cursor': sync_cursor,
+    }
+
+async def get_removed_order_ids(manager_email: str, since: str, status: Optional[str] = None) -> Optional[List[int]]:
+    """
+    Заказы, которые менялись после курсора since (по order_events), но больше не видны менеджеру:
+    удалены или переназначены другому менеджеру. Дельта-клиент убирает их из списка.
+    None — курсор старше журнала событий (ORDER_EVENTS_RETENTION_HOURS), и клиент должен
+    перезагрузить список целиком.
+    """
+    permission_filter = await _orders_permission_filter(manager_email, status)
+    if permission_filter is None:
+        return None
+    conditions, args, _ = permission_filter
+    hidden = 'o.id IS NULL'
+    if conditions:
+        hidden += f" OR NOT COALESCE(({' AND '.join(conditions)}), 0)"
+
+    async with db_connection(readonly=True) as db:
+        async with db.execute("SELECT ? < datetime('now', ?)", (since, f'-{ORDER_EVENTS_RETENTION_HOURS} hours')) as cursor:
+            if (await cursor.fetchone())[0]:
+                return None
+        async with db.execute(f'''
+            SELECT DISTINCT e.order_id
+            FROM order_events e
+            LEFT JOIN orders o ON o.id = e.order_id
+            WHERE e.created_at >= ? AND e.order_id IS NOT NULL AND ({hidden})
+        ''', [since] + args) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
 async def get_last_order_username(user_id: int) -> Optional[str]:
     """Получает username из последнего заказа пользователя"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT u.username 
             FROM orders o 
@@ -2861,274 +3431,101 @@ async def get_orders_filtered_with_permissions(
     order_id: Optional[int] = None,
     sort_by: str = 'created_at',
     sort_dir: str = 'desc',
+    created_from: Optional[str] = None,
+    created_to: Optional[str] = None,
 ) -> List[Dict]:
-    """Получает отфильтрованные заказы с учетом прав доступа менеджера"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Проверяем, является ли менеджер главным админом
-        is_admin = await is_super_admin(manager_email)
-        
-        query = '''
-            SELECT o.*, o.user_id as telegram_id, u.product, u.username, u.first_name, u.last_name, m.email as manager_email, m.full_name as manager_name, d.phone
-            FROM orders o 
-            LEFT JOIN user_profiles u ON o.user_id = u.user_id 
-            LEFT JOIN managers m ON o.assigned_manager_id = m.id 
-            LEFT JOIN delivery_addresses d ON o.id = d.order_id
-            WHERE 1=1
-        '''
-        args = []
-        
-        if not is_admin:
-            # Обычный менеджер видит только свои заказы
-            manager = await get_manager_by_email(manager_email)
-            if not manager:
-                return []
-            query += ' AND o.assigned_manager_id = ?'
-            args.append(manager["id"])
-        
-        if status:
-            query += ' AND o.status = ?'
-            args.append(status)
-        if order_type:
-            query += ' AND u.product = ?'
-            args.append(order_type)
-        if telegram_id:
-            query += ' AND o.user_id = ?'
-            args.append(int(telegram_id))
-        if order_id:
-            query += ' AND o.id = ?'
-            args.append(order_id)
-        if sort_by not in ['created_at', 'status', 'id']:
-            sort_by = 'created_at'
-        if sort_dir.lower() not in ['asc', 'desc']:
-            sort_dir = 'desc'
-        query += f' ORDER BY o.{sort_by} {sort_dir.upper()}'
-        
-        # ОТЛАДКА: Выводим SQL запрос
-        print(f"🔍 ОТЛАДКА SQL запрос: {query}")
-        print(f"🔍 ОТЛАДКА SQL аргументы: {args}")
-        
-        async with db.execute(query, args) as cursor:
-            rows = await cursor.fetchall()
-            result = [dict(zip([column[0] for column in cursor.description], row)) for row in rows]
-            
-            # ОТЛАДКА: Выводим информацию о полученных заказах
-            print(f"🔍 ОТЛАДКА get_orders_filtered_with_permissions: получено {len(result)} заказов")
-            for i, order in enumerate(result[:3]):  # Показываем первые 3 заказа
-                print(f"  Заказ {i+1}: ID={order.get('id')}, product={order.get('product')}, user_id={order.get('user_id')}")
-            
-            return result
-
-async def can_access_order(manager_email: str, order_id: int) -> bool:
-    """Проверяет, может ли менеджер получить доступ к заказу"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    """
+    Получает отфильтрованные заказы с учетом прав доступа менеджера.
+    created_from/created_to — границы created_at в UTC, [from, to) (см. msk_period_bounds).
+    """
+    async with db_connection(readonly=True) as db:
         # Проверяем, является ли менеджер главным админом
-        is_admin = await is_super_admin(manager_email)
-        
-        if is_admin:
-            return True
-        
-        # Обычный менеджер может получить доступ только к своим заказам
-        manager = await get_manager_by_email(manager_email)
-        if not manager:
-            return False
-        
-        async with db.execute('''
-            SELECT assigned_manager_id FROM orders WHERE id = ?
-        ''', (order_id,)) as cursor:
-            row = await cursor.fetchone()
-            if not row:
-                return False
-            
-            return row[0] == manager["id"] 
-
-# --- Функции для работы с фотографиями ---
-
-async def get_all_photos() -> List[Dict]:
-    """Получает все фотографии из всех таблиц и order_data"""
-    import glob
-    import os
-    from datetime import datetime
-    
-    print("🔍 ОТЛАДКА: Начинаем загрузку всех фотографий")
-    
-    async with aiosqlite.connect(DB_PATH) as db:
-        photos = []
-        processed_files = set()  # Для отслеживания уже обработанных файлов
-        
-        # Helper функция для добавления фото с правильным путем
-        def add_photo(id, order_id, filename, type, created_at, base_dir="uploads"):
-            # Проверяем, не добавляли ли мы уже этот файл
-            file_key = f"{order_id}_{filename}_{type}"
-            if file_key in processed_files:
-                print(f"🔍 ОТЛАДКА: Пропускаем дубликат {file_key}")
-                return
-            processed_files.add(file_key)
-            
-            # Проверяем, существует ли файл физически
-            file_path = os.path.join(base_dir, filename)
-            if not os.path.exists(file_path):
-                print(f"⚠️ Файл не найден: {file_path}")
-                return
-            
-            photo_data = {
-                "id": id,
-                "order_id": order_id,
-                "filename": filename,
-                "type": type,
-                "created_at": created_at,
-                "path": f"{base_dir}/{filename}"  # Используем прямые слеши для веб-путей
-            }
-            photos.append(photo_data)
-            print(f"🔍 ОТЛАДКА: Добавлена фотография в массив: {photo_data}")
-        
-        # Получаем фотографии из order_data (основной источник фотографий героев)
-        async with db.execute('''
-            SELECT id, id as order_id, order_data, created_at
-            FROM orders
-            WHERE order_data IS NOT NULL AND order_data != ''
-        ''') as cursor:
-            rows = await cursor.fetchall()
-            print(f"🔍 ОТЛАДКА: Найдено {len(rows)} заказов с order_data")
-            for row in rows:
-                order_id = row[1]
-                order_data_str = row[2]
-                created_at = row[3]
-                print(f"🔍 ОТЛАДКА: Обрабатываем заказ {order_id}")
-                
-                try:
-                    order_data = json.loads(order_data_str)
-                    print(f"🔍 ОТЛАДКА: Заказ {order_id}, order_data ключи: {list(order_data.keys())}")
-                    
-                    # Фотографии главного героя
-                    main_hero_photos = order_data.get('main_hero_photos', [])
-                    print(f"🔍 ОТЛАДКА: Заказ {order_id}, main_hero_photos: {main_hero_photos}")
-                    
-                    # Также проверяем отдельные поля фотографий
-                    main_face_1 = order_data.get('main_face_1')
-                    main_face_2 = order_data.get('main_face_2')
-                    main_full = order_data.get('main_full')
-                    joint_photo = order_data.get('joint_photo')
-                    print(f"🔍 ОТЛАДКА: Заказ {order_id}, main_face_1: {main_face_1}, main_face_2: {main_face_2}, main_full: {main_full}, joint_photo: {joint_photo}")
-                    
-                    # Обрабатываем новую структуру main_hero_photos (массив объектов)
-                    if isinstance(main_hero_photos, list):
-                        for photo_obj in main_hero_photos:
-                            if isinstance(photo_obj, dict):
-                                # Новая структура: {'type': 'face_1', 'filename': '...'}
-                                photo_filename = photo_obj.get('filename')
-                                photo_type = photo_obj.get('type', 'main_hero')
-                                if photo_filename and photo_filename != "-":
-                                    print(f"🔍 ОТЛАДКА: Добавляем фото {photo_filename} с типом {photo_type}")
-                                    add_photo(len(photos) + 1, order_id, photo_filename, photo_type, created_at)
-                            elif isinstance(photo_obj, str):
-                                # Старая структура: просто строка с именем файла
-                                photo_filename = photo_obj
-                                if photo_filename and photo_filename != "-":
-                                    # Определяем тип фотографии на основе имени файла
-                                    if "main_face_1" in photo_filename:
-                                        photo_type = "main_hero"
-                                    elif "main_face_2" in photo_filename:
-                                        photo_type = "main_hero"
-                                    elif "main_full" in photo_filename:
-                                        photo_type = "main_hero"
-                                    else:
-                                        photo_type = f"main_hero"
-                                    print(f"🔍 ОТЛАДКА: Добавляем фото {photo_filename} с типом {photo_type}")
-                                    add_photo(len(photos) + 1, order_id, photo_filename, photo_type, created_at)
-                    
-                    # Обрабатываем отдельные поля фотографий (если они есть)
-                    if main_face_1 and main_face_1 != "-":
-                        print(f"🔍 ОТЛАДКА: Добавляем main_face_1 {main_face_1}")
-                        add_photo(len(photos) + 1, order_id, main_face_1, "main_face_1", created_at)
-                    
-                    if main_face_2 and main_face_2 != "-":
-                        print(f"🔍 ОТЛАДКА: Добавляем main_face_2 {main_face_2}")
-                        add_photo(len(photos) + 1, order_id, main_face_2, "main_face_2", created_at)
-                    
-                    if main_full and main_full != "-":
-                        print(f"🔍 ОТЛАДКА: Добавляем main_full {main_full}")
-                        add_photo(len(photos) + 1, order_id, main_full, "main_full", created_at)
-                    
-                    # Совместное фото
-                    joint_photo = order_data.get('joint_photo')
-                    print(f"🔍 ОТЛАДКА: Заказ {order_id}, joint_photo: {joint_photo}")
-                    if joint_photo and joint_photo != "-":
-                        print(f"🔍 ОТЛАДКА: Добавляем совместное фото {joint_photo}")
-                        add_photo(len(photos) + 1, order_id, joint_photo, "joint_photo", created_at)
-                    
-                    # Фотографии других героев
-                    other_heroes = order_data.get('other_heroes', [])
-                    print(f"🔍 ОТЛАДКА: Заказ {order_id}, other_heroes: {other_heroes}")
-                    for hero_index, hero in enumerate(other_heroes):
-                        hero_name = hero.get('name', f'hero_{hero_index+1}')
-                        print(f"🔍 ОТЛАДКА: Обрабатываем героя {hero_name}")
-                        
-                        # Фото лица 1
-                        face_1 = hero.get('face_1')
-                        if face_1 and face_1 != "-":
-                            print(f"🔍 ОТЛАДКА: Добавляем фото второго героя {face_1} с типом {hero_name}_face_1")
-                            add_photo(len(photos) + 1, order_id, face_1, f"{hero_name}_face_1", created_at)
-                        
-                        # Фото лица 2
-                        face_2 = hero.get('face_2')
-                        if face_2 and face_2 != "-":
-                            print(f"🔍 ОТЛАДКА: Добавляем фото второго героя {face_2} с типом {hero_name}_face_2")
-                            add_photo(len(photos) + 1, order_id, face_2, f"{hero_name}_face_2", created_at)
-                        
-                        # Полное фото
-                        full = hero.get('full')
-                        if full and full != "-":
-                            print(f"🔍 ОТЛАДКА: Добавляем фото второго героя {full} с типом {hero_name}_full")
-                            add_photo(len(photos) + 1, order_id, full, f"{hero_name}_full", created_at)
-                    
-                except json.JSONDecodeError as e:
-                    print(f"Ошибка парсинга order_data для заказа {order_id}: {e}")
-                    continue
+        is_admin = await is_super_admin(manager_email)
         
-        # Получаем фотографии из папки uploads/order_{id}_pages (индивидуальные страницы)
-        try:
-            pages_dirs = glob.glob("uploads/order_*_pages")
-            for pages_dir in pages_dirs:
-                try:
-                    # Извлекаем ID заказа из имени папки
-                    order_id = int(pages_dir.split("order_")[1].split("_pages")[0])
-                    
-                    # Получаем все файлы из папки
-                    page_files = glob.glob(os.path.join(pages_dir, "*"))
-                    for i, file_path in enumerate(page_files):
-                        if os.path.isfile(file_path):
-                            filename = os.path.basename(file_path)
-                            # Для page_X типа используем полный путь к папке
-                            add_photo(len(photos) + 1, order_id, filename, f"page_{i+1}", datetime.now().isoformat(), pages_dir)
-                except Exception as e:
-                    print(f"Ошибка обработки папки {pages_dir}: {e}")
-        except Exception as e:
-            print(f"Ошибка при поиске папок страниц: {e}")
+        query = '''
+            SELECT o.*, o.user_id as telegram_id, u.product, u.username, u.first_name, u.last_name, m.email as manager_email, m.full_name as manager_name, d.phone,
+                   COALESCE(a.order_source, a.user_source) as attribution_source, a.utm_source as attribution_utm_source, a.utm_medium as attribution_utm_medium, a.utm_campaign as attribution_utm_campaign, COALESCE(a.has_upsell, 0) as has_upsell
+            FROM orders o 
+            LEFT JOIN user_profiles u ON o.user_id = u.user_id 
+            LEFT JOIN managers m ON o.assigned_manager_id = m.id 
+            LEFT JOIN delivery_addresses d ON o.id = d.order_id
+            LEFT JOIN order_attribution a ON a.order_id = o.id
+            WHERE 1=1
+        '''
+        args = []
         
-        # Получаем фотографии из таблицы uploads (фотографии первой и последней страницы и другие)
-        try:
-            async with db.execute('''
-                SELECT id, order_id, filename, file_type, uploaded_at
-                FROM uploads
-                ORDER BY uploaded_at DESC
-            ''') as cursor:
-                upload_rows = await cursor.fetchall()
-                print(f"🔍 ОТЛАДКА: Найдено {len(upload_rows)} записей в таблице uploads")
-                
-                for row in upload_rows:
-                    upload_id, order_id, filename, file_type, uploaded_at = row
-                    print(f"🔍 ОТЛАДКА: Обрабатываем upload: order_id={order_id}, filename={filename}, file_type={file_type}")
-                    add_photo(upload_id, order_id, filename, file_type, uploaded_at)
-        except Exception as e:
-            print(f"Ошибка при получении данных из таблицы uploads: {e}")
+        if not is_admin:
+            # Обычный менеджер видит только свои заказы
+            manager = await get_manager_by_email(manager_email)
+            if not manager:
+                return []
+            query += ' AND o.assigned_manager_id = ?'
+            args.append(manager["id"])
         
-        # Сортируем по дате создания (новые сначала)
-        photos.sort(key=lambda x: x["created_at"], reverse=True)
+        if status:
+            query += ' AND o.status = ?'
+            args.append(status)
+        if order_type:
+            query += ' AND u.product = ?'
+            args.append(order_type)
+        if telegram_id:
+            query += ' AND o.user_id = ?'
+            args.append(int(telegram_id))
+        if order_id:
+            query += ' AND o.id = ?'
+            args.append(order_id)
+        if created_from:
+            query += ' AND o.created_at >= ?'
+            args.append(created_from)
+        if created_to:
+            query += ' AND o.created_at < ?'
+            args.append(created_to)
+        if sort_by not in ['created_at', 'status', 'id']:
+            sort_by = 'created_at'
+        if sort_dir.lower() not in ['asc', 'desc']:
+            sort_dir = 'desc'
+        query += f' ORDER BY o.{sort_by} {sort_dir.upper()}'
         
-        print(f"🔍 ОТЛАДКА: Всего найдено фотографий: {len(photos)}")
-        print(f"🔍 ОТЛАДКА: Пример фотографий: {photos[:3] if photos else 'Нет фотографий'}")
+        # ОТЛАДКА: Выводим SQL запрос
+        print(f"🔍 ОТЛАДКА SQL запрос: {query}")
+        print(f"🔍 ОТЛАДКА SQL аргументы: {args}")
         
-        return photos
+        async with db.execute(query, args) as cursor:
+            rows = await cursor.fetchall()
+            result = [dict(zip([column[0] for column in cursor.description], row)) for row in rows]
+            
+            # ОТЛАДКА: Выводим информацию о полученных заказах
+            print(f"🔍 ОТЛАДКА get_orders_filtered_with_permissions: получено {len(result)} заказов")
+            for i, order in enumerate(result[:3]):  # Показываем первые 3 заказа
+                print(f"  Заказ {i+1}: ID={order.get('id')}, product={order.get('product')}, user_id={order.get('user_id')}")
+            
+            return result
+
+async def can_access_order(manager_email: str, order_id: int) -> bool:
+    """Проверяет, может ли менеджер получить доступ к заказу"""
+    async with db_connection(readonly=True) as db:
+        # Проверяем, является ли менеджер главным админом
+        is_admin = await is_super_admin(manager_email)
+        
+        if is_admin:
+            return True
+        
+        # Обычный менеджер может получить доступ только к своим заказам
+        manager = await get_manager_by_email(manager_email)
+        if not manager:
+            return False
+        
+        async with db.execute('''
+            SELECT assigned_manager_id FROM orders WHERE id = ?
+        ''', (order_id,)) as cursor:
+            row = await cursor.fetchone()
+            if not row:
+                return False
+            
+            return row[0] == manager["id"] 
+
+# --- Функции для работы с фотографиями ---
+
 async def get_selected_photos() -> List[Dict]:
     """Получает только выбранные фотографии из order_data"""
     import glob
@@ -3137,7 +3534,7 @@ async def get_selected_photos() -> List[Dict]:
     
     print("🔍 ОТЛАДКА: Начинаем загрузку выбранных фотографий")
     
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         photos = []
         processed_files = set()  # Для отслеживания уже обработанных файлов
         
@@ -3306,282 +3703,279 @@ async def get_selected_photos() -> List[Dict]:
                         page_num = page_info['page_number']
                         filename = page_info['filename']
                         
-                        # Проверяем, существует ли файл
-                        file_path = os.path.join(pages_dir, filename)
-                        if os.path.isfile(file_path):
-                            # Добавляем только если страница выбрана
-                            if page_num in selected_pages:
-                                print(f"🔍 ОТЛАДКА: Добавляем выбранную страницу {page_num}: {filename}")
-                                add_photo(len(photos) + 1, order_id, filename, f"page_{page_num}", datetime.now().isoformat(), pages_dir)
-                            else:
-                                print(f"🔍 ОТЛАДКА: Пропускаем невыбранную страницу {page_num}: {filename}")
-                                
-                except Exception as e:
-                    print(f"Ошибка обработки папки {pages_dir}: {e}")
-        except Exception as e:
-            print(f"Ошибка при поиске папок страниц: {e}")
-        
-        # Сортируем по дате создания (новые сначала)
-        photos.sort(key=lambda x: x["created_at"], reverse=True)
-        
-        print(f"🔍 ОТЛАДКА: Всего найдено выбранных фотографий: {len(photos)}")
-        print(f"🔍 ОТЛАДКА: Пример выбранных фотографий: {photos[:3] if photos else 'Нет фотографий'}")
-        
-        return photos
-
-async def get_complete_photos() -> List[Dict]:
-    """Получает все фотографии: выбранные страницы + вкладыши + свои фото + обложки"""
-    import glob
-    import os
-    from datetime import datetime
-    
-    async with aiosqlite.connect(DB_PATH) as db:
-        photos = []
-        processed_files = set()
-        
-        def add_photo(id, order_id, filename, type, created_at, base_dir="uploads"):
-            # Проверяем, что filename - это строка
-            if not isinstance(filename, str):
-                print(f"🔍 ОТЛАДКА: filename не является строкой: {filename}")
-                return
-                
-            file_key = f"{order_id}_{filename}_{type}"
-            if file_key in processed_files:
-                print(f"🔍 ОТЛАДКА: Файл уже обработан: {file_key}")
-                return
-            processed_files.add(file_key)
-            
-            file_path = os.path.join(base_dir, filename)
-            if not os.path.exists(file_path):
-                print(f"🔍 ОТЛАДКА: Файл не существует: {file_path}")
-                return
-            
-            # Кодируем filename для URL
-            from urllib.parse import quote
-            encoded_filename = quote(filename)
-            
-            photo_data = {
-                "id": id,
-                "order_id": order_id,
-                "filename": filename,
-                "type": type,
-                "created_at": created_at,
-                "path": f"{base_dir}/{encoded_filename}"
-            }
-            photos.append(photo_data)
-            print(f"🔍 ОТЛАДКА: Добавлена фотография: {photo_data}")
-        
-        # Получаем фотографии из order_data
-        async with db.execute('''
-            SELECT id, id as order_id, order_data, created_at
-            FROM orders
-            WHERE order_data IS NOT NULL AND order_data != ''
-        ''') as cursor:
-            rows = await cursor.fetchall()
-            for row in rows:
-                order_id = row[1]
-                order_data_str = row[2]
-                created_at = row[3]
-                
-                try:
-                    order_data = json.loads(order_data_str)
-                    
-                    # Фотографии главного героя
-                    main_hero_photos = order_data.get('main_hero_photos', [])
-                    
-                    # Обрабатываем main_hero_photos
-                    if isinstance(main_hero_photos, list):
-                        for photo_obj in main_hero_photos:
-                            if isinstance(photo_obj, dict):
-                                photo_filename = photo_obj.get('filename')
-                                photo_type = photo_obj.get('type', 'main_hero')
-                                if photo_filename and photo_filename != "-":
-                                    add_photo(len(photos) + 1, order_id, photo_filename, photo_type, created_at)
-                            elif isinstance(photo_obj, str):
-                                photo_filename = photo_obj
-                                if photo_filename and photo_filename != "-":
-                                    photo_type = "main_hero"
-                                    add_photo(len(photos) + 1, order_id, photo_filename, photo_type, created_at)
-                    
-                    # Отдельные поля фотографий
-                    main_face_1 = order_data.get('main_face_1')
-                    main_face_2 = order_data.get('main_face_2')
-                    main_full = order_data.get('main_full')
-                    joint_photo = order_data.get('joint_photo')
-                    
-                    if main_face_1 and main_face_1 != "-":
-                        add_photo(len(photos) + 1, order_id, main_face_1, "main_face_1", created_at)
-                    
-                    if main_face_2 and main_face_2 != "-":
-                        add_photo(len(photos) + 1, order_id, main_face_2, "main_face_2", created_at)
-                    
-                    if main_full and main_full != "-":
-                        add_photo(len(photos) + 1, order_id, main_full, "main_full", created_at)
-                    
-                    # Совместное фото
-                    if joint_photo and joint_photo != "-":
-                        add_photo(len(photos) + 1, order_id, joint_photo, "joint_photo", created_at)
-                    
-                    # Фотографии других героев
-                    other_heroes = order_data.get('other_heroes', [])
-                    for hero_index, hero in enumerate(other_heroes):
-                        hero_name = hero.get('name', f'hero_{hero_index+1}')
-                        
-                        # Фото лица 1
-                        face_1 = hero.get('face_1')
-                        if face_1 and face_1 != "-":
-                            add_photo(len(photos) + 1, order_id, face_1, f"{hero_name}_face_1", created_at)
-                        
-                        # Фото лица 2
-                        face_2 = hero.get('face_2')
-                        if face_2 and face_2 != "-":
-                            add_photo(len(photos) + 1, order_id, face_2, f"{hero_name}_face_2", created_at)
-                        
-                        # Полное фото
-                        full = hero.get('full')
-                        if full and full != "-":
-                            add_photo(len(photos) + 1, order_id, full, f"{hero_name}_full", created_at)
-                    
-                    # Вкладыши (inserts)
-                    inserts = order_data.get('inserts', [])
-                    for insert_filename in inserts:
-                        if insert_filename and insert_filename != "-":
-                            add_photo(len(photos) + 1, order_id, insert_filename, "insert", created_at)
-                    
-                    # Свои фотографии (custom_photos)
-                    custom_photos = order_data.get('custom_photos', [])
-                    for custom_photo_filename in custom_photos:
-                        if custom_photo_filename and custom_photo_filename != "-":
-                            add_photo(len(photos) + 1, order_id, custom_photo_filename, "custom_photo", created_at)
-                    
-                    # Выбранная обложка
-                    selected_cover = order_data.get('selected_cover', {})
-                    if selected_cover and isinstance(selected_cover, dict):
-                        cover_filename = selected_cover.get('filename')
-                        if cover_filename and cover_filename != "-":
-                            add_photo(len(photos) + 1, order_id, cover_filename, "selected_cover", created_at)
-                    
-                except json.JSONDecodeError as e:
-                    continue
-        
-        # Получаем выбранные страницы из папки uploads/order_{id}_pages
-        try:
-            pages_dirs = glob.glob("uploads/order_*_pages")
-            for pages_dir in pages_dirs:
-                try:
-                    order_id = int(pages_dir.split("order_")[1].split("_pages")[0])
-                    
-                    cursor = await db.execute('SELECT order_data FROM orders WHERE id = ?', (order_id,))
-                    row = await cursor.fetchone()
-                    if row and row[0]:
-                        try:
-                            order_data = json.loads(row[0])
-                            selected_pages = order_data.get('selected_pages', [])
-                        except json.JSONDecodeError:
-                            selected_pages = []
-                    else:
-                        selected_pages = []
-                    
-                    page_files = glob.glob(os.path.join(pages_dir, "*"))
-                    page_files.sort()
-                    
-                    for i, file_path in enumerate(page_files):
-                        if os.path.isfile(file_path):
-                            filename = os.path.basename(file_path)
-                            page_num = i + 1
-                            
-                            if page_num in selected_pages:
-                                add_photo(len(photos) + 1, order_id, filename, f"page_{page_num}", datetime.now().isoformat(), pages_dir)
-                                
-                except Exception as e:
-                    continue
-        except Exception as e:
-            pass
-        
-        # Добавляем фотографии героев из таблицы hero_photos
-        try:
-            async with db.execute('''
-                SELECT id, order_id, filename, photo_type, hero_name, created_at
-                FROM hero_photos
-                ORDER BY created_at DESC
-            ''') as cursor:
-                hero_photo_rows = await cursor.fetchall()
-                
-                for row in hero_photo_rows:
-                    photo_id, order_id, filename, photo_type, hero_name, created_at = row
-                    
-                    if hero_name:
-                        display_type = f"{hero_name}_{photo_type}"
-                    else:
-                        display_type = f"hero_{photo_type}"
-                    
-                    add_photo(photo_id, order_id, filename, display_type, created_at)
-        
-        except Exception as e:
-            pass
-        
-        # Добавляем фотографии из таблицы uploads (фотографии первой и последней страницы и другие)
-        try:
-            async with db.execute('''
-                SELECT id, order_id, filename, file_type, uploaded_at
-                FROM uploads
-                ORDER BY uploaded_at DESC
-            ''') as cursor:
-                upload_rows = await cursor.fetchall()
-                print(f"🔍 ОТЛАДКА: Найдено {len(upload_rows)} записей в таблице uploads")
-                
-                for row in upload_rows:
-                    upload_id, order_id, filename, file_type, uploaded_at = row
-                    print(f"🔍 ОТЛАДКА: Обрабатываем upload: order_id={order_id}, filename={filename}, file_type={file_type}")
-                    add_photo(upload_id, order_id, filename, file_type, uploaded_at)
+                        # Проверяем, существует ли файл
+                        file_path = os.path.join(pages_dir, filename)
+                        if os.path.isfile(file_path):
+                            # Добавляем только если страница выбрана
+                            if page_num in selected_pages:
+                                print(f"🔍 ОТЛАДКА: Добавляем выбранную страницу {page_num}: {filename}")
+                                add_photo(len(photos) + 1, order_id, filename, f"page_{page_num}", datetime.now().isoformat(), pages_dir)
+                            else:
+                                print(f"🔍 ОТЛАДКА: Пропускаем невыбранную страницу {page_num}: {filename}")
+                                
+                except Exception as e:
+                    print(f"Ошибка обработки папки {pages_dir}: {e}")
         except Exception as e:
-            print(f"❌ Ошибка при получении данных из таблицы uploads: {e}")
-            pass
+            print(f"Ошибка при поиске папок страниц: {e}")
         
         # Сортируем по дате создания (новые сначала)
         photos.sort(key=lambda x: x["created_at"], reverse=True)
         
+        print(f"🔍 ОТЛАДКА: Всего найдено выбранных фотографий: {len(photos)}")
+        print(f"🔍 ОТЛАДКА: Пример выбранных фотографий: {photos[:3] if photos else 'Нет фотографий'}")
+        
+        return photos
+
+# --- Каталог фотографий (photo_catalog) ---
+
+# Размер страницы /admin/photos по умолчанию и максимальный
+PHOTO_CATALOG_PAGE_SIZE = 100
+PHOTO_CATALOG_MAX_PAGE_SIZE = 500
+
+_MAIN_HERO_PHOTO_TYPES = ('main_face_1', 'main_face_2', 'main_full')
+
+def _hero_photo_type(photo_type: str, hero_name: Optional[str]) -> str:
+    return f"{hero_name}_{photo_type}" if hero_name else f"hero_{photo_type}"
+
+def _main_hero_photo_type(filename: str) -> str:
+    """Тип фотографии главного героя по имени файла (main_face_1_..., main_full_...)"""
+    for photo_type in _MAIN_HERO_PHOTO_TYPES:
+        if photo_type in filename:
+            return photo_type
+    return "main_hero"
+
+async def _add_to_photo_catalog(db, order_id: int, filename: str, photo_type: str, source: str,
+                                base_dir: str = "uploads", file_path: str = None,
+                                page_number: int = None, created_at: str = None):
+    """Добавляет фотографию в photo_catalog на соединении-писателе (в той же транзакции, что и сама запись)"""
+    path = (file_path or os.path.join(base_dir, filename)).replace(os.sep, "/")
+    await db.execute('''
+        INSERT OR IGNORE INTO photo_catalog (order_id, filename, path, photo_type, source, page_number, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, datetime('now')))
+    ''', (order_id, filename, path, photo_type, source, page_number, created_at))
+
+def _order_data_photos(order_id: int, order_data: Dict) -> List[Tuple[str, str, str, str]]:
+    """Фотографии, на которые ссылается order_data заказа: (filename, тип, источник, папка)"""
+    photos = []
+
+    for photo_obj in order_data.get('main_hero_photos') or []:
+        if isinstance(photo_obj, dict):
+            photos.append((photo_obj.get('filename'), photo_obj.get('type', 'main_hero'), 'main_hero', 'uploads'))
+        elif isinstance(photo_obj, str):
+            photos.append((photo_obj, 'main_hero', 'main_hero', 'uploads'))
+
+    for photo_type in _MAIN_HERO_PHOTO_TYPES:
+        photos.append((order_data.get(photo_type), photo_type, 'main_hero', 'uploads'))
+    photos.append((order_data.get('joint_photo'), 'joint_photo', 'joint', 'uploads'))
+
+    for hero_index, hero in enumerate(order_data.get('other_heroes') or []):
+        if not isinstance(hero, dict):
+            continue
+        hero_name = hero.get('name', f'hero_{hero_index+1}')
+        for photo_type in ('face_1', 'face_2', 'full'):
+            photos.append((hero.get(photo_type), f"{hero_name}_{photo_type}", 'hero', 'uploads'))
+
+    for filename in order_data.get('custom_photos') or []:
+        photos.append((filename, 'custom_photo', 'custom_photo', f"uploads/order_{order_id}_custom_photos"))
+
+    selected_cover = order_data.get('selected_cover')
+    if isinstance(selected_cover, dict):
+        photos.append((selected_cover.get('filename'), 'selected_cover', 'cover', 'uploads'))
+
+    return [photo for photo in photos if isinstance(photo[0], str) and photo[0] and photo[0] != "-"]
+
+async def _backfill_photo_catalog(db) -> int:
+    """
+    Заполняет photo_catalog по существующим данным: order_data заказов, таблицам фотографий
+    героев, uploads и order_pages. Файлы, которых нет на диске, пропускаются. Возвращает число добавленных строк.
+    """
+    rows = []
+
+    def add(order_id, filename, photo_type, source, created_at, base_dir="uploads", page_number=None):
+        path = os.path.join(base_dir, filename)
+        if os.path.isfile(path):
+            rows.append((order_id, filename, path.replace(os.sep, "/"), photo_type, source, page_number, created_at))
+
+    async with db.execute('''
+        SELECT id, order_data, created_at FROM orders
+        WHERE order_data IS NOT NULL AND order_data != ''
+    ''') as cursor:
+        async for order_id, order_data_str, created_at in cursor:
+            try:
+                order_data = json.loads(order_data_str)
+            except json.JSONDecodeError:
+                continue
+            if not isinstance(order_data, dict):
+                continue
+            for filename, photo_type, source, base_dir in _order_data_photos(order_id, order_data):
+                add(order_id, filename, photo_type, source, created_at, base_dir)
+
+    async with db.execute('''
+        SELECT hp.order_id, hp.filename, hp.photo_type, hp.hero_name, COALESCE(hp.created_at, o.created_at)
+        FROM hero_photos hp LEFT JOIN orders o ON o.id = hp.order_id
+    ''') as cursor:
+        async for order_id, filename, photo_type, hero_name, created_at in cursor:
+            if filename:
+                add(order_id, filename, _hero_photo_type(photo_type, hero_name), 'hero', created_at)
+
+    for table, source in (('main_hero_photos', 'main_hero'), ('joint_photos', 'joint')):
+        async with db.execute(f'''
+            SELECT t.order_id, t.filename, o.created_at
+            FROM {table} t LEFT JOIN orders o ON o.id = t.order_id
+        ''') as cursor:
+            async for order_id, filename, created_at in cursor:
+                if filename:
+                    photo_type = _main_hero_photo_type(filename) if source == 'main_hero' else 'joint_photo'
+                    add(order_id, filename, photo_type, source, created_at)
+
+    async with db.execute('SELECT order_id, filename, file_type, uploaded_at FROM uploads') as cursor:
+        async for order_id, filename, file_type, uploaded_at in cursor:
+            if filename:
+                add(order_id, filename, file_type, 'upload', uploaded_at)
+
+    async with db.execute('SELECT order_id, page_number, filename, created_at FROM order_pages') as cursor:
+        async for order_id, page_number, filename, created_at in cursor:
+            if filename:
+                add(order_id, filename, f"page_{page_number}", 'page', created_at,
+                    f"uploads/order_{order_id}_pages", page_number)
+
+    before = db.total_changes
+    await db.executemany('''
+        INSERT OR IGNORE INTO photo_catalog (order_id, filename, path, photo_type, source, page_number, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, datetime('now')))
+    ''', rows)
+    return db.total_changes - before
+
+async def backfill_photo_catalog() -> int:
+    """Дополняет photo_catalog фотографиями, загруженными до его появления. Возвращает число добавленных строк."""
+    return await run_write(_backfill_photo_catalog)
+
+def encode_page_cursor(created_at: str, row_id: int) -> str:
+    """Курсор постраничного вывода по ключу (created_at, id) — каталог фотографий, список заказов"""
+    return base64.urlsafe_b64encode(f"{created_at}|{row_id}".encode()).decode()
+
+def _decode_page_cursor(cursor: str) -> Tuple[str, int]:
+    """Разбирает курсор страницы; ValueError, если курсор поврежден"""
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit("|", 1)
+        return created_at, int(row_id)
+    except Exception:
+        raise ValueError("Некорректный курсор")
+
+async def get_photo_catalog(
+    order_id: Optional[int] = None,
+    photo_type: Optional[str] = None,
+    source: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = PHOTO_CATALOG_PAGE_SIZE,
+) -> Tuple[List[Dict], Optional[str]]:
+    """
+    Страница каталога фотографий, новые сначала. Постраничный вывод по ключу (created_at, id):
+    cursor — значение next_cursor предыдущей страницы. Возвращает (фотографии, next_cursor или None).
+    """
+    limit = max(1, min(limit, PHOTO_CATALOG_MAX_PAGE_SIZE))
+    conditions = []
+    params: List = []
+    if order_id is not None:
+        conditions.append("order_id = ?")
+        params.append(order_id)
+    if photo_type:
+        conditions.append("photo_type = ?")
+        params.append(photo_type)
+    if source:
+        conditions.append("source = ?")
+        params.append(source)
+    if cursor:
+        conditions.append("(created_at, id) < (?, ?)")
+        params.extend(_decode_page_cursor(cursor))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    async with db_connection(readonly=True) as db:
+        async with db.execute(f'''
+            SELECT id, order_id, filename, photo_type, source, page_number, created_at, path
+            FROM photo_catalog
+            {where}
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', (*params, limit + 1)) as db_cursor:
+            rows = await db_cursor.fetchall()
+
+    from urllib.parse import quote
+    photos = [{
+        "id": row[0],
+        "order_id": row[1],
+        "filename": row[2],
+        "type": row[3],
+        "source": row[4],
+        "page_number": row[5],
+        "created_at": row[6],
+        "path": quote(row[7]),
+    } for row in rows[:limit]]
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_page_cursor(last[6], last[0])
+    return photos, next_cursor
+
+async def get_order_catalog_photos(order_id: int) -> List[Dict]:
+    """Фотографии заказа из photo_catalog; из страниц остаются только выбранные пользователем"""
+    photos, _ = await get_photo_catalog(order_id=order_id, limit=PHOTO_CATALOG_MAX_PAGE_SIZE)
+    if not any(photo["source"] == "page" for photo in photos):
         return photos
 
+    async with db_connection(readonly=True) as db:
+        async with db.execute('SELECT order_data FROM orders WHERE id = ?', (order_id,)) as cursor:
+            row = await cursor.fetchone()
+    try:
+        selected_pages = json.loads(row[0]).get('selected_pages', []) if row and row[0] else []
+    except (json.JSONDecodeError, AttributeError):
+        selected_pages = []
+    return [photo for photo in photos if photo["source"] != "page" or photo["page_number"] in selected_pages]
+
 # --- Функции для сохранения фотографий в базу данных ---
 
 async def save_main_hero_photo(order_id: int, filename: str) -> int:
     """Сохраняет фотографию главного героя в базу данных"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             INSERT INTO main_hero_photos (order_id, filename)
             VALUES (?, ?)
         ''', (order_id, filename))
+        await _add_to_photo_catalog(db, order_id, filename, _main_hero_photo_type(filename), 'main_hero')
         await db.commit()
         return cursor.lastrowid
 
 async def save_hero_photo(order_id: int, filename: str, photo_type: str, hero_name: str = None) -> int:
     """Сохраняет фотографию другого героя в базу данных"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             INSERT INTO hero_photos (order_id, filename, photo_type, hero_name, created_at)
             VALUES (?, ?, ?, ?, datetime('now'))
         ''', (order_id, filename, photo_type, hero_name))
+        await _add_to_photo_catalog(db, order_id, filename, _hero_photo_type(photo_type, hero_name), 'hero')
         await db.commit()
         return cursor.lastrowid
 
 async def save_joint_photo(order_id: int, filename: str) -> int:
     """Сохраняет совместное фото в базу данных"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             INSERT INTO joint_photos (order_id, filename)
             VALUES (?, ?)
         ''', (order_id, filename))
+        await _add_to_photo_catalog(db, order_id, filename, 'joint_photo', 'joint')
         await db.commit()
         return cursor.lastrowid
 
-async def save_uploaded_file(order_id: int, filename: str, file_type: str = "image") -> int:
-    """Сохраняет загруженный файл в базу данных"""
-    async with aiosqlite.connect(DB_PATH) as db:
+async def save_uploaded_file(order_id: int, filename: str, file_type: str = "image", file_path: str = None) -> int:
+    """Сохраняет загруженный файл в базу данных (file_path — если файл лежит не в uploads/filename)"""
+    async with db_connection() as db:
         cursor = await db.execute('''
             INSERT INTO uploads (order_id, filename, file_type, uploaded_at)
             VALUES (?, ?, ?, datetime('now'))
         ''', (order_id, filename, file_type))
+        await _add_to_photo_catalog(db, order_id, filename, file_type, 'upload', file_path=file_path)
         await db.commit()
         return cursor.lastrowid
 
@@ -3589,7 +3983,7 @@ async def save_uploaded_file(order_id: int, filename: str, file_type: str = "ima
 
 async def get_cover_templates() -> List[Dict]:
     """Получает все шаблоны обложек"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT id, name, filename, category, created_at
             FROM cover_templates
@@ -3600,7 +3994,7 @@ async def get_cover_templates() -> List[Dict]:
 
 async def get_cover_template_by_id(template_id: int) -> Dict:
     """Получает шаблон обложки по ID"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT id, name, filename, category, created_at
             FROM cover_templates
@@ -3613,7 +4007,7 @@ async def get_cover_template_by_id(template_id: int) -> Dict:
 
 async def add_cover_template(name: str, filename: str, category: str) -> Dict:
     """Добавляет новый шаблон обложки"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             INSERT INTO cover_templates (name, filename, category, created_at)
             VALUES (?, ?, ?, datetime('now'))
@@ -3632,7 +4026,7 @@ async def add_cover_template(name: str, filename: str, category: str) -> Dict:
 
 async def delete_cover_template(template_id: int) -> bool:
     """Удаляет шаблон обложки по ID"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             DELETE FROM cover_templates
             WHERE id = ?
@@ -3644,7 +4038,7 @@ async def delete_cover_template(template_id: int) -> bool:
 
 async def get_book_styles() -> List[Dict]:
     """Получает все стили книг"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT id, name, description, filename, category, created_at
             FROM book_styles
@@ -3662,7 +4056,7 @@ async def get_book_styles() -> List[Dict]:
 
 async def add_book_style(name: str, description: str, filename: str, category: str) -> Dict:
     """Добавляет новый стиль книги"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             INSERT INTO book_styles (name, description, filename, category, created_at)
             VALUES (?, ?, ?, ?, datetime('now'))
@@ -3681,14 +4075,14 @@ async def add_book_style(name: str, description: str, filename: str, category: s
 
 async def delete_book_style(style_id: int) -> bool:
     """Удаляет стиль книги по ID"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('DELETE FROM book_styles WHERE id = ?', (style_id,))
         await db.commit()
         return cursor.rowcount > 0
 
 async def update_book_style(style_id: int, name: str, description: str, filename: str, category: str) -> bool:
     """Обновляет стиль книги"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             UPDATE book_styles 
             SET name = ?, description = ?, filename = ?, category = ?
@@ -3701,7 +4095,7 @@ async def update_book_style(style_id: int, name: str, description: str, filename
 
 async def get_voice_styles() -> List[Dict]:
     """Получает все стили голоса"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         print(f"🔍 Выполняем запрос к таблице voice_styles")
         async with db.execute('''
             SELECT id, name, description, filename, gender, created_at
@@ -3715,7 +4109,7 @@ async def get_voice_styles() -> List[Dict]:
 
 async def add_voice_style(name: str, description: str, filename: str, gender: str = "male") -> Dict:
     """Добавляет новый стиль голоса"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             INSERT INTO voice_styles (name, description, filename, gender, created_at)
             VALUES (?, ?, ?, ?, datetime('now'))
@@ -3734,7 +4128,7 @@ async def add_voice_style(name: str, description: str, filename: str, gender: st
 
 async def delete_voice_style(style_id: int) -> bool:
     """Удаляет стиль голоса"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             DELETE FROM voice_styles WHERE id = ?
         ''', (style_id,))
@@ -3743,7 +4137,7 @@ async def delete_voice_style(style_id: int) -> bool:
 
 async def update_voice_style(style_id: int, name: str, description: str, filename: str, gender: str = "male") -> bool:
     """Обновляет стиль голоса"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             UPDATE voice_styles 
             SET name = ?, description = ?, filename = ?, gender = ?
@@ -3754,7 +4148,7 @@ async def update_voice_style(style_id: int, name: str, description: str, filenam
 
 async def get_all_delayed_messages() -> List[Dict]:
     """Получает все отложенные сообщения с информацией о менеджере"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT dm.*, m.email as manager_email, m.full_name as manager_name
             FROM delayed_messages dm
@@ -3766,7 +4160,7 @@ async def get_all_delayed_messages() -> List[Dict]:
 
 async def get_manager_delayed_messages(manager_email: str) -> List[Dict]:
     """Получает отложенные сообщения только для заказов менеджера"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT dm.*, m.email as manager_email, m.full_name as manager_name
             FROM delayed_messages dm
@@ -3778,7 +4172,7 @@ async def get_manager_delayed_messages(manager_email: str) -> List[Dict]:
             return [dict(zip([column[0] for column in cursor.description], row)) for row in rows]
 async def can_manager_access_delayed_message(manager_email: str, message_id: int) -> bool:
     """Проверяет, может ли менеджер получить доступ к отложенному сообщению"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         # Проверяем, является ли пользователь администратором (is_super_admin = 1)
         async with db.execute('''
             SELECT is_super_admin FROM managers WHERE email = ?
@@ -3792,7 +4186,7 @@ async def can_manager_access_delayed_message(manager_email: str, message_id: int
 
 async def can_manager_access_message_template(manager_email: str, template_id: int) -> bool:
     """Проверяет, может ли менеджер получить доступ к шаблону сообщения"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         # Проверяем, является ли пользователь администратором (is_super_admin = 1)
         async with db.execute('''
             SELECT is_super_admin FROM managers WHERE email = ?
@@ -3806,7 +4200,7 @@ async def can_manager_access_message_template(manager_email: str, template_id: i
 
 async def delete_delayed_message(message_id: int) -> bool:
     """Удаляет отложенное сообщение"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             DELETE FROM delayed_messages WHERE id = ?
         ''', (message_id,))
@@ -3815,7 +4209,7 @@ async def delete_delayed_message(message_id: int) -> bool:
 
 async def get_delayed_message_by_id(message_id: int) -> Optional[Dict]:
     """Получает отложенное сообщение по ID"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         db.row_factory = aiosqlite.Row
         async with db.execute('''
             SELECT dm.*, m.email as manager_email, m.full_name as manager_name
@@ -3834,7 +4228,7 @@ async def get_delayed_message_by_id(message_id: int) -> Optional[Dict]:
 
 async def update_delayed_message(message_id: int, content: str, delay_minutes: int, message_type: str) -> bool:
     """Обновляет отложенное сообщение"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         # Пересчитываем scheduled_at на основе новой задержки
         cursor = await db.execute('''
             UPDATE delayed_messages 
@@ -3849,7 +4243,7 @@ async def cleanup_trigger_messages_by_type(order_id: int, message_types: List[st
     Удаляет триггерные сообщения определенных типов для заказа
     Возвращает количество удаленных сообщений
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         if not message_types:
             return 0
             
@@ -3865,7 +4259,7 @@ async def get_trigger_messages_for_order(order_id: int) -> List[Dict]:
     """
     Получает все триггерные сообщения для заказа с группировкой по типам
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         db.row_factory = aiosqlite.Row
         cursor = await db.execute('''
             SELECT message_type, COUNT(*) as count, 
@@ -3883,7 +4277,7 @@ async def get_trigger_messages_for_order(order_id: int) -> List[Dict]:
 
 async def get_pricing_items() -> List[Dict]:
     """Получает все цены"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT * FROM pricing_items ORDER BY created_at DESC
         ''') as cursor:
@@ -3892,41 +4286,45 @@ async def get_pricing_items() -> List[Dict]:
 
 async def create_pricing_item(product: str, price: float, currency: str, description: str, upgrade_price_difference: float = 0.0, is_active: bool = True) -> int:
     """Создает новую цену"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             INSERT INTO pricing_items (product, price, currency, description, upgrade_price_difference, is_active, created_at, updated_at)
             VALUES (?, ?, ?, ?, ?, ?, datetime('now'), datetime('now'))
         ''', (product, price, currency, description, upgrade_price_difference, is_active))
+        await bump_cache_version(db, 'pricing_items')
         await db.commit()
         return cursor.lastrowid
 
 async def update_pricing_item(item_id: int, product: str, price: float, currency: str, description: str, upgrade_price_difference: float = 0.0, is_active: bool = True) -> bool:
     """Обновляет цену"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             UPDATE pricing_items 
             SET product = ?, price = ?, currency = ?, description = ?, upgrade_price_difference = ?, is_active = ?, updated_at = datetime('now')
             WHERE id = ?
         ''', (product, price, currency, description, upgrade_price_difference, is_active, item_id))
+        await bump_cache_version(db, 'pricing_items')
         await db.commit()
         return cursor.rowcount > 0
 
 async def toggle_pricing_item(item_id: int, is_active: bool) -> bool:
     """Переключает статус цены"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             UPDATE pricing_items 
             SET is_active = ?, updated_at = datetime('now')
             WHERE id = ?
         ''', (is_active, item_id))
+        await bump_cache_version(db, 'pricing_items')
         await db.commit()
         return cursor.rowcount > 0
 async def delete_pricing_item(item_id: int) -> bool:
     """Удаляет цену"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             DELETE FROM pricing_items WHERE id = ?
         ''', (item_id,))
+        await bump_cache_version(db, 'pricing_items')
         await db.commit()
         return cursor.rowcount > 0
 
@@ -3951,7 +4349,7 @@ async def populate_pricing_items() -> None:
 
 async def get_content_steps() -> List[Dict]:
     """Получает все шаги контента"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT * FROM content_steps ORDER BY created_at DESC
         ''') as cursor:
@@ -3960,7 +4358,7 @@ async def get_content_steps() -> List[Dict]:
 
 async def create_content_step(step_key: str, step_name: str, content_type: str, content: str, materials: str, is_active: bool) -> int:
     """Создает новый шаг контента"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             INSERT INTO content_steps (step_key, step_name, content_type, content, materials, is_active, created_at, updated_at)
             VALUES (?, ?, ?, ?, ?, ?, datetime('now'), datetime('now'))
@@ -3970,7 +4368,7 @@ async def create_content_step(step_key: str, step_name: str, content_type: str,
 
 async def update_content_step(step_id: int, step_key: str, step_name: str, content_type: str, content: str, materials: str, is_active: bool) -> bool:
     """Обновляет шаг контента"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             UPDATE content_steps 
             SET step_key = ?, step_name = ?, content_type = ?, content = ?, materials = ?, is_active = ?, updated_at = datetime('now')
@@ -3981,7 +4379,7 @@ async def update_content_step(step_id: int, step_key: str, step_name: str, conte
 
 async def toggle_content_step(step_id: int, is_active: bool) -> bool:
     """Переключает статус шага контента"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             UPDATE content_steps 
             SET is_active = ?, updated_at = datetime('now')
@@ -3992,7 +4390,7 @@ async def toggle_content_step(step_id: int, is_active: bool) -> bool:
 
 async def delete_content_step(step_id: int) -> bool:
     """Удаляет шаг контента"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             DELETE FROM content_steps WHERE id = ?
         ''', (step_id,))
@@ -4003,7 +4401,7 @@ async def delete_content_step(step_id: int) -> bool:
 
 # --- Функции для работы с квизом песни ---
 async def get_song_quiz_list() -> List[Dict]:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT * FROM song_quiz ORDER BY relation_key, author_gender
         ''') as cursor:
@@ -4011,7 +4409,7 @@ async def get_song_quiz_list() -> List[Dict]:
             return [dict(zip([column[0] for column in cursor.description], row)) for row in rows]
 
 async def get_song_quiz_item(relation_key: str, author_gender: str) -> Dict:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT * FROM song_quiz WHERE relation_key = ? AND author_gender = ? AND is_active = 1
         ''', (relation_key, author_gender)) as cursor:
@@ -4019,7 +4417,7 @@ async def get_song_quiz_item(relation_key: str, author_gender: str) -> Dict:
             return dict(zip([column[0] for column in cursor.description], row)) if row else None
 
 async def get_song_quiz_by_id(quiz_id: int) -> Dict:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT * FROM song_quiz WHERE id = ?
         ''', (quiz_id,)) as cursor:
@@ -4027,7 +4425,7 @@ async def get_song_quiz_by_id(quiz_id: int) -> Dict:
             return dict(zip([column[0] for column in cursor.description], row)) if row else None
 
 async def create_song_quiz_item(relation_key: str, author_gender: str, title: str, intro: str, phrases_hint: str, questions_json: str, outro: str, is_active: bool = True) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             INSERT OR REPLACE INTO song_quiz (relation_key, author_gender, title, intro, phrases_hint, questions_json, outro, is_active, created_at, updated_at)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, datetime('now'), datetime('now'))
@@ -4036,7 +4434,7 @@ async def create_song_quiz_item(relation_key: str, author_gender: str, title: st
         return cursor.lastrowid
 
 async def update_song_quiz_item(item_id: int, relation_key: str, author_gender: str, title: str, intro: str, phrases_hint: str, questions_json: str, outro: str, is_active: bool) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         print(f"🔍 Обновление квиза в БД: ID={item_id}, relation_key={relation_key}, author_gender={author_gender}")
         print(f"🔍 intro (полный): {repr(intro)}")
         print(f"🔍 phrases_hint: {phrases_hint}")
@@ -4054,14 +4452,38 @@ async def update_song_quiz_item(item_id: int, relation_key: str, author_gender:
         return cursor.rowcount > 0
 
 async def delete_song_quiz_item(item_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('DELETE FROM song_quiz WHERE id = ?', (item_id,))
         await db.commit()
         return cursor.rowcount > 0
 
+async def bump_cache_version(db, name: str):
+    """Увеличивает версию кэша name в текущей транзакции (вызывается вместе с изменением таблицы)"""
+    await db.execute('''
+        INSERT INTO cache_versions (name, version, updated_at) VALUES (?, 1, datetime('now'))
+        ON CONFLICT(name) DO UPDATE SET version = version + 1, updated_at = datetime('now')
+    ''', (name,))
+
+async def get_cache_version(name: str) -> int:
+    """Текущая версия кэша name (0, если таблица еще не менялась)"""
+    async with db_connection(readonly=True) as db:
+        async with db.execute('SELECT version FROM cache_versions WHERE name = ?', (name,)) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else 0
+
+async def get_active_bot_message_contents() -> Tuple[int, Dict[str, str]]:
+    """Версия кэша bot_messages и тексты активных сообщений без подстановки примеров для админки"""
+    async with db_connection(readonly=True) as db:
+        async with db.execute("SELECT version FROM cache_versions WHERE name = 'bot_messages'") as cursor:
+            row = await cursor.fetchone()
+            version = row[0] if row else 0
+        async with db.execute('SELECT message_key, content FROM bot_messages WHERE is_active = 1') as cursor:
+            rows = await cursor.fetchall()
+            return version, {message_key: content for message_key, content in rows}
+
 async def get_bot_messages() -> List[Dict]:
     """Получает все сообщения бота"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT * FROM bot_messages ORDER BY sort_order, context, stage, message_name
         ''') as cursor:
@@ -4090,19 +4512,20 @@ async def get_bot_messages() -> List[Dict]:
 
 async def upsert_bot_message(message_key: str, message_name: str, content: str, context: str = None, stage: str = None, sort_order: int = 0) -> int:
     """Добавляет или обновляет сообщение бота"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             INSERT OR REPLACE INTO bot_messages 
             (message_key, message_name, content, context, stage, sort_order, updated_at)
             VALUES (?, ?, ?, ?, ?, ?, datetime('now'))
         ''', (message_key, message_name, content, context, stage, sort_order))
+        await bump_cache_version(db, 'bot_messages')
         await db.commit()
         return cursor.lastrowid
 
 async def update_bot_message(message_id: int, content: str, is_active: bool = True) -> bool:
     """Обновляет сообщение бота"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_connection() as db:
             # Сначала получаем ключ сообщения для логирования
             message_key = None
             try:
@@ -4134,6 +4557,7 @@ async def update_bot_message(message_id: int, content: str, is_active: bool = Tr
                 SET content = ?, is_active = ?, updated_at = datetime('now')
                 WHERE id = ?
             ''', (processed_content, is_active, message_id))
+            await bump_cache_version(db, 'bot_messages')
             await db.commit()
             
             # Логируем успешное обновление
@@ -4149,17 +4573,18 @@ async def update_bot_message(message_id: int, content: str, is_active: bool = Tr
 
 async def delete_bot_message(message_id: int) -> bool:
     """Удаляет сообщение бота"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             DELETE FROM bot_messages 
             WHERE id = ?
         ''', (message_id,))
+        await bump_cache_version(db, 'bot_messages')
         await db.commit()
         return cursor.rowcount > 0
 
 async def increment_message_usage(message_key: str) -> bool:
     """Увеличивает счетчик использования сообщения"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             UPDATE bot_messages 
             SET usage_count = usage_count + 1, last_used = datetime('now')
@@ -4170,7 +4595,7 @@ async def increment_message_usage(message_key: str) -> bool:
 
 async def get_bot_message_by_key(message_key: str) -> Dict:
     """Получает сообщение бота по ключу"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT * FROM bot_messages WHERE message_key = ?
         ''', (message_key,)) as cursor:
@@ -4179,7 +4604,7 @@ async def get_bot_message_by_key(message_key: str) -> Dict:
 
 async def get_bot_message_by_id(message_id: int) -> Dict:
     """Получает сообщение бота по ID"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT * FROM bot_messages WHERE id = ?
         ''', (message_id,)) as cursor:
@@ -4951,7 +5376,7 @@ async def auto_collect_bot_messages() -> None:
         await upsert_bot_message(message_key, message_name, content, context, stage) 
 async def get_order_other_heroes(order_id: int) -> List[Dict]:
     """Получает фотографии других героев для заказа из hero_photos таблицы и order_data"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         heroes = {}
         
         # Сначала получаем фотографии из таблицы hero_photos
@@ -5038,7 +5463,7 @@ async def get_order_other_heroes(order_id: int) -> List[Dict]:
 
 async def assign_manager_to_order(order_id: int) -> bool:
     """Автоматически назначает менеджера к заказу по принципу round-robin, исключая супер-админов"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         # Получаем следующего менеджера в очереди
         selected_manager_id = await get_next_manager_in_queue()
         
@@ -5048,17 +5473,19 @@ async def assign_manager_to_order(order_id: int) -> bool:
         # Назначаем менеджера к заказу
         await db.execute('''
             UPDATE orders
-            SET assigned_manager_id = ?
+            SET assigned_manager_id = ?, updated_at = datetime('now')
             WHERE id = ?
         ''', (selected_manager_id, order_id))
+        await record_order_event(db, order_id, 'order_changed')
         
         await db.commit()
-        return True
+    notify_order_events()
+    return True
 
 async def assign_managers_to_all_orders() -> dict:
     """Назначает менеджеров ко всем заказам, которые их не имеют"""
     print("🔍 ОТЛАДКА: assign_managers_to_all_orders() вызвана")
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         # Получаем заказы без назначенных менеджеров
         async with db.execute('''
             SELECT id FROM orders WHERE assigned_manager_id IS NULL
@@ -5104,7 +5531,7 @@ async def assign_managers_to_all_orders() -> dict:
 
 async def get_next_page_number(order_id: int) -> int:
     """Получает следующий номер страницы для заказа из базы данных"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         db.row_factory = aiosqlite.Row
         async with db.execute('''
             SELECT MAX(page_number) as max_page FROM order_pages 
@@ -5121,17 +5548,19 @@ async def get_next_page_number(order_id: int) -> int:
 
 async def save_page_number(order_id: int, page_number: int, filename: str, description: str):
     """Сохраняет информацию о странице в базу данных"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         print(f"🔍 ОТЛАДКА: save_page_number: order_id={order_id}, page_number={page_number}, filename={filename}")
         await db.execute('''
             INSERT INTO order_pages (order_id, page_number, filename, description, created_at)
             VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
         ''', (order_id, page_number, filename, description))
+        await _add_to_photo_catalog(db, order_id, filename, f"page_{page_number}", 'page',
+                                    base_dir=f"uploads/order_{order_id}_pages", page_number=page_number)
         await db.commit()
         print(f"🔍 ОТЛАДКА: Страница {page_number} успешно сохранена в БД")
 async def get_order_pages(order_id: int) -> List[Dict]:
     """Получает все страницы для заказа"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         # Сначала проверяем, существует ли заказ
         cursor = await db.execute('''
             SELECT id FROM orders WHERE id = ?
@@ -5154,7 +5583,7 @@ async def get_order_pages(order_id: int) -> List[Dict]:
 
 async def get_order_demo_content(order_id: int) -> List[Dict]:
     """Получает файлы демо-контента для заказа"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT id, filename, file_type, uploaded_at
             FROM uploads 
@@ -5166,44 +5595,56 @@ async def get_order_demo_content(order_id: int) -> List[Dict]:
 
 async def update_order_email(order_id: int, email: str) -> bool:
     """Обновляет email в заказе"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         cursor = await db.execute('''
             UPDATE orders
-            SET email = ?
+            SET email = ?, updated_at = datetime('now')
             WHERE id = ?
         ''', (email, order_id))
+        updated = cursor.rowcount > 0
+        if updated:
+            await record_order_event(db, order_id, 'order_changed')
         await db.commit()
-        return cursor.rowcount > 0
+    notify_order_events()
+    return updated
 
-async def add_upload(order_id: int, filename: str, file_type: str) -> bool:
-    """Добавляет информацию о загруженном файле в базу данных"""
-    async with aiosqlite.connect(DB_PATH) as db:
+async def add_upload(order_id: int, filename: str, file_type: str, file_path: str = None) -> bool:
+    """Добавляет информацию о загруженном файле в базу данных (file_path — если файл лежит не в uploads/filename)"""
+    async with db_connection() as db:
         await db.execute('''
             INSERT INTO uploads (order_id, filename, file_type, uploaded_at)
             VALUES (?, ?, ?, CURRENT_TIMESTAMP)
         ''', (order_id, filename, file_type))
+        await _add_to_photo_catalog(db, order_id, filename, file_type, 'upload', file_path=file_path)
         await db.commit()
         return True
 
 async def update_order_field(order_id: int, field_name: str, value: str) -> bool:
     """Обновляет поле в заказе"""
     print(f"🔍 ОТЛАДКА update_order_field: order_id={order_id}, field_name={field_name}, value={value}")
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
+        affects_metrics = field_name in ORDER_METRICS_FIELDS
+        if affects_metrics:
+            await shift_order_metrics(db, order_id, -1)
         await db.execute(f'''
             UPDATE orders 
             SET {field_name} = ?, updated_at = CURRENT_TIMESTAMP
             WHERE id = ?
         ''', (value, order_id))
+        if affects_metrics:
+            await shift_order_metrics(db, order_id, 1)
+        await record_order_event(db, order_id, 'order_changed')
         await db.commit()
         print(f"✅ Поле {field_name} успешно обновлено для заказа {order_id}")
-        return True
+    notify_order_events()
+    return True
 
 async def check_pages_sent_before(order_id: int) -> bool:
     """Проверяет, отправлялись ли уже страницы для этого заказа"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT id FROM outbox 
-            WHERE order_id = ? AND type_ = 'page_selection' 
+            WHERE order_id = ? AND type IN ('page_selection', 'page_upload')
             LIMIT 1
         ''', (order_id,)) as cursor:
             row = await cursor.fetchone()
@@ -5211,7 +5652,7 @@ async def check_pages_sent_before(order_id: int) -> bool:
 
 async def check_demo_content_sent_before(order_id: int) -> bool:
     """Проверяет, отправлялся ли уже демо-контент для этого заказа"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT id FROM outbox 
             WHERE order_id = ? AND type = 'multiple_images_with_text_and_button' 
@@ -5222,6 +5663,167 @@ async def check_demo_content_sent_before(order_id: int) -> bool:
 
 # --- Функции трекинга метрик событий ---
 
+# --- Атрибуция заказов (таблица order_attribution) ---
+
+# Полный пересчет атрибуции по event_metrics для набора заказов ({where} — условие на orders).
+# Правила атрибуции:
+# источник — первый из событий заказа, иначе первый из событий пользователя;
+# UTM — первые из событий заказа, иначе последние из событий пользователя до создания заказа.
+_ORDER_ATTRIBUTION_REFRESH = '''
+    INSERT OR REPLACE INTO order_attribution
+        (order_id, user_id, order_source, user_source, has_order_utm,
+         utm_source, utm_medium, utm_campaign, event_product_type, has_upsell, updated_at)
+    WITH target AS (
+        SELECT id, user_id, created_at FROM orders WHERE {where}
+    ),
+    order_events AS (
+        SELECT * FROM event_metrics WHERE order_id IN (SELECT id FROM target)
+    ),
+    first_order_source AS (
+        SELECT order_id, source FROM (
+            SELECT order_id, source, ROW_NUMBER() OVER (PARTITION BY order_id ORDER BY timestamp, id) AS rn
+            FROM order_events
+            WHERE source IS NOT NULL AND source != ''
+        ) WHERE rn = 1
+    ),
+    first_user_source AS (
+        SELECT user_id, source FROM (
+            SELECT user_id, source, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY timestamp, id) AS rn
+            FROM event_metrics
+            WHERE user_id IN (SELECT user_id FROM target) AND source IS NOT NULL AND source != ''
+        ) WHERE rn = 1
+    ),
+    first_order_utm AS (
+        SELECT order_id, utm_source, utm_medium, utm_campaign FROM (
+            SELECT order_id, utm_source, utm_medium, utm_campaign,
+                   ROW_NUMBER() OVER (PARTITION BY order_id ORDER BY timestamp, id) AS rn
+            FROM order_events
+            WHERE utm_source IS NOT NULL OR utm_medium IS NOT NULL OR utm_campaign IS NOT NULL
+        ) WHERE rn = 1
+    ),
+    last_user_utm AS (
+        SELECT order_id, utm_source, utm_medium, utm_campaign FROM (
+            SELECT t.id AS order_id, e.utm_source, e.utm_medium, e.utm_campaign,
+                   ROW_NUMBER() OVER (PARTITION BY t.id ORDER BY e.timestamp DESC, e.id DESC) AS rn
+            FROM target t
+            JOIN event_metrics e ON e.user_id = t.user_id
+            WHERE (e.utm_source IS NOT NULL OR e.utm_medium IS NOT NULL OR e.utm_campaign IS NOT NULL)
+            AND e.timestamp <= t.created_at
+        ) WHERE rn = 1
+    ),
+    first_order_product AS (
+        SELECT order_id, product_type FROM (
+            SELECT order_id, product_type, ROW_NUMBER() OVER (PARTITION BY order_id ORDER BY timestamp, id) AS rn
+            FROM order_events
+            WHERE product_type IS NOT NULL AND product_type != ''
+        ) WHERE rn = 1
+    ),
+    upsell_orders AS (
+        SELECT DISTINCT order_id FROM order_events WHERE event_type = 'upsell_purchased'
+    )
+    SELECT t.id, t.user_id, fos.source, fus.source,
+           CASE WHEN fou.order_id IS NOT NULL THEN 1 ELSE 0 END,
+           CASE WHEN fou.order_id IS NOT NULL THEN fou.utm_source ELSE luu.utm_source END,
+           CASE WHEN fou.order_id IS NOT NULL THEN fou.utm_medium ELSE luu.utm_medium END,
+           CASE WHEN fou.order_id IS NOT NULL THEN fou.utm_campaign ELSE luu.utm_campaign END,
+           fop.product_type,
+           CASE WHEN up.order_id IS NOT NULL THEN 1 ELSE 0 END,
+           datetime('now')
+    FROM target t
+    LEFT JOIN first_order_source fos ON fos.order_id = t.id
+    LEFT JOIN first_user_source fus ON fus.user_id = t.user_id
+    LEFT JOIN first_order_utm fou ON fou.order_id = t.id
+    LEFT JOIN last_user_utm luu ON luu.order_id = t.id
+    LEFT JOIN first_order_product fop ON fop.order_id = t.id
+    LEFT JOIN upsell_orders up ON up.order_id = t.id
+'''
+
+async def _refresh_order_attribution(db, order_id: Optional[int] = None) -> int:
+    """Пересчитывает атрибуцию одного заказа (или всех, если order_id не задан) на соединении-писателе"""
+    if order_id is None:
+        cursor = await db.execute(_ORDER_ATTRIBUTION_REFRESH.format(where='1=1'))
+    else:
+        cursor = await db.execute(_ORDER_ATTRIBUTION_REFRESH.format(where='id = ?'), (order_id,))
+    return cursor.rowcount
+
+async def _apply_event_to_attribution(
+    db,
+    user_id: int,
+    event_type: str,
+    order_id: Optional[int],
+    product_type: Optional[str],
+    source: Optional[str],
+    utm_source: Optional[str],
+    utm_medium: Optional[str],
+    utm_campaign: Optional[str],
+    event_timestamp: str,
+) -> None:
+    """Инкрементально обновляет order_attribution по только что записанному событию"""
+    has_utm = utm_source is not None or utm_medium is not None or utm_campaign is not None
+
+    # Запасные значения уровня пользователя: первый источник и последние UTM до создания заказа
+    if source:
+        await db.execute('''
+            UPDATE order_attribution SET user_source = ?, updated_at = datetime('now')
+            WHERE user_id = ? AND user_source IS NULL
+        ''', (source, user_id))
+    if has_utm:
+        await db.execute('''
+            UPDATE order_attribution
+            SET utm_source = ?, utm_medium = ?, utm_campaign = ?, updated_at = datetime('now')
+            WHERE has_order_utm = 0 AND order_id IN (
+                SELECT id FROM orders WHERE user_id = ? AND created_at >= ?
+            )
+        ''', (utm_source, utm_medium, utm_campaign, user_id, event_timestamp))
+
+    if not order_id:
+        return
+
+    async with db.execute('SELECT 1 FROM order_attribution WHERE order_id = ?', (order_id,)) as cursor:
+        exists = await cursor.fetchone()
+    if not exists:
+        # Заказ еще не материализован — пересчитываем целиком, событие уже записано
+        await _refresh_order_attribution(db, order_id)
+        return
+
+    # Значения уровня заказа: первое событие заказа выигрывает (в SET используются старые значения колонок)
+    await db.execute('''
+        UPDATE order_attribution SET
+            order_source = COALESCE(order_source, NULLIF(?, '')),
+            utm_source = CASE WHEN has_order_utm = 0 AND ? THEN ? ELSE utm_source END,
+            utm_medium = CASE WHEN has_order_utm = 0 AND ? THEN ? ELSE utm_medium END,
+            utm_campaign = CASE WHEN has_order_utm = 0 AND ? THEN ? ELSE utm_campaign END,
+            has_order_utm = MAX(has_order_utm, ?),
+            event_product_type = COALESCE(event_product_type, NULLIF(?, '')),
+            has_upsell = MAX(has_upsell, ?),
+            updated_at = datetime('now')
+        WHERE order_id = ?
+    ''', (
+        source,
+        has_utm, utm_source,
+        has_utm, utm_medium,
+        has_utm, utm_campaign,
+        1 if has_utm else 0,
+        product_type,
+        1 if event_type == 'upsell_purchased' else 0,
+        order_id,
+    ))
+
+async def backfill_order_attribution() -> int:
+    """Пересчитывает order_attribution для всех заказов по event_metrics. Возвращает число строк."""
+    async def _backfill_operation(db) -> int:
+        return await _refresh_order_attribution(db)
+
+    return await run_write(_backfill_operation)
+
+async def get_order_attribution(order_id: int) -> Optional[Dict]:
+    """Возвращает строку order_attribution для заказа (или None, если ее еще нет)"""
+    async with db_connection(readonly=True) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute('SELECT * FROM order_attribution WHERE order_id = ?', (order_id,)) as cursor:
+            row = await cursor.fetchone()
+            return dict(row) if row else None
+
 async def track_event(
     user_id: int,
     event_type: str,
@@ -5247,126 +5849,82 @@ async def track_event(
     - 'purchase_completed' - завершение покупки
     - 'upsell_purchased' - дополнительная покупка
     """
+    async def _track_operation(db) -> bool:
+        # Проверяем, не было ли уже записано такое событие в последние 5 минут
+        # Это предотвращает дублирование событий
+        async with db.execute('''
+            SELECT COUNT(*) FROM event_metrics 
+            WHERE user_id = ? AND event_type = ? 
+            AND timestamp > datetime('now', '-5 minutes')
+            AND (order_id = ? OR (order_id IS NULL AND ? IS NULL))
+        ''', (user_id, event_type, order_id, order_id)) as cursor:
+            recent_count = await cursor.fetchone()
+            if recent_count and recent_count[0] > 0:
+                return False
+        
+        cursor = await db.execute('''
+            INSERT INTO event_metrics 
+            (user_id, event_type, event_data, step_name, product_type, order_id, amount, source, utm_source, utm_medium, utm_campaign, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
+        ''', (
+            user_id,
+            event_type,
+            json.dumps(event_data) if event_data else None,
+            step_name,
+            product_type,
+            order_id,
+            amount,
+            source,
+            utm_source,
+            utm_medium,
+            utm_campaign
+        ))
+
+        # Атрибуция заказа обновляется в той же транзакции, что и само событие
+        async with db.execute('SELECT timestamp FROM event_metrics WHERE id = ?', (cursor.lastrowid,)) as ts_cursor:
+            event_timestamp = (await ts_cursor.fetchone())[0]
+        await _apply_event_to_attribution(
+            db, user_id, event_type, order_id, product_type,
+            source, utm_source, utm_medium, utm_campaign, event_timestamp
+        )
+        # Сумма в сводке — только у покупок, привязанных к заказу
+        await _bump_metrics_daily(
+            db, event_timestamp, event_type, product_type, source, 1,
+            amount if order_id is not None else None
+        )
+        return True
+    
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            # Проверяем, не было ли уже записано такое событие в последние 5 минут
-            # Это предотвращает дублирование событий
-            async with db.execute('''
-                SELECT COUNT(*) FROM event_metrics 
-                WHERE user_id = ? AND event_type = ? 
-                AND timestamp > datetime('now', '-5 minutes')
-                AND (order_id = ? OR (order_id IS NULL AND ? IS NULL))
-            ''', (user_id, event_type, order_id, order_id)) as cursor:
-                recent_count = await cursor.fetchone()
-                if recent_count and recent_count[0] > 0:
-                    print(f"⚠️ Событие {event_type} для пользователя {user_id} уже записано недавно, пропускаем")
-                    return True
-            
-            await db.execute('''
-                INSERT INTO event_metrics 
-                (user_id, event_type, event_data, step_name, product_type, order_id, amount, source, utm_source, utm_medium, utm_campaign, timestamp)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
-            ''', (
-                user_id,
-                event_type,
-                json.dumps(event_data) if event_data else None,
-                step_name,
-                product_type,
-                order_id,
-                amount,
-                source,
-                utm_source,
-                utm_medium,
-                utm_campaign
-            ))
-            await db.commit()
+        # События пишутся очень часто — выполняем запись прямо в задаче-писателе пула
+        if await run_write(_track_operation):
             print(f"✅ Записано событие {event_type} для пользователя {user_id}")
-            return True
+        else:
+            print(f"⚠️ Событие {event_type} для пользователя {user_id} уже записано недавно, пропускаем")
+        return True
     except Exception as e:
         print(f"❌ Ошибка записи события {event_type} для пользователя {user_id}: {e}")
         return False
 
 async def get_order_source(order_id: int) -> str:
-    """Получает источник заказа из таблицы event_metrics"""
+    """Получает источник заказа из таблицы order_attribution"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
-            
-            # Ищем источник в событиях для этого заказа
-            async with db.execute('''
-                SELECT source 
-                FROM event_metrics 
-                WHERE order_id = ? AND source IS NOT NULL AND source != ''
-                ORDER BY timestamp ASC
-                LIMIT 1
-            ''', (order_id,)) as cursor:
-                row = await cursor.fetchone()
-                if row and row['source']:
-                    return row['source']
-            
-            # Если не найден по order_id, ищем по user_id из заказа
-            async with db.execute('''
-                SELECT o.user_id, em.source
-                FROM orders o
-                JOIN event_metrics em ON o.user_id = em.user_id
-                WHERE o.id = ? AND em.source IS NOT NULL AND em.source != ''
-                ORDER BY em.timestamp ASC
-                LIMIT 1
-            ''', (order_id,)) as cursor:
-                row = await cursor.fetchone()
-                if row and row['source']:
-                    return row['source']
-            
-            return 'Неизвестно'
+        attribution = await get_order_attribution(order_id)
+        if attribution:
+            return attribution['order_source'] or attribution['user_source'] or 'Неизвестно'
+        return 'Неизвестно'
     except Exception as e:
         print(f"❌ Ошибка получения источника для заказа {order_id}: {e}")
         return 'Неизвестно'
 
 async def get_order_utm_data(order_id: int) -> dict:
-    """Получает UTM-данные заказа из таблицы event_metrics"""
+    """Получает UTM-данные заказа из таблицы order_attribution"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
-            
-            # Ищем UTM-данные в событиях для этого заказа
-            async with db.execute('''
-                SELECT utm_source, utm_medium, utm_campaign 
-                FROM event_metrics 
-                WHERE order_id = ? AND (utm_source IS NOT NULL OR utm_medium IS NOT NULL OR utm_campaign IS NOT NULL)
-                ORDER BY timestamp ASC
-                LIMIT 1
-            ''', (order_id,)) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    return {
-                        'utm_source': row['utm_source'] or 'Неизвестно',
-                        'utm_medium': row['utm_medium'] or 'Неизвестно',
-                        'utm_campaign': row['utm_campaign'] or 'Неизвестно'
-                    }
-            
-            # Если не найден по order_id, ищем по user_id только события ДО создания заказа
-            async with db.execute('''
-                SELECT o.user_id, o.created_at, em.utm_source, em.utm_medium, em.utm_campaign
-                FROM orders o
-                JOIN event_metrics em ON o.user_id = em.user_id
-                WHERE o.id = ? AND (em.utm_source IS NOT NULL OR em.utm_medium IS NOT NULL OR em.utm_campaign IS NOT NULL)
-                AND em.timestamp <= o.created_at
-                ORDER BY em.timestamp DESC
-                LIMIT 1
-            ''', (order_id,)) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    return {
-                        'utm_source': row['utm_source'] or 'Неизвестно',
-                        'utm_medium': row['utm_medium'] or 'Неизвестно',
-                        'utm_campaign': row['utm_campaign'] or 'Неизвестно'
-                    }
-            
-            return {
-                'utm_source': 'Неизвестно',
-                'utm_medium': 'Неизвестно',
-                'utm_campaign': 'Неизвестно'
-            }
+        attribution = await get_order_attribution(order_id) or {}
+        return {
+            'utm_source': attribution.get('utm_source') or 'Неизвестно',
+            'utm_medium': attribution.get('utm_medium') or 'Неизвестно',
+            'utm_campaign': attribution.get('utm_campaign') or 'Неизвестно'
+        }
     except Exception as e:
         print(f"❌ Ошибка получения UTM-данных заказа {order_id}: {e}")
         return {
@@ -5375,25 +5933,405 @@ async def get_order_utm_data(order_id: int) -> dict:
             'utm_campaign': 'Неизвестно'
         }
 
+# --- Дневные сводки метрик (metrics_daily) ---
+# Строка сводки — (день по Москве, тип, продукт, источник): число строк, число строк с суммой > 0
+# и сумма. Тип — event_type события из event_metrics (сумма — amount покупок с order_id)
+# или 'order_status:<статус>' для заказов, созданных в этот день и сейчас находящихся в статусе
+# (сумма — total_amount). track_event и функции изменения заказа обновляют сводку той же
+# транзакцией; отчеты суммируют сводку за закрытые дни и читают сырые строки только за сегодня.
+
+ORDER_STATUS_METRIC_PREFIX = 'order_status:'
+
+# Колонки orders, от которых зависит строка заказа в сводке
+ORDER_METRICS_FIELDS = ('created_at', 'status', 'order_data', 'source', 'total_amount')
+
+def msk_period_bounds(start_date: str, end_date: str) -> Tuple[str, str]:
+    """
+    Границы периода дней по Москве (YYYY-MM-DD, включительно) в UTC, как хранятся timestamp/created_at:
+    условие col >= from AND col < to использует индекс по колонке, в отличие от DATE(col).
+    """
+    start = datetime.strptime(start_date, '%Y-%m-%d') - timedelta(hours=3)
+    end = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1) - timedelta(hours=3)
+    return start.strftime('%Y-%m-%d %H:%M:%S'), end.strftime('%Y-%m-%d %H:%M:%S')
+
+def _split_metrics_period(start_date: str, end_date: str):
+    """
+    Делит период на закрытые дни (берутся из metrics_daily) и сегодняшний день по Москве
+    (считается по сырым строкам). Возвращает ((start, end) или None, (from_utc, to_utc) или None).
+    """
+    today = (datetime.utcnow() + timedelta(hours=3)).strftime('%Y-%m-%d')
+    yesterday = (datetime.strptime(today, '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d')
+    closed_end = min(end_date, yesterday)
+    closed = (start_date, closed_end) if start_date <= closed_end else None
+    live = msk_period_bounds(today, today) if start_date <= today <= end_date else None
+    return closed, live
+
+def _order_product(order_json: Optional[str]) -> str:
+    try:
+        order_info = json.loads(order_json) if order_json else {}
+    except (json.JSONDecodeError, TypeError):
+        return ''
+    product = order_info.get('product') if isinstance(order_info, dict) else None
+    return product if isinstance(product, str) else ''
+
+async def _bump_metrics_daily(db, timestamp: str, metric: str, product_type: Optional[str], source: Optional[str],
+                              count: int, amount: Optional[float] = None):
+    """Добавляет count строк (и сумму, если amount > 0) в сводку дня timestamp (UTC)"""
+    has_amount = amount is not None and amount > 0
+    await db.execute('''
+        INSERT INTO metrics_daily (day, event_type, product_type, source, event_count, amount_count, amount_total)
+        VALUES (date(?, '+3 hours'), ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(day, event_type, product_type, source) DO UPDATE SET
+            event_count = event_count + excluded.event_count,
+            amount_count = amount_count + excluded.amount_count,
+            amount_total = amount_total + excluded.amount_total
+    ''', (
+        timestamp, metric, product_type or '', source or '',
+        count, count if has_amount else 0, count * amount if has_amount else 0
+    ))
+
+async def shift_order_metrics(db, order_id: int, sign: int):
+    """
+    Убирает (sign=-1) или возвращает (sign=1) заказ в сводке по его текущим статусу, продукту и сумме.
+    Изменения заказа оборачиваются парой вызовов: -1 до UPDATE, +1 после.
+    """
+    async with db.execute(
+        'SELECT created_at, status, order_data, source, total_amount FROM orders WHERE id = ?', (order_id,)
+    ) as cursor:
+        row = await cursor.fetchone()
+    if not row:
+        return
+    created_at, status, order_json, source, total_amount = row
+    await _bump_metrics_daily(
+        db, created_at, f"{ORDER_STATUS_METRIC_PREFIX}{status or ''}", _order_product(order_json),
+        source, sign, total_amount
+    )
+
+async def _rebuild_metrics_daily(db) -> int:
+    """Пересчитывает metrics_daily целиком по event_metrics и orders. Возвращает число строк сводки."""
+    await db.execute('DELETE FROM metrics_daily')
+    await db.execute('''
+        INSERT INTO metrics_daily (day, event_type, product_type, source, event_count, amount_count, amount_total)
+        SELECT date(timestamp, '+3 hours'), event_type, COALESCE(product_type, ''), COALESCE(source, ''),
+               COUNT(*),
+               COUNT(CASE WHEN amount > 0 AND order_id IS NOT NULL THEN 1 END),
+               COALESCE(SUM(CASE WHEN amount > 0 AND order_id IS NOT NULL THEN amount END), 0)
+        FROM event_metrics
+        WHERE timestamp IS NOT NULL AND event_type IS NOT NULL
+        GROUP BY 1, 2, 3, 4
+    ''')
+
+    # Продукт заказа разбирается в Python так же, как при инкрементальном обновлении
+    rollup: Dict[Tuple[str, str, str, str], List] = {}
+    async with db.execute('''
+        SELECT date(created_at, '+3 hours'), status, order_data, source, total_amount
+        FROM orders
+        WHERE created_at IS NOT NULL
+    ''') as cursor:
+        async for day, status, order_json, source, total_amount in cursor:
+            key = (day, f"{ORDER_STATUS_METRIC_PREFIX}{status or ''}", _order_product(order_json), source or '')
+            totals = rollup.setdefault(key, [0, 0, 0.0])
+            totals[0] += 1
+            if total_amount is not None and total_amount > 0:
+                totals[1] += 1
+                totals[2] += total_amount
+    await db.executemany('''
+        INSERT INTO metrics_daily (day, event_type, product_type, source, event_count, amount_count, amount_total)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(day, event_type, product_type, source) DO UPDATE SET
+            event_count = event_count + excluded.event_count,
+            amount_count = amount_count + excluded.amount_count,
+            amount_total = amount_total + excluded.amount_total
+    ''', [(*key, *totals) for key, totals in rollup.items()])
+
+    async with db.execute('SELECT COUNT(*) FROM metrics_daily') as cursor:
+        return (await cursor.fetchone())[0]
+
+async def rebuild_metrics_daily() -> int:
+    """Пересчитывает сводку metrics_daily (после ручных правок заказов или событий в базе)"""
+    return await run_write(_rebuild_metrics_daily)
+
+async def _event_totals(db, start_date: str, end_date: str) -> Dict[str, List]:
+    """event_type -> [событий, покупок с суммой, сумма] за период дней по Москве"""
+    totals: Dict[str, List] = {}
+    closed, live = _split_metrics_period(start_date, end_date)
+    queries = []
+    if closed:
+        queries.append(('''
+            SELECT event_type, SUM(event_count), SUM(amount_count), SUM(amount_total)
+            FROM metrics_daily
+            WHERE day BETWEEN ? AND ? AND event_type NOT LIKE 'order_status:%'
+            GROUP BY event_type
+        ''', closed))
+    if live:
+        queries.append(('''
+            SELECT event_type, COUNT(*),
+                   COUNT(CASE WHEN amount > 0 AND order_id IS NOT NULL THEN 1 END),
+                   COALESCE(SUM(CASE WHEN amount > 0 AND order_id IS NOT NULL THEN amount END), 0)
+            FROM event_metrics
+            WHERE timestamp >= ? AND timestamp < ?
+            GROUP BY event_type
+        ''', live))
+    for query, args in queries:
+        async with db.execute(query, args) as cursor:
+            async for event_type, count, amount_count, amount_total in cursor:
+                row = totals.setdefault(event_type, [0, 0, 0.0])
+                row[0] += count or 0
+                row[1] += amount_count or 0
+                row[2] += amount_total or 0
+    return totals
+
+async def _order_status_totals(db, start_date: str, end_date: str) -> Dict[Tuple[str, str], List]:
+    """(статус, продукт) -> [заказов, заказов с суммой, сумма] для заказов, созданных в период (дни по Москве)"""
+    totals: Dict[Tuple[str, str], List] = {}
+    closed, live = _split_metrics_period(start_date, end_date)
+    if closed:
+        async with db.execute('''
+            SELECT event_type, product_type, SUM(event_count), SUM(amount_count), SUM(amount_total)
+            FROM metrics_daily
+            WHERE day BETWEEN ? AND ? AND event_type LIKE 'order_status:%'
+            GROUP BY event_type, product_type
+        ''', closed) as cursor:
+            async for metric, product, count, amount_count, amount_total in cursor:
+                row = totals.setdefault((metric[len(ORDER_STATUS_METRIC_PREFIX):], product), [0, 0, 0.0])
+                row[0] += count or 0
+                row[1] += amount_count or 0
+                row[2] += amount_total or 0
+    if live:
+        async with db.execute('''
+            SELECT status, order_data, total_amount
+            FROM orders
+            WHERE created_at >= ? AND created_at < ?
+        ''', live) as cursor:
+            async for status, order_json, total_amount in cursor:
+                row = totals.setdefault((status or '', _order_product(order_json)), [0, 0, 0.0])
+                row[0] += 1
+                if total_amount is not None and total_amount > 0:
+                    row[1] += 1
+                    row[2] += total_amount
+    return totals
+
+def _sum_order_totals(totals: Dict[Tuple[str, str], List], statuses, product: Optional[str] = None) -> List:
+    """Складывает [заказов, заказов с суммой, сумма] по статусам (и продукту) из _order_status_totals"""
+    result = [0, 0, 0.0]
+    for (status, order_product), row in totals.items():
+        if status in statuses and (product is None or order_product == product):
+            result[0] += row[0]
+            result[1] += row[1]
+            result[2] += row[2]
+    return result
+
+async def get_order_status_totals(start_date: str, end_date: str) -> List[Dict]:
+    """
+    Заказы, созданные в период (дни по Москве), по текущему статусу и продукту:
+    [{status, product_type, count, paid_count, revenue}], revenue — сумма total_amount
+    """
+    async with db_connection(readonly=True) as db:
+        totals = await _order_status_totals(db, start_date, end_date)
+    return [
+        {'status': status, 'product_type': product, 'count': count, 'paid_count': amount_count, 'revenue': amount_total}
+        for (status, product), (count, amount_count, amount_total) in totals.items()
+        if count
+    ]
+
+# --- Аналитика: заказы вместе с атрибуцией ---
+
+# Статусы, при которых заказ считается ожидающим оплаты (для аналитики и выгрузки)
+AWAITING_PAYMENT_STATUSES = ['waiting_payment', 'payment_pending', 'payment_created', 'upsell_payment_created', 'upsell_payment_pending']
+
+_ANALYTICS_ORDERS_QUERY = '''
+    WITH base AS (
+        SELECT o.id, o.user_id, o.status, o.created_at, o.email,
+               datetime(o.created_at, '+3 hours') AS created_at_msk,
+               u.product, u.username, m.email AS manager_email, d.phone,
+               a.order_source, a.user_source, a.utm_source AS attr_utm_source,
+               a.utm_medium AS attr_utm_medium, a.utm_campaign AS attr_utm_campaign,
+               a.event_product_type, COALESCE(a.has_upsell, 0) AS has_upsell,
+               CASE WHEN json_valid(o.order_data) THEN json_extract(o.order_data, '$.product') END AS order_product,
+               CASE WHEN json_valid(o.order_data) THEN json_extract(o.order_data, '$.book_format') END AS book_format,
+               CASE WHEN json_valid(o.order_data) THEN json_extract(o.order_data, '$.format') END AS format_field
+        FROM orders o
+        LEFT JOIN user_profiles u ON o.user_id = u.user_id
+        LEFT JOIN managers m ON o.assigned_manager_id = m.id
+        LEFT JOIN delivery_addresses d ON o.id = d.order_id
+        LEFT JOIN order_attribution a ON a.order_id = o.id
+        WHERE o.created_at >= ? AND o.created_at < ?{keyset}
+    ),
+    resolved AS (
+        SELECT b.id, b.user_id, b.user_id AS telegram_id, b.status, b.created_at, b.created_at_msk,
+               b.email, b.product, b.username, b.manager_email, b.phone,
+               COALESCE(b.order_source, b.user_source, 'Неизвестно') AS source,
+               COALESCE(NULLIF(b.attr_utm_source, ''), 'Неизвестно') AS utm_source,
+               COALESCE(NULLIF(b.attr_utm_medium, ''), 'Неизвестно') AS utm_medium,
+               COALESCE(NULLIF(b.attr_utm_campaign, ''), 'Неизвестно') AS utm_campaign,
+               CASE WHEN b.order_product IS NOT NULL AND b.order_product NOT IN ('', 'None', 'null', 'undefined') THEN b.order_product
+                    ELSE COALESCE(b.event_product_type, 'Неизвестно') END AS product_type,
+               CASE WHEN b.order_product = 'Книга' THEN
+                        CASE WHEN instr(COALESCE(b.book_format, ''), 'Электронная') > 0
+                               OR instr(COALESCE(b.format_field, ''), 'Электронная') > 0
+                             THEN 'Книга электронная' ELSE 'Книга печатная' END
+                    WHEN b.order_product IS NOT NULL AND b.order_product NOT IN ('', 'None', 'null', 'undefined') THEN b.order_product
+                    ELSE COALESCE(b.event_product_type, 'Неизвестно') END AS detailed_product_type,
+               CASE WHEN b.order_product = 'Книга' THEN
+                        CASE WHEN COALESCE(b.book_format, '') = '' AND COALESCE(b.format_field, '') = '' THEN 'Не выбрано'
+                             WHEN instr(COALESCE(b.book_format, ''), 'Электронная') > 0
+                               OR instr(COALESCE(b.format_field, ''), 'Электронная') > 0
+                             THEN 'Электронная' ELSE 'Печатная' END
+                    WHEN b.order_product = 'Песня' THEN '-'
+                    ELSE 'Неизвестно' END AS product_format,
+               b.has_upsell
+        FROM base b
+    )
+    SELECT * FROM resolved WHERE 1=1
+'''
+
+def _build_analytics_orders_query(
+    start_date: str,
+    end_date: str,
+    source: Optional[str] = None,
+    product_type: Optional[str] = None,
+    detailed_product_type: bool = False,
+    purchase_status: Optional[str] = None,
+    upsell_status: Optional[str] = None,
+    utm_source: Optional[str] = None,
+    utm_medium: Optional[str] = None,
+    utm_campaign: Optional[str] = None,
+    search: Optional[str] = None,
+    before: Optional[Tuple[str, int]] = None,
+    limit: Optional[int] = None,
+) -> Tuple[str, List]:
+    """
+    Строит запрос заказов за период (даты YYYY-MM-DD по Москве) вместе с источником, UTM,
+    типом/форматом продукта и признаком допродажи — одним запросом с JOIN к order_attribution
+    вместо get_order_source/get_order_utm_data/check_order_has_upsell на каждый заказ.
+    Фильтры применяются в SQL.
+
+    detailed_product_type=True — фильтр по типу продукта с учетом формата книги
+    ("Книга" включает и печатную, и электронную), как в выгрузке.
+    before/limit — ключ (created_at, id) последнего заказа предыдущей пачки и размер пачки
+    для постраничного чтения (порядок ORDER BY created_at DESC, id DESC).
+    """
+    # Границы периода в UTC один раз — сравнение с created_at напрямую использует индекс
+    params = list(msk_period_bounds(start_date, end_date))
+    keyset = ''
+    if before:
+        keyset = ' AND (o.created_at, o.id) < (?, ?)'
+        params.extend(before)
+    query = _ANALYTICS_ORDERS_QUERY.format(keyset=keyset)
+
+    # Сравнение без учета регистра (py_lower понимает кириллицу, в отличие от lower() SQLite)
+    for column, value in (('source', source), ('utm_source', utm_source),
+                          ('utm_medium', utm_medium), ('utm_campaign', utm_campaign)):
+        if value and value.strip():
+            query += f' AND py_lower({column}) = py_lower(?)'
+            params.append(value)
+
+    if product_type and product_type.strip():
+        if detailed_product_type and product_type.lower() == 'книга':
+            query += " AND instr(py_lower(detailed_product_type), 'книга') > 0"
+        else:
+            query += f" AND py_lower({'detailed_product_type' if detailed_product_type else 'product_type'}) = py_lower(?)"
+            params.append(product_type)
+
+    if purchase_status and purchase_status.strip():
+        paid_placeholders = ','.join(['?'] * len(PAID_ORDER_STATUSES))
+        awaiting_placeholders = ','.join(['?'] * len(AWAITING_PAYMENT_STATUSES))
+        if purchase_status == 'Оплачен':
+            query += f' AND status IN ({paid_placeholders})'
+            params.extend(PAID_ORDER_STATUSES)
+        elif purchase_status == 'Ждет оплаты':
+            query += f' AND status IN ({awaiting_placeholders}) AND status NOT IN ({paid_placeholders})'
+            params.extend(AWAITING_PAYMENT_STATUSES + PAID_ORDER_STATUSES)
+        elif purchase_status == 'Не оплачен':
+            query += f' AND (status IS NULL OR status NOT IN ({awaiting_placeholders}, {paid_placeholders}))'
+            params.extend(AWAITING_PAYMENT_STATUSES + PAID_ORDER_STATUSES)
+        else:
+            query += ' AND 0'
+
+    if upsell_status and upsell_status.strip():
+        if upsell_status == 'Оплачен':
+            query += ' AND has_upsell = 1'
+        elif upsell_status == 'Не оплачен':
+            query += ' AND has_upsell = 0'
+        else:
+            query += ' AND 0'
+
+    if search and search.strip():
+        search_lower = search.lower()
+        query += '''
+            AND (instr(py_lower(COALESCE(username, '')), ?) > 0
+                 OR instr(CAST(id AS TEXT), ?) > 0
+                 OR instr(py_lower(COALESCE(created_at, '')), ?) > 0)
+        '''
+        params.extend([search_lower, search_lower, search_lower])
+
+    query += ' ORDER BY created_at DESC, id DESC'
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
+    return query, params
+
+async def get_analytics_orders(start_date: str, end_date: str, **filters) -> List[Dict]:
+    """Возвращает все заказы аналитики за период списком (фильтры — как в _build_analytics_orders_query)"""
+    query, params = _build_analytics_orders_query(start_date, end_date, **filters)
+
+    async with db_connection(readonly=True) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute(query, params) as cursor:
+            rows = await cursor.fetchall()
+            return [dict(row) for row in rows]
+
+# Сколько строк аналитики читать с курсора за один раз при потоковой выгрузке
+ANALYTICS_EXPORT_CHUNK_SIZE = int(os.getenv('ANALYTICS_EXPORT_CHUNK_SIZE', '500'))
+
+async def iter_analytics_orders(
+    start_date: str,
+    end_date: str,
+    chunk_size: int = ANALYTICS_EXPORT_CHUNK_SIZE,
+    **filters,
+) -> AsyncIterator[List[Dict]]:
+    """
+    Отдает заказы аналитики пачками по chunk_size строк.
+    В памяти одновременно держится только одна пачка, независимо от длины периода.
+    Каждая пачка читается отдельным запросом по ключу (created_at, id) и соединение
+    возвращается в пул до yield: выгрузку темпирует клиент, и держать читателя
+    на все время передачи нельзя.
+    """
+    before = None
+    while True:
+        query, params = _build_analytics_orders_query(start_date, end_date, before=before, limit=chunk_size, **filters)
+
+        async with db_connection(readonly=True) as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute(query, params) as cursor:
+                rows = [dict(row) for row in await cursor.fetchall()]
+
+        if not rows:
+            break
+        yield rows
+        if len(rows) < chunk_size:
+            break
+        before = (rows[-1]['created_at'], rows[-1]['id'])
+
 async def get_event_metrics(
     start_date: str = None,
     end_date: str = None,
     event_type: str = None,
     user_id: int = None
 ) -> List[Dict]:
-    """Получает метрики событий с фильтрацией"""
+    """Получает метрики событий с фильтрацией (даты — дни по Москве)"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_connection(readonly=True) as db:
             query = "SELECT * FROM event_metrics WHERE 1=1"
             params = []
             
             if start_date:
-                query += " AND DATE(timestamp) >= ?"
-                params.append(start_date)
+                query += " AND timestamp >= ?"
+                params.append(msk_period_bounds(start_date, start_date)[0])
             
             if end_date:
-                query += " AND DATE(timestamp) <= ?"
-                params.append(end_date)
+                query += " AND timestamp < ?"
+                params.append(msk_period_bounds(end_date, end_date)[1])
             
             if event_type:
                 query += " AND event_type = ?"
@@ -5413,9 +6351,14 @@ async def get_event_metrics(
         return []
 
 async def get_funnel_metrics(start_date: str, end_date: str) -> Dict:
-    """Получает метрики воронки конверсии"""
+    """
+    Получает метрики воронки конверсии (дни по Москве).
+    Число нажатий берется из дневных сводок; уникальные пользователи по дням не складываются,
+    поэтому считаются по event_metrics через индекс (event_type, timestamp).
+    """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        period_from, period_to = msk_period_bounds(start_date, end_date)
+        async with db_connection(readonly=True) as db:
             # Уникальные пользователи по событиям
             events = [
                 'bot_entry',
@@ -5425,33 +6368,24 @@ async def get_funnel_metrics(start_date: str, end_date: str) -> Dict:
                 'purchase_completed'
             ]
             
-            funnel_data = {}
+            event_placeholders = ','.join(['?' for _ in events])
+            async with db.execute(f'''
+                SELECT event_type, COUNT(DISTINCT user_id) as unique_users
+                FROM event_metrics 
+                WHERE event_type IN ({event_placeholders})
+                AND timestamp >= ? AND timestamp < ?
+                GROUP BY event_type
+            ''', (*events, period_from, period_to)) as cursor:
+                unique_by_event = {row[0]: row[1] for row in await cursor.fetchall()}
             
+            event_totals = await _event_totals(db, start_date, end_date)
+            
+            funnel_data = {}
             for event in events:
-                # Получаем уникальных пользователей
-                async with db.execute('''
-                    SELECT COUNT(DISTINCT user_id) as unique_users
-                    FROM event_metrics 
-                    WHERE event_type = ? 
-                    AND DATE(timestamp) BETWEEN ? AND ?
-                ''', (event, start_date, end_date)) as cursor:
-                    result = await cursor.fetchone()
-                    unique_users = result[0] if result else 0
-                
-                # Получаем общее количество нажатий
-                async with db.execute('''
-                    SELECT COUNT(*) as total_clicks
-                    FROM event_metrics 
-                    WHERE event_type = ? 
-                    AND DATE(timestamp) BETWEEN ? AND ?
-                ''', (event, start_date, end_date)) as cursor:
-                    result = await cursor.fetchone()
-                    total_clicks = result[0] if result else 0
-                
                 # Для всех событий показываем уникальных пользователей по user_id
                 funnel_data[event] = {
-                    'unique_users': unique_users,  # Всегда показываем уникальных пользователей по user_id
-                    'total_clicks': total_clicks
+                    'unique_users': unique_by_event.get(event, 0),  # Всегда показываем уникальных пользователей по user_id
+                    'total_clicks': event_totals.get(event, [0])[0]
                 }
             
             # Корректировка: уникальные входы в бота не должны быть меньше, чем нажатия Старт
@@ -5461,8 +6395,8 @@ async def get_funnel_metrics(start_date: str, end_date: str) -> Dict:
                 SELECT COUNT(DISTINCT user_id) as union_users
                 FROM event_metrics
                 WHERE event_type IN ('bot_entry', 'start_clicked')
-                AND DATE(timestamp) BETWEEN ? AND ?
-            ''', (start_date, end_date)) as cursor:
+                AND timestamp >= ? AND timestamp < ?
+            ''', (period_from, period_to)) as cursor:
                 result = await cursor.fetchone()
                 union_users = result[0] if result else 0
                 if union_users > funnel_data['bot_entry']['unique_users']:
@@ -5476,8 +6410,8 @@ async def get_funnel_metrics(start_date: str, end_date: str) -> Dict:
                 SELECT COUNT(DISTINCT user_id) as song_demo_users
                 FROM event_metrics 
                 WHERE event_type = 'song_demo_learn_price_clicked'
-                AND DATE(timestamp) BETWEEN ? AND ?
-            ''', (start_date, end_date)) as cursor:
+                AND timestamp >= ? AND timestamp < ?
+            ''', (period_from, period_to)) as cursor:
                 result = await cursor.fetchone()
                 song_demo_users = result[0] if result else 0
             
@@ -5486,8 +6420,8 @@ async def get_funnel_metrics(start_date: str, end_date: str) -> Dict:
                 SELECT COUNT(DISTINCT user_id) as book_demo_users
                 FROM event_metrics 
                 WHERE event_type = 'demo_learn_price_clicked'
-                AND DATE(timestamp) BETWEEN ? AND ?
-            ''', (start_date, end_date)) as cursor:
+                AND timestamp >= ? AND timestamp < ?
+            ''', (period_from, period_to)) as cursor:
                 result = await cursor.fetchone()
                 book_demo_users = result[0] if result else 0
             
@@ -5497,8 +6431,8 @@ async def get_funnel_metrics(start_date: str, end_date: str) -> Dict:
                 async with db.execute('''
                     SELECT COUNT(DISTINCT user_id) as unique_users, COUNT(*) as total_orders
                     FROM orders 
-                    WHERE DATE(created_at) BETWEEN ? AND ?
-                ''', (start_date, end_date)) as cursor:
+                    WHERE created_at >= ? AND created_at < ?
+                ''', (period_from, period_to)) as cursor:
                     result = await cursor.fetchone()
                     unique_users = result[0] if result else 0
                     total_orders = result[1] if result else 0
@@ -5515,8 +6449,8 @@ async def get_funnel_metrics(start_date: str, end_date: str) -> Dict:
                     SELECT COUNT(DISTINCT user_id) as unique_users, COUNT(*) as paid_orders
                     FROM orders 
                     WHERE status IN ({status_placeholders})
-                    AND DATE(created_at) BETWEEN ? AND ?
-                ''', (*PAID_ORDER_STATUSES, start_date, end_date)) as cursor:
+                    AND created_at >= ? AND created_at < ?
+                ''', (*PAID_ORDER_STATUSES, period_from, period_to)) as cursor:
                     result = await cursor.fetchone()
                     unique_users = result[0] if result else 0
                     paid_orders = result[1] if result else 0
@@ -5533,11 +6467,11 @@ async def get_funnel_metrics(start_date: str, end_date: str) -> Dict:
                 FROM event_metrics 
                 WHERE event_type = 'purchase_completed'
                 AND (event_data NOT LIKE '%"upsell_type": "print"%' OR event_data IS NULL)
-                AND DATE(timestamp) BETWEEN ? AND ?
+                AND timestamp >= ? AND timestamp < ?
                 AND amount IS NOT NULL 
                 AND amount > 0
                 AND order_id IS NOT NULL
-            ''', (start_date, end_date)) as cursor:
+            ''', (period_from, period_to)) as cursor:
                 result = await cursor.fetchone()
                 upsell_unique_users = result[0] if result else 0
                 upsell_total_clicks = result[1] if result else 0
@@ -5570,182 +6504,98 @@ async def get_abandonment_metrics(start_date: str, end_date: str) -> Dict:
     
     Считает количество ЗАКАЗОВ (не уникальных пользователей) на каждом этапе.
     Это позволяет корректно отображать метрики, когда у одного пользователя несколько заказов.
+    Статусы заказов берутся из дневных сводок (за сегодня — из orders).
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with db_connection(readonly=True) as db:
+            order_totals = await _order_status_totals(db, start_date, end_date)
             
             # Глава 1: Создание заказа (product_selection)
             # Прошло шаг = все созданные заказы
-            async with db.execute('''
-                SELECT COUNT(*) as total_orders
-                FROM orders
-                WHERE DATE(created_at) BETWEEN ? AND ?
-            ''', (start_date, end_date)) as cursor:
-                row = await cursor.fetchone()
-                product_selection_total = row[0] if row else 0
+            product_selection_total = sum(row[0] for row in order_totals.values())
             
             # Отвалились = заказы, которые остались на начальных статусах
-            async with db.execute('''
-                SELECT COUNT(*) as abandoned_orders
-                FROM orders
-                WHERE status IN ('created', 'product_selected', 'gender_selected', 'relation_selected', 'collecting_facts')
-                AND DATE(created_at) BETWEEN ? AND ?
-            ''', (start_date, end_date)) as cursor:
-                row = await cursor.fetchone()
-                product_selection_abandoned = row[0] if row else 0
+            product_selection_abandoned = _sum_order_totals(order_totals, [
+                'created', 'product_selected', 'gender_selected', 'relation_selected', 'collecting_facts'
+            ])[0]
             
             # Глава 2: Демо-версия ПЕСНИ (demo_sent)
             # Прошло шаг = заказы песни, достигшие demo_sent или дальше (включая ВСЕ статусы после демо)
-            async with db.execute('''
-                SELECT COUNT(*) as total_orders
-                FROM orders
-                WHERE JSON_EXTRACT(order_data, '$.product') = 'Песня'
-                AND status IN ('demo_sent', 'demo_content', 'waiting_payment', 'payment_created', 'payment_pending',
-                               'paid', 'upsell_paid', 'upsell_payment_created', 'upsell_payment_pending', 'additional_payment_paid',
-                               'collecting_facts', 'waiting_plot_options', 'plot_selected', 'waiting_final_version',
-                               'waiting_draft', 'draft_sent', 'editing', 'waiting_feedback', 'feedback_processed',
-                               'prefinal_sent', 'waiting_final', 'final_sent', 'ready', 'delivered', 'completed')
-                AND DATE(created_at) BETWEEN ? AND ?
-            ''', (start_date, end_date)) as cursor:
-                row = await cursor.fetchone()
-                demo_sent_song_total = row[0] if row else 0
+            demo_sent_song_total = _sum_order_totals(order_totals, [
+                'demo_sent', 'demo_content', 'waiting_payment', 'payment_created', 'payment_pending',
+                'paid', 'upsell_paid', 'upsell_payment_created', 'upsell_payment_pending', 'additional_payment_paid',
+                'collecting_facts', 'waiting_plot_options', 'plot_selected', 'waiting_final_version',
+                'waiting_draft', 'draft_sent', 'editing', 'waiting_feedback', 'feedback_processed',
+                'prefinal_sent', 'waiting_final', 'final_sent', 'ready', 'delivered', 'completed'
+            ], 'Песня')[0]
             
             # Отвалились = заказы песни в статусе demo_sent или demo_content, которые НЕ оплачены
-            async with db.execute('''
-                SELECT COUNT(*) as abandoned_orders
-                FROM orders
-                WHERE JSON_EXTRACT(order_data, '$.product') = 'Песня'
-                AND status IN ('demo_sent', 'demo_content')
-                AND DATE(created_at) BETWEEN ? AND ?
-            ''', (start_date, end_date)) as cursor:
-                row = await cursor.fetchone()
-                demo_sent_song_abandoned = row[0] if row else 0
+            demo_sent_song_abandoned = _sum_order_totals(order_totals, ['demo_sent', 'demo_content'], 'Песня')[0]
             
             # Глава 2: Демо-версия КНИГИ (demo_sent_book)
             # Прошло шаг = заказы книги, достигшие demo_sent или дальше (включая ВСЕ статусы после демо)
-            async with db.execute('''
-                SELECT COUNT(*) as total_orders
-                FROM orders
-                WHERE JSON_EXTRACT(order_data, '$.product') = 'Книга'
-                AND status IN ('demo_sent', 'demo_content', 'answering_questions', 'questions_completed', 
-                               'waiting_payment', 'payment_created', 'payment_pending', 'paid', 'upsell_paid',
-                               'story_selection', 'waiting_story_options', 'waiting_story_choice', 'story_selected', 'story_options_sent',
-                               'pages_selected', 'covers_sent', 'waiting_cover_choice', 'cover_selected',
-                               'waiting_draft', 'draft_sent', 'editing', 'waiting_feedback', 'feedback_processed',
-                               'prefinal_sent', 'waiting_final', 'final_sent',
-                               'waiting_delivery', 'print_delivery_pending', 'ready', 'delivered', 'completed',
-                               'upsell_payment_created', 'upsell_payment_pending', 'additional_payment_paid')
-                AND DATE(created_at) BETWEEN ? AND ?
-            ''', (start_date, end_date)) as cursor:
-                row = await cursor.fetchone()
-                demo_sent_book_total = row[0] if row else 0
+            demo_sent_book_total = _sum_order_totals(order_totals, [
+                'demo_sent', 'demo_content', 'answering_questions', 'questions_completed',
+                'waiting_payment', 'payment_created', 'payment_pending', 'paid', 'upsell_paid',
+                'story_selection', 'waiting_story_options', 'waiting_story_choice', 'story_selected', 'story_options_sent',
+                'pages_selected', 'covers_sent', 'waiting_cover_choice', 'cover_selected',
+                'waiting_draft', 'draft_sent', 'editing', 'waiting_feedback', 'feedback_processed',
+                'prefinal_sent', 'waiting_final', 'final_sent',
+                'waiting_delivery', 'print_delivery_pending', 'ready', 'delivered', 'completed',
+                'upsell_payment_created', 'upsell_payment_pending', 'additional_payment_paid'
+            ], 'Книга')[0]
             
             # Отвалились = заказы книги на этапе демо или вопросов, но НЕ оплатившие
-            async with db.execute('''
-                SELECT COUNT(*) as abandoned_orders
-                FROM orders
-                WHERE JSON_EXTRACT(order_data, '$.product') = 'Книга'
-                AND status IN ('demo_sent', 'demo_content', 'answering_questions', 'questions_completed')
-                AND DATE(created_at) BETWEEN ? AND ?
-            ''', (start_date, end_date)) as cursor:
-                row = await cursor.fetchone()
-                demo_sent_book_abandoned = row[0] if row else 0
+            demo_sent_book_abandoned = _sum_order_totals(order_totals, [
+                'demo_sent', 'demo_content', 'answering_questions', 'questions_completed'
+            ], 'Книга')[0]
             
             # Глава 3: Оплата заказа (payment)
             # Прошло шаг = все заказы, достигшие этапа оплаты (включая статусы ожидания оплаты и все оплаченные)
             # Используем динамический список всех оплаченных статусов + статусы ожидания оплаты
             payment_statuses = ['waiting_payment', 'payment_created', 'payment_pending'] + PAID_ORDER_STATUSES
-            status_placeholders = ','.join(['?' for _ in payment_statuses])
-            async with db.execute(f'''
-                SELECT COUNT(*) as total_orders
-                FROM orders
-                WHERE status IN ({status_placeholders})
-                AND DATE(created_at) BETWEEN ? AND ?
-            ''', (*payment_statuses, start_date, end_date)) as cursor:
-                row = await cursor.fetchone()
-                payment_total = row[0] if row else 0
+            payment_total = _sum_order_totals(order_totals, payment_statuses)[0]
             
             # Отвалились = заказы в ожидании оплаты (НЕ оплачены)
-            async with db.execute('''
-                SELECT COUNT(*) as abandoned_orders
-                FROM orders
-                WHERE status IN ('waiting_payment', 'payment_created', 'payment_pending')
-                AND DATE(created_at) BETWEEN ? AND ?
-            ''', (start_date, end_date)) as cursor:
-                row = await cursor.fetchone()
-                payment_abandoned = row[0] if row else 0
+            payment_abandoned = _sum_order_totals(order_totals, ['waiting_payment', 'payment_created', 'payment_pending'])[0]
             
             # Глава 4: Предфинальная версия (prefinal_sent)
             # Прошло шаг = оплаченные заказы (используем все статусы из PAID_ORDER_STATUSES)
-            status_placeholders_paid = ','.join(['?' for _ in PAID_ORDER_STATUSES])
-            async with db.execute(f'''
-                SELECT COUNT(*) as total_orders
-                FROM orders
-                WHERE status IN ({status_placeholders_paid})
-                AND DATE(created_at) BETWEEN ? AND ?
-            ''', (*PAID_ORDER_STATUSES, start_date, end_date)) as cursor:
-                row = await cursor.fetchone()
-                prefinal_total = row[0] if row else 0
+            prefinal_total = _sum_order_totals(order_totals, PAID_ORDER_STATUSES)[0]
             
             # Отвалились = оплаченные заказы, не достигшие prefinal_sent
             # Это заказы в начальных статусах после оплаты
-            async with db.execute('''
-                SELECT COUNT(*) as abandoned_orders
-                FROM orders
-                WHERE status IN ('paid', 'upsell_paid', 'story_selection', 'waiting_story_options', 
-                                 'waiting_story_choice', 'story_selected', 'story_options_sent',
-                                 'waiting_draft', 'draft_sent', 'collecting_facts', 
-                                 'waiting_plot_options', 'plot_selected')
-                AND DATE(created_at) BETWEEN ? AND ?
-            ''', (start_date, end_date)) as cursor:
-                row = await cursor.fetchone()
-                prefinal_abandoned = row[0] if row else 0
+            prefinal_abandoned = _sum_order_totals(order_totals, [
+                'paid', 'upsell_paid', 'story_selection', 'waiting_story_options',
+                'waiting_story_choice', 'story_selected', 'story_options_sent',
+                'waiting_draft', 'draft_sent', 'collecting_facts',
+                'waiting_plot_options', 'plot_selected'
+            ])[0]
             
             # Глава 5: Правки и доработки (editing)
             # Прошло шаг = заказы, достигшие prefinal_sent или дальше (включая все промежуточные статусы)
-            async with db.execute('''
-                SELECT COUNT(*) as total_orders
-                FROM orders
-                WHERE status IN ('prefinal_sent', 'editing', 'waiting_feedback', 'feedback_processed',
-                                 'waiting_final', 'final_sent', 'waiting_delivery', 'print_delivery_pending',
-                                 'ready', 'delivered', 'completed')
-                AND DATE(created_at) BETWEEN ? AND ?
-            ''', (start_date, end_date)) as cursor:
-                row = await cursor.fetchone()
-                editing_total = row[0] if row else 0
+            editing_total = _sum_order_totals(order_totals, [
+                'prefinal_sent', 'editing', 'waiting_feedback', 'feedback_processed',
+                'waiting_final', 'final_sent', 'waiting_delivery', 'print_delivery_pending',
+                'ready', 'delivered', 'completed'
+            ])[0]
             
             # Отвалились = заказы в статусах prefinal_sent, editing и промежуточных (не завершенные)
-            async with db.execute('''
-                SELECT COUNT(*) as abandoned_orders
-                FROM orders
-                WHERE status IN ('prefinal_sent', 'editing', 'waiting_feedback', 'feedback_processed',
-                                 'waiting_final', 'final_sent', 'waiting_delivery', 'print_delivery_pending')
-                AND DATE(created_at) BETWEEN ? AND ?
-            ''', (start_date, end_date)) as cursor:
-                row = await cursor.fetchone()
-                editing_abandoned = row[0] if row else 0
+            editing_abandoned = _sum_order_totals(order_totals, [
+                'prefinal_sent', 'editing', 'waiting_feedback', 'feedback_processed',
+                'waiting_final', 'final_sent', 'waiting_delivery', 'print_delivery_pending'
+            ])[0]
             
             # Глава 6: Завершение проекта (completed)
             # Прошло шаг = заказы в финальных статусах (включая waiting_delivery и print_delivery_pending)
-            async with db.execute('''
-                SELECT COUNT(*) as total_orders
-                FROM orders
-                WHERE status IN ('ready', 'waiting_delivery', 'print_delivery_pending', 'delivered', 'completed')
-                AND DATE(created_at) BETWEEN ? AND ?
-            ''', (start_date, end_date)) as cursor:
-                row = await cursor.fetchone()
-                completed_total = row[0] if row else 0
+            completed_total = _sum_order_totals(order_totals, [
+                'ready', 'waiting_delivery', 'print_delivery_pending', 'delivered', 'completed'
+            ])[0]
             
             # Отвалились = заказы готовые, но не завершенные (включая промежуточные статусы доставки)
-            async with db.execute('''
-                SELECT COUNT(*) as abandoned_orders
-                FROM orders
-                WHERE status IN ('ready', 'waiting_delivery', 'print_delivery_pending', 'delivered')
-                AND DATE(created_at) BETWEEN ? AND ?
-            ''', (start_date, end_date)) as cursor:
-                row = await cursor.fetchone()
-                completed_abandoned = row[0] if row else 0
+            completed_abandoned = _sum_order_totals(order_totals, [
+                'ready', 'waiting_delivery', 'print_delivery_pending', 'delivered'
+            ])[0]
             
             abandonment_data = [
                 {
@@ -5793,48 +6643,23 @@ async def get_abandonment_metrics(start_date: str, end_date: str) -> Dict:
         return []
 
 async def get_revenue_metrics(start_date: str, end_date: str) -> Dict:
-    """Получает метрики выручки"""
+    """Получает метрики выручки (дни по Москве, суммы из дневных сводок)"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        period_from, period_to = msk_period_bounds(start_date, end_date)
+        async with db_connection(readonly=True) as db:
+            order_totals = await _order_status_totals(db, start_date, end_date)
+            event_totals = await _event_totals(db, start_date, end_date)
+            
             # Количество основных покупок считаем ПО СТАТУСАМ (как в аналитике)
             # Это убирает расхождения, когда событие purchase_completed отсутствует, а статус уже оплачен
-            status_placeholders = ','.join(['?' for _ in PAID_ORDER_STATUSES])
-            async with db.execute(f'''
-                SELECT 
-                    COUNT(*) as purchase_count
-                FROM orders 
-                WHERE status IN ({status_placeholders})
-                AND DATE(created_at) BETWEEN ? AND ?
-            ''', (*PAID_ORDER_STATUSES, start_date, end_date)) as cursor:
-                status_count_row = await cursor.fetchone()
-                purchases_count_by_status = status_count_row[0] if status_count_row else 0
+            purchases_count_by_status, _, paid_orders_revenue = _sum_order_totals(order_totals, PAID_ORDER_STATUSES)
             
             # Основная выручка из событий
-            async with db.execute('''
-                SELECT 
-                    COALESCE(SUM(amount), 0) as total_revenue
-                FROM event_metrics 
-                WHERE event_type = 'purchase_completed'
-                AND DATE(timestamp) BETWEEN ? AND ?
-                AND amount IS NOT NULL
-                AND amount > 0
-                AND order_id IS NOT NULL
-            ''', (start_date, end_date)) as cursor:
-                main_revenue_row = await cursor.fetchone()
-                main_revenue_sum = float(main_revenue_row[0]) if main_revenue_row and main_revenue_row[0] is not None else 0.0
+            main_revenue_sum = float(event_totals.get('purchase_completed', [0, 0, 0.0])[2])
             
             # Если нет данных в событиях, берем из заказов
             if main_revenue_sum == 0:
-                async with db.execute('''
-                    SELECT 
-                        COALESCE(SUM(total_amount), 0) as total_revenue
-                    FROM orders 
-                    WHERE status IN ({status_placeholders})
-                    AND DATE(created_at) BETWEEN ? AND ?
-                    AND total_amount IS NOT NULL AND total_amount > 0
-                ''', (*PAID_ORDER_STATUSES, start_date, end_date)) as cursor:
-                    row = await cursor.fetchone()
-                    main_revenue_sum = float(row[0]) if row and row[0] is not None else 0.0
+                main_revenue_sum = float(paid_orders_revenue)
             
             # Дополнительные покупки из событий
             # Считаем уникальные order_id, исключаем нулевые суммы
@@ -5844,25 +6669,17 @@ async def get_revenue_metrics(start_date: str, end_date: str) -> Dict:
                     SUM(amount) as upsell_revenue
                 FROM event_metrics 
                 WHERE event_type = 'upsell_purchased'
-                AND DATE(timestamp) BETWEEN ? AND ?
+                AND timestamp >= ? AND timestamp < ?
                 AND amount IS NOT NULL 
                 AND amount > 0
                 AND order_id IS NOT NULL
-            ''', (start_date, end_date)) as cursor:
+            ''', (period_from, period_to)) as cursor:
                 upsells = await cursor.fetchone()
             
             # Если нет данных в событиях, берем из заказов с статусом upsell_paid
             if not upsells or upsells[0] == 0:
-                async with db.execute('''
-                    SELECT 
-                        COUNT(*) as upsell_count,
-                        COALESCE(SUM(total_amount), 0) as upsell_revenue
-                    FROM orders 
-                    WHERE status = 'upsell_paid'
-                    AND DATE(created_at) BETWEEN ? AND ?
-                    AND total_amount IS NOT NULL AND total_amount > 0
-                ''', (start_date, end_date)) as cursor:
-                    upsells = await cursor.fetchone()
+                _, upsell_count, upsell_revenue = _sum_order_totals(order_totals, ['upsell_paid'])
+                upsells = (upsell_count, upsell_revenue)
             
             # Средний чек считаем по количеству покупок (по статусам)
             avg_value = (main_revenue_sum / purchases_count_by_status) if purchases_count_by_status > 0 else 0
@@ -5886,7 +6703,8 @@ async def get_detailed_revenue_metrics(start_date: str, end_date: str) -> Dict:
     """Получает детализированные метрики выручки по типам продуктов"""
     try:
         import json
-        async with aiosqlite.connect(DB_PATH) as db:
+        period_from, period_to = msk_period_bounds(start_date, end_date)
+        async with db_connection(readonly=True) as db:
             # Сначала получаем суммы из event_metrics для каждого заказа
             # Берем ПЕРВОЕ событие purchase_completed (основную покупку), а не сумму
             async with db.execute('''
@@ -5896,12 +6714,12 @@ async def get_detailed_revenue_metrics(start_date: str, end_date: str) -> Dict:
                     MAX(amount) as max_amount
                 FROM event_metrics
                 WHERE event_type = 'purchase_completed'
-                AND DATE(timestamp) BETWEEN ? AND ?
+                AND timestamp >= ? AND timestamp < ?
                 AND amount IS NOT NULL
                 AND amount > 0
                 AND order_id IS NOT NULL
                 GROUP BY order_id
-            ''', (start_date, end_date)) as cursor:
+            ''', (period_from, period_to)) as cursor:
                 events_data = {row[0]: {'initial': row[1], 'max': row[2]} for row in await cursor.fetchall()}
             
             # Проверяем, у каких заказов есть доплаты
@@ -5922,9 +6740,9 @@ async def get_detailed_revenue_metrics(start_date: str, end_date: str) -> Dict:
                     status
                 FROM orders 
                 WHERE order_data IS NOT NULL AND order_data != ""
-                AND DATE(created_at) BETWEEN ? AND ?
+                AND created_at >= ? AND created_at < ?
                 AND status NOT IN ('created', 'cancelled', 'refunded')
-            ''', (start_date, end_date)) as cursor:
+            ''', (period_from, period_to)) as cursor:
                 rows = await cursor.fetchall()
                 
             # Инициализируем результат
@@ -6039,7 +6857,7 @@ async def get_detailed_revenue_metrics(start_date: str, end_date: str) -> Dict:
 
 async def get_orders_count_with_permissions(manager_email: str, status: Optional[str] = None) -> int:
     """Получает общее количество заказов с учетом прав доступа менеджера"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         # Проверяем, является ли менеджер главным админом
         is_admin = await is_super_admin(manager_email)
         
@@ -6083,13 +6901,70 @@ async def get_orders_count_with_permissions(manager_email: str, status: Optional
             row = await cursor.fetchone()
             return row[0] if row else 0
 
+# --- События заказов для админки (order_events) ---
+
+# Сколько часов хранить события: вкладка, переподключившаяся позже, просто перезапрашивает данные
+ORDER_EVENTS_RETENTION_HOURS = int(os.getenv('ORDER_EVENTS_RETENTION_HOURS', '24'))
+
+# Колбэки, которые вызываются после записи событий заказов в этом процессе (будят рассылку админки)
+_order_event_listeners: List[Callable[[], None]] = []
+
+def add_order_event_listener(callback: Callable[[], None]):
+    """Подписывает колбэк на появление новых событий заказов в текущем процессе"""
+    _order_event_listeners.append(callback)
+
+def remove_order_event_listener(callback: Callable[[], None]):
+    if callback in _order_event_listeners:
+        _order_event_listeners.remove(callback)
+
+def notify_order_events():
+    """Сообщает подписчикам, что в order_events появились события"""
+    for callback in list(_order_event_listeners):
+        try:
+            callback()
+        except Exception as e:
+            print(f"❌ Ошибка уведомления о событии заказа: {e}")
+
+async def record_order_event(db, order_id: int, event_type: str):
+    """Записывает событие заказа в текущей транзакции (вызывается вместе с самим изменением)"""
+    await db.execute('''
+        INSERT INTO order_events (order_id, event_type, created_at) VALUES (?, ?, datetime('now'))
+    ''', (order_id, event_type))
+
+async def get_last_order_event_id() -> int:
+    async with db_connection(readonly=True) as db:
+        async with db.execute('SELECT COALESCE(MAX(id), 0) FROM order_events') as cursor:
+            return (await cursor.fetchone())[0]
+
+async def get_order_events_since(last_id: int, limit: int = 500) -> List[Dict]:
+    """События с id больше last_id по порядку; assigned_manager_id — для фильтрации по правам менеджера"""
+    async with db_connection(readonly=True) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute('''
+            SELECT e.id, e.order_id, e.event_type, e.created_at, o.assigned_manager_id
+            FROM order_events e
+            LEFT JOIN orders o ON o.id = e.order_id
+            WHERE e.id > ?
+            ORDER BY e.id
+            LIMIT ?
+        ''', (last_id, limit)) as cursor:
+            return [dict(row) for row in await cursor.fetchall()]
+
+async def prune_order_events() -> int:
+    """Удаляет события старше ORDER_EVENTS_RETENTION_HOURS, возвращает число удаленных"""
+    async def _prune_operation(db) -> int:
+        cursor = await db.execute('''
+            DELETE FROM order_events WHERE created_at < datetime('now', ?)
+        ''', (f'-{ORDER_EVENTS_RETENTION_HOURS} hours',))
+        return cursor.rowcount
+
+    return await run_write(_prune_operation)
+
 # --- Функции для работы с уведомлениями ---
 
 async def create_or_update_order_notification(order_id: int, manager_id: int = None):
     """Создает или обновляет уведомление для заказа при получении сообщения от пользователя"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await configure_db_connection(db)
-        
+    async with db_connection() as db:
         # Если manager_id не указан, получаем его из заказа
         if not manager_id:
             async with db.execute('SELECT assigned_manager_id FROM orders WHERE id = ?', (order_id,)) as cursor:
@@ -6115,27 +6990,27 @@ async def create_or_update_order_notification(order_id: int, manager_id: int = N
                 (order_id, manager_id, is_read, last_user_message_at, created_at, updated_at)
                 VALUES (?, ?, 0, datetime('now'), datetime('now'), datetime('now'))
             ''', (order_id, manager_id))
+        await record_order_event(db, order_id, 'notification')
         await db.commit()
+    notify_order_events()
 
 async def mark_notification_as_read(order_id: int, manager_id: int = None):
     """Отмечает уведомление как прочитанное"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await configure_db_connection(db)
-        
+    async with db_connection() as db:
         # Просто обновляем уведомление для заказа (независимо от менеджера)
         await db.execute('''
             UPDATE order_notifications 
             SET is_read = 1, updated_at = datetime('now')
             WHERE order_id = ?
         ''', (order_id,))
+        await record_order_event(db, order_id, 'notification')
         
         await db.commit()
+    notify_order_events()
 
 async def get_order_notifications(manager_id: int = None) -> List[Dict]:
     """Получает уведомления для менеджера или все уведомления (для супер-админа)"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await configure_db_connection(db)
-        
+    async with db_connection(readonly=True) as db:
         if manager_id:
             # Получаем уведомления только для конкретного менеджера
             async with db.execute('''
@@ -6165,9 +7040,7 @@ async def get_order_notifications(manager_id: int = None) -> List[Dict]:
 
 async def get_notification_by_order_id(order_id: int) -> Dict:
     """Получает уведомление по ID заказа"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await configure_db_connection(db)
-        
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT * FROM order_notifications WHERE order_id = ?
         ''', (order_id,)) as cursor:
@@ -6178,9 +7051,7 @@ async def get_notification_by_order_id(order_id: int) -> Dict:
 
 async def create_notifications_for_all_orders():
     """Создает уведомления для всех заказов"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await configure_db_connection(db)
-        
+    async with db_connection() as db:
         # Находим все заказы
         async with db.execute('''
             SELECT id, assigned_manager_id 
@@ -6208,9 +7079,7 @@ async def create_notifications_for_all_orders():
 
 async def get_order_notifications_v2(manager_id: int = None) -> List[Dict]:
     """Получает уведомления для менеджера или все уведомления (для супер-админа)"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await configure_db_connection(db)
-        
+    async with db_connection(readonly=True) as db:
         if manager_id:
             # Получаем уведомления только для конкретного менеджера
             async with db.execute('''
@@ -6240,9 +7109,7 @@ async def get_order_notifications_v2(manager_id: int = None) -> List[Dict]:
 
 async def get_notification_by_order_id(order_id: int) -> Dict:
     """Получает уведомление по ID заказа"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await configure_db_connection(db)
-        
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT * FROM order_notifications WHERE order_id = ?
         ''', (order_id,)) as cursor:
@@ -6252,9 +7119,7 @@ async def get_notification_by_order_id(order_id: int) -> Dict:
             return None
 async def create_notifications_for_all_orders():
     """Создает уведомления для всех заказов"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await configure_db_connection(db)
-        
+    async with db_connection() as db:
         # Находим все заказы
         async with db.execute('''
             SELECT id, assigned_manager_id 
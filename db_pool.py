@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+"""
+Пул соединений SQLite на весь процесс.
+
+Одно соединение на запись и несколько соединений на чтение открываются один раз,
+сразу настраиваются PRAGMA (WAL, mmap и т.д.) и переиспользуются всеми функциями db.py
+вместо aiosqlite.connect() на каждый вызов.
+
+Соединением на запись владеет отдельная задача-писатель: запросы на запись становятся
+в asyncio-очередь и применяются пачками в одной транзакции (group commit) —
+один COMMIT на DB_WRITE_BATCH_SIZE операций или на DB_WRITE_BATCH_WINDOW_MS миллисекунд.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+# Количество соединений на чтение (соединение на запись всегда одно)
+DB_POOL_READERS = int(os.getenv('DB_POOL_READERS', '4'))
+
+# Максимум операций записи в одной транзакции
+DB_WRITE_BATCH_SIZE = int(os.getenv('DB_WRITE_BATCH_SIZE', '64'))
+
+# Сколько миллисекунд транзакция ждет следующие операции записи перед COMMIT
+DB_WRITE_BATCH_WINDOW_MS = float(os.getenv('DB_WRITE_BATCH_WINDOW_MS', '2'))
+
+
+def _py_lower(value):
+    """lower() для SQL с поддержкой кириллицы (встроенный lower() SQLite понимает только ASCII)"""
+    return value.lower() if isinstance(value, str) else value
+
+
+async def configure_db_connection(db):
+    """Настраивает соединение с базой данных для лучшей производительности"""
+    await db.execute('PRAGMA journal_mode=WAL')
+    await db.execute('PRAGMA synchronous=NORMAL')
+    await db.execute('PRAGMA cache_size=10000')
+    await db.execute('PRAGMA temp_store=MEMORY')
+    await db.execute('PRAGMA mmap_size=268435456')  # 256MB
+    await db.execute('PRAGMA busy_timeout=30000')  # 30 секунд таймаут
+    await db.create_function('py_lower', 1, _py_lower, deterministic=True)
+
+
+def _resolve(future: asyncio.Future, result=None, error: Optional[BaseException] = None):
+    """Завершает future, если его еще никто не завершил и не отменил"""
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class _PoolCounters:
+    """Счетчики выдачи соединений одного вида (writer/reader)"""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.waits = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.hold_time_total = 0.0
+        self.hold_time_max = 0.0
+
+    def as_dict(self) -> Dict:
+        return {
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'in_use': self.in_use,
+            'waiting': self.waiting,
+            'wait_time_total_ms': round(self.wait_time_total * 1000, 3),
+            'wait_time_max_ms': round(self.wait_time_max * 1000, 3),
+            'wait_time_avg_ms': round(self.wait_time_total * 1000 / self.checkouts, 3) if self.checkouts else 0.0,
+            'hold_time_total_ms': round(self.hold_time_total * 1000, 3),
+            'hold_time_max_ms': round(self.hold_time_max * 1000, 3),
+            'hold_time_avg_ms': round(self.hold_time_total * 1000 / self.checkouts, 3) if self.checkouts else 0.0,
+        }
+
+
+class _BatchCounters:
+    """Счетчики пакетной записи"""
+
+    def __init__(self):
+        self.batches = 0
+        self.operations = 0
+        self.failed_operations = 0
+        self.failed_batches = 0
+        self.max_batch = 0
+        self.commit_time_total = 0.0
+        self.commit_time_max = 0.0
+
+    def as_dict(self) -> Dict:
+        return {
+            'batches': self.batches,
+            'operations': self.operations,
+            'failed_operations': self.failed_operations,
+            'failed_batches': self.failed_batches,
+            'avg_batch': round(self.operations / self.batches, 2) if self.batches else 0.0,
+            'max_batch': self.max_batch,
+            'commit_time_total_ms': round(self.commit_time_total * 1000, 3),
+            'commit_time_max_ms': round(self.commit_time_max * 1000, 3),
+        }
+
+
+class _Checkout:
+    """Соединение, выданное задаче (для повторного входа из вложенных вызовов)"""
+
+    __slots__ = ('conn', 'kind')
+
+    def __init__(self, conn, kind: str):
+        self.conn = conn
+        self.kind = kind
+
+
+class _WriteRequest:
+    """
+    Операция записи в очереди писателя.
+
+    Либо op — корутина op(db), которую писатель выполняет сам, либо «слот»:
+    писатель выдает соединение через granted и ждет, пока вызывающий закончит блок (done).
+    """
+
+    __slots__ = ('op', 'granted', 'done', 'committed', 'result', 'error')
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, op=None):
+        self.op = op
+        self.granted = loop.create_future()
+        self.done = loop.create_future()
+        self.committed = loop.create_future()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class _BatchConnection:
+    """
+    Соединение на запись внутри пакетной транзакции.
+
+    Каждая операция выполняется в своей точке сохранения: commit() фиксирует сделанное
+    до этого момента внутри пакета, rollback() откатывает к последней фиксации.
+    Настоящий COMMIT делает писатель один раз на весь пакет.
+    """
+
+    _SAVEPOINT = 'write_op'
+
+    def __init__(self, conn):
+        object.__setattr__(self, '_conn', conn)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    async def commit(self):
+        await self._conn.execute(f'RELEASE {self._SAVEPOINT}')
+        await self._conn.execute(f'SAVEPOINT {self._SAVEPOINT}')
+
+    async def rollback(self):
+        await self._conn.execute(f'ROLLBACK TO {self._SAVEPOINT}')
+
+
+class SQLitePool:
+    """
+    Пул соединений SQLite: одно соединение на запись и readers соединений на чтение.
+
+    Соединения открываются лениво и живут до close(). Выдача повторно входима в рамках
+    одной asyncio-задачи: если функция db.py, держащая соединение, вызывает другую
+    функцию db.py, вложенный вызов получает то же соединение, а не ждет само себя.
+    """
+
+    def __init__(self, path: str, readers: int = DB_POOL_READERS,
+                 batch_size: int = DB_WRITE_BATCH_SIZE, batch_window_ms: float = DB_WRITE_BATCH_WINDOW_MS):
+        self.path = path
+        self.readers = max(1, readers)
+        self.batch_size = max(1, batch_size)
+        self.batch_window = max(0.0, batch_window_ms) / 1000
+        self.loop = asyncio.get_running_loop()
+        self._writer = None
+        self._writer_task: Optional[asyncio.Task] = None
+        self._write_queue: asyncio.Queue = asyncio.Queue()
+        self._idle_readers: asyncio.Queue = asyncio.Queue()
+        self._opened_readers = 0
+        self._all: List = []
+        self._held: Dict[asyncio.Task, List[_Checkout]] = {}
+        self._counters = {'writer': _PoolCounters(), 'reader': _PoolCounters()}
+        self._batch_counters = _BatchCounters()
+        self._closed = False
+
+    async def _open_connection(self):
+        conn = aiosqlite.connect(self.path)
+        # Рабочий поток соединения не должен мешать завершению процесса
+        thread = getattr(conn, '_thread', conn)
+        thread.daemon = True
+        await conn
+        await configure_db_connection(conn)
+        self._all.append(conn)
+        return conn
+
+    async def _get_reader(self):
+        if self._idle_readers.empty() and self._opened_readers < self.readers:
+            self._opened_readers += 1
+            try:
+                return await self._open_connection()
+            except Exception:
+                self._opened_readers -= 1
+                raise
+        return await self._idle_readers.get()
+
+    def _ensure_writer_task(self):
+        if self._writer_task is None or self._writer_task.done():
+            self._writer_task = self.loop.create_task(self._writer_loop())
+
+    # --- Задача-писатель ---
+
+    async def _writer_loop(self):
+        """Берет операции записи из очереди и применяет их пакетами в одной транзакции"""
+        while True:
+            request = await self._write_queue.get()
+            if request is None:
+                return
+            try:
+                if self._writer is None:
+                    self._writer = await self._open_connection()
+                await self._writer.execute('BEGIN IMMEDIATE')
+            except Exception as e:
+                logger.error(f"❌ Не удалось начать транзакцию записи: {e}")
+                self._fail_request(request, e)
+                continue
+
+            batch = []
+            started = self.loop.time()
+            stopping = False
+            while request is not None:
+                await self._apply(request)
+                batch.append(request)
+                request = None
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    request = self._write_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    remaining = self.batch_window - (self.loop.time() - started)
+                    if remaining <= 0:
+                        break
+                    try:
+                        request = await asyncio.wait_for(self._write_queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                if request is None:
+                    stopping = True
+
+            await self._commit_batch(batch)
+            if stopping:
+                return
+
+    async def _apply(self, request: _WriteRequest):
+        """Выполняет одну операцию пакета в собственной точке сохранения"""
+        conn = self._writer
+        proxy = _BatchConnection(conn)
+        try:
+            await conn.execute(f'SAVEPOINT {_BatchConnection._SAVEPOINT}')
+        except Exception as e:
+            request.error = e
+            _resolve(request.granted, error=e)
+            return
+
+        if request.op is not None:
+            task = asyncio.current_task()
+            checkout = _Checkout(proxy, 'writer')
+            self._held.setdefault(task, []).append(checkout)
+            try:
+                request.result = await request.op(proxy)
+            except Exception as e:
+                request.error = e
+            finally:
+                stack = self._held.get(task)
+                stack.remove(checkout)
+                if not stack:
+                    del self._held[task]
+        elif request.granted.done():
+            # Вызывающий перестал ждать (задача отменена) — слот пропускаем
+            request.error = asyncio.CancelledError()
+        else:
+            request.granted.set_result(proxy)
+            request.error = await request.done
+
+        try:
+            if request.error is not None:
+                await conn.execute(f'ROLLBACK TO {_BatchConnection._SAVEPOINT}')
+                self._batch_counters.failed_operations += 1
+            await conn.execute(f'RELEASE {_BatchConnection._SAVEPOINT}')
+        except Exception as e:
+            logger.error(f"❌ Ошибка завершения операции записи: {e}")
+        conn.row_factory = None
+
+    async def _commit_batch(self, batch: List[_WriteRequest]):
+        counters = self._batch_counters
+        started = time.perf_counter()
+        error = None
+        try:
+            await self._writer.commit()
+        except Exception as e:
+            error = e
+            counters.failed_batches += 1
+            logger.error(f"❌ Ошибка фиксации пакета из {len(batch)} операций записи: {e}")
+            try:
+                await self._writer.rollback()
+            except Exception:
+                pass
+        commit_time = time.perf_counter() - started
+        counters.batches += 1
+        counters.operations += len(batch)
+        counters.max_batch = max(counters.max_batch, len(batch))
+        counters.commit_time_total += commit_time
+        counters.commit_time_max = max(counters.commit_time_max, commit_time)
+        for request in batch:
+            _resolve(request.committed, request.result, error)
+
+    @staticmethod
+    def _fail_request(request: _WriteRequest, error: BaseException):
+        _resolve(request.granted, error=error)
+        _resolve(request.committed, error=error)
+
+    # --- Выдача соединений ---
+
+    @staticmethod
+    def _find_held(stack: List[_Checkout], readonly: bool) -> Optional[_Checkout]:
+        # Для записи подходит только уже взятое соединение на запись,
+        # для чтения — любое (соединение на запись видит свои незакоммиченные изменения)
+        for checkout in reversed(stack):
+            if checkout.kind == 'writer':
+                return checkout
+        if readonly and stack:
+            return stack[-1]
+        return None
+
+    def holds_connection(self) -> bool:
+        """Держит ли текущая задача соединение из пула"""
+        return asyncio.current_task() in self._held
+
+    async def run_write(self, op):
+        """
+        Ставит операцию op(db) в очередь писателя и возвращает ее результат
+        после фиксации пакета, в который она попала.
+        """
+        if self._closed:
+            raise RuntimeError('Пул соединений SQLite закрыт')
+        stack = self._held.get(asyncio.current_task())
+        held = self._find_held(stack, False) if stack else None
+        if held is not None:
+            return await op(held.conn)
+
+        request = _WriteRequest(self.loop, op)
+        self._ensure_writer_task()
+        self._write_queue.put_nowait(request)
+        await request.committed
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    @asynccontextmanager
+    async def connection(self, readonly: bool = False):
+        """Выдает соединение из пула: readonly=True — на чтение, иначе — слот в очереди писателя"""
+        if self._closed:
+            raise RuntimeError('Пул соединений SQLite закрыт')
+
+        task = asyncio.current_task()
+        stack = self._held.get(task)
+        held = self._find_held(stack, readonly) if stack else None
+        if held is not None:
+            # Вложенный вызов из той же задачи — отдаем то же соединение
+            row_factory = held.conn.row_factory
+            try:
+                yield held.conn
+            finally:
+                held.conn.row_factory = row_factory
+            return
+
+        kind = 'reader' if readonly else 'writer'
+        counters = self._counters[kind]
+        started = time.perf_counter()
+        request = None
+        counters.waiting += 1
+        try:
+            if readonly:
+                conn = await self._get_reader()
+            else:
+                request = _WriteRequest(self.loop)
+                self._ensure_writer_task()
+                self._write_queue.put_nowait(request)
+                try:
+                    conn = await request.granted
+                except asyncio.CancelledError:
+                    if request.granted.done() and not request.granted.cancelled():
+                        _resolve(request.done, asyncio.CancelledError())
+                    raise
+        finally:
+            counters.waiting -= 1
+
+        checked_out = time.perf_counter()
+        wait_time = checked_out - started
+        counters.checkouts += 1
+        counters.in_use += 1
+        counters.wait_time_total += wait_time
+        counters.wait_time_max = max(counters.wait_time_max, wait_time)
+        if wait_time > 0.001:
+            counters.waits += 1
+
+        checkout = _Checkout(conn, kind)
+        self._held.setdefault(task, []).append(checkout)
+        error = None
+        try:
+            yield conn
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            stack = self._held.get(task)
+            if stack:
+                stack.remove(checkout)
+                if not stack:
+                    del self._held[task]
+            hold_time = time.perf_counter() - checked_out
+            counters.in_use -= 1
+            counters.hold_time_total += hold_time
+            counters.hold_time_max = max(counters.hold_time_max, hold_time)
+            if readonly:
+                self._release_reader(conn)
+            else:
+                _resolve(request.done, error)
+                if error is None:
+                    # Выходим из блока только после COMMIT пакета: дальше изменения видны всем
+                    await request.committed
+
+    def _release_reader(self, conn):
+        conn.row_factory = None
+        self._idle_readers.put_nowait(conn)
+
+    def stats(self) -> Dict:
+        """Возвращает размер пула, счетчики ожидания/удержания соединений и пакетной записи"""
+        return {
+            'path': self.path,
+            'size': {'writer': 1, 'readers': self.readers},
+            'opened': {'writer': 1 if self._writer is not None else 0, 'readers': self._opened_readers},
+            'idle_readers': self._idle_readers.qsize(),
+            'write_queue': self._write_queue.qsize(),
+            'writer': self._counters['writer'].as_dict(),
+            'reader': self._counters['reader'].as_dict(),
+            'batches': self._batch_counters.as_dict(),
+        }
+
+    async def close(self):
+        """Дожидается записи очереди и закрывает все соединения пула"""
+        self._closed = True
+        if self._writer_task is not None and not self._writer_task.done():
+            self._write_queue.put_nowait(None)
+            try:
+                await self._writer_task
+            except Exception as e:
+                logger.error(f"❌ Ошибка остановки писателя: {e}")
+        for conn in self._all:
+            try:
+                await conn.close()
+            except Exception as e:
+                logger.error(f"❌ Ошибка закрытия соединения пула: {e}")
+        self._all.clear()
+        self._writer = None
+
+
+_pools: Dict[str, SQLitePool] = {}
+
+
+def get_pool(path: str) -> SQLitePool:
+    """Возвращает пул для файла базы данных, создавая его в текущем цикле событий"""
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(path)
+    if pool is None or pool.loop is not loop or pool._closed:
+        if pool is not None and not pool._closed:
+            # Цикл событий сменился (например, повторный asyncio.run в скрипте) —
+            # старые соединения привязаны к завершенному циклу, просто останавливаем их потоки
+            for conn in pool._all:
+                conn.stop()
+        pool = SQLitePool(path)
+        _pools[path] = pool
+    return pool
+
+
+def get_pool_stats() -> Dict:
+    """Статистика по всем открытым пулам"""
+    return {path: pool.stats() for path, pool in _pools.items()}
+
+
+async def close_pools():
+    """Закрывает все пулы текущего процесса"""
+    for path in list(_pools):
+        pool = _pools.pop(path)
+        if pool.loop is asyncio.get_running_loop():
+            await pool.close()
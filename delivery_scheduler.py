@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Планировщик доставки сообщений в Telegram.
+
+Отправки (задачи outbox, сообщения по таймерам, напоминания об оплате) выполняются
+параллельно для разных пользователей, но строго по порядку для одного пользователя:
+у каждого чата своя очередь и свой обработчик.
+
+Лимиты Telegram соблюдаются двумя корзинами токенов — общей на бота и отдельной на чат.
+Ответ RetryAfter (flood control) не считается ошибкой: чат ставится на паузу, запрос
+повторяется после указанной паузы, а задача не тратит попытку из retry_count.
+"""
+
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Сколько пользователей обслуживается одновременно
+DELIVERY_MAX_CONCURRENCY = int(os.getenv('DELIVERY_MAX_CONCURRENCY', '16'))
+
+# Общий лимит бота (Telegram допускает около 30 сообщений в секунду, оставляем запас на ответы в диалогах)
+DELIVERY_GLOBAL_RATE = float(os.getenv('DELIVERY_GLOBAL_RATE', '25'))
+
+# Лимит на один чат: около одного сообщения в секунду с небольшим запасом на всплеск
+DELIVERY_CHAT_RATE = float(os.getenv('DELIVERY_CHAT_RATE', '1'))
+DELIVERY_CHAT_BURST = float(os.getenv('DELIVERY_CHAT_BURST', '3'))
+
+# Сколько раз повторять запрос после RetryAfter, прежде чем вернуть ошибку вызывающему
+DELIVERY_MAX_FLOOD_RETRIES = int(os.getenv('DELIVERY_MAX_FLOOD_RETRIES', '3'))
+
+# Неактивные корзины чатов удаляются, чтобы словарь не рос бесконечно
+_CHAT_BUCKET_TTL = 600
+
+# Чат, для которого сейчас выполняется задача планировщика (None — обычный обработчик бота)
+_delivery_chat: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar('delivery_chat', default=None)
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens: float = 1.0):
+        """Ждет, пока в корзине наберется tokens токенов, и забирает их"""
+        tokens = min(tokens, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Не выдает токены seconds секунд (после RetryAfter от Telegram)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class _DeliveryCounters:
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.flood_waits = 0
+        self.flood_wait_time = 0.0
+
+    def as_dict(self) -> Dict:
+        return {
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'flood_waits': self.flood_waits,
+            'flood_wait_time_s': round(self.flood_wait_time, 1),
+        }
+
+
+class DeliveryScheduler:
+    """Очереди отправки по чатам с общим ограничением параллельности и лимитами Telegram"""
+
+    def __init__(
+        self,
+        max_concurrency: int = DELIVERY_MAX_CONCURRENCY,
+        global_rate: float = DELIVERY_GLOBAL_RATE,
+        chat_rate: float = DELIVERY_CHAT_RATE,
+        chat_burst: float = DELIVERY_CHAT_BURST,
+    ):
+        self.max_concurrency = max_concurrency
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._queues: Dict[int, Deque[Tuple[Callable[[], Awaitable[Any]], asyncio.Future]]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._counters = _DeliveryCounters()
+
+    def submit(self, chat_id: int, job: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        """
+        Ставит job (функцию без аргументов, возвращающую корутину) в очередь чата.
+        Возвращает future с результатом job; задачи одного чата выполняются по порядку.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queues.setdefault(chat_id, deque()).append((job, future))
+        self._counters.submitted += 1
+        if chat_id not in self._workers:
+            self._workers[chat_id] = loop.create_task(self._chat_worker(chat_id))
+        return future
+
+    async def run(self, chat_id: int, job: Callable[[], Awaitable[Any]]) -> Any:
+        """Выполняет job в очереди чата и возвращает результат (исключения пробрасываются)"""
+        return await self.submit(chat_id, job)
+
+    async def _chat_worker(self, chat_id: int):
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                job, future = queue.popleft()
+                if future.cancelled():
+                    continue
+                async with self._semaphore:
+                    token = _delivery_chat.set(chat_id)
+                    try:
+                        result = await job()
+                    except asyncio.CancelledError:
+                        future.cancel()
+                        raise
+                    except Exception as e:
+                        self._counters.failed += 1
+                        if not future.done():
+                            future.set_exception(e)
+                    else:
+                        self._counters.completed += 1
+                        if not future.done():
+                            future.set_result(result)
+                    finally:
+                        _delivery_chat.reset(token)
+        finally:
+            del self._workers[chat_id]
+            if not queue:
+                del self._queues[chat_id]
+            self._drop_idle_buckets()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _drop_idle_buckets(self):
+        now = time.monotonic()
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if chat_id not in self._workers and now - bucket.updated > _CHAT_BUCKET_TTL and now > bucket.paused_until:
+                del self._chat_buckets[chat_id]
+
+    async def throttle(self, chat_id: Optional[int], tokens: float = 1.0):
+        """Ждет свободные токены в корзине чата и в общей корзине бота"""
+        if chat_id is not None:
+            await self._chat_bucket(chat_id).acquire(tokens)
+        await self._global_bucket.acquire(tokens)
+
+    def flood_wait(self, chat_id: Optional[int], seconds: float):
+        """Ставит чат на паузу после RetryAfter"""
+        self._counters.flood_waits += 1
+        self._counters.flood_wait_time += seconds
+        if chat_id is not None:
+            self._chat_bucket(chat_id).pause(seconds)
+
+    def stats(self) -> Dict:
+        """Возвращает размер очередей и счетчики доставки"""
+        return {
+            'max_concurrency': self.max_concurrency,
+            'active_chats': len(self._workers),
+            'queued': sum(len(queue) for queue in self._queues.values()),
+            **self._counters.as_dict(),
+        }
+
+
+def _method_chat_id(method) -> Optional[int]:
+    chat_id = getattr(method, 'chat_id', None)
+    return chat_id if isinstance(chat_id, int) else None
+
+
+def _method_cost(method) -> float:
+    # Медиагруппа расходует лимит как отдельные сообщения
+    media = getattr(method, 'media', None)
+    return float(len(media)) if isinstance(media, list) else 1.0
+
+
+class DeliveryRateLimitMiddleware(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: запросы из задач планировщика проходят через корзины токенов,
+    а на RetryAfter чат ставится на паузу и запрос повторяется.
+    Запросы обработчиков диалога проходят как раньше.
+    """
+
+    def __init__(self, scheduler: DeliveryScheduler, max_flood_retries: int = DELIVERY_MAX_FLOOD_RETRIES):
+        self.scheduler = scheduler
+        self.max_flood_retries = max_flood_retries
+
+    async def __call__(self, make_request, bot, method):
+        delivery_chat = _delivery_chat.get()
+        if delivery_chat is None:
+            return await make_request(bot, method)
+
+        chat_id = _method_chat_id(method)
+        if chat_id is None:
+            # getFile, getChat без chat_id и т.п. — лимиты на сообщения к ним не относятся
+            return await make_request(bot, method)
+
+        attempt = 0
+        while True:
+            await self.scheduler.throttle(chat_id, _method_cost(method))
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.scheduler.flood_wait(chat_id, e.retry_after)
+                attempt += 1
+                if attempt > self.max_flood_retries:
+                    raise
+                logger.warning(f"⏳ Flood control для чата {chat_id}: повтор {attempt}/{self.max_flood_retries} через {e.retry_after} с")
+
+
+delivery_scheduler = DeliveryScheduler()
+
+
+def setup_delivery(bot) -> DeliveryScheduler:
+    """Подключает лимиты планировщика к сессии бота"""
+    bot.session.middleware(DeliveryRateLimitMiddleware(delivery_scheduler))
+    return delivery_scheduler
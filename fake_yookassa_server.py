@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Локальный фейковый сервер ЮKassa для проверки платежей без реального API.
+
+Запуск:
+    python fake_yookassa_server.py            # http://127.0.0.1:8765/v3
+    YOOKASSA_API_URL=http://127.0.0.1:8765/v3 python bot.py
+
+Поддерживает создание и получение платежей и создание возвратов; повторный запрос
+с тем же заголовком Idempotence-Key возвращает уже созданный платеж, как настоящая ЮKassa. Платеж можно
+перевести в succeeded запросом POST /fake/payments/{id}/succeed или сразу создавать
+успешными (FAKE_YOOKASSA_AUTO_SUCCEED=true). FAKE_YOOKASSA_DELAY добавляет задержку
+к каждому ответу, чтобы проверить таймауты и гистограммы payment_gateway.
+"""
+
+import asyncio
+import os
+import uuid
+from datetime import datetime, timezone
+from typing import Dict
+
+from fastapi import FastAPI, HTTPException, Request
+
+FAKE_YOOKASSA_HOST = os.getenv('FAKE_YOOKASSA_HOST', '127.0.0.1')
+FAKE_YOOKASSA_PORT = int(os.getenv('FAKE_YOOKASSA_PORT', '8765'))
+FAKE_YOOKASSA_DELAY = float(os.getenv('FAKE_YOOKASSA_DELAY', '0'))
+FAKE_YOOKASSA_AUTO_SUCCEED = os.getenv('FAKE_YOOKASSA_AUTO_SUCCEED', 'false').lower() == 'true'
+
+app = FastAPI(title="Fake YooKassa")
+
+payments: Dict[str, Dict] = {}
+payment_ids_by_idempotence_key: Dict[str, str] = {}
+refunds: Dict[str, Dict] = {}
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+async def _delay():
+    if FAKE_YOOKASSA_DELAY:
+        await asyncio.sleep(FAKE_YOOKASSA_DELAY)
+
+
+def _succeed(payment: Dict):
+    payment.update({'status': 'succeeded', 'paid': True, 'captured_at': _now()})
+
+
+@app.post("/v3/payments")
+async def create_payment(request: Request):
+    idempotence_key = request.headers.get('Idempotence-Key')
+    if idempotence_key in payment_ids_by_idempotence_key:
+        await _delay()
+        return payments[payment_ids_by_idempotence_key[idempotence_key]]
+    body = await request.json()
+    payment_id = str(uuid.uuid4())
+    payment = {
+        'id': payment_id,
+        'status': 'pending',
+        'paid': False,
+        'amount': body['amount'],
+        'description': body.get('description'),
+        'metadata': body.get('metadata', {}),
+        'confirmation': {
+            'type': 'redirect',
+            'confirmation_url': f"http://{FAKE_YOOKASSA_HOST}:{FAKE_YOOKASSA_PORT}/fake/checkout/{payment_id}",
+        },
+        'created_at': _now(),
+        'test': True,
+        'refundable': False,
+        'recipient': {'account_id': '0', 'gateway_id': '0'},
+    }
+    if FAKE_YOOKASSA_AUTO_SUCCEED:
+        _succeed(payment)
+    payments[payment_id] = payment
+    if idempotence_key:
+        payment_ids_by_idempotence_key[idempotence_key] = payment_id
+    # Задержка после создания: клиент может не дождаться ответа, а платеж уже есть
+    await _delay()
+    return payment
+
+
+@app.get("/v3/payments/{payment_id}")
+async def get_payment(payment_id: str):
+    await _delay()
+    payment = payments.get(payment_id)
+    if payment is None:
+        raise HTTPException(status_code=404, detail={'type': 'error', 'code': 'not_found'})
+    return payment
+
+
+@app.post("/v3/refunds")
+async def create_refund(request: Request):
+    await _delay()
+    body = await request.json()
+    payment = payments.get(body.get('payment_id'))
+    if payment is None or payment['status'] != 'succeeded':
+        raise HTTPException(status_code=400, detail={'type': 'error', 'code': 'invalid_request'})
+    refund_id = str(uuid.uuid4())
+    refund = {
+        'id': refund_id,
+        'payment_id': payment['id'],
+        'status': 'succeeded',
+        'amount': body['amount'],
+        'created_at': _now(),
+    }
+    refunds[refund_id] = refund
+    return refund
+
+
+@app.post("/fake/payments/{payment_id}/succeed")
+async def succeed_payment(payment_id: str):
+    payment = payments.get(payment_id)
+    if payment is None:
+        raise HTTPException(status_code=404, detail="Платеж не найден")
+    _succeed(payment)
+    return payment
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host=FAKE_YOOKASSA_HOST, port=FAKE_YOOKASSA_PORT)
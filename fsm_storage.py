@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Хранилище состояний FSM бота.
+
+MemoryStorage теряет все незавершенные диалоги при перезапуске. SQLiteStorage хранит
+состояние и данные в таблице fsm_storage общей базы, но обработчики работают с
+памятью: перед базой стоит LRU-кэш, а изменения записываются пачкой в фоне
+(write-behind) не реже чем раз в FSM_FLUSH_INTERVAL секунд и при остановке бота.
+
+LRU-кэш рассчитан на один процесс бота. Для нескольких процессов укажите
+FSM_STORAGE=redis и FSM_REDIS_URL — тогда используется RedisStorage из aiogram
+(нужен пакет redis).
+"""
+
+import asyncio
+import json
+import logging
+import os
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from db import db_connection, run_write
+
+logger = logging.getLogger(__name__)
+
+# sqlite (по умолчанию), redis или memory
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite')
+FSM_REDIS_URL = os.getenv('FSM_REDIS_URL', 'redis://localhost:6379/0')
+
+# Сколько пользователей держать в памяти
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', '10000'))
+
+# Задержка записи изменений в базу
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', '0.5'))
+
+_Record = Tuple[Optional[str], Dict[str, Any]]
+
+
+def _storage_key(key: StorageKey) -> str:
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+
+def _state_name(state: StateType) -> Optional[str]:
+    return state.state if isinstance(state, State) else state
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в SQLite с LRU-кэшем и отложенной пакетной записью"""
+
+    def __init__(self, cache_size: int = FSM_CACHE_SIZE, flush_interval: float = FSM_FLUSH_INTERVAL):
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self._cache: 'OrderedDict[str, _Record]' = OrderedDict()
+        # Изменения, еще не записанные в базу (из кэша не вытесняются до записи)
+        self._dirty: Dict[str, _Record] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    async def _load(self, key: str) -> _Record:
+        record = self._dirty.get(key)
+        if record is None:
+            record = self._cache.get(key)
+        if record is not None:
+            self._cache[key] = record
+            self._cache.move_to_end(key)
+            return record
+
+        async with db_connection(readonly=True) as db:
+            async with db.execute('SELECT state, data FROM fsm_storage WHERE key = ?', (key,)) as cursor:
+                row = await cursor.fetchone()
+
+        # Пока читали базу, обработчик мог изменить запись
+        record = self._dirty.get(key) or self._cache.get(key)
+        if record is None:
+            record = (row[0], json.loads(row[1]) if row and row[1] else {}) if row else (None, {})
+        self._remember(key, record)
+        return record
+
+    def _remember(self, key: str, record: _Record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        self._trim()
+
+    def _trim(self):
+        while len(self._cache) > self.cache_size:
+            oldest = next(iter(self._cache))
+            if oldest in self._dirty:
+                break
+            del self._cache[oldest]
+
+    def _store(self, key: str, record: _Record):
+        self._remember(key, record)
+        self._dirty[key] = record
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_interval)
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи состояний FSM: {e}")
+            # Изменения остались в _dirty, повторим позже
+            if self._dirty:
+                self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def flush(self):
+        """Записывает накопленные изменения в базу одной транзакцией"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            batch = self._dirty
+            self._dirty = {}
+
+            upserts = []
+            deletes = []
+            for key, (state, data) in batch.items():
+                if state is None and not data:
+                    deletes.append((key,))
+                else:
+                    upserts.append((key, state, json.dumps(data, ensure_ascii=False, default=str)))
+
+            async def _flush_operation(db):
+                if upserts:
+                    await db.executemany('''
+                        INSERT OR REPLACE INTO fsm_storage (key, state, data, updated_at)
+                        VALUES (?, ?, ?, datetime('now'))
+                    ''', upserts)
+                if deletes:
+                    await db.executemany('DELETE FROM fsm_storage WHERE key = ?', deletes)
+
+            try:
+                await run_write(_flush_operation)
+            except BaseException:
+                # Возвращаем непримененные изменения (в том числе при отмене), не затирая более свежие
+                for key, record in batch.items():
+                    self._dirty.setdefault(key, record)
+                raise
+            self._trim()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = _storage_key(key)
+        _, data = await self._load(storage_key)
+        self._store(storage_key, (_state_name(state), data))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(_storage_key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = _storage_key(key)
+        state, _ = await self._load(storage_key)
+        self._store(storage_key, (state, data.copy()))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(_storage_key(key))
+        return data.copy()
+
+    async def close(self) -> None:
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+
+
+def create_fsm_storage() -> BaseStorage:
+    """Создает хранилище FSM по настройке FSM_STORAGE"""
+    if FSM_STORAGE == 'memory':
+        return MemoryStorage()
+
+    if FSM_STORAGE == 'redis':
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+            return RedisStorage.from_url(FSM_REDIS_URL)
+        except ImportError:
+            logger.warning("⚠️ Пакет redis не установлен, состояния FSM хранятся в SQLite")
+
+    return SQLiteStorage()
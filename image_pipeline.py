@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Обработка загруженных фотографий: сжатие оригинала и миниатюры для админки.
+
+Декодирование, уменьшение и кодирование (PIL) выполняются в отдельном пуле потоков,
+поэтому загрузки не блокируют цикл событий бота и админки: на этих операциях PIL
+отпускает GIL, и потоки работают параллельно. Для каждой фотографии
+рядом с оригиналом, в папке .thumbs, сохраняются миниатюры THUMBNAIL_SIZES
+(WebP, если PIL его поддерживает, иначе JPEG): uploads/.thumbs/photo.jpg.256.webp.
+"""
+
+import asyncio
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Сколько потоков обрабатывают изображения
+IMAGE_PIPELINE_WORKERS = int(os.getenv('IMAGE_PIPELINE_WORKERS', '2'))
+
+# Размеры миниатюр по длинной стороне: 256 — сетка галереи, 1024 — просмотр
+THUMBNAIL_SIZES = (256, 1024)
+
+# Длинная сторона оригинала, до которой он уменьшается, если файл больше лимита
+MAX_ORIGINAL_SIDE = 4096
+
+THUMBNAIL_DIR = '.thumbs'
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp')
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=IMAGE_PIPELINE_WORKERS, thread_name_prefix='image')
+    return _executor
+
+
+def is_image_file(path: str) -> bool:
+    return path.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def _thumbnail_format() -> str:
+    try:
+        from PIL import features
+        return 'webp' if features.check('webp') else 'jpg'
+    except Exception:
+        return 'jpg'
+
+
+def thumbnail_path(image_path: str, size: int, thumbnail_format: str = None) -> str:
+    """Путь миниатюры size для image_path (в папке .thumbs рядом с файлом)"""
+    directory, filename = os.path.split(image_path)
+    return os.path.join(directory, THUMBNAIL_DIR, f"{filename}.{size}.{thumbnail_format or _thumbnail_format()}")
+
+
+def _thumbnail_is_fresh(image_path: str, thumb_path: str) -> bool:
+    try:
+        return os.path.getmtime(thumb_path) >= os.path.getmtime(image_path)
+    except OSError:
+        return False
+
+
+def _compress_original(img, image_path: str, max_size_mb: float, quality: int) -> Optional[str]:
+    """Сжимает оригинал, если он больше max_size_mb. Возвращает описание результата для лога"""
+    file_size = os.path.getsize(image_path) / (1024 * 1024)
+    if file_size <= max_size_mb:
+        return None
+
+    is_png = image_path.lower().endswith('.png')
+    if max(img.size) > MAX_ORIGINAL_SIDE:
+        img = img.copy()
+        img.thumbnail((MAX_ORIGINAL_SIDE, MAX_ORIGINAL_SIDE))
+
+    def _encode(q: int) -> bytes:
+        output = io.BytesIO()
+        if is_png:
+            img.save(output, format='PNG', optimize=True)
+        else:
+            img.convert('RGB').save(output, format='JPEG', quality=q, optimize=True, progressive=True)
+        return output.getvalue()
+
+    data = _encode(quality)
+    # После уменьшения обычно хватает одного кодирования; качество снижаем только для JPEG
+    while not is_png and len(data) > max_size_mb * 1024 * 1024 and quality > 30:
+        quality -= 15
+        data = _encode(quality)
+
+    if len(data) > max_size_mb * 1024 * 1024:
+        return f"не удалось сжать до {max_size_mb} МБ"
+
+    tmp_path = f"{image_path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, image_path)
+    return f"{file_size:.2f} МБ → {len(data) / (1024 * 1024):.2f} МБ (качество {quality})"
+
+
+def _make_thumbnails(img, image_path: str, sizes: Iterable[int], thumbnail_format: str) -> Dict[int, str]:
+    from PIL import ImageOps
+
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+
+    thumbnails = {}
+    # От большего к меньшему: каждая миниатюра строится из предыдущей
+    for size in sorted(sizes, reverse=True):
+        thumb_path = thumbnail_path(image_path, size, thumbnail_format)
+        if not _thumbnail_is_fresh(image_path, thumb_path):
+            os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+            img.thumbnail((size, size))
+            tmp_path = f"{thumb_path}.tmp"
+            if thumbnail_format == 'webp':
+                img.save(tmp_path, format='WEBP', quality=80, method=4)
+            else:
+                img.convert('RGB').save(tmp_path, format='JPEG', quality=80, optimize=True, progressive=True)
+            os.replace(tmp_path, thumb_path)
+        thumbnails[size] = thumb_path
+    return thumbnails
+
+
+def _process_image_sync(image_path: str, max_size_mb: Optional[float], quality: int, sizes: Iterable[int]) -> Dict:
+    """Выполняется в процессе пула: сжатие оригинала и миниатюры"""
+    from PIL import Image
+
+    result = {'compressed': None, 'thumbnails': {}}
+    with Image.open(image_path) as img:
+        img.load()
+        if max_size_mb is not None:
+            result['compressed'] = _compress_original(img, image_path, max_size_mb, quality)
+        if sizes:
+            result['thumbnails'] = _make_thumbnails(img, image_path, sizes, _thumbnail_format())
+    return result
+
+
+async def process_image(image_path: str, max_size_mb: Optional[float] = 5.0, quality: int = 85,
+                        sizes: Iterable[int] = THUMBNAIL_SIZES) -> Optional[Dict]:
+    """
+    Сжимает оригинал до max_size_mb (None — не трогать) и строит миниатюры sizes в пуле потоков.
+    Возвращает {'compressed': описание или None, 'thumbnails': {размер: путь}} или None при ошибке.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(
+            _get_executor(), _process_image_sync, image_path, max_size_mb, quality, tuple(sizes)
+        )
+    except ImportError:
+        logger.warning("⚠️ PIL не установлен, сжатие изображений недоступно")
+        return None
+    except Exception as e:
+        logger.error(f"❌ Ошибка обработки изображения {image_path}: {e}")
+        return None
+
+    if result['compressed']:
+        logger.info(f"📸 Изображение {image_path} сжато: {result['compressed']}")
+    return result
+
+
+def existing_thumbnail(image_path: str, size: int) -> Optional[str]:
+    """Путь актуальной миниатюры size или None, если ее еще нет"""
+    thumb_path = thumbnail_path(image_path, size)
+    return thumb_path if _thumbnail_is_fresh(image_path, thumb_path) else None
+
+
+def shutdown_image_pipeline():
+    """Останавливает пул потоков (при остановке процесса)"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Асинхронная обертка над SDK ЮKassa.
+
+SDK синхронный (requests), поэтому вызовы Payment.find_one/Payment.create/Refund.create
+выполняются в отдельном ограниченном пуле потоков и не блокируют цикл событий бота.
+У каждого вызова есть таймаут (YOOKASSA_TIMEOUT), а время ответов собирается
+в гистограммы по операциям (get_gateway_stats), которые процесс бота периодически
+пишет в лог (log_gateway_stats).
+
+YOOKASSA_API_URL позволяет направить SDK на локальный фейковый сервер
+(см. fake_yookassa_server.py) вместо https://api.yookassa.ru/v3.
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from yookassa import Payment, Refund
+
+logger = logging.getLogger(__name__)
+
+# Сколько запросов к ЮKassa выполняется одновременно
+YOOKASSA_MAX_WORKERS = int(os.getenv('YOOKASSA_MAX_WORKERS', '8'))
+
+# Таймаут одного вызова API, секунд
+YOOKASSA_TIMEOUT = float(os.getenv('YOOKASSA_TIMEOUT', '15'))
+
+# Ответы дольше этого порога логируются как медленные
+YOOKASSA_SLOW_CALL_SECONDS = 2.0
+
+# Как часто писать гистограммы в лог, секунд (0 — не писать)
+YOOKASSA_STATS_LOG_INTERVAL = float(os.getenv('YOOKASSA_STATS_LOG_INTERVAL', '600'))
+
+# Границы корзин гистограммы времени ответа, секунд
+_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class PaymentGatewayTimeout(Exception):
+    """ЮKassa не ответила за YOOKASSA_TIMEOUT секунд"""
+
+
+class LatencyHistogram:
+    """Гистограмма времени ответа одной операции"""
+
+    def __init__(self):
+        self.buckets = [0] * (len(_LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.errors = 0
+        self.timeouts = 0
+
+    def observe(self, seconds: float):
+        index = 0
+        while index < len(_LATENCY_BUCKETS) and seconds > _LATENCY_BUCKETS[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self) -> Dict:
+        labels = [f"le_{bound}s" for bound in _LATENCY_BUCKETS] + ['le_inf']
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total / self.count * 1000, 1) if self.count else 0,
+            'max_ms': round(self.max * 1000, 1),
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'buckets': dict(zip(labels, self.buckets)),
+        }
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_histograms: Dict[str, LatencyHistogram] = {}
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=YOOKASSA_MAX_WORKERS, thread_name_prefix='yookassa')
+    return _executor
+
+
+async def _call(operation: str, func: Callable, *args, timeout: float = None, **kwargs) -> Any:
+    """Выполняет синхронный вызов SDK в пуле потоков с таймаутом и замером времени"""
+    histogram = _histograms.setdefault(operation, LatencyHistogram())
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    try:
+        return await asyncio.wait_for(
+            loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs)),
+            timeout or YOOKASSA_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        histogram.timeouts += 1
+        raise PaymentGatewayTimeout(f"ЮKassa не ответила на {operation} за {timeout or YOOKASSA_TIMEOUT} с")
+    except Exception:
+        histogram.errors += 1
+        raise
+    finally:
+        elapsed = time.monotonic() - started
+        histogram.observe(elapsed)
+        if elapsed > YOOKASSA_SLOW_CALL_SECONDS:
+            logger.warning(f"🐢 Медленный ответ ЮKassa: {operation} за {elapsed:.1f} с")
+
+
+async def find_payment(payment_id: str, timeout: float = None):
+    """Payment.find_one без блокировки цикла событий"""
+    return await _call('payment.find_one', Payment.find_one, payment_id, timeout=timeout)
+
+
+async def create_payment_request(payment_request, idempotency_key: str = None, timeout: float = None):
+    """Payment.create без блокировки цикла событий"""
+    return await _call('payment.create', Payment.create, payment_request, idempotency_key, timeout=timeout)
+
+
+async def create_refund(payment_id: str, amount: float, currency: str = 'RUB', timeout: float = None):
+    """Refund.create без блокировки цикла событий"""
+    return await _call('refund.create', Refund.create, {
+        'payment_id': payment_id,
+        'amount': {
+            'value': str(amount),
+            'currency': currency
+        }
+    }, timeout=timeout)
+
+
+def get_gateway_stats() -> Dict:
+    """Гистограммы времени ответа ЮKassa по операциям"""
+    return {
+        'max_workers': YOOKASSA_MAX_WORKERS,
+        'timeout_s': YOOKASSA_TIMEOUT,
+        'operations': {name: histogram.as_dict() for name, histogram in _histograms.items()},
+    }
+
+
+async def log_gateway_stats(interval: float = YOOKASSA_STATS_LOG_INTERVAL):
+    """Фоновая задача: раз в interval секунд пишет get_gateway_stats() в лог, если были новые вызовы"""
+    if interval <= 0:
+        return
+    logged_calls = 0
+    while True:
+        await asyncio.sleep(interval)
+        calls = sum(histogram.count for histogram in _histograms.values())
+        if calls != logged_calls:
+            logged_calls = calls
+            logger.info(f"📊 Время ответа ЮKassa: {json.dumps(get_gateway_stats(), ensure_ascii=False)}")
+
+
+def shutdown_gateway():
+    """Останавливает пул потоков (при остановке процесса)"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Общий клиент Telegram Bot API для бота и админки.
+
+Один aiogram Bot на процесс с одной aiohttp-сессией (пул соединений к api.telegram.org
+переиспользуется всеми отправками и скачиваниями). Модуль не тянет за собой bot.py
+с его обработчиками и диспетчером, поэтому админка импортирует только его и
+запускается быстро.
+
+Middleware сессии (планировщик доставки, кэш file_id) подключает сам процесс бота.
+"""
+
+import os
+from typing import Optional
+
+import dotenv
+from aiogram import Bot
+
+dotenv.load_dotenv()
+
+# Сначала пробуем BOT_TOKEN (как в .env/docker-compose), затем TELEGRAM_BOT_TOKEN
+API_TOKEN = os.getenv('BOT_TOKEN') or os.getenv('TELEGRAM_BOT_TOKEN', 'ВАШ_ТОКЕН_БОТА')
+
+_bot: Optional[Bot] = None
+
+
+def get_bot() -> Bot:
+    """Bot процесса (создается при первом обращении)"""
+    global _bot
+    if _bot is None:
+        _bot = Bot(token=API_TOKEN)
+    return _bot
+
+
+async def close_bot():
+    """Закрывает HTTP-сессию бота (при остановке процесса)"""
+    global _bot
+    if _bot is not None:
+        await _bot.session.close()
+        _bot = None
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Кэш file_id Telegram для статических файлов.
+
+Обложки, стили книг, примеры голосов и вложения шаблонов одинаковы для всех
+пользователей, поэтому загружать их с диска при каждой отправке незачем. После первой
+загрузки Telegram возвращает file_id, который сохраняется в таблице telegram_file_ids
+и дальше отправляется вместо файла.
+
+Запись привязана к пути, mtime и размеру файла: если админ заменил файл, кэш не
+совпадет и файл загрузится заново. Кэшируются только файлы, явно помеченные
+CachedInputFile, — разовые загрузки пользователей в таблицу не попадают.
+"""
+
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+
+logger = logging.getLogger(__name__)
+
+# Поля методов отправки, в которых передается файл, и тип file_id для них
+_METHOD_FILE_FIELDS = ('photo', 'audio', 'video', 'animation', 'document', 'voice')
+
+# Ошибки Telegram, означающие, что сохраненный file_id больше не действителен.
+# Остальные BadRequest (чат не найден, длинная подпись, разметка) к кэшу отношения не имеют
+_STALE_FILE_ID_ERRORS = ('wrong file identifier', 'file reference', 'wrong remote file')
+
+
+def _is_stale_file_id_error(error: TelegramBadRequest) -> bool:
+    message = (error.message or '').lower()
+    return any(marker in message for marker in _STALE_FILE_ID_ERRORS)
+
+
+# Тип вложения InputMedia* для медиагрупп
+_INPUT_MEDIA_KINDS = {
+    'photo': 'photo',
+    'audio': 'audio',
+    'video': 'video',
+    'animation': 'animation',
+    'document': 'document',
+}
+
+
+class CachedInputFile(FSInputFile):
+    """FSInputFile, для которого file_id Telegram кэшируется между отправками"""
+
+
+_FileKey = Tuple[str, str]
+
+
+class TelegramFileCache:
+    """file_id по (путь, тип), действительные при совпадении mtime и размера файла"""
+
+    def __init__(self):
+        self._entries: Dict[_FileKey, Tuple[int, int, str]] = {}
+        self._loaded = False
+
+    async def _ensure_loaded(self):
+        if self._loaded:
+            return
+        from db import get_telegram_file_ids
+        try:
+            rows = await get_telegram_file_ids()
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось загрузить кэш file_id: {e}")
+            return
+        self._entries = {
+            (row['path'], row['kind']): (row['mtime_ns'], row['size'], row['file_id'])
+            for row in rows
+        }
+        self._loaded = True
+
+    @staticmethod
+    def _stat(path: str) -> Optional[Tuple[str, int, int]]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return os.path.abspath(path), st.st_mtime_ns, st.st_size
+
+    async def get(self, path: str, kind: str) -> Optional[str]:
+        """Возвращает file_id, если файл не менялся с момента загрузки"""
+        await self._ensure_loaded()
+        stat = self._stat(path)
+        if stat is None:
+            return None
+        abs_path, mtime_ns, size = stat
+        entry = self._entries.get((abs_path, kind))
+        if entry and entry[0] == mtime_ns and entry[1] == size:
+            return entry[2]
+        return None
+
+    async def put(self, path: str, kind: str, file_id: str):
+        stat = self._stat(path)
+        if stat is None:
+            return
+        abs_path, mtime_ns, size = stat
+        if self._entries.get((abs_path, kind)) == (mtime_ns, size, file_id):
+            return
+        self._entries[(abs_path, kind)] = (mtime_ns, size, file_id)
+        from db import save_telegram_file_id
+        try:
+            await save_telegram_file_id(abs_path, kind, mtime_ns, size, file_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось сохранить file_id для {path}: {e}")
+
+    async def discard(self, path: str, kind: str):
+        abs_path = os.path.abspath(path)
+        if self._entries.pop((abs_path, kind), None) is None:
+            return
+        from db import delete_telegram_file_id
+        try:
+            await delete_telegram_file_id(abs_path, kind)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось удалить file_id для {path}: {e}")
+
+
+def _message_file_id(message: Any, kind: str) -> Optional[str]:
+    """Достает file_id загруженного файла из ответа Telegram"""
+    if not isinstance(message, Message):
+        return None
+    if kind == 'photo':
+        return message.photo[-1].file_id if message.photo else None
+    # Telegram может вернуть файл под другим типом (например, gif как animation + document)
+    for attr in (kind, 'animation', 'video', 'audio', 'voice', 'document'):
+        media = getattr(message, attr, None)
+        if media is not None:
+            return media.file_id
+    return None
+
+
+class TelegramFileCacheMiddleware(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: подставляет сохраненный file_id вместо CachedInputFile,
+    а после загрузки запоминает file_id из ответа. Если Telegram отклонил
+    сохраненный file_id, запись удаляется и файл загружается заново.
+    """
+
+    def __init__(self, cache: TelegramFileCache):
+        self.cache = cache
+
+    async def _resolve(self, method, use_cache: bool = True) -> Tuple[Any, List[Tuple[int, str, str]], List[Tuple[str, str]]]:
+        """
+        Возвращает метод с подставленными file_id, список загружаемых файлов
+        (индекс в ответе, путь, тип) и список подставленных записей (путь, тип)
+        """
+        uploads: List[Tuple[int, str, str]] = []
+        substituted: List[Tuple[str, str]] = []
+
+        media = getattr(method, 'media', None)
+        if isinstance(media, list):
+            new_media = []
+            for index, item in enumerate(media):
+                input_file = getattr(item, 'media', None)
+                kind = _INPUT_MEDIA_KINDS.get(getattr(item, 'type', None))
+                if isinstance(input_file, CachedInputFile) and kind:
+                    file_id = await self.cache.get(input_file.path, kind) if use_cache else None
+                    if file_id:
+                        item = item.model_copy(update={'media': file_id})
+                        substituted.append((input_file.path, kind))
+                    else:
+                        uploads.append((index, input_file.path, kind))
+                new_media.append(item)
+            if substituted:
+                method = method.model_copy(update={'media': new_media})
+            return method, uploads, substituted
+
+        for field in _METHOD_FILE_FIELDS:
+            input_file = getattr(method, field, None)
+            if isinstance(input_file, CachedInputFile):
+                file_id = await self.cache.get(input_file.path, field) if use_cache else None
+                if file_id:
+                    method = method.model_copy(update={field: file_id})
+                    substituted.append((input_file.path, field))
+                else:
+                    uploads.append((0, input_file.path, field))
+                break
+        return method, uploads, substituted
+
+    async def __call__(self, make_request, bot, method):
+        resolved, uploads, substituted = await self._resolve(method)
+        if not uploads and not substituted:
+            return await make_request(bot, method)
+
+        try:
+            result = await make_request(bot, resolved)
+        except TelegramBadRequest as e:
+            if not substituted or not _is_stale_file_id_error(e):
+                raise
+            logger.warning(f"⚠️ Telegram отклонил сохраненный file_id ({e}), загружаем файлы заново")
+            for path, kind in substituted:
+                await self.cache.discard(path, kind)
+            resolved, uploads, substituted = await self._resolve(method, use_cache=False)
+            result = await make_request(bot, resolved)
+
+        messages = result if isinstance(result, list) else [result]
+        for index, path, kind in uploads:
+            if index < len(messages):
+                file_id = _message_file_id(messages[index], kind)
+                if file_id:
+                    await self.cache.put(path, kind, file_id)
+        return result
+
+
+telegram_file_cache = TelegramFileCache()
+
+
+def setup_file_cache(bot) -> TelegramFileCache:
+    """Подключает кэш file_id к сессии бота"""
+    bot.session.middleware(TelegramFileCacheMiddleware(telegram_file_cache))
+    return telegram_file_cache
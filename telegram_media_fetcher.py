@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Фоновая докачка файлов Telegram для /photo админки.
+
+Если файла нет в uploads, имя считается file_id Telegram и файл скачивается.
+Одновременные запросы одного файла ждут одну и ту же загрузку, загрузка идет
+в фоне (обрыв запроса галереи ее не отменяет) и пишет файл на диск потоково
+(aiogram пишет через aiofiles), а неудачи запоминаются на время, чтобы
+открытие галереи с битыми ссылками не превращалось в поток запросов к Telegram.
+
+Для скачивания используется общий Bot процесса из telegram_client (без диспетчера бота).
+"""
+
+import asyncio
+import logging
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict
+
+from aiogram.exceptions import TelegramBadRequest, TelegramNotFound
+
+from telegram_client import get_bot
+
+logger = logging.getLogger(__name__)
+
+# Сколько файлов скачивается одновременно
+TELEGRAM_FETCH_CONCURRENCY = int(os.getenv('TELEGRAM_FETCH_CONCURRENCY', '4'))
+
+# Таймаут скачивания одного файла, секунд
+TELEGRAM_FETCH_TIMEOUT = int(os.getenv('TELEGRAM_FETCH_TIMEOUT', '60'))
+
+# Сколько помнить, что file_id не скачивается: Telegram его не знает / временная ошибка
+TELEGRAM_FETCH_NEGATIVE_TTL = float(os.getenv('TELEGRAM_FETCH_NEGATIVE_TTL', '600'))
+TELEGRAM_FETCH_RETRY_TTL = float(os.getenv('TELEGRAM_FETCH_RETRY_TTL', '30'))
+
+_NEGATIVE_CACHE_SIZE = 10000
+
+# file_id Telegram — base64url без точек; имена обычных файлов (photo_1.jpg) в Telegram не отправляем
+_FILE_ID_RE = re.compile(r'^[A-Za-z0-9_-]{20,}$')
+
+
+def looks_like_file_id(name: str) -> bool:
+    return bool(_FILE_ID_RE.match(name))
+
+
+class TelegramMediaFetcher:
+    """Скачивание файлов Telegram с объединением одинаковых запросов и кэшем неудач"""
+
+    def __init__(self, concurrency: int = TELEGRAM_FETCH_CONCURRENCY):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._inflight: Dict[str, asyncio.Task] = {}
+        # file_id -> момент (monotonic), до которого не пытаться снова
+        self._failures: 'OrderedDict[str, float]' = OrderedDict()
+        self.downloads = 0
+        self.coalesced = 0
+        self.negative_hits = 0
+
+    def _remember_failure(self, file_id: str, ttl: float):
+        self._failures[file_id] = time.monotonic() + ttl
+        self._failures.move_to_end(file_id)
+        while len(self._failures) > _NEGATIVE_CACHE_SIZE:
+            self._failures.popitem(last=False)
+
+    def _recently_failed(self, file_id: str) -> bool:
+        expires_at = self._failures.get(file_id)
+        if expires_at is None:
+            return False
+        if expires_at > time.monotonic():
+            return True
+        del self._failures[file_id]
+        return False
+
+    async def fetch(self, file_id: str, dest_path: str) -> bool:
+        """
+        Скачивает файл file_id в dest_path (если его там еще нет).
+        True — файл на диске, False — скачать не удалось (или недавно не удавалось).
+        """
+        if os.path.isfile(dest_path):
+            return True
+        if not looks_like_file_id(file_id):
+            return False
+        if self._recently_failed(file_id):
+            self.negative_hits += 1
+            return False
+
+        task = self._inflight.get(dest_path)
+        if task is None:
+            task = asyncio.create_task(self._download(file_id, dest_path))
+            self._inflight[dest_path] = task
+            task.add_done_callback(lambda _: self._inflight.pop(dest_path, None))
+        else:
+            self.coalesced += 1
+        # Отмена запроса (клиент ушел) не отменяет общую загрузку
+        return await asyncio.shield(task)
+
+    async def _download(self, file_id: str, dest_path: str) -> bool:
+        tmp_path = f"{dest_path}.{uuid.uuid4().hex}.part"
+        async with self._semaphore:
+            try:
+                bot = get_bot()
+                file_info = await bot.get_file(file_id)
+                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                await bot.download_file(file_info.file_path, destination=tmp_path, timeout=TELEGRAM_FETCH_TIMEOUT)
+                os.replace(tmp_path, dest_path)
+                self.downloads += 1
+                logger.info(f"📥 Файл Telegram {file_id} сохранен: {dest_path}")
+                return True
+            except (TelegramBadRequest, TelegramNotFound) as e:
+                logger.warning(f"⚠️ Telegram не отдает файл {file_id}: {e}")
+                self._remember_failure(file_id, TELEGRAM_FETCH_NEGATIVE_TTL)
+                return False
+            except Exception as e:
+                logger.error(f"❌ Ошибка скачивания файла Telegram {file_id}: {e}")
+                self._remember_failure(file_id, TELEGRAM_FETCH_RETRY_TTL)
+                return False
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def stats(self) -> Dict:
+        return {
+            'inflight': len(self._inflight),
+            'downloads': self.downloads,
+            'coalesced': self.coalesced,
+            'negative_hits': self.negative_hits,
+            'negative_cached': len(self._failures),
+        }
+
+    async def close(self):
+        for task in list(self._inflight.values()):
+            task.cancel()
+
+
+telegram_media_fetcher = TelegramMediaFetcher()
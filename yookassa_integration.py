@@ -1,12 +1,17 @@
 import os
 import json
 import logging
+import asyncio
+import hashlib
+import time
+import uuid
+from types import MappingProxyType
 from typing import Dict, Optional, List
-from yookassa import Configuration, Payment
+from yookassa import Configuration
 from yookassa.domain.request import PaymentRequest
 from yookassa.domain.models import Amount, Receipt, ReceiptItem
-import aiosqlite
-from db import DB_PATH, update_order_status
+from db import db_connection, update_order_status
+from payment_gateway import find_payment, create_payment_request, create_refund
 
 # Принудительно загружаем .env файл
 try:
@@ -40,6 +45,12 @@ class YooKassaConfig:
         # Инициализация конфигурации ЮKassa
         Configuration.account_id = self.shop_id
         Configuration.secret_key = self.secret_key
+        
+        # Адрес API можно подменить локальным фейковым сервером (fake_yookassa_server.py)
+        api_url = os.getenv('YOOKASSA_API_URL')
+        if api_url:
+            Configuration.api_url = api_url
+            logger.info(f"🔧 YooKassa API URL: {api_url}")
 
 # Инициализация конфигурации
 try:
@@ -50,6 +61,20 @@ except ValueError as e:
     yookassa_config = None
     logger.warning("YooKassa не настроен. Платежи будут эмулироваться.")
 
+# Статусы, после которых платеж больше не сверяется с ЮKassa
+FINAL_PAYMENT_STATUSES = ('succeeded', 'canceled', 'invalid', 'expired')
+
+# Промежуточный статус: переход платежа сейчас обрабатывается (вебхук или сверка).
+# Конечный статус записывается только после обработки заказа
+PAYMENT_PROCESSING_STATUS = 'processing'
+
+# Через сколько минут зависший в processing платеж (процесс упал посреди обработки) можно занять снова
+PAYMENT_PROCESSING_TIMEOUT_MINUTES = int(os.getenv('PAYMENT_PROCESSING_TIMEOUT_MINUTES', '5'))
+
+# Платежи, которые этот процесс уже довел до конечного статуса (webhook или сверка).
+# Сверка пропускает их, даже если строка в payments еще не обновилась
+settled_payment_ids = set()
+
 # Резервные цены (используются если база данных недоступна)
 FALLBACK_PRICES = {
     "Книга": {
@@ -61,45 +86,93 @@ FALLBACK_PRICES = {
     }
 }
 
-async def get_pricing_items_from_db() -> Dict:
+# Как часто процесс сверяет версию цен с базой (правки из админки видны не позже чем через столько секунд)
+PRICING_VERSION_CHECK_INTERVAL = float(os.getenv('PRICING_VERSION_CHECK_INTERVAL', '5'))
+
+def _categorize_product(product: str) -> str:
+    """Категория продукта по названию формата"""
+    if "книга" in product.lower() or "📦" in product or "печатная" in product.lower():
+        return "Книга"
+    if "песня" in product.lower():
+        return "Песня"
+    return "Другое"
+
+class PricingCatalog:
     """
-    Получает актуальные цены из базы данных
+    Неизменяемый каталог цен: активные цены по (категория, формат) и разница для апгрейда по формату.
+    Заменяется целиком при перезагрузке, поэтому читатели всегда видят согласованный снимок.
     """
+    
+    def __init__(self, version: int, rows: List[tuple]):
+        prices = {}
+        by_category = {}
+        upgrade_differences = {}
+        for product, price, upgrade_price_difference, is_active in rows:
+            # Разница для апгрейда учитывается и у неактивных позиций (как и раньше)
+            upgrade_differences[product] = upgrade_price_difference or 0
+            if not is_active:
+                continue
+            category = _categorize_product(product)
+            prices[(category, product)] = price
+            by_category.setdefault(category, {})[product] = price
+        
+        self.version = version
+        self.prices = MappingProxyType(prices)
+        self.by_category = MappingProxyType({
+            category: MappingProxyType(formats) for category, formats in (by_category or FALLBACK_PRICES).items()
+        })
+        self.upgrade_differences = MappingProxyType(upgrade_differences)
+
+_pricing_catalog: Optional[PricingCatalog] = None
+_pricing_checked_at = 0.0
+_pricing_check_task: Optional[asyncio.Task] = None
+
+async def reload_pricing_catalog() -> PricingCatalog:
+    """Перечитывает цены из базы и атомарно подменяет каталог"""
+    global _pricing_catalog, _pricing_checked_at
+    async with db_connection(readonly=True) as db:
+        async with db.execute("SELECT version FROM cache_versions WHERE name = 'pricing_items'") as cursor:
+            row = await cursor.fetchone()
+            version = row[0] if row else 0
+        async with db.execute('''
+            SELECT product, price, upgrade_price_difference, is_active FROM pricing_items
+        ''') as cursor:
+            rows = await cursor.fetchall()
+    
+    _pricing_catalog = PricingCatalog(version, rows)
+    _pricing_checked_at = time.monotonic()
+    logger.info(f"💰 Каталог цен загружен: {len(_pricing_catalog.prices)} активных позиций (версия {version})")
+    return _pricing_catalog
+
+async def _check_pricing_version():
+    global _pricing_checked_at
+    _pricing_checked_at = time.monotonic()
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            async with db.execute('''
-                SELECT product, price, currency, upgrade_price_difference, is_active 
-                FROM pricing_items 
-                WHERE is_active = 1
-            ''') as cursor:
-                rows = await cursor.fetchall()
-                
-                pricing = {}
-                for row in rows:
-                    product, price, currency, upgrade_price_difference, is_active = row
-                    
-                    # Определяем категорию продукта
-                    logger.info(f"🔍 Определение категории для продукта: '{product}'")
-                    
-                    if "книга" in product.lower() or "📦" in product or "печатная" in product.lower():
-                        category = "Книга"
-                        logger.info(f"✅ Продукт '{product}' отнесен к категории 'Книга'")
-                    elif "песня" in product.lower():
-                        category = "Песня"
-                        logger.info(f"✅ Продукт '{product}' отнесен к категории 'Песня'")
-                    else:
-                        category = "Другое"
-                        logger.info(f"⚠️ Продукт '{product}' отнесен к категории 'Другое'")
-                    
-                    if category not in pricing:
-                        pricing[category] = {}
-                    
-                    pricing[category][product] = price
-                
-                return pricing if pricing else FALLBACK_PRICES
+        from db import get_cache_version
+        if await get_cache_version('pricing_items') != _pricing_catalog.version:
+            await reload_pricing_catalog()
     except Exception as e:
-        logger.error(f"Ошибка получения цен из БД: {e}")
-        return FALLBACK_PRICES
+        logger.error(f"Ошибка проверки версии цен: {e}")
+
+async def get_pricing_catalog() -> PricingCatalog:
+    """
+    Возвращает каталог цен из памяти. База читается только при первом обращении
+    и при смене версии pricing_items (проверка в фоне не чаще PRICING_VERSION_CHECK_INTERVAL)
+    """
+    global _pricing_catalog, _pricing_checked_at, _pricing_check_task
+    if _pricing_catalog is None:
+        try:
+            return await reload_pricing_catalog()
+        except Exception as e:
+            logger.error(f"Ошибка получения цен из БД: {e}")
+            _pricing_catalog = PricingCatalog(-1, [])
+            _pricing_checked_at = time.monotonic()
+            return _pricing_catalog
+    
+    if time.monotonic() - _pricing_checked_at >= PRICING_VERSION_CHECK_INTERVAL:
+        if _pricing_check_task is None or _pricing_check_task.done():
+            _pricing_check_task = asyncio.create_task(_check_pricing_version())
+    return _pricing_catalog
 
 def get_product_price(product: str, format_type: str = None) -> float:
     """
@@ -123,13 +196,9 @@ def get_product_price(product: str, format_type: str = None) -> float:
 
 async def get_product_price_async(product: str, format_type: str = None) -> float:
     """
-    Получает актуальную цену продукта из базы данных
+    Получает актуальную цену продукта из каталога цен (в памяти)
     """
-    pricing = await get_pricing_items_from_db()
-    
-    # Добавляем отладочную информацию
-    logger.info(f"🔍 get_product_price_async: product={product}, format_type={format_type}")
-    logger.info(f"🔍 pricing keys: {list(pricing.keys())}")
+    pricing = (await get_pricing_catalog()).by_category
     
     # Если продукт не найден в БД, используем резервные цены
     if product not in pricing:
@@ -157,18 +226,12 @@ async def get_upgrade_price_difference(product: str, from_format: str, to_format
     Получает разницу в цене для апгрейда с одного формата на другой
     """
     try:
-        from db import get_pricing_items
-        pricing_items = await get_pricing_items()
+        catalog = await get_pricing_catalog()
         
-        # Ищем целевой формат (куда апгрейдим)
-        target_item = None
-        for item in pricing_items:
-            if item['product'] == to_format:
-                target_item = item
-                break
-        
-        if target_item and target_item.get('upgrade_price_difference', 0) > 0:
-            return target_item['upgrade_price_difference']
+        # Разница, заданная у целевого формата (куда апгрейдим)
+        upgrade_difference = catalog.upgrade_differences.get(to_format, 0)
+        if upgrade_difference > 0:
+            return upgrade_difference
         
         # Если разница не задана в БД, вычисляем её
         from_price = await get_product_price_async(product, from_format)
@@ -184,7 +247,7 @@ async def get_upgrade_price_difference(product: str, from_format: str, to_format
 
 async def init_payments_table():
     """Инициализация таблицы платежей в базе данных"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         await db.execute('''
             CREATE TABLE IF NOT EXISTS payments (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -200,8 +263,54 @@ async def init_payments_table():
                 FOREIGN KEY(order_id) REFERENCES orders(id)
             )
         ''')
+        
+        # Индекс для сверки ожидающих платежей (auto_check_payments)
+        await db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_payments_status_created_at ON payments(status, created_at)
+        ''')
+        
+        # Ключи идемпотентности попыток создания платежа, которые еще не сохранены в payments
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS payment_idempotency_keys (
+                order_id INTEGER NOT NULL,
+                is_upsell INTEGER NOT NULL,
+                request_hash TEXT NOT NULL,
+                idempotency_key TEXT NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (order_id, is_upsell)
+            )
+        ''')
         await db.commit()
 
+async def get_payment_idempotency_key(order_id: int, is_upsell: bool, payment_request: PaymentRequest) -> str:
+    """
+    Ключ идемпотентности для Payment.create.
+    
+    Повторная попытка оплаты того же заказа с тем же запросом получает тот же ключ, пока платеж
+    не сохранен в payments (и не дольше суток — столько ЮKassa помнит ключ). Если ЮKassa
+    не ответила за таймаут, но платеж создала, повтор вернет этот платеж, а не создаст второй.
+    """
+    request_hash = hashlib.sha256(
+        json.dumps(dict(payment_request), sort_keys=True, ensure_ascii=False).encode('utf-8')
+    ).hexdigest()
+    async with db_connection() as db:
+        async with db.execute('''
+            SELECT idempotency_key FROM payment_idempotency_keys
+            WHERE order_id = ? AND is_upsell = ? AND request_hash = ?
+            AND created_at > datetime('now', '-23 hours')
+        ''', (order_id, int(is_upsell), request_hash)) as cursor:
+            row = await cursor.fetchone()
+        if row:
+            return row[0]
+        
+        idempotency_key = str(uuid.uuid4())
+        await db.execute('''
+            INSERT OR REPLACE INTO payment_idempotency_keys (order_id, is_upsell, request_hash, idempotency_key, created_at)
+            VALUES (?, ?, ?, ?, datetime('now'))
+        ''', (order_id, int(is_upsell), request_hash, idempotency_key))
+        await db.commit()
+    return idempotency_key
+
 async def create_payment(order_id: int, amount: float, description: str, product_type: str, is_upsell: bool = False) -> Dict:
     """
     Создает платеж в ЮKassa
@@ -224,7 +333,7 @@ async def create_payment(order_id: int, amount: float, description: str, product
         payment_id = f"test_payment_{order_id}_{int(amount)}"
         
         # Сохраняем тестовый платеж в БД
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_connection() as db:
             await db.execute('''
                 INSERT OR REPLACE INTO payments 
                 (order_id, payment_id, amount, currency, status, description, created_at)
@@ -237,9 +346,8 @@ async def create_payment(order_id: int, amount: float, description: str, product
         # Для тестовых платежей сразу помечаем как успешные
         try:
             await asyncio.sleep(1)  # Ждем 1 секунду
-            await update_payment_status(payment_id, 'succeeded')
             
-            # Обрабатываем успешный тестовый платеж
+            # Обрабатываем успешный тестовый платеж (статус succeeded записывает process_payment_webhook)
             webhook_data = {
                 'event': 'payment.succeeded',
                 'object': {
@@ -267,7 +375,7 @@ async def create_payment(order_id: int, amount: float, description: str, product
         # Получаем email пользователя из заказа
         customer_email = "customer@test.com"  # По умолчанию тестовый email
         try:
-            async with aiosqlite.connect(DB_PATH) as db:
+            async with db_connection(readonly=True) as db:
                 async with db.execute('SELECT email FROM orders WHERE id = ?', (order_id,)) as cursor:
                     row = await cursor.fetchone()
                     if row and row[0] and row[0] != "None":
@@ -354,7 +462,8 @@ async def create_payment(order_id: int, amount: float, description: str, product
         
         # Создаем платеж в ЮKassa
         logger.info(f"💳 Отправляем запрос в YooKassa...")
-        payment = Payment.create(payment_request)
+        idempotency_key = await get_payment_idempotency_key(order_id, is_upsell, payment_request)
+        payment = await create_payment_request(payment_request, idempotency_key)
         logger.info(f"💳 Ответ от YooKassa получен: {payment.id}")
         
         # Логируем ответ от ЮКассы
@@ -377,12 +486,15 @@ async def create_payment(order_id: int, amount: float, description: str, product
         except Exception as e:
             logger.error(f"💳 Ошибка логирования ответа от ЮКассы: {e}")
         
-        # Сохраняем платеж в базу данных
-        async with aiosqlite.connect(DB_PATH) as db:
+        # Сохраняем платеж в базу данных; следующая попытка оплаты — уже новый платеж с новым ключом
+        async with db_connection() as db:
             await db.execute('''
                 INSERT INTO payments (order_id, payment_id, amount, status, description, created_at, updated_at)
                 VALUES (?, ?, ?, ?, ?, datetime('now'), datetime('now'))
             ''', (order_id, payment.id, amount, payment.status, description))
+            await db.execute('''
+                DELETE FROM payment_idempotency_keys WHERE order_id = ? AND is_upsell = ?
+            ''', (order_id, int(is_upsell)))
             await db.commit()
         
         # Обновляем статус заказа в зависимости от типа платежа
@@ -410,8 +522,8 @@ async def create_payment(order_id: int, amount: float, description: str, product
                         'description': description
                     }
                 }
+                # Статус succeeded записывает process_payment_webhook после обработки заказа
                 await process_payment_webhook(webhook_data)
-                await update_payment_status(payment.id, 'succeeded')
         except Exception as immediate_error:
             logger.error(f"❌ IMMEDIATE CHECK: Ошибка немедленной проверки: {immediate_error}")
         
@@ -458,7 +570,7 @@ async def get_payment_status(payment_id: str) -> Optional[Dict]:
         return None
     
     try:
-        payment = Payment.find_one(payment_id)
+        payment = await find_payment(payment_id)
         return {
             "payment_id": payment.id,
             "status": payment.status,
@@ -479,11 +591,64 @@ async def update_payment_status(payment_id: str, status: str):
         payment_id: ID платежа
         status: Новый статус
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection() as db:
         await db.execute('''
             UPDATE payments SET status = ?, updated_at = datetime('now') WHERE payment_id = ?
         ''', (status, payment_id))
         await db.commit()
+    
+    if status in FINAL_PAYMENT_STATUSES:
+        settled_payment_ids.add(payment_id)
+
+async def claim_payment_status(payment_id: str, status: str) -> Optional[str]:
+    """
+    Занимает обработку перехода платежа в статус status: переводит платеж в PAYMENT_PROCESSING_STATUS.
+    
+    Проверка и запись идут в одном блоке под писателем БД, поэтому из вебхука (процесс админки)
+    и автопроверки (процесс бота) переход займет только один вызов. Сам статус status записывает
+    settle_payment_status после обработки заказа, а при ошибке release_payment_claim возвращает
+    прежний — повторный вебхук или сверка обработают платеж заново.
+    
+    Returns:
+        Прежний статус платежа, если переход занят; None если платеж уже в этом или в конечном
+        статусе, его обрабатывает другой вызов или он не найден
+    """
+    async with db_connection() as db:
+        async with db.execute(f'''
+            SELECT status,
+                   updated_at < datetime('now', '-{PAYMENT_PROCESSING_TIMEOUT_MINUTES} minutes') AS stale
+            FROM payments WHERE payment_id = ?
+        ''', (payment_id,)) as cursor:
+            row = await cursor.fetchone()
+        if not row:
+            return None
+        previous, stale = row
+        if previous == status or previous in FINAL_PAYMENT_STATUSES:
+            return None
+        if previous == PAYMENT_PROCESSING_STATUS:
+            if not stale:
+                return None
+            # Обработка оборвалась вместе с процессом: платеж снова считается ожидающим
+            previous = 'pending'
+        
+        await db.execute('''
+            UPDATE payments SET status = ?, updated_at = datetime('now') WHERE payment_id = ?
+        ''', (PAYMENT_PROCESSING_STATUS, payment_id))
+        await db.commit()
+    return previous
+
+async def settle_payment_status(payment_id: str, status: str):
+    """Записывает статус, занятый claim_payment_status, после успешной обработки перехода"""
+    await update_payment_status(payment_id, status)
+
+async def release_payment_claim(payment_id: str, previous_status: str):
+    """Возвращает платежу прежний статус, если обработка перехода, занятого claim_payment_status, упала"""
+    async with db_connection() as db:
+        await db.execute('''
+            UPDATE payments SET status = ?, updated_at = datetime('now')
+            WHERE payment_id = ? AND status = ?
+        ''', (previous_status, payment_id, PAYMENT_PROCESSING_STATUS))
+        await db.commit()
 
 async def get_payment_by_order_id(order_id: int) -> Optional[Dict]:
     """
@@ -495,7 +660,7 @@ async def get_payment_by_order_id(order_id: int) -> Optional[Dict]:
     Returns:
         Dict с данными платежа или None
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT * FROM payments WHERE order_id = ? ORDER BY created_at DESC LIMIT 1
         ''', (order_id,)) as cursor:
@@ -515,6 +680,8 @@ async def process_payment_webhook(webhook_data: Dict) -> bool:
     Returns:
         True если обработка прошла успешно
     """
+    payment_id = None
+    previous_status = None
     try:
         logger.info(f"🔔 Обрабатываем webhook: {webhook_data}")
         
@@ -529,15 +696,24 @@ async def process_payment_webhook(webhook_data: Dict) -> bool:
             logger.error("Неверные данные webhook'а")
             return False
         
-        # Обновляем статус платежа в базе данных
-        await update_payment_status(payment_id, status)
-        
         # Получаем заказ по платежу
         payment = await get_payment_by_payment_id(payment_id)
         if not payment:
             logger.error(f"Платеж {payment_id} не найден в базе данных")
             return False
         
+        # Занимаем переход: статус платежа запишем только после обработки заказа
+        previous_status = await claim_payment_status(payment_id, status)
+        if previous_status is None:
+            current = await get_payment_by_payment_id(payment_id)
+            if current and current['status'] == PAYMENT_PROCESSING_STATUS:
+                # Платеж сейчас обрабатывает другой вызов — пусть ЮKassa или сверка повторят позже
+                logger.info(f"ℹ️ Платеж {payment_id} уже обрабатывается")
+                return False
+            # Повторный вебхук или автопроверка после вебхука: платеж уже обработан
+            logger.info(f"ℹ️ Платеж {payment_id} уже в статусе {current['status'] if current else status}, повторно не обрабатываем")
+            return True
+        
         order_id = payment['order_id']
         
         # Обрабатываем статус платежа
@@ -750,10 +926,16 @@ async def process_payment_webhook(webhook_data: Dict) -> bool:
                 await update_order_status(order_id, "payment_pending")
                 logger.info(f"Платеж для заказа {order_id} в обработке")
         
+        await settle_payment_status(payment_id, status)
         return True
         
     except Exception as e:
         logger.error(f"Ошибка обработки webhook'а: {e}")
+        if previous_status is not None:
+            try:
+                await release_payment_claim(payment_id, previous_status)
+            except Exception as release_error:
+                logger.error(f"❌ Не удалось вернуть статус платежа {payment_id}: {release_error}")
         return False
 
 async def get_payment_by_payment_id(payment_id: str) -> Optional[Dict]:
@@ -766,7 +948,7 @@ async def get_payment_by_payment_id(payment_id: str) -> Optional[Dict]:
     Returns:
         Dict с данными платежа или None
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT * FROM payments WHERE payment_id = ? ORDER BY created_at DESC LIMIT 1
         ''', (payment_id,)) as cursor:
@@ -788,17 +970,11 @@ async def refund_payment(payment_id: str, amount: Optional[float] = None) -> boo
         True если возврат прошел успешно
     """
     try:
-        payment = Payment.find_one(payment_id)
-        
         if amount is None:
+            payment = await find_payment(payment_id)
             amount = float(payment.amount.value)
         
-        refund = payment.create_refund({
-            "amount": {
-                "value": str(amount),
-                "currency": "RUB"
-            }
-        })
+        await create_refund(payment_id, amount)
         
         logger.info(f"Возврат {amount} RUB для платежа {payment_id}")
         return True
@@ -817,7 +993,7 @@ async def get_payment_history(order_id: int) -> List[Dict]:
     Returns:
         Список платежей
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connection(readonly=True) as db:
         async with db.execute('''
             SELECT * FROM payments WHERE order_id = ? ORDER BY created_at DESC
         ''', (order_id,)) as cursor:
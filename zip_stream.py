@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Потоковая сборка zip-архивов для скачивания из админки.
+
+Архив не собирается целиком в памяти: записи читаются с диска блоками и сразу
+отдаются клиенту, поэтому память не зависит от размера архива, а первые байты
+уходят до окончания сжатия. Уже сжатые форматы (JPEG, PNG, видео...) кладутся
+в архив без повторного deflate.
+
+Собранный архив можно одновременно сохранить в кэш (ARCHIVE_CACHE_DIR) под
+ключом, который зависит от имен, размеров и mtime входящих файлов: следующий
+запрос того же набора отдается готовым файлом, а при изменении набора
+(например, order_pages заказа) ключ меняется и старый архив удаляется.
+"""
+
+import hashlib
+import os
+import time
+import zipfile
+from typing import Iterator, List, Optional, Tuple
+
+# Папка кэша готовых архивов (не внутри uploads — она раздается без авторизации)
+ARCHIVE_CACHE_DIR = os.getenv('ARCHIVE_CACHE_DIR', 'archive_cache')
+
+# Общий размер кэша архивов; при превышении удаляются давно не запрашивавшиеся
+ARCHIVE_CACHE_MAX_MB = int(os.getenv('ARCHIVE_CACHE_MAX_MB', '2048'))
+
+# Размер блока чтения файла и отдачи клиенту
+ZIP_CHUNK_SIZE = 256 * 1024
+
+# Форматы, которые уже сжаты: deflate почти не уменьшает их, но тратит процессор
+STORED_EXTENSIONS = (
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp4', '.mov', '.avi', '.mkv', '.webm', '.m4v',
+    '.mp3', '.m4a', '.ogg', '.opus', '.aac',
+    '.zip', '.rar', '.7z', '.gz', '.pdf',
+)
+
+# (путь к файлу на диске, имя внутри архива)
+ZipEntry = Tuple[str, str]
+
+
+class _ChunkSink:
+    """Несжимаемый поток для ZipFile: копит записанные байты до следующей выдачи"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._offset = 0
+        self.pending = 0
+
+    def write(self, data) -> int:
+        if data:
+            self._chunks.append(bytes(data))
+            self._offset += len(data)
+            self.pending += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        self.pending = 0
+        return data
+
+
+def _compress_type(path: str) -> int:
+    return zipfile.ZIP_STORED if path.lower().endswith(STORED_EXTENSIONS) else zipfile.ZIP_DEFLATED
+
+
+def stream_zip(entries: List[ZipEntry]) -> Iterator[bytes]:
+    """
+    Генератор байтов zip-архива из entries. Синхронный: StreamingResponse
+    выполняет его в пуле потоков, чтение и сжатие не блокируют цикл событий.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w') as archive:
+        for file_path, archive_name in entries:
+            st = os.stat(file_path)
+            info = zipfile.ZipInfo(archive_name, time.localtime(st.st_mtime)[:6])
+            info.compress_type = _compress_type(file_path)
+            info.file_size = st.st_size  # нужен заранее, чтобы при необходимости включить zip64
+            with open(file_path, 'rb') as src, archive.open(info, 'w') as dest:
+                while True:
+                    chunk = src.read(ZIP_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    if sink.pending >= ZIP_CHUNK_SIZE:
+                        yield sink.drain()
+            data = sink.drain()
+            if data:
+                yield data
+    # Центральный каталог записывается при закрытии архива
+    data = sink.drain()
+    if data:
+        yield data
+
+
+def archive_cache_key(entries: List[ZipEntry]) -> str:
+    """Ключ набора файлов: меняется, если изменился состав, имена, размер или mtime файлов"""
+    digest = hashlib.sha1()
+    for file_path, archive_name in entries:
+        st = os.stat(file_path)
+        digest.update(f"{archive_name}\0{file_path}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return digest.hexdigest()[:20]
+
+
+def cached_archive_path(prefix: str, entries: List[ZipEntry]) -> str:
+    return os.path.join(ARCHIVE_CACHE_DIR, f"{prefix}_{archive_cache_key(entries)}.zip")
+
+
+def get_cached_archive(prefix: str, entries: List[ZipEntry]) -> Optional[str]:
+    """Путь готового архива для этого набора файлов или None"""
+    path = cached_archive_path(prefix, entries)
+    if not os.path.isfile(path):
+        return None
+    # mtime отмечает последнее обращение — по нему чистится кэш
+    os.utime(path)
+    return path
+
+
+def _drop_stale_archives(prefix: str, keep_path: str):
+    """Удаляет архивы prefix с другими ключами — наборы файлов, которых больше нет"""
+    keep_name = os.path.basename(keep_path)
+    for name in os.listdir(ARCHIVE_CACHE_DIR):
+        if name.startswith(f"{prefix}_") and name.endswith('.zip') and name != keep_name:
+            try:
+                os.remove(os.path.join(ARCHIVE_CACHE_DIR, name))
+            except OSError:
+                pass
+
+
+def _trim_archive_cache():
+    files = []
+    for name in os.listdir(ARCHIVE_CACHE_DIR):
+        if not name.endswith('.zip'):
+            continue
+        try:
+            st = os.stat(os.path.join(ARCHIVE_CACHE_DIR, name))
+        except OSError:
+            continue
+        files.append((st.st_mtime, st.st_size, name))
+    total = sum(size for _, size, _ in files)
+    limit = ARCHIVE_CACHE_MAX_MB * 1024 * 1024
+    for _, size, name in sorted(files):
+        if total <= limit:
+            break
+        try:
+            os.remove(os.path.join(ARCHIVE_CACHE_DIR, name))
+            total -= size
+        except OSError:
+            pass
+
+
+def stream_zip_cached(prefix: str, entries: List[ZipEntry]) -> Iterator[bytes]:
+    """
+    stream_zip, который параллельно пишет архив в кэш. Файл кэша появляется
+    только после успешной отдачи архива целиком; при обрыве загрузки удаляется.
+    """
+    os.makedirs(ARCHIVE_CACHE_DIR, exist_ok=True)
+    cache_path = cached_archive_path(prefix, entries)
+    tmp_path = f"{cache_path}.{os.getpid()}.{time.monotonic_ns()}.tmp"
+    completed = False
+    try:
+        with open(tmp_path, 'wb') as cache_file:
+            for chunk in stream_zip(entries):
+                cache_file.write(chunk)
+                yield chunk
+        os.replace(tmp_path, cache_path)
+        completed = True
+        _drop_stale_archives(prefix, cache_path)
+        _trim_archive_cache()
+    finally:
+        if not completed and os.path.exists(tmp_path):
+            os.remove(tmp_path)